@@ -8,35 +8,40 @@
 # License   : 3-Clause BSD
 
 import os
-import csv
 import json
 import glob
 import logging
+import itertools
 import traceback
-from io import StringIO
 from time import strftime
-from decimal import Decimal
 from functools import wraps
 from flasgger import Swagger
 from logging.handlers import TimedRotatingFileHandler
 from flask import (Flask, request, send_from_directory, make_response,
-                   render_template, abort, url_for, current_app)
+                   render_template, abort, url_for, current_app,
+                   stream_with_context)
 
-from scripts import (db_queries, users, info_page,
-                     file_manager, backgroundExtract)
-from scripts.chip_extract import (creodiasCARDchips, rawChipExtractor,
-                                  chipS2Extractor, rawChipBatchExtract,
-                                  rawS1ChipBatchExtract)
+from scripts import (db, db_queries, users, info_page, streaming,
+                     response_cache, chip_jobs, file_manager,
+                     backgroundExtract, admission, registry, metrics,
+                     parcel_cube)
+from scripts.chip_extract import (creodiasCARDchips, chipS2Extractor,
+                                  chipWorkers, chipCache, chipRipper,
+                                  chipStack, sceneCache)
 
 # Global variables
 UPLOAD_ENABLE = False  # Enable upload page (http://HOST/files/upload).
 DEFAULT_AOI = ''
 STORAGE = 'files'  # Storage folder
+POLYGON_MAX_PARCELS = 50000  # Max parcels returned by parcelsByPolygon.
+POLYGON_TOLERANCE = 1.0  # Default tolerance of the simplified geometries.
+CHIP_JOB_TIMEOUT = 600  # Seconds to wait for the jobs of the chip queries.
 
 
 app = Flask(__name__)
 app.secret_key = os.urandom(12)
-datasets = db_queries.get_datasets()
+# The datasets of config/datasets.json, kept up to date by the registry.
+datasets = registry.registry().start().datasets
 
 try:
     import flask_monitoringdashboard as dashboard
@@ -55,9 +60,23 @@ handler.suffix = '%Y%m%d'
 logger = logging.getLogger('tdm')
 logger.setLevel(logging.INFO)
 logger.addHandler(handler)
+# The json access log, one line per request (see access_log).
+access_handler = TimedRotatingFileHandler('logs/access.log', when='midnight',
+                                          interval=1)
+access_handler.suffix = '%Y%m%d'
+access_logger = logging.getLogger('access')
+access_logger.setLevel(logging.INFO)
+access_logger.addHandler(access_handler)
+access_logger.addHandler(logging.StreamHandler())
+access_logger.propagate = False
 user = 'None'
 
 
+@app.before_request
+def before_request():
+    metrics.start_request()
+
+
 @app.after_request
 def after_request(response):
     timestamp = strftime('[%Y-%b-%d %H:%M]')
@@ -65,17 +84,34 @@ def after_request(response):
         logger.error('%s %s %s %s %s %s %s', timestamp, request.remote_addr,
                      user, request.method, request.scheme,
                      request.full_path, response.status)
-    try:
-        print('%s %s %s %s %s %s %s', timestamp, request.remote_addr,
-              user, request.method, request.scheme, request.full_path,
-              response.status)
-    except Exception:
-        print('%s %s %s %s %s %s', timestamp, request.remote_addr,
-              request.method, request.scheme, request.full_path,
-              response.status)
+    # Recorded when the response is sent, also for streamed responses.
+    response.call_on_close(access_log(response))
     return response
 
 
+def access_log(response):
+    """Get the function that records the metrics and the access log line of
+    the request, when the response is closed."""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    fields = {'remote_addr': request.remote_addr,
+              'user': request.authorization.username
+              if request.authorization else None,
+              'method': request.method, 'route': route,
+              'path': request.full_path.rstrip('?'),
+              'status': response.status_code}
+
+    def close():
+        duration, parts = metrics.end_request(route, fields['method'],
+                                              fields['status'])
+        try:
+            access_logger.info(metrics.access_record(
+                duration, parts, **fields,
+                bytes=response.calculate_content_length()))
+        except Exception as err:
+            print("Can not write the access log:", err)
+    return close
+
+
 @app.errorhandler(Exception)
 def exceptions(e):
     tb = traceback.format_exc()
@@ -101,8 +137,14 @@ def auth_required(f):  # Authentication decorator.
         except Exception:
             user = 'None'
         if auth and users.auth(auth.username, auth.password) is True:
-            if 'aoi' in request.args.keys():
-                aoi = request.args.get('aoi').lower()
+            params = request.get_json(silent=True) if request.is_json else {}
+            if not isinstance(params, dict):
+                params = {}
+            # The aoi is a query, json or path (e.g. tiles) parameter.
+            params = {**params, **request.args.to_dict(),
+                      **(request.view_args or {})}
+            if 'aoi' in params.keys():
+                aoi = str(params['aoi']).lower()
                 if users.data_auth(aoi, auth.username):
                     return f(*args, **kwargs)
                 else:
@@ -117,11 +159,188 @@ def auth_required(f):  # Authentication decorator.
     return decorated
 
 
-class CustomJsonEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(CustomJsonEncoder, self).default(obj)
+def cached_response(f):  # Response cache decorator.
+    """Serve the response from the response cache, with a strong ETag.
+
+    Requests with a matching If-None-Match header get a 304 response.
+    The cache key includes the registry and dataset versions, so cached
+    responses are renewed when the datasets configuration changes or new
+    signatures are extracted.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        cache = response_cache.store()
+        # The aoi and year are query or path (e.g. tiles) parameters.
+        params = {**request.args.to_dict(), **(request.view_args or {})}
+        aoi = str(params.get('aoi', DEFAULT_AOI)).lower()
+        dskey = f"{aoi}_{params.get('year')}"
+        if cache is None or dskey not in datasets:
+            return f(*args, **kwargs)
+        version = (registry.version(),
+                   response_cache.dataset_version(datasets[dskey]))
+        key = response_cache.cache_key(request.path, request.args,
+                                       request.headers.get('Accept', ''),
+                                       version)
+        entry = cache.get(key)
+        if entry is None:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            parts, size = [], 0
+            chunks = response.iter_encoded()
+            for chunk in chunks:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > response_cache.MAX_ENTRY_SIZE:
+                    # Too large to be cached, continue streaming it.
+                    response_cache.stats['uncached'] += 1
+                    response.response = itertools.chain(parts, chunks)
+                    return response
+            body = b''.join(parts)
+            if body.strip() == b'{}':  # Empty or failed queries.
+                response.set_data(body)
+                return response
+            entry = {'body': body, 'mimetype': response.mimetype,
+                     'etag': response_cache.etag(body), 'headers': {}}
+            if 'Content-Disposition' in response.headers:
+                entry['headers']['Content-Disposition'] = \
+                    response.headers['Content-Disposition']
+            cache.set(key, entry)
+            response_cache.stats['misses'] += 1
+        else:
+            response_cache.stats['hits'] += 1
+
+        if request.if_none_match.contains(entry['etag'].strip('"')):
+            response_cache.stats['not_modified'] += 1
+            response = make_response('', 304)
+        else:
+            response = make_response(entry['body'])
+            response.mimetype = entry['mimetype']
+            response.headers.update(entry['headers'])
+        response.headers['ETag'] = entry['etag']
+        response.headers['Cache-Control'] = 'private, no-cache'
+        # The same URL has other formats for other Accept headers.
+        response.vary.add('Accept')
+        return response
+    return decorated
+
+
+def admitted(eclass):  # Admission control decorator.
+    """Run the request when a slot of the endpoint class ('light', 'heavy'
+    or 'chips') is free for the user and the server, with the statement
+    timeout of the class. Requests that can not be admitted get a 429 or 503
+    response with a Retry-After header. The slot of a streamed response is
+    released when the response is sent.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            auth = request.authorization
+            username = auth.username.lower() if auth else 'None'
+            try:
+                ticket = admission.admit(username, eclass,
+                                         users.tier(username))
+            except admission.Rejected as err:
+                return make_response({"error": str(err)}, err.status,
+                                     {'Retry-After': str(err.retry_after)})
+            try:
+                with db.statement_timeout(ticket.statement_timeout):
+                    response = make_response(f(*args, **kwargs))
+            except Exception:
+                ticket.release()
+                raise
+            if response.is_streamed:
+                response.response = ticket.released_after(
+                    response.response,
+                    db.statement_timeout(ticket.statement_timeout))
+                response.call_on_close(ticket.release)
+            else:
+                ticket.release()
+            return response
+        return decorated
+    return decorator
+
+
+def output_format(param='tsformat', default='json'):
+    """Get the requested output format, from the query parameter or else
+    from the Accept header (e.g. application/vnd.apache.arrow.stream)."""
+    if param in request.args.keys():
+        return request.args.get(param)
+    formats = {v: k for k, v in streaming.MIMETYPES.items()}
+    formats['application/x-parquet'] = 'parquet'
+    for value, quality in request.accept_mimetypes:  # Best quality first.
+        if value in formats:
+            return formats[value]
+    return default
+
+
+def stream_response(stream, oformat='json', filename=None):
+    """Send a db_queries.stream_rows() result as a streamed response.
+
+    Arguments:
+        stream, the stream of the query results (generator)
+        oformat, the output format 'json', 'ndjson', 'csv', 'arrow'
+            or 'parquet' (str)
+        filename, the name of the file for csv downloads (str)
+    """
+    if oformat in streaming.BINARY and streaming.pa is None:
+        return make_response(
+            {"error": f"The {oformat} format is not available."}, 406)
+    try:
+        columns = next(stream)
+    except Exception as err:
+        print("Did not find data, please select the right database and table: ",
+              err)
+        return {}
+    if oformat not in streaming.MIMETYPES:
+        oformat = 'json'
+    body = streaming.generator(itertools.chain([columns], stream), oformat)
+    response = current_app.response_class(
+        stream_with_context(body), mimetype=streaming.MIMETYPES[oformat])
+    response.vary.add('Accept')  # The format can be set by the Accept header.
+    if oformat in ['csv', 'parquet'] and filename:
+        filename = f"{filename.rsplit('.', 1)[0]}.{oformat}"
+        response.headers["Content-Disposition"] = \
+            f"attachment; filename={filename}"
+    return response
+
+
+def chip_job_response(query, params):
+    """Run a chip query as a job and send the result file when it is done,
+    identical requests share the same job."""
+    params, error = chip_jobs.check_params(query, params)
+    if error:
+        return {"error": error}
+    logger.info(chip_jobs.unique_dir(query, params))
+    try:
+        job = chip_jobs.submit(query, params, request_user())
+    except chip_jobs.JobQueueFull as err:
+        return make_response({"error": str(err)}, 503, {'Retry-After': '30'})
+    with metrics.timed('chips'):
+        job = chip_jobs.wait(job, CHIP_JOB_TIMEOUT)
+    if job['status'] == 'done':
+        return send_from_directory(job['unique_dir'],
+                                   os.path.basename(job['result']))
+    elif job['status'] == 'failed':
+        return {}
+    return make_response(job_status(job), 202)
+
+
+def request_user():
+    """Get the name of the user of this request, the global user is shared
+    by the threads of the concurrent requests."""
+    auth = request.authorization
+    return auth.username.lower() if auth and auth.username else 'None'
+
+
+def job_status(job):
+    status = {k: job.get(k) for k in ['id', 'query', 'status', 'submitted',
+                                       'started', 'finished', 'progress',
+                                       'error']}
+    status['status_url'] = url_for('chipJob', job_id=job['id'])
+    if job['status'] == 'done':
+        status['result_url'] = url_for('chipJobResult', job_id=job['id'])
+    return status
 
 
 def get_user_id():
@@ -167,6 +386,7 @@ def favicon():
 
 @app.route('/query/backgroundByLocation', methods=['GET'])
 @auth_required
+@admitted('chips')
 def backgroundByLocation_query():
     """
     Generate an extract from either Google or Bing.
@@ -193,8 +413,9 @@ def backgroundByLocation_query():
         iformat = request.args.get('iformat')
 
     unique_id = f"static/tmp/E{lon}N{lat}_{chipsize}_{chipextend}_{tms}".replace('.', '_')
-    data = backgroundExtract.getBackgroundExtract(
-        lon, lat, chipsize, chipextend, unique_id, tms, iformat, False)
+    with metrics.timed('chips'):
+        data = backgroundExtract.getBackgroundExtract(
+            lon, lat, chipsize, chipextend, unique_id, tms, iformat, False)
     if data:
         if 'raw' in request.args.keys() or iformat == 'tif':
             return f"{unique_id}/{tms.lower()}.{iformat}"
@@ -209,6 +430,7 @@ def backgroundByLocation_query():
 
 @app.route('/query/backgroundByParcelID', methods=['GET'])
 @auth_required
+@admitted('chips')
 def backgroundByID_query():
     """
     Generate an extract from either Google or Bing.
@@ -247,8 +469,10 @@ def backgroundByID_query():
     dataset = datasets[f'{aoi}_{year}']
     lon, lat = db_queries.getParcelCentroid(dataset, pid, ptype)
     unique_id = f"static/tmp/E{lon}N{lat}_{chipsize}_{chipextend}_{tms}".replace('.', '_')
-    data = backgroundExtract.getBackgroundExtract(
-        lon, lat, chipsize, chipextend, unique_id, tms, iformat, withGeometry)
+    with metrics.timed('chips'):
+        data = backgroundExtract.getBackgroundExtract(
+            lon, lat, chipsize, chipextend, unique_id, tms, iformat,
+            withGeometry)
     if data:
         if 'raw' in request.args.keys() or iformat == 'tif':
             return f"{unique_id}/{tms.lower()}.{iformat}"
@@ -266,6 +490,7 @@ def backgroundByID_query():
 
 @app.route('/query/chipsByLocation', methods=['GET'])
 @auth_required
+@admitted('chips')
 def chipsByLocation_query():
     """
     Get chips images by location.
@@ -293,19 +518,14 @@ def chipsByLocation_query():
     else:
         plevel = 'LEVEL2A'
 
-    unique_id = f"static/tmp/E{lon}N{lat}L{lut}_{plevel}_{bands}".replace(
-        '.', '_')
-    data = chipS2Extractor.parallelExtract(
-        lon, lat, start_date, end_date, unique_id, lut, bands, plevel)
-    chipS2Extractor.buildHTML(unique_id, start_date, end_date)
-    if data >= 0:
-        return send_from_directory(unique_id, 'chipsview.html')
-    else:
-        return {}
+    return chip_job_response('chipsByLocation', {
+        'lon': lon, 'lat': lat, 'start_date': start_date,
+        'end_date': end_date, 'lut': lut, 'bands': bands, 'plevel': plevel})
 
 
 @app.route('/query/chipsByParcelID', methods=['GET'])
 @auth_required
+@admitted('chips')
 def chipsByParcelID_query():
     """
     Get chips images by parcel id.
@@ -350,8 +570,9 @@ def chipsByParcelID_query():
     lat = str(json.loads(parcel)['clat'][0])
     unique_id = f"static/tmp/E{lon}N{lat}_{plevel}_{chipsize}_{band}".replace(
         '.', '_')
-    data = chipS2Extractor.parallelExtract(
-        lon, lat, start_date, end_date, unique_id, band, chipsize, plevel)
+    with metrics.timed('chips'):
+        data = chipS2Extractor.parallelExtract(
+            lon, lat, start_date, end_date, unique_id, band, chipsize, plevel)
     if data:
         return send_from_directory(unique_id, 'chipslist.json')
     else:
@@ -360,6 +581,7 @@ def chipsByParcelID_query():
 
 @app.route('/query/rawChipByLocation', methods=['GET'])
 @auth_required
+@admitted('chips')
 def rawChipByLocation_query():
     """
     Get chips images by parcel location.
@@ -394,19 +616,43 @@ def rawChipByLocation_query():
                 lat), start_date, end_date, int(chipsize), plevel)
             chiplist = creodiasCARDchips.rinseAndDryS2(chiplist)
             return {'chips': chiplist}
-    unique_id = f"static/tmp/E{lon}N{lat}_{plevel}_{chipsize}_{band}".replace(
-        '.', '_')
-    data = rawChipExtractor.parallelExtract(
-        lon, lat, start_date, end_date, unique_id, band, chipsize, plevel)
-    rawChipExtractor.buildJSON(unique_id, start_date, end_date)
-    if data >= 0:
-        return send_from_directory(unique_id, 'chipslist.json')
-    else:
-        return {}
+    return chip_job_response('rawChipByLocation', {
+        'lon': lon, 'lat': lat, 'start_date': start_date,
+        'end_date': end_date, 'band': band, 'chipsize': chipsize,
+        'plevel': plevel})
+
+
+@app.route('/query/rawChipStack', methods=['GET'])
+@auth_required
+@admitted('chips')
+def rawChipStack_query():
+    """
+    Get the raw chips of all the Sentinel-2 acquisitions of a time window
+    at a location, for one or more bands (e.g. B08_B04_SCL), stacked in one
+    file. The bands are resampled to the grid of the first band.
+    responses:
+        description: A compressed GeoTIFF with one band for each date and
+        band (time x band order, with 'date' and 'band' tags) or a NPZ file
+        with the time x band x y x x 'data' array and the 'dates', 'bands',
+        'crs' and 'transform'.
+    """
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+    params = {k: request.args.get(k) for k in [
+        'lon', 'lat', 'start_date', 'end_date', 'bands', 'plevel',
+        'chipsize', 'format'] if request.args.get(k)}
+    bands = params.get('bands', 'B08_B04_B03').split('_')
+    unknown = [b for b in bands if b not in chipRipper.BAND_RESOLUTION]
+    if unknown:
+        return make_response({"error": f"Unknown bands: {unknown}"}, 400)
+    if params.get('format', 'tif') not in chipStack.FORMATS:
+        return make_response({"error": "The format must be one of: "
+                              f"{', '.join(chipStack.FORMATS)}"}, 400)
+    return chip_job_response('rawChipStack', params)
 
 
 @app.route('/query/rawChipByParcelID', methods=['GET'])
 @auth_required
+@admitted('chips')
 def rawChipByParcelID_query():
     """
     Get chips images by parcel ID.
@@ -456,21 +702,17 @@ def rawChipByParcelID_query():
                 lat), start_date, end_date, int(chipsize), plevel)
             chiplist = creodiasCARDchips.rinseAndDryS2(chiplist)
             return {'chips': chiplist}
-    unique_id = f"static/tmp/E{lon}N{lat}_{plevel}_{chipsize}_{band}".replace(
-        '.', '_')
-    data = rawChipExtractor.parallelExtract(
-        lon, lat, start_date, end_date, unique_id, band, chipsize, plevel)
-    rawChipExtractor.buildJSON(unique_id, start_date, end_date)
-    if data >= 0:
-        return send_from_directory(unique_id, 'chipslist.json')
-    else:
-        return {}
+    return chip_job_response('rawChipByLocation', {
+        'lon': lon, 'lat': lat, 'start_date': start_date,
+        'end_date': end_date, 'band': band, 'chipsize': chipsize,
+        'plevel': plevel})
 
 
 # -------- Queries - raw Chip Images Batch ----------------------------------- #
 
 @app.route('/query/rawChipsBatch', methods=['POST'])
 @auth_required
+@admitted('chips')
 def rawChipsBatch_query():
     """
     Get chips images with post requst.
@@ -490,25 +732,12 @@ def rawChipsBatch_query():
                 i += 1
         if i != len(required):
             return {"error": f"{i} parameters supplied, {len(required)} required"}
-    unique_id = f"static/tmp/{params.get('lon')}_{params.get('lat')}_{params.get('chipsize')}_RAW".replace('.', '_')
-    logger.info(unique_id)
-
-    if not os.path.exists(unique_id):
-        os.makedirs(unique_id)
-    with open(f"{unique_id}/params.json", "w") as f:
-        logger.info("Dumping params")
-        f.write(json.dumps(params))
-
-    data = rawChipBatchExtract.parallelExtract(unique_id)
-    rawChipBatchExtract.buildJSON(unique_id)
-    if data >= 0:
-        return send_from_directory(unique_id, 'chipslist.json')
-    else:
-        return {}
+    return chip_job_response('rawChipsBatch', params)
 
 
 @app.route('/query/rawS1ChipsBatch', methods=['POST'])
 @auth_required
+@admitted('chips')
 def rawS1ChipsBatch_query():
     """
     Get S1 chips images with post requst.
@@ -528,27 +757,125 @@ def rawS1ChipsBatch_query():
                 i += 1
         if i != len(required):
             return {"error": f"{i} parameters supplied, {len(required)} required"}
-    unique_id = f"static/tmp/{params.get('lon')}_{params.get('lat')}_{params.get('chipsize')}_{params.get('plevel')}_RAW".replace('.', '_')
-    logger.info(unique_id)
-
-    if not os.path.exists(unique_id):
-        os.makedirs(unique_id)
-    with open(f"{unique_id}/params.json", "w") as f:
-        logger.info("Dumping params")
-        f.write(json.dumps(params))
-
-    data = rawS1ChipBatchExtract.parallelExtract(unique_id)
-    rawS1ChipBatchExtract.buildJSON(unique_id)
-    if data >= 0:
-        return send_from_directory(unique_id, 'chipslist.json')
+    return chip_job_response('rawS1ChipsBatch', params)
+
+
+# -------- Queries - Chip Jobs ---------------------------------------------- #
+
+@app.route('/query/chipJobs/<query>', methods=['POST'])
+@auth_required
+def chipJobs_submit(query):
+    """
+    Submit a chip extraction job, for the chipsByLocation, rawChipByLocation,
+    rawChipStack, rawChipsBatch and rawS1ChipsBatch queries.
+    responses:
+        description: A JSON dictionary with the job id and status.
+    """
+    if request.is_json:
+        params = request.get_json()
     else:
-        return {}
+        params = request.args.to_dict()
+    if query == 'parcelsCube':
+        return make_response({"error": "Use /query/parcelsCube"}, 400)
+    params, error = chip_jobs.check_params(query, params)
+    if error:
+        return make_response({"error": error}, 400)
+    try:
+        job = chip_jobs.submit(query, params, request_user())
+    except chip_jobs.JobQueueFull as err:
+        return make_response({"error": str(err)}, 503, {'Retry-After': '30'})
+    return make_response(job_status(chip_jobs.get(job['id'])), 202)
+
+
+@app.route('/query/chipJobs', methods=['GET'])
+@auth_required
+def chipJobs():
+    """
+    Get the chip extraction jobs of the user.
+    responses:
+        description: A JSON list with the status of the jobs.
+    """
+    return current_app.response_class(
+        json.dumps([job_status(j) for j in chip_jobs.jobs(request_user())]),
+        mimetype="application/json")
+
+
+@app.route('/query/chipJobs/<job_id>', methods=['GET'])
+@auth_required
+def chipJob(job_id):
+    """
+    Get the status and progress of a chip extraction job.
+    responses:
+        description: A JSON dictionary with the job status.
+    """
+    job = chip_jobs.get(job_id)
+    if job is None or job['user'] != request_user():
+        return make_response({"error": "No such job"}, 404)
+    return job_status(job)
+
+
+@app.route('/query/chipJobs/<job_id>/result', methods=['GET'])
+@auth_required
+def chipJobResult(job_id):
+    """
+    Get the result of a chip extraction job, the list of the chips.
+    responses:
+        description: The chipslist.json (or chipsview.html) of the job.
+    """
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+    job = chip_jobs.get(job_id)
+    if job is None or job['user'] != request_user():
+        return make_response({"error": "No such job"}, 404)
+    if job['status'] == 'failed':
+        return make_response(job_status(job), 500)
+    elif job['status'] != 'done':
+        return make_response(job_status(job), 202)
+    return send_from_directory(job['unique_dir'],
+                               os.path.basename(job['result']))
+
+
+@app.route('/query/chipWorkers', methods=['GET'])
+@auth_required
+def chipWorkers_query():
+    """
+    Get the load, latency, failures and utilisation of the chip workers,
+    and the statistics of the chip store and of the scene cache.
+    responses:
+        description: A JSON dictionary with the status of each worker
+        and the hits, misses and size of the chip store and of the scene
+        cache (null if it is not configured).
+    """
+    scenes = sceneCache.cache()
+    return {'workers': chipWorkers.status(),
+            'cache': chipCache.cache().stats(),
+            'scenes': scenes.stats() if scenes is not None else None}
+
+
+# -------- Metrics ----------------------------------------------------------- #
+
+@app.route('/metrics', methods=['GET'])
+@auth_required
+def metrics_query():
+    """
+    Get the metrics of this server process in the Prometheus text format:
+    the requests and their duration, database and chip extraction time per
+    route, the connection pools, caches and admission control. Only for the
+    admin users.
+    responses:
+        description: The metrics in the Prometheus text format.
+    """
+    if not users.data_auth('admin', request.authorization.username):
+        return make_response("Not authorized for the metrics.", 401)
+    return current_app.response_class(
+        metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 # -------- Queries - Parcel Peers -------------------------------------------- #
 
 @app.route('/query/parcelPeers', methods=['GET'])
 @auth_required
+@cached_response
+@admitted('light')
 def parcelPeers_query():
     """
     Get the parcel “peers” for a known parcel ID,
@@ -589,10 +916,107 @@ def parcelPeers_query():
                         [list(i) for i in zip(*data[1:])]))
 
 
+@app.route('/query/parcelStatsPeers', methods=['GET'])
+@auth_required
+@cached_response
+@admitted('heavy')
+def parcelStatsPeers_query():
+    """
+    Get the parcels with a weekly (or monthly) band summary in a value range.
+    responses:
+        List of parcel IDs
+    """
+    aoi = DEFAULT_AOI
+    year = request.args.get('year')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    band = request.args.get('band')
+    value = request.args.get('values')
+    stype = request.args.get('stype', 'mean')
+    period = request.args.get('period', 'week')
+    maxPeers = 100
+    ptype = ''
+    if 'aoi' in request.args.keys():
+        aoi = request.args.get('aoi').lower()
+    if 'ptype' in request.args.keys():
+        if request.args.get('ptype') != '':
+            ptype = f"_{request.args.get('ptype')}"
+    if 'max' in request.args.keys():
+        maxPeers = min(int(request.args.get('max')), 10000)
+    if period not in db_queries.PERIODS:
+        return {"error": f"period must be one of {db_queries.PERIODS}"}
+    if stype not in db_queries.PEER_STATS:
+        return make_response({"error": "The stype must be one of: "
+                              f"{', '.join(db_queries.PEER_STATS)}"}, 400)
+    try:
+        values = [float(v) for v in value.split('-')]
+    except (AttributeError, ValueError):
+        values = []
+    if len(values) not in [1, 2]:
+        return make_response({"error": "values must be a value or a range "
+                              "of values (min-max)"}, 400)
+    if f'{aoi}_{year}' not in datasets:
+        return make_response({"error": f"No dataset found for {aoi} {year}"},
+                             404)
+
+    dataset = datasets[f'{aoi}_{year}']
+    data = db_queries.getParcelStatsPeers(dataset, start_date, end_date, band,
+                                          stype, value, maxPeers, ptype,
+                                          period)
+    return {'pids': data or []}
+
+
+@app.route('/query/peersTimeSeries', methods=['GET'])
+@auth_required
+@cached_response
+@admitted('light')
+def peersTimeSeries_query():
+    """
+    Get the weekly (or monthly) time series of the peers of a parcel.
+    responses:
+        For each period and band the number of peers, the mean and the
+        percentiles of the period means of the peers.
+    """
+    aoi = DEFAULT_AOI
+    year = request.args.get('year')
+    pid = request.args.get('pid')
+    distance = 2000.0
+    maxPeers = 100
+    ptype = ''
+    tstype = request.args.get('tstype', 's2')
+    band = request.args.get('band', '')
+    period = request.args.get('period', 'week')
+    if 'aoi' in request.args.keys():
+        aoi = request.args.get('aoi').lower()
+    if 'ptype' in request.args.keys():
+        if request.args.get('ptype') != '':
+            ptype = f"_{request.args.get('ptype')}"
+    if 'distance' in request.args.keys():
+        distance = float(request.args.get('distance'))
+    if 'max' in request.args.keys():
+        maxPeers = min(int(request.args.get('max')), 10000)
+    if period not in db_queries.PERIODS:
+        return {"error": f"period must be one of {db_queries.PERIODS}"}
+
+    dataset = datasets[f'{aoi}_{year}']
+    data = db_queries.getPeersTimeSeries(dataset, pid, distance, maxPeers,
+                                         ptype, tstype, band, period)
+    if not data:
+        return {}
+    elif len(data) == 1:
+        return dict(zip(list(data[0]),
+                        [[] for i in range(len(data[0]))]))
+    else:
+        return dict(zip(list(data[0]),
+                        [list(i) for i in zip(*data[1:])]))
+
+
 # -------- Queries - Time Series --------------------------------------------- #
 
 @app.route('/query/parcelTimeSeries', methods=['GET'])
 @auth_required
+@cached_response
+@admitted('light')
 def parcelTimeSeries_query():
     """
     Get the time series for a parcel ID.
@@ -605,7 +1029,6 @@ def parcelTimeSeries_query():
     band = ''
     scl = True
     ref = False
-    tsformat = False
     if 'aoi' in request.args.keys():
         aoi = request.args.get('aoi').lower()
     if 'ptype' in request.args.keys():
@@ -621,38 +1044,120 @@ def parcelTimeSeries_query():
             scl = False
     if 'ref' in request.args.keys():
         ref = True if request.args.get('ref') == 'True' else False
-    if 'tsformat' in request.args.keys():
-        tsformat = True if request.args.get('tsformat') == 'csv' else False
+    tsformat = output_format('tsformat')
 
     dataset = datasets[f'{aoi}_{year}']
     if tstype.lower() == 'scl':
         data = db_queries.getParcelSCL(dataset, pid, ptype)
+        stream = streaming.from_rows(data) if data else None
     else:
-        data = db_queries.getParcelTimeSeries(dataset, pid, ptype,
-                                              tstype, band, scl, ref)
-    if tsformat:
-        io_file = StringIO()
-        write = csv.writer(io_file, delimiter=',')
-        write.writerows(data)
-        csv_file = make_response(io_file.getvalue())
-        fname = f"filename=timeseries_{aoi}{year}{ptype}_{pid}_{tstype}.csv"
-        csv_file.headers["Content-Disposition"] = f"attachment; {fname}"
-        csv_file.headers["Content-type"] = "text/csv"
-        return csv_file
-    else:
-        if not data:
-            return {}
-        elif len(data) == 1:
-            return dict(zip(list(data[0]),
-                            [[] for i in range(len(data[0]))]))
-        else:
-            return json.dumps(dict(zip(list(data[0]),
-                                       [list(i) for i in zip(*data[1:])])),
-                              cls=CustomJsonEncoder)
+        stream = db_queries.getParcelTimeSeries(dataset, pid, ptype, tstype,
+                                                band, scl, ref, stream=True)
+    fname = f"timeseries_{aoi}{year}{ptype}_{pid}_{tstype}.csv"
+    return stream_response(stream, tsformat, fname)
+
+
+@app.route('/query/parcelTimeSeriesBatch', methods=['POST'])
+@auth_required
+@admitted('heavy')
+def parcelTimeSeriesBatch_query():
+    """
+    Get the time series for many parcels in one request.
+    The parcels are selected with a list of parcel IDs ('pids'), a polygon
+    or, if none of them is given, all the parcels of the 'ptype' dataset.
+    responses:
+        description: A JSON dictionary with the parcel IDs as keys and the
+        time series of each parcel, streamed one parcel at a time.
+    """
+    allowed = ["aoi", "year", "pids", "polygon", "ptype",
+               "tstype", "band", "scl", "ref"]
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict):
+        return {"error": "A JSON dictionary with the parameters is required"}
+    for k in params.keys():
+        if k not in allowed:
+            return {"error": f"{k} not allowed as key"}
+    aoi = str(params.get('aoi', DEFAULT_AOI)).lower()
+    year = params.get('year')
+    pids = params.get('pids')
+    polygon = params.get('polygon')
+    ptype = f"_{params['ptype']}" if params.get('ptype') else ''
+    tstype = params.get('tstype', 's2')
+    band = params.get('band', '')
+    scl = str(params.get('scl', True)) == 'True'
+    ref = str(params.get('ref', False)) == 'True'
+    if tstype.lower() in ['bs', 'c6']:
+        scl = False
+    if f'{aoi}_{year}' not in datasets:
+        return {"error": f"No dataset found for {aoi} {year}"}
+    if pids is not None and (not isinstance(pids, list) or not pids):
+        return make_response(
+            {"error": "pids must be a non empty list of parcel IDs"}, 400)
+
+    dataset = datasets[f'{aoi}_{year}']
+    series = db_queries.getParcelsTimeSeries(dataset, pids, polygon, ptype,
+                                             tstype, band, scl, ref)
+
+    def generate():
+        yield '{'
+        sep = ''
+        for pid, columns, rows in series:
+            parcel = dict(zip(columns, [list(i) for i in zip(*rows)]))
+            yield f"{sep}{json.dumps(pid)}: " + json.dumps(
+                parcel, cls=streaming.JsonEncoder)
+            sep = ', '
+        yield '}'
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype="application/json")
+
+
+@app.route('/query/parcelsCube', methods=['POST'])
+@auth_required
+def parcelsCube_submit():
+    """
+    Submit the export of the signatures of many parcels as a dense
+    parcel x time x band x stat cube (Zarr store or NPZ shards), for the
+    dates from start_date to end_date. The parcels are selected like in
+    parcelTimeSeriesBatch. The job status is read from /query/chipJobs.
+    responses:
+        description: A JSON dictionary with the job id and status, the
+        result of the job is the zip file of the cube.
+    """
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict):
+        return make_response(
+            {"error": "A JSON dictionary with the parameters is required"},
+            400)
+    params, error = chip_jobs.check_params('parcelsCube', params)
+    if error:
+        return make_response({"error": error}, 400)
+    params['aoi'] = str(params['aoi']).lower()
+    params['year'] = str(params['year'])
+    if not users.data_auth(params['aoi'], request_user()):
+        return make_response("""Not authorized for this dataset.
+            Please contact the system administrator.""", 401)
+    if f"{params['aoi']}_{params['year']}" not in datasets:
+        return make_response({"error": "No dataset found for "
+                              f"{params['aoi']} {params['year']}"}, 404)
+    if params['format'] not in parcel_cube.FORMATS:
+        return make_response({"error": "The format must be one of: "
+                              f"{', '.join(parcel_cube.FORMATS)}"}, 400)
+    if params['pids'] is not None and (
+            not isinstance(params['pids'], list) or not params['pids']):
+        return make_response(
+            {"error": "pids must be a non empty list of parcel IDs"}, 400)
+    try:
+        job = chip_jobs.submit('parcelsCube', params, request_user())
+    except chip_jobs.JobQueueFull as err:
+        return make_response({"error": str(err)}, 503, {'Retry-After': '30'})
+    return make_response(job_status(chip_jobs.get(job['id'])), 202)
 
 
 @app.route('/query/weatherTimeSeries', methods=['GET'])
 @auth_required
+@cached_response
+@admitted('light')
 def meteo():
     """
     Get weather time series for a parcel ID.
@@ -662,41 +1167,23 @@ def meteo():
     year = request.args.get('year')
     pid = request.args.get('pid')
     ptype = ''
-    tsformat = False
     if 'aoi' in request.args.keys():
         aoi = request.args.get('aoi').lower()
     if 'ptype' in request.args.keys():
         if request.args.get('ptype') != '':
             ptype = f"_{request.args.get('ptype')}"
-    if 'tsformat' in request.args.keys():
-        tsformat = True if request.args.get('tsformat') == 'csv' else False
+    tsformat = output_format('tsformat')
     dataset = datasets[f'{aoi}_{year}']
-    data = db_queries.getParcelWeatherTS(dataset, pid, ptype)
-    if tsformat:
-        io_file = StringIO()
-        write = csv.writer(io_file, delimiter=',')
-        write.writerows(data)
-        csv_file = make_response(io_file.getvalue())
-        fname = f"filename=timeseries_{aoi}{year}{ptype}_{pid}_WeatherTS.csv"
-        csv_file.headers["Content-Disposition"] = f"attachment; {fname}"
-        csv_file.headers["Content-type"] = "text/csv"
-        return csv_file
-    else:
-        if not data:
-            return {}
-        elif len(data) == 1:
-            return dict(zip(list(data[0]),
-                            [[] for i in range(len(data[0]))]))
-        else:
-            return json.dumps(dict(zip(list(data[0]),
-                                       [list(i) for i in zip(*data[1:])])),
-                              cls=CustomJsonEncoder)
+    stream = db_queries.getParcelWeatherTS(dataset, pid, ptype, stream=True)
+    fname = f"timeseries_{aoi}{year}{ptype}_{pid}_WeatherTS.csv"
+    return stream_response(stream, tsformat, fname)
 
 
 # -------- Queries - Parcel information -------------------------------------- #
 
 @app.route('/query/parcelByLocation', methods=['GET'])
 @auth_required
+@admitted('light')
 def parcelByLocation_query():
     """
     Find parcel information for a geographical location.
@@ -730,6 +1217,8 @@ def parcelByLocation_query():
 
 @app.route('/query/parcelByID', methods=['GET'])
 @auth_required
+@cached_response
+@admitted('light')
 def parcelByID_query():
     """
     Get a parcel information for a known parcel ID,
@@ -761,9 +1250,14 @@ def parcelByID_query():
 
 @app.route('/query/parcelsByPolygon', methods=['GET'])
 @auth_required
+@admitted('heavy')
 def parcelsByPolygon_query():
     """
-    Find a parcel IDs within a given polygon.
+    Find a parcel IDs within a given polygon, in pages of parcels ordered by
+    parcel ID. The next page is linked in the Link (rel="next") and
+    X-Next-Page headers, with the 'page' token of the request.
+    The geometry is 'full', 'simplified' (to the tolerance, in the units of
+    the parcels table), 'bbox' or 'centroid'.
     """
     aoi = DEFAULT_AOI
     year = request.args.get('year')
@@ -772,7 +1266,10 @@ def parcelsByPolygon_query():
     withGeometry = True if request.args.get(
         'withGeometry') == 'True' else False
     only_ids = True
+    limit = 100
     wgs84 = True if request.args.get('wgs84') == 'True' else False
+    geometry = request.args.get('geometry', 'full')
+    tolerance = request.args.get('tolerance', POLYGON_TOLERANCE, type=float)
     if 'aoi' in request.args.keys():
         aoi = request.args.get('aoi').lower()
     if 'ptype' in request.args.keys():
@@ -781,22 +1278,80 @@ def parcelsByPolygon_query():
     if 'only_ids' in request.args.keys():
         only_ids = True if request.args.get(
             'only_ids') == 'True' else False
+    if 'limit' in request.args.keys():
+        limit = min(int(request.args.get('limit')), POLYGON_MAX_PARCELS)
+    if 'page_size' in request.args.keys():
+        limit = min(int(request.args.get('page_size')), POLYGON_MAX_PARCELS)
+    if geometry not in db_queries.GEOMETRY_MODES:
+        return make_response({"error": "The geometry must be one of: "
+                              f"{', '.join(db_queries.GEOMETRY_MODES)}."},
+                             400)
+    if 'geometry' in request.args.keys():
+        withGeometry = True
+    oformat = output_format('format')
     dataset = datasets[f'{aoi}_{year}']
-    data = db_queries.getParcelsByPolygon(
-        dataset, polygon, ptype, withGeometry, only_ids, wgs84)
+    # The pages are of the same query only.
+    query = {'aoi': aoi, 'year': year, 'ptype': ptype, 'polygon': polygon,
+             'geometry': geometry if withGeometry else None,
+             'tolerance': tolerance if geometry == 'simplified' else None,
+             'only_ids': only_ids, 'wgs84': wgs84}
+    after = None
+    if request.args.get('page'):
+        try:
+            after = streaming.page_after(request.args.get('page'), query)
+        except ValueError as err:
+            return make_response({"error": str(err)}, 400)
+    until, more = db_queries.getPolygonPageEnd(
+        dataset, polygon, ptype, limit, after)
+    stream = db_queries.getParcelsByPolygon(
+        dataset, polygon, ptype, withGeometry, only_ids, wgs84,
+        limit, stream=True, geometry=geometry, tolerance=tolerance,
+        after=after, until=until if more else None)
+    response = stream_response(stream, oformat,
+                               f"parcels_{aoi}{year}{ptype}.csv")
+    if more and isinstance(response, current_app.response_class):
+        token = streaming.page_token(until, query)
+        url = url_for('parcelsByPolygon_query',
+                      **{**request.args.to_dict(), 'page': token})
+        response.headers['Link'] = f'<{url}>; rel="next"'
+        response.headers['X-Next-Page'] = token
+    return response
 
-    if not data:
-        return {}
-    elif len(data) == 1:
-        return dict(zip(list(data[0]),
-                        [[] for i in range(len(data[0]))]))
-    else:
-        return dict(zip(list(data[0]),
-                        [list(i) for i in zip(*data[1:])]))
+
+@app.route('/query/tiles/<aoi>/<int:year>/<int:z>/<int:x>/<int:y>.mvt',
+           methods=['GET'])
+@auth_required
+@cached_response
+@admitted('light')
+def parcelTiles_query(aoi, year, z, x, y):
+    """
+    Get a Mapbox vector tile of the parcels, with the geometries simplified
+    to the zoom level. The optional attributes (comma separated) are 'crop'
+    (crop name and code), 'area' and 'marker' (the latest marker).
+    responses:
+        description: A Mapbox vector tile with the 'parcels' layer, empty
+        for the zoom levels below 10.
+    """
+    aoi = aoi.lower()
+    ptype = ''
+    if request.args.get('ptype', '') != '':
+        ptype = f"_{request.args.get('ptype')}"
+    attributes = [a for a in request.args.get('attributes', '').split(',')
+                  if a]
+    dataset = datasets.get(f'{aoi}_{year}')
+    if dataset is None:
+        abort(404)
+    tile = db_queries.getParcelTile(dataset, aoi, year, z, x, y, ptype,
+                                    attributes)
+    if tile is None:
+        return make_response({"error": "Can not get the parcels tile."}, 500)
+    return current_app.response_class(
+        tile, mimetype='application/vnd.mapbox-vector-tile')
 
 
 @app.route('/query/markers', methods=['GET'])
 @auth_required
+@admitted('light')
 def markers():
     """
     Get a parcel information for a known parcel ID,
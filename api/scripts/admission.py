@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Admission control of the API queries.
+
+The endpoints are grouped in classes: 'light' (one parcel), 'heavy' (many
+parcels, e.g. parcelsByPolygon or the batch time series) and 'chips' (chip
+and background images). For each class there is a limit on the number of
+requests that run at the same time, globally and per user. The per user
+limits depend on the tier of the user ("tier" in config/users.json,
+'default' if not set).
+
+A request over a limit waits for a free slot, for at most "max_wait"
+seconds. If the wait queue is full, or no slot is freed in time, the
+request is rejected. The response is 429 (Too Many Requests) when the user
+limit is reached, and 503 (Service Unavailable) when the server is full.
+Both responses have a Retry-After header.
+
+The database queries of an admitted request have the "statement_timeout"
+(in seconds) of its class.
+
+The limits are set in config/limits.json, reloaded when it changes, e.g.:
+    {"global": {"light": 64, "heavy": 8, "chips": 8},
+     "queue_size": 64, "max_wait": 10,
+     "statement_timeout": {"light": 10, "heavy": 120, "chips": 60},
+     "tiers": {"default": {"light": 8, "heavy": 1, "chips": 2,
+                           "queue_size": 4, "max_wait": 5},
+               "power": {"light": 16, "heavy": 4, "chips": 4,
+                         "queue_size": 8, "max_wait": 20}}}
+"""
+
+import os
+import json
+import math
+import time
+import threading
+from collections import Counter
+
+limits_file = 'config/limits.json'
+
+CLASSES = ['light', 'heavy', 'chips']
+GLOBAL_LIMITS = {'light': 64, 'heavy': 8, 'chips': 8}
+QUEUE_SIZE = 64  # Requests waiting for a slot, in all classes.
+MAX_WAIT = 10  # Seconds a request waits for a slot.
+STATEMENT_TIMEOUTS = {'light': 10, 'heavy': 120, 'chips': 60}
+TIERS = {'default': {'light': 8, 'heavy': 1, 'chips': 2,
+                     'queue_size': 4, 'max_wait': 5}}
+DURATION_WEIGHT = 0.1  # Weight of the last request in the mean durations.
+
+_config = {'stamp': None, 'limits': None}
+_lock = threading.Lock()
+
+
+class Rejected(Exception):
+    """A request that was not admitted, with the http status (429 or 503)
+    and the seconds after which it can be retried."""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def config():
+    """Get the limits of config/limits.json, reloaded only if it changed."""
+    try:
+        stat = os.stat(limits_file)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        stamp = None
+    with _lock:
+        if _config['limits'] is not None and _config['stamp'] == stamp:
+            return _config['limits']
+    conf = {}
+    if stamp:
+        try:
+            with open(limits_file) as f:
+                conf = json.load(f)
+        except Exception as err:
+            print(f"Can not read the limits file {limits_file}: {err}")
+    tiers = {**TIERS, **conf.get('tiers', {})}
+    tiers['default'] = {**TIERS['default'], **tiers['default']}
+    limits = {'global': {**GLOBAL_LIMITS, **conf.get('global', {})},
+              'queue_size': int(conf.get('queue_size', QUEUE_SIZE)),
+              'max_wait': float(conf.get('max_wait', MAX_WAIT)),
+              'statement_timeout': {**STATEMENT_TIMEOUTS,
+                                    **conf.get('statement_timeout', {})},
+              'tiers': tiers}
+    with _lock:
+        _config.update({'stamp': stamp, 'limits': limits})
+    return limits
+
+
+def tier_limits(tier):
+    """Get the limits of a tier, the default tier for unknown tiers."""
+    tiers = config()['tiers']
+    return {**tiers['default'], **tiers.get(tier, tiers['default'])}
+
+
+class Ticket:
+    """The slot of an admitted request, released once."""
+
+    def __init__(self, controller, user, eclass, statement_timeout):
+        self.controller = controller
+        self.user = user
+        self.eclass = eclass
+        self.statement_timeout = statement_timeout
+        self.start = time.monotonic()
+        self._released = False
+
+    def release(self):
+        with self.controller._cond:
+            if self._released:
+                return
+            self._released = True
+        self.controller.release(self)
+
+    def released_after(self, iterable, context=None):
+        """Release the slot when the iterable (a streamed response) is
+        consumed or closed, it is run in the context if given (e.g. the
+        statement timeout)."""
+        try:
+            if context is None:
+                yield from iterable
+            else:
+                with context:
+                    yield from iterable
+        finally:
+            self.release()
+
+
+class Admission:
+    """Concurrency limits per user and endpoint class and per class, with
+    a bounded wait for a free slot."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.active = Counter()  # By class and by (user, class).
+        self.waiting = Counter()  # By user.
+        self.queued = 0  # Waiting requests of all users.
+        self.durations = {}  # Mean duration of the requests of each class.
+        self.stats = Counter()
+
+    def retry_after(self, eclass):
+        return max(1, math.ceil(self.durations.get(eclass, 1)))
+
+    def _reject(self, message, status, eclass):
+        self.stats[f'rejected_{status}'] += 1
+        raise Rejected(message, status, self.retry_after(eclass))
+
+    def acquire(self, user, eclass, tier='default'):
+        """Wait for a slot of the class, a Rejected exception is raised if
+        the request can not be admitted."""
+        conf = config()
+        limits = tier_limits(tier)
+        user_limit = limits.get(eclass)
+        global_limit = conf['global'].get(eclass)
+        max_wait = float(limits.get('max_wait', conf['max_wait']))
+        deadline = time.monotonic() + max_wait
+        waited = False
+        with self._cond:
+            try:
+                while True:
+                    user_full = (user_limit is not None and
+                                 self.active[(user, eclass)] >= user_limit)
+                    global_full = (global_limit is not None and
+                                   self.active[eclass] >= global_limit)
+                    if not (user_full or global_full):
+                        break
+                    if not waited:
+                        if self.waiting[user] >= int(limits.get(
+                                'queue_size', 0)):
+                            self._reject("Too many requests for this user, "
+                                         "please retry later.", 429, eclass)
+                        if self.queued >= conf['queue_size']:
+                            self._reject("The server is busy, please retry "
+                                         "later.", 503, eclass)
+                        waited = True
+                        self.waiting[user] += 1
+                        self.queued += 1
+                        self.stats['waits'] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if user_full:
+                            self._reject("Too many concurrent requests for "
+                                         "this user, please retry later.",
+                                         429, eclass)
+                        self._reject("The server is busy, please retry "
+                                     "later.", 503, eclass)
+                    self._cond.wait(remaining)
+            finally:
+                if waited:
+                    self.waiting[user] -= 1
+                    self.queued -= 1
+                    if self.waiting[user] <= 0:
+                        del self.waiting[user]
+            self.active[(user, eclass)] += 1
+            self.active[eclass] += 1
+            self.stats['admitted'] += 1
+        timeout = conf['statement_timeout'].get(eclass)
+        return Ticket(self, user, eclass, timeout)
+
+    def release(self, ticket):
+        duration = time.monotonic() - ticket.start
+        with self._cond:
+            self.active[(ticket.user, ticket.eclass)] -= 1
+            self.active[ticket.eclass] -= 1
+            if self.active[(ticket.user, ticket.eclass)] <= 0:
+                del self.active[(ticket.user, ticket.eclass)]
+            mean = self.durations.get(ticket.eclass, duration)
+            self.durations[ticket.eclass] = (
+                mean + DURATION_WEIGHT * (duration - mean))
+            self._cond.notify_all()
+
+    def metrics(self):
+        """Get the active and waiting requests and the admission counters."""
+        with self._cond:
+            return {'active': {c: self.active[c] for c in CLASSES},
+                    'waiting': self.queued,
+                    'mean_duration': dict(self.durations),
+                    **self.stats}
+
+
+_controller = Admission()
+
+
+def admit(user, eclass, tier='default'):
+    """Get the ticket of an admitted request (see Admission.acquire)."""
+    return _controller.acquire(user, eclass, tier)
+
+
+def metrics():
+    return _controller.metrics()
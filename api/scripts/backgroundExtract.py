@@ -18,14 +18,13 @@
 
 import os
 import glob
-import math
-import numpy as np
 import logging
 import rasterio as rio
-from rasterio.windows import Window
 from rasterio.transform import Affine
 from osgeo import osr, ogr
 
+from scripts import tile_cache
+
 
 def getBackgroundExtract(lon, lat, chipSize, chipExtend, unique_dir,
                          tms="Google", iformat='tif', withGeometry=False):
@@ -78,87 +77,78 @@ def getBackgroundExtract(lon, lat, chipSize, chipExtend, unique_dir,
     north = point.GetY() + chipExtend / 2
 
     if os.path.isfile(f"config/tms/{tms.lower()}.xml"):
-        with rio.open(f"config/tms/{tms.lower()}.xml") as TMS_dataset:
-            bl = TMS_dataset.index(west, south, op=math.floor)
-            tr = TMS_dataset.index(east, north, op=math.ceil)
-
-            window = Window(bl[1], tr[0], tr[1] - bl[1], bl[0] - tr[0])
-
-            # image_size is a tuple (num_bands, h, w)
-            output_dataset = np.empty(shape=(
-                TMS_dataset.count, chipSize, chipSize),
-                dtype=TMS_dataset.profile['dtype'])
-
-            # Read all bands
-            TMS_dataset.read(out=output_dataset, window=window)
-
-            res = float(chipExtend) / chipSize
-            transform = Affine.translation(
-                west + res / 2, north - res / 2) * Affine.scale(res, -res)
-
-            if iformat == 'tif':
-                chipset = rio.open(f"{unique_dir}/{tms.lower()}.tif", 'w',
-                                   driver='GTiff',
-                                   width=output_dataset.shape[2],
-                                   height=output_dataset.shape[1],
-                                   count=TMS_dataset.count,
-                                   crs=3857,
-                                   transform=transform,
-                                   dtype=TMS_dataset.profile['dtype']
-                                   )
-            elif iformat == 'png':
-                chipset = rio.open(f"{unique_dir}/{tms.lower()}.png", 'w',
-                                   driver='PNG',
-                                   width=output_dataset.shape[2],
-                                   height=output_dataset.shape[1],
-                                   count=TMS_dataset.count,
-                                   crs=3857,
-                                   transform=transform,
-                                   dtype=TMS_dataset.profile['dtype']
-                                   )
+        # image_size is a tuple (num_bands, h, w)
+        output_dataset = tile_cache.read_window(
+            tms.lower(), f"config/tms/{tms.lower()}.xml",
+            (west, south, east, north), chipSize)
+
+        res = float(chipExtend) / chipSize
+        transform = Affine.translation(
+            west + res / 2, north - res / 2) * Affine.scale(res, -res)
+
+        if iformat == 'tif':
+            chipset = rio.open(f"{unique_dir}/{tms.lower()}.tif", 'w',
+                               driver='GTiff',
+                               width=output_dataset.shape[2],
+                               height=output_dataset.shape[1],
+                               count=output_dataset.shape[0],
+                               crs=3857,
+                               transform=transform,
+                               dtype=output_dataset.dtype
+                               )
+        elif iformat == 'png':
+            chipset = rio.open(f"{unique_dir}/{tms.lower()}.png", 'w',
+                               driver='PNG',
+                               width=output_dataset.shape[2],
+                               height=output_dataset.shape[1],
+                               count=output_dataset.shape[0],
+                               crs=3857,
+                               transform=transform,
+                               dtype=output_dataset.dtype
+                               )
+        else:
+            return False
+        chipset.write(output_dataset)
+        chipset.close()
+        if withGeometry and iformat == 'png':
+            from copy import copy
+            from rasterio.plot import show
+            import matplotlib.pyplot as plt
+            from descartes import PolygonPatch
+
+            from scripts import spatial_utils
+            from scripts import db_queries, registry
+
+            def overlay_parcel(img, geom):
+                """Create parcel polygon overlay"""
+                patche = [PolygonPatch(feature, edgecolor="yellow",
+                                       facecolor="none", linewidth=2
+                                       ) for feature in geom['geom']]
+                return patche
+            datasets = registry.datasets()
+            aoi, year, pid, ptype = withGeometry
+            dataset = datasets[f'{aoi}_{year}']
+            pdata = db_queries.getParcelByID(dataset, pid, ptype,
+                                             withGeometry, False)
+            if len(pdata) == 1:
+                parcel = dict(zip(list(pdata[0]),
+                                  [[] for i in range(len(pdata[0]))]))
             else:
-                return False
-            chipset.write(output_dataset)
-            chipset.close()
-            if withGeometry and iformat == 'png':
-                from copy import copy
-                from rasterio.plot import show
-                import matplotlib.pyplot as plt
-                from descartes import PolygonPatch
-
-                from scripts import spatial_utils
-                from scripts import db_queries
-
-                def overlay_parcel(img, geom):
-                    """Create parcel polygon overlay"""
-                    patche = [PolygonPatch(feature, edgecolor="yellow",
-                                           facecolor="none", linewidth=2
-                                           ) for feature in geom['geom']]
-                    return patche
-                datasets = db_queries.get_datasets()
-                aoi, year, pid, ptype = withGeometry
-                dataset = datasets[f'{aoi}_{year}']
-                pdata = db_queries.getParcelByID(dataset, pid, ptype,
-                                                 withGeometry, False)
-                if len(pdata) == 1:
-                    parcel = dict(zip(list(pdata[0]),
-                                      [[] for i in range(len(pdata[0]))]))
-                else:
-                    parcel = dict(zip(list(pdata[0]),
-                                      [list(i) for i in zip(*pdata[1:])]))
-
-                with rio.open(f"{unique_dir}/{tms.lower()}.png") as img:
-                    geom = spatial_utils.transform_geometry(parcel, 3857)
-                    patches = overlay_parcel(img, geom)
-                    for patch in patches:
-                        fig = plt.figure()
-                        ax = fig.gca()
-                        plt.axis('off')
-                        plt.box(False)
-                        ax.add_patch(copy(patch))
-                        show(img, ax=ax)
-                        plt.savefig(f"{unique_dir}/{tms.lower()}.png",
-                                    bbox_inches='tight')
-            return True
+                parcel = dict(zip(list(pdata[0]),
+                                  [list(i) for i in zip(*pdata[1:])]))
+
+            with rio.open(f"{unique_dir}/{tms.lower()}.png") as img:
+                geom = spatial_utils.transform_geometry(parcel, 3857)
+                patches = overlay_parcel(img, geom)
+                for patch in patches:
+                    fig = plt.figure()
+                    ax = fig.gca()
+                    plt.axis('off')
+                    plt.box(False)
+                    ax.add_patch(copy(patch))
+                    show(img, ax=ax)
+                    plt.savefig(f"{unique_dir}/{tms.lower()}.png",
+                                bbox_inches='tight')
+        return True
     else:
         return False
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+A content addressed store of the extracted chips.
+
+The chips are stored by scene reference, band and the window in the pixel
+grid of the image (UTM for Sentinel-2), so requests that differ only by the
+rounding of lon/lat or by the band order share the pixels. The chips of the
+requests (in the unique_dir) are links to the stored chips and are removed
+with them. An SQLite index, shared by all the server and worker processes,
+keeps the size, the last access and the hit/miss counts. The least recently
+used chips are evicted when the size limit is reached, and all chips after
+the max age.
+
+The store is configured in config/main.json, e.g.:
+    "chips": {"cache_size_mb": 2048, "cache_max_age_days": 30}
+"""
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+db_conf_file = 'config/main.json'
+
+CACHE_DIR = 'static/tmp/chipcache'
+CACHE_SIZE_MB = 2048
+CACHE_MAX_AGE_DAYS = 30
+EVICT_INTERVAL = 60  # Seconds between the checks of the size and age.
+
+
+def key(reference, band, window, chipsize):
+    """Get the key of a chip, window is the rasterio Window in the image."""
+    parts = [reference.replace('.SAFE', ''), band, int(window.col_off),
+             int(window.row_off), int(window.width), int(window.height),
+             int(chipsize)]
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def _link(src, dst):
+    # Link a stored chip to the unique_dir, or copy it if that fails.
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ChipCache:
+    """The chip store, safe to use from several processes."""
+
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE_MB * 1024 * 1024,
+                 max_age=CACHE_MAX_AGE_DAYS * 86400):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self._evicted = 0
+        os.makedirs(path, exist_ok=True)
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS chips (
+                key text PRIMARY KEY, size integer, created real,
+                accessed real)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS outputs (
+                key text, path text, PRIMARY KEY (key, path))""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                name text PRIMARY KEY, value integer)""")
+            conn.execute("""INSERT OR IGNORE INTO stats VALUES
+                ('hits', 0), ('misses', 0), ('evictions', 0)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS chips_accessed
+                ON chips (accessed)""")
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                               timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.tif")
+
+    def fetch(self, key, write, output=None):
+        """Get the path of a stored chip, the chip is written with
+        write(path) if it is not in the store. If output is given, the
+        chip is linked to it."""
+        path = self._file(key)
+        now = time.time()
+        with self._db() as conn:
+            hit = conn.execute("UPDATE chips SET accessed = ? WHERE key = ?",
+                               (now, key)).rowcount == 1
+            if hit and not os.path.isfile(path):
+                conn.execute("DELETE FROM chips WHERE key = ?", (key,))
+                hit = False
+            conn.execute("UPDATE stats SET value = value + 1 WHERE name = ?",
+                         ('hits' if hit else 'misses',))
+        if not hit:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                write(tmp)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            with self._db() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO chips VALUES (?, ?, ?, ?)",
+                    (key, os.path.getsize(path), now, now))
+        if output is not None:
+            _link(path, output)
+            with self._db() as conn:
+                conn.execute("INSERT OR IGNORE INTO outputs VALUES (?, ?)",
+                             (key, output))
+        if time.time() - self._evicted > EVICT_INTERVAL:
+            self.evict()
+        return path
+
+    def stored(self, keys):
+        """Get the keys of the chips that are in the store."""
+        stored = set()
+        with self._db() as conn:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                stored.update([r[0] for r in conn.execute(
+                    "SELECT key FROM chips WHERE key IN (%s)" % ','.join(
+                        '?' * len(part)), part)])
+        return {k for k in stored if os.path.isfile(self._file(k))}
+
+    def evict(self):
+        """Remove the chips older than the max age, and the least recently
+        used chips above the size limit."""
+        self._evicted = time.time()
+        with self._db() as conn:
+            keys = [r[0] for r in conn.execute(
+                "SELECT key FROM chips WHERE accessed < ?",
+                (time.time() - self.max_age,))]
+            total = conn.execute(
+                "SELECT coalesce(sum(size), 0) FROM chips").fetchone()[0]
+            if total > self.max_size:
+                for k, size in conn.execute("""SELECT key, size FROM chips
+                        WHERE accessed >= ? ORDER BY accessed""",
+                                            (time.time() - self.max_age,)):
+                    if total <= self.max_size:
+                        break
+                    keys.append(k)
+                    total -= size
+        for k in keys:
+            self.remove(k)
+        return len(keys)
+
+    def remove(self, key):
+        with self._db() as conn:
+            outputs = [r[0] for r in conn.execute(
+                "SELECT path FROM outputs WHERE key = ?", (key,))]
+            conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+            conn.execute("DELETE FROM chips WHERE key = ?", (key,))
+            conn.execute("""UPDATE stats SET value = value + 1
+                WHERE name = 'evictions'""")
+        for path in [self._file(key)] + outputs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logging.debug(f"Chip {key} evicted")
+
+    def stats(self):
+        """Get the hit/miss counts, the number and size of the chips."""
+        with self._db() as conn:
+            stats = dict(conn.execute("SELECT name, value FROM stats"))
+            stats['chips'], stats['size'] = conn.execute(
+                "SELECT count(*), coalesce(sum(size), 0) FROM chips"
+            ).fetchone()
+        requests = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / requests if requests else None
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def cache(create=True):
+    """Get the chip store of this process. With create=False a store that
+    does not exist yet is not created, None is returned."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            try:
+                with open(db_conf_file) as f:
+                    conf = json.load(f).get('chips', {})
+            except Exception:
+                conf = {}
+            path = conf.get('cache_dir', CACHE_DIR)
+            if not create and not os.path.isfile(
+                    os.path.join(path, 'index.sqlite')):
+                return None
+            _cache = ChipCache(
+                path,
+                int(float(conf.get('cache_size_mb', CACHE_SIZE_MB)) *
+                    1024 * 1024),
+                float(conf.get('cache_max_age_days', CACHE_MAX_AGE_DAYS)) *
+                86400)
+    return _cache
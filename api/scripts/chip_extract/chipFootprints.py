@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Chip overlap of the scene footprints and selection of the best scene of each
+acquisition, for all candidate scenes of a chip request at once.
+
+The chip centre is projected once, the vertices of all the footprints are
+projected in one array operation and clipped to the chip square together.
+The overlap is computed in EPSG:3857 (spherical Mercator) for a chip of
+chipsize x chipsize.
+
+Usage:
+    overlaps = chip_overlaps(lon, lat, chipsize, footprints)
+    chiplist = best_per_acquisition(references, s2_acquisition, s2_rank)
+with the footprints as WKT (Multi)Polygons or GeoJSON geometries in
+EPSG:4326.
+"""
+
+import re
+
+import numpy as np
+
+EARTH_RADIUS = 6378137.0  # Of EPSG:3857.
+MAX_LAT = 85.0511287798  # Latitude limit of EPSG:3857.
+OVERLAP_DIGITS = 6  # Overlaps that differ less are the same for the ranking.
+
+_WKT_TOKENS = re.compile(r'\(+|\)+|[^()]+')
+
+
+def mercator(lon, lat):
+    """Project lon, lat (scalars or arrays) to EPSG:3857."""
+    lon = np.radians(lon)
+    lat = np.radians(np.clip(lat, -MAX_LAT, MAX_LAT))
+    return (EARTH_RADIUS * lon,
+            EARTH_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2)))
+
+
+def wkt_rings(wkt):
+    """Get the rings of a WKT (Multi)Polygon, as [(coordinates, hole)]."""
+    rings = []
+    opened = 0
+    for token in _WKT_TOKENS.findall(wkt[wkt.index('('):]):
+        if token[0] == '(':
+            opened = len(token)
+        elif token[0] != ')' and token.strip(' ,'):
+            # A ring after '((' starts a polygon, after ',(' it is a hole.
+            coords = [c.split()[:2] for c in token.split(',')]
+            rings.append((np.array(coords, dtype=float), opened < 2))
+            opened = 0
+    return rings
+
+
+def geojson_rings(geometry):
+    """Get the rings of a GeoJSON (Multi)Polygon, as [(coordinates, hole)]."""
+    polygons = geometry['coordinates']
+    if geometry['type'] == 'Polygon':
+        polygons = [polygons]
+    return [(np.array(ring, dtype=float)[:, :2], i > 0)
+            for polygon in polygons for i, ring in enumerate(polygon)]
+
+
+def _clip(pts, cnt, axis, bound, keep_above):
+    # Clip the rings (pts: rings x vertices x 2, cnt: vertices of each ring)
+    # to one side of the line pts[..., axis] == bound (Sutherland-Hodgman).
+    k = pts.shape[1]
+    j = np.arange(k)
+    valid = j < cnt[:, None]
+    nxt = np.take_along_axis(
+        pts, ((j + 1) % np.maximum(cnt, 1)[:, None])[..., None], axis=1)
+    side = pts[..., axis] - bound
+    nside = nxt[..., axis] - bound
+    if not keep_above:
+        side, nside = -side, -nside
+    inside, ninside = side >= 0, nside >= 0
+    crossing = valid & (inside != ninside)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(crossing, side / (side - nside), 0)
+    cross = pts + t[..., None] * (nxt - pts)
+    # Each edge gives the crossing point and/or its end point, in order.
+    out = np.stack([cross, nxt], axis=2).reshape(len(pts), 2 * k, 2)
+    mask = np.stack([crossing, valid & ninside], axis=2).reshape(
+        len(pts), 2 * k)
+    order = np.argsort(~mask, axis=1, kind='stable')
+    out = np.take_along_axis(out, order[..., None], axis=1)
+    cnt = mask.sum(axis=1)
+    width = max(int(cnt.max(initial=0)), 1)
+    return out[:, :width], cnt
+
+
+def _areas(pts, cnt):
+    # The shoelace area of each ring.
+    j = np.arange(pts.shape[1])
+    nxt = np.take_along_axis(
+        pts, ((j + 1) % np.maximum(cnt, 1)[:, None])[..., None], axis=1)
+    cross = pts[..., 0] * nxt[..., 1] - nxt[..., 0] * pts[..., 1]
+    return 0.5 * np.abs(np.where(j < cnt[:, None], cross, 0).sum(axis=1))
+
+
+def chip_overlaps(lon, lat, chipsize, footprints):
+    """Get the fraction of the chip centred on lon, lat that is covered by
+    each footprint (WKT or GeoJSON geometry), as an array."""
+    rings, owner, holes = [], [], []
+    for i, footprint in enumerate(footprints):
+        if isinstance(footprint, str):
+            parts = wkt_rings(footprint)
+        else:
+            parts = geojson_rings(footprint)
+        for coords, hole in parts:
+            if len(coords) > 1 and np.array_equal(coords[0], coords[-1]):
+                coords = coords[:-1]
+            rings.append(coords)
+            owner.append(i)
+            holes.append(hole)
+    overlaps = np.zeros(len(footprints))
+    if not rings:
+        return overlaps
+    cnt = np.array([len(r) for r in rings])
+    pts = np.zeros((len(rings), cnt.max(), 2))
+    pts[np.arange(cnt.max()) < cnt[:, None]] = np.concatenate(rings)
+    pts[..., 0], pts[..., 1] = mercator(pts[..., 0], pts[..., 1])
+
+    x, y = mercator(lon, lat)
+    half = chipsize // 2
+    for axis, bound, keep_above in [(0, x - half, True), (0, x + half, False),
+                                    (1, y - half, True), (1, y + half, False)]:
+        pts, cnt = _clip(pts, cnt, axis, bound, keep_above)
+    areas = np.where(holes, -1, 1) * _areas(pts, cnt)
+    np.add.at(overlaps, owner, areas)
+    return np.clip(overlaps / (2 * half) ** 2, 0, 1)
+
+
+def s2_acquisition(reference):
+    # S2A_MSIL2A_20190503T104031_N0211_R008_T31TEG_20190503T112944.SAFE
+    return reference['id'].split('_')[2]
+
+
+def s2_rank(reference):
+    # The best covering tile, then the latest processing baseline and the
+    # latest processing.
+    parts = reference['id'].replace('.SAFE', '').split('_')
+    return (round(reference['chipoverlap'], OVERLAP_DIGITS), parts[3],
+            parts[6], reference['id'])
+
+
+def s1_acquisition(reference):
+    # S1B_IW_GRDH_1SDV_20190301T172436_20190301T172501_015164_01C5BF_40F5_CARD_BS
+    # or the CARD-COH6 references, with the time stamp second.
+    parts = reference['id'].split('_')
+    if reference['id'].endswith('CARD_BS'):
+        return parts[4][0:8]
+    return parts[1][0:8]
+
+
+def s1_rank(reference):
+    return (round(reference['chipoverlap'], OVERLAP_DIGITS),
+            reference.get('orbitDirection') or '', reference['id'])
+
+
+def best_per_acquisition(references, acquisition=s2_acquisition,
+                         rank=s2_rank):
+    """Get the ids of the best ranked reference of each acquisition, the
+    latest acquisitions first. The result does not depend on the order of
+    the references."""
+    best = {}
+    for reference in references:
+        key, value = acquisition(reference), rank(reference)
+        if key not in best or value > best[key][0]:
+            best[key] = (value, reference['id'])
+    return [best[key][1] for key in sorted(best, reverse=True)]
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Extract chips from Sentinel images in the DIAS object storage, in the
+long-lived chip worker processes.
+
+Replaces the rawChipRipper.py, rawChipRipper2.py, rawS1ChipRipper.py and
+chipRipper2.py scripts that were run in a new docker container for each
+chip. The worker calls init() once and keeps the GDAL settings, the S3
+client, the granule paths and the open images for all the following chips.
+
+The chips are taken from the chipCache store, the composites are made from
+the stored single band chips. The tiled GeoTIFF (COG) bands are read with
+byte ranges of the tiles of the chip windows (rangeReader), the other images
+with GDAL, and the chips of a batch that are in the same image band are read
+in one pass. The JP2 bands are read from the scene cache (sceneCache), as
+tiled GeoTIFFs with byte ranges, if it is configured.
+"""
+
+import os
+import json
+import logging
+from functools import lru_cache
+from collections import OrderedDict
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+from rasterio.warp import transform as warp_transform
+from rasterio.enums import Resampling
+
+from scripts.chip_extract import chipCache, rangeReader, sceneCache
+
+db_conf_file = 'config/main.json'
+
+EODATA = '/eodata'  # Mounted DIAS object storage, if available.
+MAX_CHIPSIZE = 5120  # Max chip size in meters.
+OPEN_IMAGES = 32  # Images kept open by each worker.
+BAND_RESOLUTION = {'B02': 10, 'B03': 10, 'B04': 10, 'B08': 10,
+                   'B05': 20, 'B06': 20, 'B07': 20, 'B8A': 20, 'B11': 20,
+                   'B12': 20, 'SCL': 20, 'B01': 60, 'B09': 60, 'B10': 60}
+
+# The scripts of the ssh/docker chip extraction and their chip tasks.
+SCRIPTS = {'rawChipRipper.py': 's2', 'rawChipRipper2.py': 's2',
+           'rawS1ChipRipper.py': 's1', 'chipRipper2.py': 's2_composite'}
+
+_s3 = {}
+_images = OrderedDict()
+
+
+def init():
+    """Set up GDAL for the S3 object storage, once for each worker."""
+    try:
+        with open(db_conf_file) as f:
+            s3 = json.load(f)['s3']
+    except Exception as err:
+        print("Could not read the s3 configuration: ", err)
+        s3 = {}
+    _s3.update(s3)
+    host = s3.get('host', '')
+    os.environ.update({
+        'AWS_S3_ENDPOINT': host.split('://')[-1],
+        'AWS_HTTPS': 'NO' if host.startswith('http://') else 'YES',
+        'AWS_VIRTUAL_HOSTING': 'FALSE',
+        'AWS_ACCESS_KEY_ID': s3.get('access_key', ''),
+        'AWS_SECRET_ACCESS_KEY': s3.get('secret_key', ''),
+        'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+        'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.jp2,.tif,.img,.hdr,.xml',
+        'GDAL_HTTP_MULTIRANGE': 'YES',
+        'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+        'VSI_CACHE': 'TRUE'})
+
+
+def storage_path(key):
+    """Get the GDAL path of an object storage key."""
+    if os.path.isdir(EODATA):
+        return f"{EODATA}/{key}"
+    return f"/vsis3/{_s3.get('bucket', 'DIAS')}/{key}"
+
+
+@lru_cache(maxsize=1)
+def s3_client():
+    import boto3
+    session = boto3.session.Session(
+        aws_access_key_id=_s3.get('access_key'),
+        aws_secret_access_key=_s3.get('secret_key'))
+    return session.client('s3', endpoint_url=_s3.get('host'))
+
+
+def list_dir(key):
+    """List the names in an object storage 'folder'."""
+    if os.path.isdir(EODATA):
+        return sorted(os.listdir(f"{EODATA}/{key}"))
+    response = s3_client().list_objects_v2(
+        Bucket=_s3.get('bucket', 'DIAS'), Prefix=f"{key}/", Delimiter='/')
+    return sorted([p['Prefix'].rstrip('/').split('/')[-1]
+                   for p in response.get('CommonPrefixes', [])])
+
+
+@lru_cache(maxsize=1024)
+def s2_granule(reference):
+    """Get the GRANULE folder of a Sentinel-2 product."""
+    if not reference.endswith('.SAFE'):
+        reference = f"{reference}.SAFE"
+    tstamp = reference.split('_')[2]
+    level = 'L1C' if 'MSIL1C' in reference else 'L2A'
+    product = (f"Sentinel-2/MSI/{level}/{tstamp[0:4]}/{tstamp[4:6]}/"
+               f"{tstamp[6:8]}/{reference}/GRANULE")
+    granules = list_dir(product)
+    if not granules:
+        raise FileNotFoundError(f"Resource {product} not available")
+    return f"{product}/{granules[0]}/IMG_DATA"
+
+
+def s2_band_path(reference, band):
+    """Get the GDAL path of a Sentinel-2 band image."""
+    tile = reference.split('_')[5]
+    tstamp = reference.split('_')[2]
+    img_data = s2_granule(reference)
+    if 'MSIL1C' in reference:
+        return storage_path(f"{img_data}/{tile}_{tstamp}_{band}.jp2")
+    res = BAND_RESOLUTION.get(band, 10)
+    return storage_path(
+        f"{img_data}/R{res}m/{tile}_{tstamp}_{band}_{res}m.jp2")
+
+
+def s1_band_path(reference, pol, plevel='CARD-BS'):
+    """Get the GDAL path and band index of a Sentinel-1 CARD image."""
+    if plevel == 'CARD-COH6':
+        tstamp = reference.split('_')[1]
+        obs_path = f"{tstamp[0:4]}/{tstamp[4:6]}/{tstamp[6:8]}"
+        return storage_path(f"Sentinel-1/SAR/CARD-COH6/{obs_path}/"
+                            f"{reference}/{reference}.tif"), \
+            1 if pol == 'VV' else 2
+    tstamp = reference.split('_')[4]
+    obs_path = f"{tstamp[0:4]}/{tstamp[4:6]}/{tstamp[6:8]}"
+    return storage_path(f"Sentinel-1/SAR/CARD-BS/{obs_path}/{reference}/"
+                        f"{reference}.data/Gamma0_{pol}.img"), 1
+
+
+def open_image(path):
+    """Get an open image, the images are kept open for the next chips."""
+    if path in _images:
+        _images.move_to_end(path)
+        return _images[path]
+    image = rio.open(path)
+    _images[path] = image
+    while len(_images) > OPEN_IMAGES:
+        _images.popitem(last=False)[1].close()
+    return image
+
+
+def chip_window(image, lon, lat, chipsize):
+    """Get the window of the chip centred on lon, lat, aligned to the
+    pixels of the image."""
+    xs, ys = warp_transform('EPSG:4326', image.crs, [lon], [lat])
+    col, row = ~image.transform * (xs[0], ys[0])
+    size = max(1, int(round(chipsize / image.res[0])))
+    return Window(int(round(col - size / 2)), int(round(row - size / 2)),
+                  size, size)
+
+
+def write_chip(path, data, crs, transform, driver='GTiff', nodata=None):
+    """Write a chip atomically, readers never see partial files."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    profile = {'driver': driver, 'width': data.shape[-1],
+               'height': data.shape[-2], 'count': data.shape[0],
+               'dtype': data.dtype, 'crs': crs, 'transform': transform}
+    if driver == 'GTiff':
+        profile.update({'compress': 'deflate', 'nodata': nodata})
+    with rio.open(tmp, 'w', **profile) as dst:
+        dst.write(data)
+    os.replace(tmp, path)
+    return path
+
+
+def open_band(path):
+    """Get the image of a band and the function that reads its windows,
+    with byte ranges if possible, else with GDAL. The JP2 bands are read
+    from the scene cache, if it is configured."""
+    path = sceneCache.resolve(path)
+    try:
+        band = rangeReader.open_band(path)
+        return band, band.read
+    except rangeReader.Unsupported:
+        image = open_image(path)
+        return image, lambda windows, index: [
+            image.read(index, window=w, boundless=True, fill_value=0)
+            for w in windows]
+
+
+def band_chips(path, index, reference, band, chips, dtype=None):
+    """Get the stored chips of an image band, for a list of chips (dicts
+    with lon, lat, chipsize and output). The chips that are not in the
+    store are read in one pass. Returns the paths of the stored chips."""
+    image, read = open_band(path)
+    windows = [chip_window(image, c['lon'], c['lat'], c['chipsize'])
+               for c in chips]
+    keys = [chipCache.key(reference, band, w, c['chipsize'])
+            for w, c in zip(windows, chips)]
+    cache = chipCache.cache()
+    stored = cache.stored(keys)
+    missing = [i for i, k in enumerate(keys) if k not in stored]
+    data = dict(zip(missing, read([windows[i] for i in missing], index)
+                    if missing else []))
+
+    def writer(i):
+        def write(chip_path):
+            chip = data.pop(i, None)
+            if chip is None:  # Removed from the store after the check.
+                chip = read([windows[i]], index)[0]
+            if dtype is not None:
+                chip = chip.astype(dtype)
+            write_chip(chip_path, chip[np.newaxis, ...], image.crs,
+                       image.window_transform(windows[i]),
+                       nodata=image.nodata)
+        return write
+    return [cache.fetch(k, writer(i), c.get('output'))
+            for i, (k, c) in enumerate(zip(keys, chips))]
+
+
+def band_chip(path, index, reference, band, lon, lat, chipsize, output=None,
+              dtype=None):
+    """Get the stored chip of an image band, it is extracted if it is not
+    in the store."""
+    return band_chips(path, index, reference, band, [
+        {'lon': lon, 'lat': lat, 'chipsize': chipsize, 'output': output}],
+        dtype)[0]
+
+
+def s2_chip(task):
+    band_chip(s2_band_path(task['reference'], task['band']), 1,
+              task['reference'], task['band'], task['lon'], task['lat'],
+              task['chipsize'], task['output'])
+    return task['output']
+
+
+def s1_chip(task):
+    path, index = s1_band_path(task['reference'], task['band'],
+                               task['plevel'])
+    band_chip(path, index, task['reference'],
+              f"{task['plevel']}_{task['band']}", task['lon'], task['lat'],
+              task['chipsize'], task['output'], np.float32)
+    return task['output']
+
+
+def s2_composite(task):
+    """A byte scaled 3 band composite, the first band sets the resolution."""
+    bands = task['bands'].split('_')
+    lut = [float(v) for v in task['lut'].split('_')]
+    layers = []
+    for i, band in enumerate(bands):
+        chip = band_chip(s2_band_path(task['reference'], band), 1,
+                         task['reference'], band, task['lon'], task['lat'],
+                         task['chipsize'])
+        with rio.open(chip) as src:
+            if i == 0:
+                first = src.profile
+                data = src.read(1).astype(np.float32)
+            else:
+                data = src.read(1, out_shape=(first['height'],
+                                              first['width']),
+                                resampling=Resampling.bilinear
+                                ).astype(np.float32)
+        if len(lut) == 6:
+            low, high = lut[2 * i], lut[2 * i + 1]
+        else:
+            valid = data[data > 0]
+            if valid.size == 0:
+                valid = data
+            low, high = np.percentile(valid, lut[0:2])
+        layers.append(np.clip(255 * (data - low) / max(high - low, 1e-6),
+                              0, 255).astype(np.uint8))
+    return write_chip(task['output'], np.stack(layers), first['crs'],
+                      first['transform'], 'PNG')
+
+
+def task_band(task):
+    """Get the image band of a single band chip task, as (path, index,
+    reference, band, dtype)."""
+    if task['type'] == 's1':
+        path, index = s1_band_path(task['reference'], task['band'],
+                                   task['plevel'])
+        return (path, index, task['reference'],
+                f"{task['plevel']}_{task['band']}", np.float32)
+    return (s2_band_path(task['reference'], task['band']), 1,
+            task['reference'], task['band'], None)
+
+
+def extract_batch(tasks):
+    """Extract chip tasks, the chips of the same image band are read in one
+    pass. Returns {output: path of the chip or error}."""
+    results = {}
+    bands = OrderedDict()
+    for task in tasks:
+        task['chipsize'] = min(int(task['chipsize']), MAX_CHIPSIZE)
+        task['lon'], task['lat'] = float(task['lon']), float(task['lat'])
+        try:
+            if task['type'] == 's2_composite':
+                results[task['output']] = s2_composite(task)
+            else:
+                bands.setdefault(task_band(task), []).append(task)
+        except Exception as err:
+            results[task['output']] = f"{type(err).__name__}: {err}"
+    for (path, index, reference, band, dtype), chips in bands.items():
+        try:
+            band_chips(path, index, reference, band, chips, dtype)
+            results.update({c['output']: c['output'] for c in chips})
+        except Exception as err:
+            results.update({c['output']: f"{type(err).__name__}: {err}"
+                            for c in chips})
+    return results
+
+
+def extract(task):
+    """Extract one chip task, returns the path of the chip. A 'batch' task
+    (with the 'tasks' of a scene) returns the results of extract_batch."""
+    if task['type'] == 'batch':
+        return extract_batch(task['tasks'])
+    task['chipsize'] = min(int(task['chipsize']), MAX_CHIPSIZE)
+    task['lon'], task['lat'] = float(task['lon']), float(task['lat'])
+    if task['type'] == 's1':
+        return s1_chip(task)
+    elif task['type'] == 's2_composite':
+        return s2_composite(task)
+    return s2_chip(task)
+
+
+def tasks(chiplist, lon, lat, unique_dir, script, args):
+    """Get the chip tasks of a chip list, with the arguments of the
+    ssh/docker chip extraction scripts."""
+    args = str(args).split()
+    ctype = SCRIPTS[script]
+    tlist = []
+    for reference in chiplist:
+        task = {'type': ctype, 'lon': lon, 'lat': lat}
+        if script == 'rawChipRipper.py':
+            band, chipsize, plevel = args
+            tlist.append({**task, 'reference': reference, 'band': band,
+                          'chipsize': chipsize, 'output':
+                          f"{unique_dir}/{reference.replace('SAFE', band)}.tif"})
+        elif script == 'rawChipRipper2.py':
+            tile, band = reference.rsplit('.', 1)
+            tlist.append({**task, 'reference': tile, 'band': band,
+                          'chipsize': args[0],
+                          'output': f"{unique_dir}/{reference}.tif"})
+        elif script == 'rawS1ChipRipper.py':
+            chipsize, plevel = args
+            for pol in ['VV', 'VH']:
+                tlist.append({**task, 'reference': reference, 'band': pol,
+                              'chipsize': chipsize, 'plevel': plevel,
+                              'output': f"{unique_dir}/{reference}_{pol}.tif"})
+        else:
+            lut, bands, plevel = args
+            tlist.append({**task, 'reference': reference, 'bands': bands,
+                          'lut': lut, 'chipsize': 1280,
+                          'output': f"{unique_dir}/{reference}.png"})
+    logging.debug(tlist)
+    return tlist
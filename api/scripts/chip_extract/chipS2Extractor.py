@@ -71,7 +71,6 @@ def parallelExtract(lon, lat, start_date, end_date, unique_dir,
                       'chipRipper2.py', f'{lut} {bands} {plevel}')
 
     logging.debug(f"Generated {len(chiplist)} chips")
-    chiptools.chipCollect(unique_dir, 'png')  # Collect the generate chips
     return len(chiplist)
 
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Load-aware assignment of chip tasks to workers.
+
+The registry keeps the tasks in flight, the recent latency and the failures
+of each worker. Tasks go to the least loaded healthy worker and failed tasks
+are retried on another worker. Workers that keep failing are left out for a
+while.
+
+The workers can be anything that runs a task, e.g. the local chip worker
+processes or the VMs of the ssh backend:
+    registry = WorkerRegistry(['vm1', 'vm2'], capacity=4)
+    results = run_tasks(registry, launch, tasks)
+where launch(worker, task) runs the task on the worker and raises an
+exception if it fails.
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+RETRIES = 2  # Other workers to try when a task fails.
+MAX_FAILURES = 3  # Consecutive failures before a worker is left out.
+COOLDOWN = 60  # Seconds before a worker that was left out gets tasks again.
+LATENCY_WEIGHT = 0.3  # Weight of the last task in the recent latency.
+WAIT_TIMEOUT = 300  # Seconds to wait for a free worker.
+
+
+class NoWorkerAvailable(Exception):
+    """There is no healthy worker to run the task."""
+
+
+class WorkerRegistry:
+    """The chip workers with their load and health."""
+
+    def __init__(self, workers=(), capacity=1, max_failures=MAX_FAILURES,
+                 cooldown=COOLDOWN):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._workers = {}
+        self._cond = threading.Condition()
+        for name in workers:
+            self.add(name, capacity)
+
+    def add(self, name, capacity=1):
+        with self._cond:
+            self._workers[name] = {
+                'capacity': capacity, 'inflight': 0, 'tasks': 0,
+                'failures': 0, 'consecutive_failures': 0, 'latency': None,
+                'busy_time': 0.0, 'dropped_until': 0, 'since': time.time()}
+            self._cond.notify_all()
+
+    def remove(self, name):
+        with self._cond:
+            self._workers.pop(name, None)
+
+    def capacity(self):
+        return sum([w['capacity'] for w in self._workers.values()])
+
+    def healthy(self, name):
+        return self._workers[name]['dropped_until'] <= time.time()
+
+    def acquire(self, exclude=(), timeout=WAIT_TIMEOUT):
+        """Get the least loaded healthy worker, waits if all are busy."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                candidates = [n for n in self._workers
+                              if n not in exclude and self.healthy(n)]
+                if not candidates:
+                    raise NoWorkerAvailable("No healthy chip worker")
+                free = [n for n in candidates if self._workers[n][
+                    'inflight'] < self._workers[n]['capacity']]
+                if free:
+                    name = min(free, key=self._load)
+                    self._workers[name]['inflight'] += 1
+                    return name
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise NoWorkerAvailable("All chip workers are busy")
+                self._cond.wait(min(remaining, 1))
+
+    def _load(self, name):
+        w = self._workers[name]
+        return (w['inflight'] / w['capacity'], w['latency'] or 0)
+
+    def release(self, name, duration, ok=True):
+        """Record the end of a task on a worker."""
+        with self._cond:
+            w = self._workers.get(name)
+            if w is None:
+                return
+            w['inflight'] -= 1
+            w['tasks'] += 1
+            w['busy_time'] += duration
+            if ok:
+                w['consecutive_failures'] = 0
+                if w['latency'] is None:
+                    w['latency'] = duration
+                else:
+                    w['latency'] += LATENCY_WEIGHT * (duration - w['latency'])
+            else:
+                w['failures'] += 1
+                w['consecutive_failures'] += 1
+                if w['consecutive_failures'] >= self.max_failures:
+                    logging.debug(f"Chip worker {name} left out for "
+                                  f"{self.cooldown} seconds")
+                    w['dropped_until'] = time.time() + self.cooldown
+                    w['consecutive_failures'] = 0
+            self._cond.notify_all()
+
+    def status(self):
+        """Get the load, latency, failures and utilisation of the workers."""
+        now = time.time()
+        with self._cond:
+            return {str(n): {
+                'healthy': self.healthy(n),
+                'inflight': w['inflight'],
+                'capacity': w['capacity'],
+                'tasks': w['tasks'],
+                'failures': w['failures'],
+                'latency': w['latency'],
+                'utilisation': w['busy_time'] / max(
+                    (now - w['since']) * w['capacity'], 1e-6)}
+                for n, w in self._workers.items()}
+
+
+def run_task(registry, launch, task, retries=RETRIES):
+    """Run a task on the least loaded worker, retry on other workers."""
+    tried = []
+    while True:
+        try:
+            worker = registry.acquire(exclude=tried)
+        except NoWorkerAvailable:
+            if tried:
+                raise error
+            raise
+        start = time.time()
+        try:
+            result = launch(worker, task)
+        except Exception as err:
+            registry.release(worker, time.time() - start, False)
+            logging.debug(f"Chip task failed on {worker}: {err}")
+            error = err
+            tried.append(worker)
+            if len(tried) > retries:
+                raise
+            continue
+        registry.release(worker, time.time() - start, True)
+        return result
+
+
+def run_tasks(registry, launch, tasks, retries=RETRIES):
+    """Run the tasks in parallel on the workers of the registry.
+    Returns the result, or the exception, of each task."""
+    if not tasks:
+        return []
+    results = []
+    threads = max(1, min(len(tasks), registry.capacity()))
+    with ThreadPoolExecutor(threads) as executor:
+        futures = [executor.submit(run_task, registry, launch, t, retries)
+                   for t in tasks]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as err:
+                results.append(err)
+    return results
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Extract the raw chips of all the acquisitions of a time window and bands at
+a location, as one time x band x y x x stack.
+
+Derived from rawChipExtractor.py, for all the bands of a request. The chips
+of a scene are extracted by one worker (one batch), the chips already in the
+unique_dir or in the chip store are not read again. The stack is a
+compressed GeoTIFF with one band for each date and band (with date, band and
+reference tags) or a NPZ file.
+"""
+
+import os
+import glob
+import time
+import logging
+
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+
+from scripts.chip_extract import chiptools, chipRipper, chipWorkers
+
+MAX_DATES = 60  # Max acquisitions of a stack.
+FORMATS = ['tif', 'npz']
+DIMENSIONS = 'time,band,y,x'
+
+
+def chip_path(unique_dir, reference, band):
+    # The names of the rawChipByLocation chips.
+    return f"{unique_dir}/{reference.replace('SAFE', band)}.tif"
+
+
+def acquisition(reference):
+    # S2A_MSIL2A_20190503T104031_N0211_R008_T31TEG_20190503T112944.SAFE
+    return reference.split('_')[2]
+
+
+def parallelExtract(lon, lat, start_date, end_date, unique_dir, bands,
+                    chipsize, plevel):
+    """Extract the chips of the bands (list) of the acquisitions, returns
+    the number of acquisitions or -1 if there are too many."""
+    from scripts.chip_extract import creodiasCARDchips
+    start = time.time()
+    chiplist = creodiasCARDchips.getS2Chips(
+        float(lon), float(lat), start_date, end_date, int(chipsize), plevel)
+    # One scene for each acquisition, the best covering tile.
+    chiplist = creodiasCARDchips.rinseAndDryS2(chiplist)
+    if len(chiplist) > MAX_DATES:
+        print("Request results in too many chips, please revise selection")
+        return -1
+    os.makedirs(unique_dir, exist_ok=True)
+    cached = set(glob.glob(f"{unique_dir}/*.tif"))
+    missing = {b: [r for r in chiplist
+                   if chip_path(unique_dir, r, b) not in cached]
+               for b in bands}
+    logging.debug(f"Stack of {len(chiplist)} acquisitions, "
+                  f"{sum(len(m) for m in missing.values())} new chips")
+    if chipWorkers.config()['backend'] != 'ssh':
+        tasks = [t for b in bands for t in chipRipper.tasks(
+            missing[b], lon, lat, unique_dir, 'rawChipRipper.py',
+            f'{b} {chipsize} {plevel}')]
+        if tasks:
+            chipWorkers.pool().run(tasks)
+    else:
+        for b in bands:
+            if missing[b]:
+                chiptools.runjobs(missing[b], lon, lat, unique_dir,
+                                  'rawChipRipper.py',
+                                  f'{b} {chipsize} {plevel}')
+    print(f"Total time required for the stack of {len(chiplist)} images: "
+          f"{time.time() - start} seconds")
+    return len(chiplist)
+
+
+def stack(unique_dir, start_date, end_date, bands):
+    """Read the chips of the bands in the time window as a stack, with
+    the grid of the first band (the other bands are resampled). The
+    missing chips are 0 (nodata). Returns (data, dates, references,
+    profile), data is time x band x y x x."""
+    references = {}
+    for band in bands:
+        for f in glob.glob(f"{unique_dir}/*.{band}.tif"):
+            reference = os.path.basename(f)[:-len(f".{band}.tif")]
+            references[acquisition(reference)] = f"{reference}.SAFE"
+    dates = chiptools.calendarCheck(sorted(references.keys()), start_date,
+                                    end_date)
+    paths = [[chip_path(unique_dir, references[d], band) for band in bands]
+             for d in dates]
+    found = [row[b] for b in range(len(bands)) for row in paths
+             if os.path.isfile(row[b])]
+    if not found:
+        return (np.zeros((len(dates), len(bands), 0, 0), 'uint16'), dates,
+                [references[d] for d in dates], None)
+    with rio.open(found[0]) as src:
+        profile = src.profile
+    data = np.zeros((len(dates), len(bands), profile['height'],
+                     profile['width']), profile['dtype'])
+    for t, row in enumerate(paths):
+        for b, path in enumerate(row):
+            if not os.path.isfile(path):
+                continue  # Extraction failed.
+            with rio.open(path) as src:
+                data[t, b] = src.read(
+                    1, out_shape=data.shape[2:],
+                    resampling=Resampling.nearest if bands[b] == 'SCL'
+                    else Resampling.bilinear)
+    return data, dates, [references[d] for d in dates], profile
+
+
+def buildStack(unique_dir, start_date, end_date, bands, sformat='tif'):
+    """Write the stack of the chips of the time window, returns the path
+    of the stack file or None if there are no chips."""
+    data, dates, references, profile = stack(unique_dir, start_date,
+                                             end_date, bands)
+    if profile is None:
+        return None
+    output = f"{unique_dir}/chipstack_{start_date}_{end_date}.{sformat}"
+    tmp = f"{output}.{os.getpid()}.tmp"
+    if sformat == 'npz':
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(
+                f, data=data, dates=np.array(dates), bands=np.array(bands),
+                references=np.array(references),
+                crs=profile['crs'].to_wkt(),
+                transform=np.array(profile['transform'][:6]))
+    else:
+        t, b, height, width = data.shape
+        with rio.open(tmp, 'w', driver='GTiff', width=width, height=height,
+                      count=t * b, dtype=data.dtype, crs=profile['crs'],
+                      transform=profile['transform'],
+                      nodata=profile.get('nodata'), compress='deflate',
+                      predictor=2, interleave='band') as dst:
+            dst.write(data.reshape(t * b, height, width))
+            dst.update_tags(dimensions=DIMENSIONS, dates=','.join(dates),
+                            bands=','.join(bands))
+            for i in range(t * b):
+                date, band = dates[i // b], bands[i % b]
+                dst.set_band_description(i + 1, f"{date}_{band}")
+                dst.update_tags(i + 1, date=date, band=band,
+                                reference=references[i // b])
+    os.replace(tmp, output)
+    return output
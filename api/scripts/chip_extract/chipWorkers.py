@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+A pool of long-lived chip extraction workers.
+
+The workers are started once and write the chips directly to the unique_dir,
+without a docker container or a copy for each chip. Each worker has its own
+queue, the chipScheduler assigns the tasks to the least loaded healthy
+worker, and the chip tasks of a scene are sent to one worker as a batch.
+
+The pool is configured in config/main.json, e.g.:
+    "chips": {"backend": "local", "workers": 4, "retries": 2}
+"""
+
+import json
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, TimeoutError
+
+from scripts.chip_extract import chipScheduler
+
+db_conf_file = 'config/main.json'
+
+BACKEND = 'local'  # 'local' worker processes or 'ssh' (docker on the VMs).
+WORKERS = 4
+TASK_TIMEOUT = 300  # Seconds to wait for the chips of a request.
+
+
+def config():
+    try:
+        with open(db_conf_file) as f:
+            conf = json.load(f).get('chips', {})
+    except Exception:
+        conf = {}
+    return {'backend': conf.get('backend', BACKEND),
+            'workers': int(conf.get('workers', WORKERS)),
+            'retries': int(conf.get('retries', chipScheduler.RETRIES)),
+            'max_failures': int(conf.get('max_failures',
+                                         chipScheduler.MAX_FAILURES)),
+            'cooldown': float(conf.get('cooldown', chipScheduler.COOLDOWN))}
+
+
+def _worker(wid, tasks, results):
+    # The loop of a worker process.
+    from scripts.chip_extract import chipRipper
+    chipRipper.init()
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        task_id, task = item
+        results.put(('start', wid, task_id, None))
+        try:
+            results.put(('done', wid, task_id, chipRipper.extract(task)))
+        except Exception as err:
+            results.put(('error', wid, task_id,
+                         f"{type(err).__name__}: {err}"))
+
+
+def batches(tasks):
+    """Group the chip tasks by scene, in 'batch' tasks (see
+    chipRipper.extract_batch)."""
+    scenes = {}
+    for task in tasks:
+        scenes.setdefault(task['reference'], []).append(task)
+    return [{'type': 'batch', 'reference': reference, 'tasks': scene}
+            for reference, scene in scenes.items()]
+
+
+class LocalWorkerPool:
+    """Chip worker processes on this host, started once and kept running."""
+
+    def __init__(self, workers=WORKERS, retries=chipScheduler.RETRIES,
+                 max_failures=chipScheduler.MAX_FAILURES,
+                 cooldown=chipScheduler.COOLDOWN):
+        self._ctx = multiprocessing.get_context('spawn')
+        self._tasks = [self._ctx.Queue() for wid in range(workers)]
+        self.retries = retries
+        self.registry = chipScheduler.WorkerRegistry(
+            range(workers), 1, max_failures, cooldown)
+        # Written without a feeder thread, so the results are not lost
+        # if a worker dies right after a chip.
+        self._results = self._ctx.SimpleQueue()
+        self._futures = {}
+        self._running = {}  # worker id: task id.
+        self._lock = threading.Lock()
+        self._workers = [self._start(wid) for wid in range(workers)]
+        for target in [self._collect, self._check_workers]:
+            threading.Thread(target=target, daemon=True,
+                             name='chip_workers').start()
+
+    def _start(self, wid):
+        process = self._ctx.Process(target=_worker, daemon=True, args=(
+            wid, self._tasks[wid], self._results))
+        process.start()
+        return process
+
+    def _collect(self):
+        # Hand over the results to the futures.
+        while True:
+            event, wid, task_id, value = self._results.get()
+            with self._lock:
+                if event == 'start':
+                    self._running[wid] = task_id
+                    continue
+                self._running.pop(wid, None)
+                future = self._futures.pop(task_id, None)
+            if future is None:
+                continue
+            if event == 'done':
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def _check_workers(self):
+        # Replace the dead workers, their running tasks fail.
+        while True:
+            time.sleep(1)
+            for wid, process in enumerate(self._workers):
+                if process.is_alive():
+                    continue
+                logging.debug(f"Chip worker {wid} exited, restarting")
+                with self._lock:
+                    future = self._futures.pop(
+                        self._running.pop(wid, None), None)
+                if future is not None:
+                    future.set_exception(RuntimeError(
+                        f"Chip worker {wid} exited with {process.exitcode}"))
+                self._workers[wid] = self._start(wid)
+
+    def submit(self, task, wid):
+        """Queue a chip task on a worker, returns a future with the chip
+        path."""
+        task_id = uuid.uuid4().hex
+        future = Future()
+        with self._lock:
+            self._futures[task_id] = future
+        self._tasks[wid].put((task_id, task))
+        return future
+
+    def launch(self, wid, task, timeout=TASK_TIMEOUT):
+        """Extract a chip on a worker and wait for it."""
+        try:
+            return self.submit(task, wid).result(timeout)
+        except TimeoutError:
+            # The worker hangs, it is restarted by _check_workers.
+            self._workers[wid].terminate()
+            raise
+
+    def run(self, tasks):
+        """Extract the chips of a request, returns {output: path or error}.
+        The tasks of the same scene are run as one batch by one worker, so
+        each image band is opened and read once."""
+        scenes = batches(tasks)
+        results = chipScheduler.run_tasks(self.registry, self.launch, scenes,
+                                          self.retries)
+        chip_set = {}
+        for batch, result in zip(scenes, results):
+            if isinstance(result, Exception):
+                result = f"{type(result).__name__}: {result}"
+                result = {t['output']: result for t in batch['tasks']}
+            for output, chip in result.items():
+                if chip != output:
+                    print(f"Chip {output} failed: {chip}")
+                chip_set[output] = chip
+        return chip_set
+
+    def status(self):
+        return self.registry.status()
+
+    def close(self):
+        for queue in self._tasks:
+            queue.put(None)
+        for process in self._workers:
+            process.join(5)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    """Get the chip worker pool of this server process."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            conf = config()
+            _pool = LocalWorkerPool(conf['workers'], conf['retries'],
+                                    conf['max_failures'], conf['cooldown'])
+    return _pool
+
+
+def status():
+    """Get the load and health of the chip workers."""
+    if config()['backend'] == 'ssh':
+        from scripts.chip_extract import chiptools
+        return chiptools.vm_registry().status()
+    return pool().status()
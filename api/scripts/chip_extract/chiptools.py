@@ -1,15 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
-import sys
 import socket
 import logging
-from ssh2.session import Session
 from datetime import datetime, timedelta
-from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from scripts.chip_extract import chipWorkers, chipRipper, chipScheduler
 
 
 vms = ['192.168.0.11', '192.168.0.13', '192.168.0.8', '192.168.0.15']
+VM_CAPACITY = 6  # Chips extracted in parallel on each VM.
+SSH_TIMEOUT = 300  # Seconds to wait for the ssh connections.
 USERNAME = 'eouser'
 PRIVATEKEY = 'config/master.pem'
 CHIPSDIR = f'/home/{USERNAME}/chips'
@@ -37,29 +38,44 @@ def calendarCheck(klist, start_date, end_date):
 
 
 def runjobs(chiplist, lon, lat, unique_dir, script, args):
-    chip_set = {}
-    with ProcessPoolExecutor(len(chiplist)) as executor:
-        jobs = {}
-        for i in range(len(chiplist)):
-            reference = chiplist[i]
-            vm = i % len(vms)
-            logging.debug(f"{reference} launched on {vms[vm]}")
-            logging.debug(f"{DOCKERRUN} {script} {lon} {lat} {reference} {unique_dir} {args}")
-            docker_launch = f"{DOCKERRUN} {script} {lon} {lat} {reference} {unique_dir} {args}"
-            job = executor.submit(launchjob, vms[vm], docker_launch)
-            jobs[job] = docker_launch
+    # Extract the chips on the chip worker pool, or with a docker
+    # container on the VMs for each chip with the 'ssh' backend.
+    if chipWorkers.config()['backend'] != 'ssh':
+        tasks = chipRipper.tasks(chiplist, lon, lat, unique_dir, script, args)
+        return chipWorkers.pool().run(tasks)
+
+    conf = chipWorkers.config()
+    docker_launches = []
+    for reference in chiplist:
+        docker_launch = f"{DOCKERRUN} {script} {lon} {lat} {reference} {unique_dir} {args}"
+        logging.debug(docker_launch)
+        docker_launches.append(docker_launch)
+    results = chipScheduler.run_tasks(vm_registry(), launchjob,
+                                      docker_launches, conf['retries'])
+    chip_set = dict(zip(docker_launches, results))
+    # Collect the generated chips
+    chipCollect(unique_dir, 'png' if script == 'chipRipper2.py' else 'tif')
+    return chip_set
+
+
+_vm_registry = None
+
 
-        for job in as_completed(jobs):
-            instance = jobs[job]
-            chip_set[instance] = job.result()
+def vm_registry():
+    # The load and health of the VMs, kept for all the requests.
+    global _vm_registry
+    if _vm_registry is None:
+        conf = chipWorkers.config()
+        _vm_registry = chipScheduler.WorkerRegistry(
+            vms, VM_CAPACITY, conf['max_failures'], conf['cooldown'])
+    return _vm_registry
 
 
 def launchjob(host, cmd):
+    from ssh2.session import Session
     if not os.path.isfile(PRIVATEKEY):
-        print(f"No such private key {PRIVATEKEY}")
-        sys.exit(1)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((host, 22))
+        raise FileNotFoundError(f"No such private key {PRIVATEKEY}")
+    sock = socket.create_connection((host, 22), SSH_TIMEOUT)
     s = Session()
     s.handshake(sock)
     s.userauth_publickey_fromfile(USERNAME, PRIVATEKEY, passphrase='')
@@ -69,3 +85,8 @@ def launchjob(host, cmd):
     while size > 0:
         print(data)
         size, data = chan.read()
+    chan.close()
+    chan.wait_closed()
+    status = chan.get_exit_status()
+    if status != 0:
+        raise RuntimeError(f"'{cmd}' exited with {status} on {host}")
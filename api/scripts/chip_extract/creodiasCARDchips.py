@@ -14,47 +14,41 @@
 # - Include intersection calculation
 #
 
-import logging
 import requests
-import pandas as pd
-from osgeo import ogr, osr
+
+from scripts.chip_extract import sceneIndex, chipFootprints
 
 # Define the query string for the DIAS catalog search
 
 
-def ogr_intersect(lon, lat, chipsize, footprint):
-    # footprint expected as GML
-    point = ogr.Geometry(ogr.wkbPoint)
-    point.AddPoint(lon, lat)
-    logging.debug(point)
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(4326)
-    # Do all calcs in EPSG:3857
-    target = osr.SpatialReference()
-    target.ImportFromEPSG(3857)
-
-    transform = osr.CoordinateTransformation(source, target)
-    point.Transform(transform)
-    # env = [minX, maxX, minY, maxY]
-    env = point.Buffer(chipsize // 2).GetEnvelope()
-
-    chip = ogr.Geometry(ogr.wkbLinearRing)
-    chip.AddPoint(env[0], env[2])
-    chip.AddPoint(env[0], env[3])
-    chip.AddPoint(env[1], env[3])
-    chip.AddPoint(env[1], env[2])
-    chip.AddPoint(env[0], env[2])
-
-    chipPoly = ogr.Geometry(ogr.wkbPolygon)
-    chipPoly.AddGeometry(chip)
-    imagePoly = ogr.CreateGeometryFromGML(footprint)
-    imagePoly.Transform(transform)
-    intersection = imagePoly.Intersection(chipPoly)
-    return intersection.GetArea() / chipPoly.GetArea()
-
-
-def getS2Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='LEVEL2A'):
+def overlaps(lon, lat, chipsize, references, footprints):
+    # Add the chip overlap of the footprints to the references.
+    for reference, overlap in zip(references, chipFootprints.chip_overlaps(
+            lon, lat, chipsize, footprints)):
+        reference['chipoverlap'] = float(overlap)
+    return references
+
+
+def indexed(lon, lat, chipsize, references, footprints):
+    # The index finds the scenes by bounding box, keep the ones with a
+    # footprint that overlaps the chip.
+    return [reference for reference in overlaps(
+        lon, lat, chipsize, references, footprints)
+        if reference['chipoverlap'] > 0]
+
+
+def getS2Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='LEVEL2A',
+               max_cloud=None):
     # Select all footprint that intersect with the chip centroid
+    if sceneIndex.available('Sentinel2', ptype, (lon, lat), startDate,
+                            endDate):
+        scenes = sceneIndex.index().search(
+            'Sentinel2', startDate, endDate, (lon, lat), ptype, max_cloud)
+        references = indexed(lon, lat, chipsize,
+                             [{'id': s['reference']} for s in scenes],
+                             [s['footprint'] for s in scenes])
+        if references:
+            return references
     aoi = "POINT({}+{})".format(lon, lat)
     # Query must be one continuous line, without line breaks!!
     url = """https://finder.creodias.eu/resto/api/collections/Sentinel2/search.json?maxRecords=2000&startDate={}T00:00:00Z&completionDate={}T23:59:59Z&processingLevel={}&sortParam=startDate&sortOrder=descending&status=all&geometry={}&dataset=ESA-DATASET"""
@@ -63,6 +57,7 @@ def getS2Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='LEVEL2A'):
     response = requests.get(url)
     contentType = response.headers.get('content-type').lower()
     references = []
+    footprints = []
 
     if contentType.find('json') == -1:
         print("FAIL: Server does not return JSON content for metadata, but {}.".format(contentType))
@@ -74,27 +69,31 @@ def getS2Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='LEVEL2A'):
             # productIdentifier serves as key, but we want orbitDirection
             reference['id'] = f['properties']['productIdentifier'].split(
                 '/')[-1]
-            footprint = f['properties']['gmlgeometry']
-            reference['chipoverlap'] = ogr_intersect(
-                lon, lat, chipsize, footprint)
             references.append(reference)
+            footprints.append(f['geometry'])
 
-    return references
+    return overlaps(lon, lat, chipsize, references, footprints)
 
 
 def rinseAndDryS2(references):
-    # Chips can have the same time stamp but different processor versions.
-    #   Eliminate the lowest version.
-    df = pd.DataFrame(references, columns=['id', 'chipoverlap'])
-    # S2 chips have id like: /eodata/Sentinel-2/MSI/L2A/2019/05/03/S2A_MSIL2A_20190503T104031_N0211_R008_T31TEG_20190503T112944.SAFE
-    df['tstamp'] = df.id.apply(lambda r: r.split('_')[2])
-    df['version'] = df.id.apply(lambda r: r.split('_')[3])
-    df.sort_values(by=['chipoverlap', 'version', 'tstamp'], inplace=True)
-    df.drop_duplicates(subset='tstamp', keep='last', inplace=True)
-    return list(df.id)
+    # Chips can have the same time stamp but different tiles or processor
+    #   versions. Keep the best covering tile, of the highest version.
+    return chipFootprints.best_per_acquisition(
+        references, chipFootprints.s2_acquisition, chipFootprints.s2_rank)
 
 
 def getS1Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='CARD-BS'):
+    if sceneIndex.available('Sentinel1', ptype, (lon, lat), startDate,
+                            endDate):
+        scenes = sceneIndex.index().search(
+            'Sentinel1', startDate, endDate, (lon, lat), ptype)
+        references = indexed(lon, lat, chipsize,
+                             [{'id': s['reference'],
+                               'orbitDirection': s['orbit']}
+                              for s in scenes],
+                             [s['footprint'] for s in scenes])
+        if references:
+            return references
     aoi = "POINT({}+{})".format(lon, lat)
     # Query must be one continuous line, without line breaks!!
     url = """https://finder.creodias.eu/resto/api/collections/Sentinel1/search.json?maxRecords=2000&startDate={}T00:00:00Z&completionDate={}T23:59:59Z&productType={}&sortParam=startDate&sortOrder=descending&status=all&geometry={}&dataset=ESA-DATASET"""
@@ -105,6 +104,7 @@ def getS1Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='CARD-BS'):
 
     contentType = response.headers.get('content-type').lower()
     references = []
+    footprints = []
 
     if contentType.find('json') == -1:
         print("FAIL: Server does not return JSON content for metadata, but {}.".format(contentType))
@@ -117,25 +117,16 @@ def getS1Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='CARD-BS'):
             reference['id'] = f['properties']['productIdentifier'].split(
                 '/')[-1]
             reference['orbitDirection'] = f['properties']['orbitDirection']
-            footprint = f['properties']['gmlgeometry']
-            reference['chipoverlap'] = ogr_intersect(
-                lon, lat, chipsize, footprint)
             references.append(reference)
-    return references
+            footprints.append(f['geometry'])
+    return overlaps(lon, lat, chipsize, references, footprints)
 
 
 def rinseAndDryS1(references):
     # Chips can have the same time stamp.
-    # Eliminate only if from same orbitDirection.
-    df = pd.DataFrame(references, columns=[
-                      'id', 'orbitDirection', 'chipoverlap'])
-    # S1 chips have id like: /eodata/Sentinel-1/SAR/CARD-BS/2019/03/01/S1B_IW_GRDH_1SDV_20190301T172436_20190301T172501_015164_01C5BF_40F5_CARD_BS
-    df['tstamp'] = df.id.apply(lambda r: r.split(
-        '_')[4][0:8] if r.endswith('CARD_BS') else r.split('_')[1][0:8])
-    df.sort_values(
-        by=['chipoverlap', 'orbitDirection', 'tstamp'], inplace=True)
-    df.drop_duplicates(subset='tstamp', keep='last', inplace=True)
-    return list(df.id)
+    # Keep the best covering one of each day.
+    return chipFootprints.best_per_acquisition(
+        references, chipFootprints.s1_acquisition, chipFootprints.s1_rank)
 
 
 if __name__ == "__main__":
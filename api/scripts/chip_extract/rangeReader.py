@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Windowed byte range reads of tiled GeoTIFF (COG) images in the DIAS object
+storage.
+
+Each image band is opened once by each chip worker: the header, the
+georeferencing and the tile index (offsets and sizes of the tiles) are read
+once and kept for the next chips. The chips of all the windows requested
+from a band are read in one pass, with only the byte ranges of the tiles
+that intersect the windows. Ranges that are close are merged in one request.
+
+Tiled or stripped GeoTIFFs, uncompressed or deflate compressed (with or
+without horizontal predictor) are supported. Other images (e.g. the
+Sentinel-2 JP2 files) raise Unsupported, they are read with GDAL.
+
+Usage:
+    band = open_band('/vsis3/DIAS/path/image.tif')
+    chips = band.read([window1, window2], index=1)
+where the paths are the GDAL paths of chipRipper (/vsis3/, /vsicurl/ or
+local files) and the windows are rasterio Windows.
+"""
+
+import os
+import zlib
+import struct
+import logging
+import threading
+import http.client
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.windows import Window, transform as window_transform
+
+HEADER_SIZE = 65536  # Bytes read first, the COG headers are at the start.
+MERGE_GAP = 16384  # Ranges closer than this are read in one request.
+MAX_RANGE = 8 * 1024 * 1024  # Max size of a merged range.
+OPEN_BANDS = 64  # Bands kept open by each worker.
+
+# TIFF tags.
+WIDTH, HEIGHT, BITS, COMPRESSION, SAMPLES, PLANAR = 256, 257, 258, 259, \
+    277, 284
+STRIP_OFFSETS, ROWS_PER_STRIP, STRIP_COUNTS = 273, 278, 279
+PREDICTOR, SAMPLE_FORMAT = 317, 339
+TILE_WIDTH, TILE_HEIGHT, TILE_OFFSETS, TILE_COUNTS = 322, 323, 324, 325
+PIXEL_SCALE, TIEPOINT, GEO_KEYS, NODATA = 33550, 33922, 34735, 42113
+DEFLATE = (8, 32946)
+# (size, struct format) of the TIFF field types.
+TYPES = {1: (1, 'B'), 2: (1, 's'), 3: (2, 'H'), 4: (4, 'I'), 5: (8, 'II'),
+         6: (1, 'b'), 7: (1, 'B'), 8: (2, 'h'), 9: (4, 'i'), 10: (8, 'ii'),
+         11: (4, 'f'), 12: (8, 'd'), 16: (8, 'Q'), 17: (8, 'q'), 18: (8, 'Q')}
+
+stats = {'opened': 0, 'requests': 0, 'bytes': 0, 'tiles': 0}
+
+
+class Unsupported(Exception):
+    """The image can not be read with byte ranges, use GDAL."""
+
+
+def merge_ranges(ranges, gap=MERGE_GAP, max_size=MAX_RANGE):
+    """Merge byte ranges [(start, end)] that overlap or are closer than gap.
+    Returns [(start, end, [indexes of the merged ranges])]."""
+    merged = []
+    for i in sorted(range(len(ranges)), key=lambda i: ranges[i]):
+        start, end = ranges[i]
+        if merged and start - merged[-1][1] <= gap and \
+                max(end, merged[-1][1]) - merged[-1][0] <= max_size:
+            merged[-1][1] = max(end, merged[-1][1])
+            merged[-1][2].append(i)
+        else:
+            merged.append([start, end, [i]])
+    return [tuple(m) for m in merged]
+
+
+class FileSource:
+    """Byte ranges of a local (or mounted /eodata) file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def read(self, start, end):
+        return os.pread(self._fd, end - start, start)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class HTTPSource:
+    """Byte ranges of an http(s) object, with a kept-alive connection."""
+
+    def __init__(self, url, headers=None):
+        self.url = urlsplit(url)
+        self.headers = headers or {}
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            cls = (http.client.HTTPSConnection if self.url.scheme == 'https'
+                   else http.client.HTTPConnection)
+            self._conn = cls(self.url.netloc, timeout=60)
+        return self._conn
+
+    def read(self, start, end):
+        path = self.url.path + (f"?{self.url.query}" if self.url.query
+                                else '')
+        headers = {**self.headers, 'Range': f"bytes={start}-{end - 1}"}
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self.close()  # A dropped kept-alive connection, reconnect.
+                if attempt:
+                    raise
+        if response.status == 200:  # The server ignored the range.
+            return data[start:end]
+        if response.status != 206:
+            raise IOError(f"HTTP {response.status} for {self.url.geturl()}")
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class S3Source:
+    """Byte ranges of an object of the S3 object storage."""
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def read(self, start, end):
+        from scripts.chip_extract import chipRipper
+        return chipRipper.s3_client().get_object(
+            Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={start}-{end - 1}")['Body'].read()
+
+    def close(self):
+        pass
+
+
+def source(path):
+    """Get the byte source of a GDAL path."""
+    if path.startswith('/vsis3/'):
+        bucket, key = path[len('/vsis3/'):].split('/', 1)
+        return S3Source(bucket, key)
+    if path.startswith('/vsicurl/'):
+        path = path[len('/vsicurl/'):]
+    if path.startswith(('http://', 'https://')):
+        return HTTPSource(path)
+    if path.startswith('/vsi'):
+        raise Unsupported(f"No byte ranges for {path}")
+    return FileSource(path)
+
+
+class TiffBand:
+    """The header and tile index of a tiled (or stripped) GeoTIFF, read once,
+    and the windowed reads of its bands."""
+
+    def __init__(self, path, src=None):
+        self.path = path
+        self.src = src or source(path)
+        try:
+            self._parse()
+        except Exception:
+            self.src.close()
+            raise
+
+    def _parse(self):
+        path = self.path
+        self._header = self._read(0, HEADER_SIZE)
+        order = self._header[:2]
+        if order not in (b'II', b'MM'):
+            raise Unsupported(f"{path} is not a TIFF image")
+        self._order = '<' if order == b'II' else '>'
+        version = self._unpack('H', 2)[0]
+        if version == 42:
+            self._big = False
+            ifd = self._unpack('I', 4)[0]
+        elif version == 43:
+            self._big = True
+            ifd = self._unpack('Q', 8)[0]
+        else:
+            raise Unsupported(f"{path} is not a TIFF image")
+        tags = self._ifd(ifd)
+        stats['opened'] += 1
+
+        self.width = tags[WIDTH][0]
+        self.height = tags[HEIGHT][0]
+        self.count = tags.get(SAMPLES, [1])[0]
+        self.planar = tags.get(PLANAR, [1])[0]
+        self.compression = tags.get(COMPRESSION, [1])[0]
+        self.predictor = tags.get(PREDICTOR, [1])[0]
+        if self.compression not in (1,) + DEFLATE or \
+                self.predictor not in (1, 2):
+            raise Unsupported(f"{path}: compression {self.compression}, "
+                              f"predictor {self.predictor}")
+        bits = tags.get(BITS, [8])[0]
+        kind = {1: 'u', 2: 'i', 3: 'f'}.get(tags.get(SAMPLE_FORMAT, [1])[0])
+        if kind is None or bits not in (8, 16, 32, 64):
+            raise Unsupported(f"{path}: {bits} bits samples")
+        self.dtype = np.dtype(f"{self._order}{kind}{bits // 8}")
+        if TILE_OFFSETS in tags:
+            self.block = (tags[TILE_HEIGHT][0], tags[TILE_WIDTH][0])
+            self.offsets, self.counts = tags[TILE_OFFSETS], tags[TILE_COUNTS]
+        else:
+            self.block = (min(tags.get(ROWS_PER_STRIP, [self.height])[0],
+                              self.height), self.width)
+            self.offsets, self.counts = tags[STRIP_OFFSETS], \
+                tags[STRIP_COUNTS]
+        self.blocks = (-(-self.height // self.block[0]),
+                       -(-self.width // self.block[1]))
+
+        self.nodata = None
+        if NODATA in tags:
+            try:
+                self.nodata = float(tags[NODATA].strip(b'\x00 '))
+            except ValueError:
+                pass
+        self.crs, self.transform = self._georeference(tags)
+        self.res = (abs(self.transform.a), abs(self.transform.e))
+
+    def _read(self, start, end):
+        stats['requests'] += 1
+        data = self.src.read(start, end)
+        stats['bytes'] += len(data)
+        return data
+
+    def _unpack(self, fmt, offset, data=None):
+        data = self._header if data is None else data
+        return struct.unpack_from(self._order + fmt, data, offset)
+
+    def _bytes(self, offset, size):
+        # Bytes of the header, the values after it are read on demand.
+        if offset + size <= len(self._header):
+            return self._header[offset:offset + size]
+        return self._read(offset, offset + size)
+
+    def _ifd(self, offset):
+        count_fmt, entry_size, value_size = (
+            ('Q', 20, 8) if self._big else ('H', 12, 4))
+        head = 8 if self._big else 2
+        n = self._unpack(count_fmt, 0, self._bytes(offset, head))[0]
+        entries = self._bytes(offset + head, n * entry_size)
+        tags = {}
+        for i in range(n):
+            entry = i * entry_size
+            tag, ftype = self._unpack('HH', entry, entries)
+            count = self._unpack('Q' if self._big else 'I', entry + 4,
+                                 entries)[0]
+            if ftype not in TYPES:
+                continue
+            size, fmt = TYPES[ftype]
+            total = size * count
+            value_at = entry + (12 if self._big else 8)
+            if total <= value_size:
+                data = entries[value_at:value_at + total]
+            else:
+                pointer = self._unpack('Q' if self._big else 'I', value_at,
+                                       entries)[0]
+                data = self._bytes(pointer, total)
+            if fmt == 's':
+                tags[tag] = data
+            elif len(fmt) == 2:  # Rationals.
+                values = struct.unpack(f"{self._order}{2 * count}{fmt[0]}",
+                                       data)
+                tags[tag] = [values[j] / values[j + 1] if values[j + 1] else 0
+                             for j in range(0, len(values), 2)]
+            else:
+                tags[tag] = list(struct.unpack(f"{self._order}{count}{fmt}",
+                                               data))
+        return tags
+
+    def _georeference(self, tags):
+        if PIXEL_SCALE not in tags or TIEPOINT not in tags:
+            raise Unsupported(f"{self.path} is not georeferenced")
+        sx, sy = tags[PIXEL_SCALE][:2]
+        i, j, k, x, y = tags[TIEPOINT][:5]
+        keys = tags.get(GEO_KEYS, [])
+        geokeys = {keys[n]: keys[n + 3] for n in range(4, len(keys), 4)
+                   if keys[n + 1] == 0}
+        if geokeys.get(1025) == 2:  # PixelIsPoint.
+            x, y = x - sx / 2, y + sy / 2
+        epsg = geokeys.get(3072) or geokeys.get(2048)
+        if not epsg or epsg == 32767:
+            raise Unsupported(f"{self.path} has no EPSG code")
+        return CRS.from_epsg(epsg), Affine(sx, 0, x - i * sx,
+                                           0, -sy, y + j * sy)
+
+    def window_transform(self, window):
+        return window_transform(window, self.transform)
+
+    def _decode(self, data):
+        if self.compression in DEFLATE:
+            data = zlib.decompress(data)
+        cols = self.block[1]
+        samples = 1 if self.planar == 2 else self.count
+        tile = np.frombuffer(data, self.dtype)
+        # The last strip of an image can have less rows.
+        rows = min(self.block[0], tile.size // (cols * samples))
+        tile = tile[:rows * cols * samples].reshape(rows, cols, samples)
+        if self.predictor == 2:
+            tile = np.cumsum(tile, axis=1, dtype=self.dtype)
+        return tile
+
+    def _block_index(self, row, col, index):
+        block = row * self.blocks[1] + col
+        if self.planar == 2:
+            return (index - 1) * self.blocks[0] * self.blocks[1] + block
+        return block
+
+    def read(self, windows, index=1):
+        """Read the windows of a band (1 based index) in one pass, the
+        pixels out of the image are 0. Returns the arrays of the windows."""
+        windows = [Window(*[int(v) for v in w.flatten()]) for w in windows]
+        needed = set()
+        for w in windows:
+            for row in range(max(0, w.row_off // self.block[0]),
+                             min(self.blocks[0], -(-(w.row_off + w.height) //
+                                                   self.block[0]))):
+                for col in range(max(0, w.col_off // self.block[1]),
+                                 min(self.blocks[1],
+                                     -(-(w.col_off + w.width) //
+                                       self.block[1]))):
+                    needed.add((row, col))
+        needed = sorted(needed)
+        ranges = []
+        for row, col in needed:
+            b = self._block_index(row, col, index)
+            ranges.append((self.offsets[b], self.offsets[b] + self.counts[b]))
+        tiles = {}
+        for start, end, members in merge_ranges(ranges):
+            data = self._read(start, end)
+            for m in members:
+                s, e = ranges[m]
+                if e > s:  # Empty (sparse) tiles are 0.
+                    tiles[needed[m]] = self._decode(data[s - start:e - start])
+        stats['tiles'] += len(tiles)
+
+        sample = 0 if self.planar == 2 else index - 1
+        chips = []
+        for w in windows:
+            chip = np.zeros((w.height, w.width), self.dtype.newbyteorder('='))
+            for (row, col), tile in tiles.items():
+                top, left = row * self.block[0], col * self.block[1]
+                r0, r1 = max(top, w.row_off), min(top + tile.shape[0],
+                                                  w.row_off + w.height,
+                                                  self.height)
+                c0, c1 = max(left, w.col_off), min(left + self.block[1],
+                                                   w.col_off + w.width,
+                                                   self.width)
+                if r0 >= r1 or c0 >= c1:
+                    continue
+                chip[r0 - w.row_off:r1 - w.row_off,
+                     c0 - w.col_off:c1 - w.col_off] = \
+                    tile[r0 - top:r1 - top, c0 - left:c1 - left, sample]
+            chips.append(chip)
+        return chips
+
+    def close(self):
+        self.src.close()
+
+
+_bands = OrderedDict()
+_lock = threading.Lock()
+
+
+def open_band(path):
+    """Get the open TiffBand of an image, kept open for the next chips.
+    Unsupported is raised (also on the next calls) for the images that can
+    not be read with byte ranges."""
+    with _lock:
+        if path in _bands:
+            _bands.move_to_end(path)
+            band = _bands[path]
+            if band is None:
+                raise Unsupported(f"{path} is read with GDAL")
+            return band
+    if path.lower().endswith(('.jp2', '.img')):
+        band = None
+    else:
+        try:
+            band = TiffBand(path)
+        except Unsupported as err:
+            logging.debug(err)
+            band = None
+    with _lock:
+        _bands[path] = band
+        while len(_bands) > OPEN_BANDS:
+            old = _bands.popitem(last=False)[1]
+            if old is not None:
+                old.close()
+    if band is None:
+        raise Unsupported(f"{path} is read with GDAL")
+    return band
@@ -90,7 +90,6 @@ def parallelExtract(unique_dir):
     logging.debug(
         f"Total time required for {len(chiplist)} images: {time.time() - start} seconds")
     logging.debug(f"Generated {len(chiplist)} chips")
-    chiptools.chipCollect(unique_dir)  # Collect the generate chips
     return len(chiplist)
 
 
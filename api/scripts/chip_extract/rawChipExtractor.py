@@ -69,7 +69,6 @@ def parallelExtract(lon, lat, start_date, end_date, unique_dir,
     logging.debug(f"Total time required for {len(chiplist)} images: {time.time() - start} seconds")
     logging.debug(f"Generated {len(chiplist)} chips")
     print(f"Total time required for {len(chiplist)} images: {time.time() - start} seconds")
-    chiptools.chipCollect(unique_dir)  # Collect the generate chips
     return len(chiplist)
 
 
@@ -89,7 +89,6 @@ def parallelExtract(unique_dir):
     logging.debug(
         f"Total time required for {len(chiplist)} images: {time.time() - start} seconds")
     logging.debug(f"Generated {len(chiplist)} chips")
-    chiptools.chipCollect(unique_dir)
     return len(chiplist)
 
 
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+A disk cache of the Sentinel-2 JP2 band images, transcoded to tiled Cloud
+Optimised GeoTIFFs on first access.
+
+The JPEG2000 bands are slow to decode and have no cheap windowed reads,
+every chip or extraction read decodes them again. With the cache, the first
+read of a band transcodes it to a deflate compressed COG with 512x512 tiles,
+the next reads are windowed byte range reads of the tiles (rangeReader). The
+readers get the image of a band with resolve(), the images are stored by
+object storage key, so the chip workers and the extraction scripts
+(cbm/extract/scene_cache.py, the same store) can share the cache_dir. A band
+is transcoded by one process at a time, the other processes wait for it.
+The least recently used bands are evicted when the size quota is reached.
+
+The cache is optional, configured in config/main.json, e.g.:
+    "scenes": {"cache": true, "cache_dir": "static/tmp/scenecache",
+               "cache_size_mb": 51200}
+"""
+
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+import rasterio as rio
+from rasterio.env import GDALVersion
+from rasterio.shutil import copy as rio_copy
+
+db_conf_file = 'config/main.json'
+
+CACHE_DIR = 'static/tmp/scenecache'
+CACHE_SIZE_MB = 51200
+BLOCKSIZE = 512  # Pixels of the tiles of the transcoded images.
+EXTENSIONS = ('.jp2',)  # The images that are transcoded.
+EODATA = '/eodata'
+
+
+def object_key(path):
+    """Get the object storage key of a GDAL path (/eodata/, /vsis3/)."""
+    if path.startswith(f"{EODATA}/"):
+        return path[len(EODATA) + 1:]
+    if path.startswith('/vsis3/'):
+        return path[len('/vsis3/'):].split('/', 1)[1]
+    return path.lstrip('/')
+
+
+def transcode(src_path, dst_path):
+    """Write an image as a tiled, deflate compressed (with predictor) COG,
+    without overviews."""
+    if GDALVersion.runtime().at_least('3.1'):
+        options = {'driver': 'COG', 'BLOCKSIZE': BLOCKSIZE,
+                   'COMPRESS': 'DEFLATE', 'PREDICTOR': 'YES',
+                   'OVERVIEWS': 'NONE'}
+    else:
+        options = {'driver': 'GTiff', 'TILED': 'YES',
+                   'BLOCKXSIZE': BLOCKSIZE, 'BLOCKYSIZE': BLOCKSIZE,
+                   'COMPRESS': 'DEFLATE', 'PREDICTOR': 2}
+    with rio.Env(GDAL_NUM_THREADS='ALL_CPUS'):
+        rio_copy(src_path, dst_path, BIGTIFF='IF_SAFER',
+                 NUM_THREADS='ALL_CPUS', **options)
+
+
+class SceneCache:
+    """The transcoded images, safe to use from several processes."""
+
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE_MB * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS scenes (
+                key text PRIMARY KEY, size integer, created real,
+                accessed real, seconds real)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                name text PRIMARY KEY, value integer)""")
+            conn.execute("""INSERT OR IGNORE INTO stats VALUES
+                ('hits', 0), ('misses', 0), ('evictions', 0)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS scenes_accessed
+                ON scenes (accessed)""")
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                               timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _file(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], f"{digest}.tif")
+
+    @contextmanager
+    def _lock(self, path):
+        # One transcoding of an image at a time, over all the processes.
+        with open(f"{path}.lock", 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _lookup(self, key, path):
+        with self._db() as conn:
+            hit = conn.execute(
+                "UPDATE scenes SET accessed = ? WHERE key = ?",
+                (time.time(), key)).rowcount == 1
+            if hit and not os.path.isfile(path):
+                conn.execute("DELETE FROM scenes WHERE key = ?", (key,))
+                hit = False
+        return hit
+
+    def _count(self, name):
+        with self._db() as conn:
+            conn.execute("UPDATE stats SET value = value + 1 WHERE name = ?",
+                         (name,))
+
+    def get(self, key, source):
+        """Get the path of the transcoded image of a key. If it is not in
+        the cache, it is transcoded from source, the GDAL path of the image
+        or a function that downloads it, fetch(local_path), and returns
+        False if it is not found (FileNotFoundError is raised)."""
+        path = self._file(key)
+        hit = self._lookup(key, path)
+        if not hit:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self._lock(path):
+                # Transcoded by an other process in the meantime?
+                hit = self._lookup(key, path)
+                if not hit:
+                    self._transcode(key, path, source)
+        self._count('hits' if hit else 'misses')
+        if not hit:
+            self.evict(keep=key)
+        return path
+
+    def _transcode(self, key, path, source):
+        start = time.time()
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        download = None
+        try:
+            if callable(source):
+                download = f"{tmp}{os.path.splitext(key)[1]}"
+                if not source(download):
+                    raise FileNotFoundError(f"{key} not found")
+                source = download
+            transcode(source, tmp)
+            os.replace(tmp, path)
+        finally:
+            for f in [tmp, download]:
+                if f is not None and os.path.exists(f):
+                    os.remove(f)
+        seconds = time.time() - start
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?)",
+                (key, os.path.getsize(path), start, start, seconds))
+        logging.debug(f"Scene band {key} transcoded in {seconds} seconds")
+
+    def evict(self, keep=None):
+        """Remove the least recently used images above the size quota,
+        except the keep key."""
+        keys = []
+        with self._db() as conn:
+            total = conn.execute(
+                "SELECT coalesce(sum(size), 0) FROM scenes").fetchone()[0]
+            if total > self.max_size:
+                for k, size in conn.execute(
+                        "SELECT key, size FROM scenes ORDER BY accessed"):
+                    if total <= self.max_size:
+                        break
+                    if k != keep:
+                        keys.append(k)
+                        total -= size
+        for k in keys:
+            self.remove(k)
+        return len(keys)
+
+    def remove(self, key):
+        # The readers that have the image open keep reading it.
+        with self._db() as conn:
+            conn.execute("DELETE FROM scenes WHERE key = ?", (key,))
+            conn.execute("""UPDATE stats SET value = value + 1
+                WHERE name = 'evictions'""")
+        try:
+            os.remove(self._file(key))  # The (empty) lock file is kept.
+        except OSError:
+            pass
+        logging.debug(f"Scene band {key} evicted")
+
+    def stats(self):
+        """Get the hit/miss counts, the number and size of the images and
+        the mean transcoding time."""
+        with self._db() as conn:
+            stats = dict(conn.execute("SELECT name, value FROM stats"))
+            stats['scenes'], stats['size'], stats['transcode_seconds'] = \
+                conn.execute("""SELECT count(*), coalesce(sum(size), 0),
+                    avg(seconds) FROM scenes""").fetchone()
+        requests = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / requests if requests else None
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def cache(create=True):
+    """Get the scene cache of this process, None if it is not configured.
+    With create=False a cache that does not exist yet is not created, None
+    is returned."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            try:
+                with open(db_conf_file) as f:
+                    conf = json.load(f).get('scenes', {})
+            except Exception:
+                conf = {}
+            path = conf.get('cache_dir', CACHE_DIR)
+            if conf.get('cache') and not create and not os.path.isfile(
+                    os.path.join(path, 'index.sqlite')):
+                return None
+            _cache = False
+            if conf.get('cache'):
+                _cache = SceneCache(
+                    path,
+                    int(float(conf.get('cache_size_mb', CACHE_SIZE_MB)) *
+                        1024 * 1024))
+    return _cache or None
+
+
+def resolve(path, fetch=None, default=None):
+    """Get the path to read an image of the object storage. path is the
+    GDAL path or the object storage key of the image. The readers that copy
+    the images to the local disk give fetch(local_path), that downloads the
+    image and returns False if it is not found, and the default local path.
+    The JP2 images are read from the scene cache if it is configured.
+    Returns the path to read, or None if the image is not found."""
+    scenes = cache()
+    if scenes is not None and path.lower().endswith(EXTENSIONS):
+        try:
+            return scenes.get(object_key(path), fetch or path)
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            print(f"Could not transcode {path}, it is read as is: {err}")
+    if fetch is None:
+        return path
+    return default if fetch(default) else None
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+A local, spatially indexed catalogue of the Sentinel scenes, to find the
+scenes of the chips without the remote finder.
+
+SQLite mirror with an RTree index of the scene footprints, filled from the
+dias_catalogue table of a dataset (as populated by cbm/card2db) or from the
+CREODIAS finder. Searches by bbox, date range, processing level and cloud
+cover. The extent and date range of each sync are recorded (coverage), the
+index is only used for the requests that a sync covers.
+
+Usage (from the api folder):
+    python -m scripts.chip_extract.sceneIndex catalogue <aoi>_<year>
+    python -m scripts.chip_extract.sceneIndex finder <Sentinel2|Sentinel1>
+        <LEVEL2A|CARD-BS|CARD-COH6> <minx,miny,maxx,maxy> <start> <end>
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+db_conf_file = 'config/main.json'
+
+INDEX_FILE = 'static/tmp/scenes.sqlite'
+FINDER = "https://finder.creodias.eu/resto/api/collections/{}/search.json"
+FINDER_PAGE = 2000
+
+# The CARD types of the dias_catalogue table.
+CARDS = {'s2': ('Sentinel2', 'LEVEL2A'), 'bs': ('Sentinel1', 'CARD-BS'),
+         'c6': ('Sentinel1', 'CARD-COH6')}
+
+COLUMNS = ['reference', 'collection', 'ptype', 'obstime', 'cloud', 'orbit',
+           'footprint']
+
+
+def wkt_bounds(wkt):
+    """Get the (minx, miny, maxx, maxy) of a WKT (Multi)Polygon."""
+    text = wkt[wkt.index('('):].replace('(', ' ').replace(')', ' ')
+    coords = [c.split() for c in text.split(',') if c.strip()]
+    xs = [float(c[0]) for c in coords]
+    ys = [float(c[1]) for c in coords]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def geojson_wkt(geometry):
+    """Get the WKT of a GeoJSON (Multi)Polygon."""
+    def ring(r):
+        return f"({', '.join([f'{x} {y}' for x, y, *z in r])})"
+
+    def polygon(p):
+        return f"({', '.join([ring(r) for r in p])})"
+    if geometry['type'] == 'MultiPolygon':
+        return "MULTIPOLYGON(" + ', '.join(
+            [polygon(p) for p in geometry['coordinates']]) + ")"
+    return f"POLYGON{polygon(geometry['coordinates'])}"
+
+
+def orbit_direction(obstime):
+    # Not stored in the dias_catalogue, the UTC time stamps in the (local)
+    # morning are for descending orbits, in the evening for ascending orbits.
+    return 'DESCENDING' if int(str(obstime)[11:13]) < 12 else 'ASCENDING'
+
+
+class SceneIndex:
+    """The scene catalogue, safe to use from several processes."""
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS scenes (
+                id integer PRIMARY KEY, reference text UNIQUE,
+                collection text, ptype text, obstime text, cloud real,
+                orbit text, footprint text)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS scenes_obstime
+                ON scenes (collection, ptype, obstime)""")
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS scenes_rtree
+                USING rtree(id, minx, maxx, miny, maxy)""")
+            # The extent and date range of the syncs.
+            conn.execute("""CREATE TABLE IF NOT EXISTS coverage (
+                collection text, ptype text, minx real, miny real,
+                maxx real, maxy real, start_date text, end_date text,
+                source text, synced real)""")
+
+    @contextmanager
+    def _db(self):
+        # A connection for each thread, kept open for the next lookups.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+        with conn:
+            yield conn
+
+    def add(self, scenes):
+        """Add or update scenes, dicts with the COLUMNS keys (the
+        footprint as WKT in EPSG:4326). Returns the number of scenes."""
+        n = 0
+        with self._db() as conn:
+            for s in scenes:
+                row = [s.get(c) for c in COLUMNS]
+                row[3] = str(row[3])[:19].replace('T', ' ')
+                conn.execute(f"""INSERT INTO scenes ({', '.join(COLUMNS)})
+                    VALUES ({', '.join(['?'] * len(COLUMNS))})
+                    ON CONFLICT (reference) DO UPDATE SET
+                    {', '.join([f'{c} = excluded.{c}' for c in COLUMNS])}
+                    """, row)
+                sid = conn.execute("SELECT id FROM scenes WHERE reference = ?",
+                                   (s['reference'],)).fetchone()[0]
+                minx, miny, maxx, maxy = wkt_bounds(s['footprint'])
+                conn.execute("""INSERT OR REPLACE INTO scenes_rtree
+                    VALUES (?, ?, ?, ?, ?)""", (sid, minx, maxx, miny, maxy))
+                n += 1
+        return n
+
+    def search(self, collection, start_date, end_date, bbox=None,
+               ptype=None, max_cloud=None):
+        """Get the scenes that intersect the bbox (minx, miny, maxx, maxy),
+        or a point (lon, lat), within the dates (YYYY-mm-dd, inclusive).
+        The latest scenes first."""
+        sql = f"""SELECT {', '.join([f's.{c}' for c in COLUMNS])}
+            FROM scenes s"""
+        params = []
+        if bbox is not None:
+            if len(bbox) == 2:
+                bbox = (bbox[0], bbox[1], bbox[0], bbox[1])
+            # The RTree first, the planner would scan it for each scene
+            # in the date range.
+            sql = sql.replace("FROM scenes s",
+                              "FROM scenes_rtree r CROSS JOIN scenes s")
+            sql += """ ON r.id = s.id
+                AND r.minx <= ? AND r.maxx >= ?
+                AND r.miny <= ? AND r.maxy >= ?"""
+            params += [bbox[2], bbox[0], bbox[3], bbox[1]]
+        sql += """ WHERE s.collection = ? AND s.obstime >= ?
+            AND s.obstime <= ?"""
+        params += [collection, str(start_date)[:10],
+                   f"{str(end_date)[:10]} 23:59:59"]
+        if ptype is not None:
+            sql += " AND s.ptype = ?"
+            params.append(ptype)
+        if max_cloud is not None:
+            sql += " AND (s.cloud IS NULL OR s.cloud <= ?)"
+            params.append(float(max_cloud))
+        sql += " ORDER BY s.obstime DESC"
+        with self._db() as conn:
+            return [dict(zip(COLUMNS, r)) for r in conn.execute(sql, params)]
+
+    def count(self):
+        with self._db() as conn:
+            return conn.execute("SELECT count(*) FROM scenes").fetchone()[0]
+
+    def add_coverage(self, collection, ptype, bbox, start_date, end_date,
+                     source):
+        """Record that all the scenes of the bbox (minx, miny, maxx, maxy)
+        and dates (YYYY-mm-dd, inclusive) were added."""
+        with self._db() as conn:
+            conn.execute("""INSERT INTO coverage
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         (collection, ptype, *[float(v) for v in bbox],
+                          str(start_date)[:10], str(end_date)[:10], source,
+                          time.time()))
+
+    def covers(self, collection, ptype, bbox, start_date, end_date):
+        """Check if a sync covers the bbox, or the point (lon, lat), and
+        the dates of a search."""
+        if len(bbox) == 2:
+            bbox = (bbox[0], bbox[1], bbox[0], bbox[1])
+        with self._db() as conn:
+            return conn.execute("""SELECT count(*) FROM coverage
+                WHERE collection = ? AND ptype = ?
+                AND minx <= ? AND miny <= ? AND maxx >= ? AND maxy >= ?
+                AND start_date <= ? AND end_date >= ?""",
+                (collection, ptype, *[float(v) for v in bbox],
+                 str(start_date)[:10], str(end_date)[:10])).fetchone()[0] > 0
+
+
+def sync_catalogue(dataset):
+    """Add the scenes of the dias_catalogue table of a dataset. The extent
+    of the parcels of the dataset and its dates (or the dates of the scenes)
+    are the coverage of each CARD type, the scene footprints can cover more
+    than the area that was extracted."""
+    from scripts import db
+    parcels = dataset['tables']['parcels']
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT reference, obstime, card, ST_AsText(footprint)
+            FROM {dataset['tables']['dias_catalog']}
+            WHERE footprint IS NOT NULL;""")
+        rows = cur.fetchall()
+        cur.execute(f"""
+            SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+            FROM (SELECT ST_Transform(ST_SetSRID(
+                ST_Extent(wkb_geometry)::geometry,
+                Find_SRID('', %s, 'wkb_geometry')), 4326)::box2d As e
+                FROM {parcels}) As extent;""", (parcels,))
+        extent = cur.fetchone()
+    scenes = []
+    for reference, obstime, card, footprint in rows:
+        collection, ptype = CARDS.get(card.strip(), CARDS['s2'])
+        scenes.append({'reference': reference, 'collection': collection,
+                       'ptype': ptype, 'obstime': obstime,
+                       'orbit': orbit_direction(obstime),
+                       'footprint': footprint})
+    n = index().add(scenes)
+    if extent is None or None in extent:
+        return n
+    for collection, ptype in set([(s['collection'], s['ptype'])
+                                  for s in scenes]):
+        obstimes = [str(s['obstime']) for s in scenes
+                    if (s['collection'], s['ptype']) == (collection, ptype)]
+        index().add_coverage(
+            collection, ptype, extent,
+            dataset.get('start_date') or min(obstimes),
+            dataset.get('end_date') or max(obstimes),
+            f"catalogue {dataset['tables']['dias_catalog']}")
+    return n
+
+
+def sync_finder(collection, ptype, bbox, start_date, end_date):
+    """Add the scenes of the CREODIAS finder, for the bbox and dates."""
+    import requests
+    minx, miny, maxx, maxy = bbox
+    aoi = (f"POLYGON(({minx} {miny},{maxx} {miny},{maxx} {maxy},"
+           f"{minx} {maxy},{minx} {miny}))")
+    level = 'processingLevel' if collection == 'Sentinel2' else 'productType'
+    n, page = 0, 1
+    while True:
+        response = requests.get(FINDER.format(collection), params={
+            'maxRecords': FINDER_PAGE, 'page': page, level: ptype,
+            'startDate': f"{start_date}T00:00:00Z",
+            'completionDate': f"{end_date}T23:59:59Z",
+            'status': 'all', 'geometry': aoi, 'dataset': 'ESA-DATASET'})
+        features = response.json().get('features', [])
+        scenes = []
+        for f in features:
+            p = f['properties']
+            scenes.append({
+                'reference': p['productIdentifier'].split('/')[-1],
+                'collection': collection, 'ptype': ptype,
+                'obstime': p['startDate'], 'cloud': p.get('cloudCover'),
+                'orbit': p.get('orbitDirection'),
+                'footprint': geojson_wkt(f['geometry'])})
+        n += index().add(scenes)
+        if len(features) < FINDER_PAGE:
+            index().add_coverage(collection, ptype, bbox, start_date,
+                                 end_date, 'finder')
+            return n
+        page += 1
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def index_file():
+    try:
+        with open(db_conf_file) as f:
+            conf = json.load(f).get('chips', {})
+    except Exception:
+        conf = {}
+    return conf.get('scene_index', INDEX_FILE)
+
+
+def index():
+    """Get the scene index of this process."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SceneIndex(index_file())
+    return _index
+
+
+def available(collection=None, ptype=None, bbox=None, start_date=None,
+              end_date=None):
+    """Check if the scene index exists and has scenes, and if given, that
+    a sync covers the bbox (or point) and dates of a search."""
+    if _index is None and not os.path.isfile(index_file()):
+        return False
+    try:
+        if bbox is not None:
+            return index().covers(collection, ptype, bbox, start_date,
+                                  end_date)
+        return index().count() > 0
+    except sqlite3.Error as err:
+        logging.debug(f"Scene index not available: {err}")
+        return False
+
+
+if __name__ == "__main__":
+    import sys
+    start = datetime.now()
+    if sys.argv[1] == 'catalogue':
+        from scripts import db_queries
+        print(sync_catalogue(db_queries.get_datasets()[sys.argv[2]]),
+              "scenes added from the dias_catalogue")
+    else:
+        bbox = [float(v) for v in sys.argv[4].split(',')]
+        print(sync_finder(sys.argv[2], sys.argv[3], bbox, sys.argv[5],
+                          sys.argv[6]), "scenes added from the finder")
+    print(f"In {datetime.now() - start}")
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Background jobs for the chip extraction queries.
+
+A job runs one chip query (e.g. rawChipByLocation) on an executor and
+writes the usual result file (chipslist.json or chipsview.html) to the
+unique_dir of the query, rawChipStack writes the stack of the chips of all
+the dates and bands (see chipStack). The parcelsCube export (see
+parcel_cube) runs as a job too, its result is the cube.zip of the
+signatures. The state of the jobs is kept as json files in JOBS_DIR, so it
+can be read by all the server processes. Identical requests (the same query
+and parameters) share the job that is already queued or running, the other
+users get their own job id that follows it. The jobs of a unique_dir (the
+chips are shared by the requests with e.g. other dates) run one at a time,
+each job keeps its own copy of the result file.
+
+The executor is configured in config/main.json, e.g.:
+    "jobs": {"executor": "thread", "workers": 4, "queue_size": 32}
+"""
+
+import os
+import json
+import glob
+import time
+import uuid
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from scripts import metrics, streaming
+
+db_conf_file = 'config/main.json'
+
+JOBS_DIR = 'static/tmp/jobs'
+EXECUTOR = 'thread'  # 'thread' or 'process'.
+WORKERS = 4
+QUEUE_SIZE = 32  # Max queued and running jobs for each server process.
+JOB_TIMEOUT = 3600  # Seconds after which an unfinished job is abandoned.
+JOB_TTL = 86400  # Seconds to keep the state of the finished jobs.
+
+# The chip queries that can run as jobs, with the required parameters, the
+# default values of the optional parameters, the unique_dir and the
+# result file of each query.
+QUERIES = {
+    'chipsByLocation': {
+        'required': ['lon', 'lat', 'start_date', 'end_date'],
+        'optional': {'lut': '5_95', 'bands': 'B08_B04_B03',
+                     'plevel': 'LEVEL2A'},
+        'unique_dir': 'static/tmp/E{lon}N{lat}L{lut}_{plevel}_{bands}',
+        'result': 'chipsview.html'},
+    'rawChipByLocation': {
+        'required': ['lon', 'lat', 'start_date', 'end_date'],
+        'optional': {'band': None, 'plevel': 'LEVEL2A', 'chipsize': '1280'},
+        'unique_dir': 'static/tmp/E{lon}N{lat}_{plevel}_{chipsize}_{band}',
+        'result': 'chipslist.json'},
+    'rawChipsBatch': {
+        'required': ['lon', 'lat', 'tiles', 'bands', 'chipsize'],
+        'optional': {},
+        'unique_dir': 'static/tmp/{lon}_{lat}_{chipsize}_RAW',
+        'result': 'chipslist.json'},
+    'rawS1ChipsBatch': {
+        'required': ['lon', 'lat', 'dates', 'chipsize', 'plevel'],
+        'optional': {},
+        'unique_dir': 'static/tmp/{lon}_{lat}_{chipsize}_{plevel}_RAW',
+        'result': 'chipslist.json'},
+    'rawChipStack': {
+        'required': ['lon', 'lat', 'start_date', 'end_date'],
+        'optional': {'bands': 'B08_B04_B03', 'plevel': 'LEVEL2A',
+                     'chipsize': '1280', 'format': 'tif'},
+        'unique_dir': ('static/tmp/E{lon}N{lat}_{plevel}_{chipsize}_'
+                       '{bands}_STACK'),
+        'result': 'chipstack_{start_date}_{end_date}.{format}'},
+    'parcelsCube': {
+        'required': ['aoi', 'year', 'start_date', 'end_date'],
+        'optional': {'pids': None, 'polygon': None, 'ptype': '',
+                     'tstype': 's2', 'format': 'zarr'},
+        'unique_dir': 'static/tmp/cube_{aoi}{year}_{tstype}_{hash}',
+        'result': 'cube.zip'}
+}
+FINISHED = ['done', 'failed']
+
+
+class JobQueueFull(Exception):
+    """There are too many queued and running jobs."""
+
+
+_executor = None
+_futures = {}  # job id: future, of the jobs submitted by this process.
+_lock = threading.Lock()
+
+
+def config():
+    try:
+        with open(db_conf_file) as f:
+            conf = json.load(f).get('jobs', {})
+    except Exception:
+        conf = {}
+    return {'executor': conf.get('executor', EXECUTOR),
+            'workers': int(conf.get('workers', WORKERS)),
+            'queue_size': int(conf.get('queue_size', QUEUE_SIZE))}
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        conf = config()
+        if conf['executor'] == 'process':
+            _executor = ProcessPoolExecutor(conf['workers'])
+        else:
+            _executor = ThreadPoolExecutor(conf['workers'],
+                                           thread_name_prefix='chip_job')
+    return _executor
+
+
+def check_params(query, params):
+    """Get the parameters of the query with the default values,
+    or an error message if the parameters are not valid."""
+    if query not in QUERIES:
+        return None, f"{query} is not a chip query"
+    spec = QUERIES[query]
+    for k in params.keys():
+        if k not in spec['required'] and k not in spec['optional']:
+            return None, f"{k} not allowed as key"
+    missing = [k for k in spec['required'] if k not in params.keys()]
+    if missing:
+        return None, f"Missing required parameters: {', '.join(missing)}"
+    return {**spec['optional'], **params}, None
+
+
+def unique_dir(query, params):
+    # The hash of all the parameters, for the queries with long parameters.
+    return QUERIES[query]['unique_dir'].format(
+        **params, hash=streaming.params_hash(params)).replace('.', '_')
+
+
+def _job_file(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def job_key(query, params):
+    """Get the key of the identical requests, the hash of the query and all
+    its parameters."""
+    return streaming.params_hash({'query': query, 'params': params})
+
+
+def _marker(key):
+    # Holds the id of the job that is working on the request key.
+    return os.path.join(JOBS_DIR, f"{key}.active")
+
+
+def _dir_lock(udir):
+    return os.path.join(JOBS_DIR, f"{os.path.basename(udir)}.lock")
+
+
+def _write(job):
+    tmp = f"{_job_file(job['id'])}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp, _job_file(job['id']))
+
+
+def get(job_id):
+    """Get the state of a job, None if there is no such job."""
+    if not all(c in '0123456789abcdef' for c in str(job_id)):
+        return None
+    try:
+        with open(_job_file(job_id)) as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if job.get('runner') and job['status'] not in FINISHED:
+        # The job of an other user that runs the same request.
+        runner = get(job['runner'])
+        if runner is None:
+            runner = {'status': 'failed', 'error': "The job was lost"}
+        for k in ['status', 'started', 'finished', 'result', 'error',
+                  'progress']:
+            job[k] = runner.get(k)
+        return job
+    if job['status'] not in FINISHED:
+        job['progress'] = {'chips': len(
+            glob.glob(f"{job['unique_dir']}/*.tif") +
+            glob.glob(f"{job['unique_dir']}/*.png"))}
+    return job
+
+
+def jobs(user):
+    """Get the jobs of a user, the latest first."""
+    jlist = []
+    for f in glob.glob(os.path.join(JOBS_DIR, '*.json')):
+        job = get(os.path.basename(f)[:-5])
+        if job and job['user'] == user:
+            jlist.append(job)
+    return sorted(jlist, key=lambda j: j['submitted'], reverse=True)
+
+
+def _active(key):
+    # Get the job working on the request key, if any.
+    try:
+        with open(_marker(key)) as f:
+            job = get(f.read().strip())
+    except OSError:
+        return None
+    if job is None or job['status'] in FINISHED or (
+            time.time() - job['submitted'] > JOB_TIMEOUT):
+        return None
+    return job
+
+
+def _purge():
+    # Remove the state of the old finished jobs.
+    for f in glob.glob(os.path.join(JOBS_DIR, '*.json')):
+        try:
+            if time.time() - os.path.getmtime(f) > JOB_TTL:
+                os.remove(f)
+        except OSError:
+            pass
+
+
+def submit(query, params, user='None'):
+    """Submit a chip query, the parameters must be checked with
+    check_params(). Returns the new job, the job of the user that is
+    already working on the same request, or a new job of the user that
+    follows the job of an other user.
+    """
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    udir = unique_dir(query, params)
+    key = job_key(query, params)
+    with _lock:
+        active = _active(key)
+        if active is not None:
+            if active['user'] == user:
+                return active
+            job = {'id': uuid.uuid4().hex, 'query': query, 'user': user,
+                   'unique_dir': udir, 'params': params, 'key': key,
+                   'runner': active['id'], 'status': 'queued',
+                   'submitted': time.time(), 'started': None,
+                   'finished': None, 'result': None, 'error': None}
+            _write(job)
+            return job
+        running = [j for j, f in _futures.items() if not f.done()]
+        if len(running) >= config()['queue_size']:
+            raise JobQueueFull(
+                f"{len(running)} chip jobs in the queue, try again later")
+        for j in [j for j, f in _futures.items() if f.done()]:
+            del _futures[j]
+        _purge()
+        job = {'id': uuid.uuid4().hex, 'query': query, 'user': user,
+               'unique_dir': udir, 'params': params, 'key': key,
+               'status': 'queued', 'submitted': time.time(),
+               'started': None, 'finished': None, 'result': None,
+               'error': None}
+        _write(job)
+        with open(f"{_marker(key)}.{os.getpid()}.tmp", 'w') as f:
+            f.write(job['id'])
+        os.replace(f"{_marker(key)}.{os.getpid()}.tmp", _marker(key))
+        _futures[job['id']] = executor().submit(run, job)
+    return job
+
+
+def wait(job, timeout=None):
+    """Wait for a job to finish and get its final state."""
+    future = _futures.get(job.get('runner') or job['id'])
+    if future is not None:
+        try:
+            future.result(timeout)
+        except Exception as err:
+            print("Chip job error: ", err)
+    else:
+        start = time.time()
+        while timeout is None or time.time() - start < timeout:
+            job = get(job['id'])
+            if job is None or job['status'] in FINISHED:
+                break
+            time.sleep(1)
+    return get(job['id'])
+
+
+@contextmanager
+def _locked(udir):
+    # One job at a time in a unique_dir, over all the processes.
+    with open(_dir_lock(udir), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run(job):
+    """Run a chip query job, this is done by the executor."""
+    with _locked(job['unique_dir']):
+        return _run(job)
+
+
+def _run(job):
+    job.update({'status': 'running', 'started': time.time()})
+    _write(job)
+    query, udir, p = job['query'], job['unique_dir'], job['params']
+    data = -1
+    try:
+        from scripts.chip_extract import (rawChipExtractor, chipS2Extractor,
+                                          rawChipBatchExtract,
+                                          rawS1ChipBatchExtract)
+        if query == 'chipsByLocation':
+            data = chipS2Extractor.parallelExtract(
+                p['lon'], p['lat'], p['start_date'], p['end_date'], udir,
+                p['lut'], p['bands'], p['plevel'])
+            chipS2Extractor.buildHTML(udir, p['start_date'], p['end_date'])
+        elif query == 'rawChipByLocation':
+            data = rawChipExtractor.parallelExtract(
+                p['lon'], p['lat'], p['start_date'], p['end_date'], udir,
+                p['band'], p['chipsize'], p['plevel'])
+            rawChipExtractor.buildJSON(udir, p['start_date'], p['end_date'])
+        elif query == 'rawChipStack':
+            from scripts.chip_extract import chipStack
+            data = chipStack.parallelExtract(
+                p['lon'], p['lat'], p['start_date'], p['end_date'], udir,
+                p['bands'].split('_'), p['chipsize'], p['plevel'])
+            if data >= 0 and chipStack.buildStack(
+                    udir, p['start_date'], p['end_date'],
+                    p['bands'].split('_'), p['format']) is None:
+                raise ValueError("No chips found for the request")
+        elif query == 'parcelsCube':
+            from scripts import registry, parcel_cube
+            dataset = registry.datasets()[f"{p['aoi']}_{p['year']}"]
+            data = parcel_cube.export(dataset, udir, p)
+        else:
+            os.makedirs(udir, exist_ok=True)
+            with open(f"{udir}/params.json", "w") as f:
+                f.write(json.dumps(p))
+            if query == 'rawChipsBatch':
+                data = rawChipBatchExtract.parallelExtract(udir)
+                rawChipBatchExtract.buildJSON(udir)
+            else:
+                data = rawS1ChipBatchExtract.parallelExtract(udir)
+                rawS1ChipBatchExtract.buildJSON(udir)
+        if data >= 0:
+            # The next jobs of the unique_dir write the result file again.
+            result = f"{udir}/{QUERIES[query]['result'].format(**p)}"
+            root, ext = os.path.splitext(result)
+            shutil.copyfile(result, f"{root}_{job['key']}{ext}")
+            job.update({'status': 'done',
+                        'result': f"{root}_{job['key']}{ext}"})
+        else:
+            job.update({'status': 'failed', 'error':
+                        "Request results in too many chips, please revise selection"})
+    except Exception as err:
+        print("Chip job error: ", err)
+        job.update({'status': 'failed', 'error': str(err)})
+    finally:
+        job['finished'] = time.time()
+        duration = job['finished'] - job['started']
+        metrics.CHIP_JOBS.observe(duration, query, job['status'])
+        _write(job)
+        try:
+            os.remove(_marker(job['key']))
+        except OSError:
+            pass
+    return data
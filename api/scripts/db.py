@@ -14,6 +14,16 @@ Functions:
       - Create a new database session and return a new connection object.
   connection_cursor(db='main'):
       - Create a cursor to execute PostgreSQL command in a database session.
+  pooled(db='main')
+      - Borrow a connection from the database connection pool.
+  Connection
+      - Pooled connection that keeps its prepared statements (db_sql.py).
+  TimedConnection
+      - Pooled connection with the query time in the metrics (metrics.py).
+  pool_metrics()
+      - Get the usage and saturation metrics of the connection pools.
+  statement_timeout(seconds)
+      - Context with a statement timeout for the pooled connections.
   information(db='main')
       - Get database connection information.
   get_version(dict_keys, var_name=None)
@@ -25,27 +35,48 @@ Options:
 """
 
 import json
+import time
+import threading
 import psycopg2
+import psycopg2.extensions
 import pandas as pd
+from psycopg2 import pool as pg_pool
+from contextlib import contextmanager
+from scripts import metrics
 # from cbm.utils import config
 
 db_conf_file = 'config/main.json'
 
+# Connection pool defaults, can be overridden per database with a "pool"
+# entry in config/main.json, e.g.: "pool": {"min": 1, "max": 10}
+POOL_MIN = 1
+POOL_MAX = 10
+POOL_TIMEOUT = 30  # Seconds to wait for a free connection.
+POOL_CHECK_IDLE = 30  # Ping connections that were idle for more seconds.
+POOL_PREPARE = True  # Prepare the frequent statements, "prepare": false for
+# servers behind a transaction pooler (e.g. pgbouncer).
 
-def conn_str(db='main'):
-    """Get the database connection string to connect to the database.
-    The database credentials is needed for this (database server address,
-    port, databese name, username and password)."""
+
+def db_config(db='main'):
+    """Get the configuration of the given database from main.json."""
     try:
         with open(db_conf_file) as json_file:
             configs = json.load(json_file)
     except Exception:
-        configs = create_db_config(db_conf_file)
-    DB_HOST = configs['db'][db]['host']
-    DB_NAME = configs['db'][db]['name']
-    DB_USER = configs['db'][db]['user']
-    DB_PORT = configs['db'][db]['port']
-    DB_PASS = configs['db'][db]['pass']
+        configs = create_db_config()
+    return configs['db'][db]
+
+
+def conn_str(db='main'):
+    """Get the database connection string to connect to the database.
+    The database credentials is needed for this (database server address,
+    port, databese name, username and password)."""
+    dbconf = db_config(db)
+    DB_HOST = dbconf['host']
+    DB_NAME = dbconf['name']
+    DB_USER = dbconf['user']
+    DB_PORT = dbconf['port']
+    DB_PASS = dbconf['pass']
     postgres = ("host={} dbname={} user={} port={} password={}"
                 .format(DB_HOST, DB_NAME, DB_USER, DB_PORT, DB_PASS))
     return postgres
@@ -61,6 +92,247 @@ def conn(db='main'):
         return ''
 
 
+_timed_cursors = {}
+
+
+def timed_cursor(factory):
+    """Get the subclass of a cursor class that adds the time of its
+    queries and fetches to the 'db' metrics (metrics.py)."""
+    try:
+        return _timed_cursors[factory]
+    except KeyError:
+        pass
+
+    def timed(method, query=False):
+        def call(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.add('db', time.perf_counter() - start)
+                if query:
+                    metrics.QUERIES.inc()
+        return call
+
+    cls = type(f"Timed{factory.__name__}", (factory,), {
+        'execute': timed(factory.execute, True),
+        'executemany': timed(factory.executemany, True),
+        'callproc': timed(factory.callproc, True),
+        'fetchone': timed(factory.fetchone),
+        'fetchmany': timed(factory.fetchmany),
+        'fetchall': timed(factory.fetchall)})
+    _timed_cursors[factory] = cls
+    return cls
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    """A connection whose cursors are timed (see timed_cursor), also the
+    cursors with a cursor_factory."""
+
+    def cursor(self, *args, **kwargs):
+        factory = (kwargs.get('cursor_factory') or self.cursor_factory or
+                   psycopg2.extensions.cursor)
+        kwargs['cursor_factory'] = timed_cursor(factory)
+        return super().cursor(*args, **kwargs)
+
+
+class Connection(TimedConnection):
+    """A connection with the names and parameters of the statements that
+    are prepared in its session (see db_sql.execute)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+class ConnectionPool:
+    """A thread safe pool of connections to one database of main.json.
+
+    Connections are checked for health when borrowed and are always rolled
+    back before they are returned, so no session is left idle in
+    transaction. Callers waiting for a free connection are blocked for up
+    to 'timeout' seconds, after that a psycopg2.pool.PoolError is raised.
+    """
+
+    def __init__(self, db='main', minconn=POOL_MIN, maxconn=POOL_MAX,
+                 timeout=POOL_TIMEOUT, prepare=POOL_PREPARE):
+        self.db = db
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = pg_pool.ThreadedConnectionPool(
+            minconn, maxconn, conn_str(db),
+            connection_factory=Connection if prepare else TimedConnection)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.stats = {'checkouts': 0, 'in_use': 0, 'peak_in_use': 0,
+                      'waits': 0, 'wait_time': 0.0, 'timeouts': 0,
+                      'discarded': 0}
+
+    def _healthy(self, conn):
+        """Check that a pooled connection is still usable."""
+        if conn.closed:
+            return False
+        idle = time.time() - self._last_used.get(id(conn), 0)
+        if idle < POOL_CHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Borrow a connection, waiting if the pool is saturated."""
+        start = time.time()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.stats['waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.stats['timeouts'] += 1
+                raise pg_pool.PoolError(
+                    f"No free connection to the '{self.db}' database "
+                    f"after {self.timeout} seconds.")
+        try:
+            conn = self._pool.getconn()
+            while not self._healthy(conn):
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                with self._lock:
+                    self.stats['discarded'] += 1
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+            self.stats['wait_time'] += time.time() - start
+            self.stats['peak_in_use'] = max(self.stats['peak_in_use'],
+                                            self.stats['in_use'])
+        return conn
+
+    def putconn(self, conn):
+        """Return a borrowed connection to the pool."""
+        try:
+            close = bool(conn.closed)
+            if not close:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+            if close:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.time()
+            self._pool.putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self.stats['in_use'] -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that always returns the connection to the pool.
+
+        Example:
+            with db.pool('main').connection() as conn:
+                cur = conn.cursor()
+        """
+        conn = self.getconn()
+        try:
+            timeout = getattr(_session, 'statement_timeout', None)
+            if timeout:
+                # Reset by the rollback when the connection is returned.
+                with conn.cursor() as cur:
+                    cur.execute("SET statement_timeout = %s;",
+                                (int(timeout * 1000),))
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def metrics(self):
+        """Get the pool size, usage and saturation counters."""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['min'] = self.minconn
+        stats['max'] = self.maxconn
+        stats['saturation'] = stats['in_use'] / self.maxconn
+        return stats
+
+    def closeall(self):
+        self._pool.closeall()
+        self._last_used.clear()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_session = threading.local()
+
+
+def pool(db='main'):
+    """Get the connection pool of a database, created on first use."""
+    try:
+        return _pools[db]
+    except KeyError:
+        pass
+    with _pools_lock:
+        if db not in _pools:
+            pconf = db_config(db).get('pool', {})
+            _pools[db] = ConnectionPool(
+                db, int(pconf.get('min', POOL_MIN)),
+                int(pconf.get('max', POOL_MAX)),
+                float(pconf.get('timeout', POOL_TIMEOUT)),
+                bool(pconf.get('prepare', POOL_PREPARE)))
+        return _pools[db]
+
+
+def pooled(db='main'):
+    """Borrow a connection from the pool of the given database.
+
+    Example:
+        with db.pooled(dataset['db']) as conn:
+            cur = conn.cursor()
+            cur.execute(sql)
+    """
+    return pool(db).connection()
+
+
+@contextmanager
+def statement_timeout(seconds):
+    """Abort the queries of the connections borrowed from the pools by this
+    thread in the context, that run longer than seconds (None or 0 for no
+    limit).
+
+    Example:
+        with db.statement_timeout(10):
+            data = db_queries.getParcelByID(dataset, pid)
+    """
+    previous = getattr(_session, 'statement_timeout', None)
+    _session.statement_timeout = seconds
+    try:
+        yield
+    finally:
+        _session.statement_timeout = previous
+
+
+def pool_metrics():
+    """Get the metrics of all the active connection pools."""
+    return {name: p.metrics() for name, p in list(_pools.items())}
+
+
+def close_pools():
+    """Close all the connections of all the pools."""
+    with _pools_lock:
+        for p in _pools.values():
+            p.closeall()
+        _pools.clear()
+
+
 def conn_cur(db='main'):
     """Create a cursor to execute PostgreSQL command in a database session"""
     try:
@@ -138,19 +410,19 @@ def tables(db='main', schema='public'):
     """Get the database tables as a python list"""
     list_ = []
     try:
-        conn = psycopg2.connect(conn_str(db))
-        cur = conn.cursor()
-        allTablesSql = f"""
-          SELECT table_name
-          FROM information_schema.tables
-          WHERE table_type='BASE TABLE'
-          AND table_schema='{schema}'
-          ORDER BY table_name ASC;
-        """
-        # Execute the query
-        cur.execute(allTablesSql)
-        for row in cur:
-            list_.append(row[0])
+        with pooled(db) as conn:
+            cur = conn.cursor()
+            allTablesSql = """
+              SELECT table_name
+              FROM information_schema.tables
+              WHERE table_type='BASE TABLE'
+              AND table_schema=%s
+              ORDER BY table_name ASC;
+            """
+            # Execute the query
+            cur.execute(allTablesSql, (schema,))
+            for row in cur:
+                list_.append(row[0])
         return list_
     except Exception:
         return []
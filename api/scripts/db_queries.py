@@ -12,582 +12,1063 @@ import psycopg2
 import psycopg2.extras
 import logging
 import pandas as pd
+from psycopg2 import sql
 
 from scripts import db
+from scripts import db_sql
+
+# The signature bands of each time series type.
+TSTYPE_BANDS = {
+    's2': ['B02', 'B03', 'B04', 'B05', 'B08', 'B11',
+           'B2', 'B3', 'B4', 'B5', 'B8', 'SC'],
+    'bs': ['VVb', 'VHb'],
+    'c6': ['VVc', 'VHc'],
+    'c1': ['VVc', 'VHc']
+}
+BATCH_MAX_PARCELS = 10000  # Max number of parcels in a batch request.
+FETCH_SIZE = 2000  # Rows read at a time from server side cursors.
+PEERS_SRID = 3035  # Equal area projection of the parcel peers queries.
+PEERS_MIN_AREA = 3000.0  # Min area of the parcel peers, in square meters.
+PERIODS = ['week', 'month']  # Periods of the period stats tables.
+PERIOD_STATS = ['n', 'mean', 'std', 'min', 'max', 'p25', 'p50', 'p75']
+# The signatures stats of the period stats, named otherwise.
+SIGNATURE_STATS = {'n': 'count'}
+# The stats types of the parcel stats peers, of both tables.
+PEER_STATS = PERIOD_STATS + list(SIGNATURE_STATS.values())
+# The geometry modes of the parcel queries.
+GEOMETRY_MODES = {
+    'full': "wkb_geometry",
+    'simplified': "st_simplifypreservetopology(wkb_geometry, %(tolerance)s)",
+    'bbox': "st_envelope(wkb_geometry)",
+    'centroid': "st_centroid(wkb_geometry)"}
+TILE_EXTENT = 4096  # Size of the vector tiles, in tile coordinates.
+TILE_BUFFER = 64  # Buffer of the vector tiles, in tile coordinates.
+TILE_MIN_ZOOM = 10  # Lower zoom levels get empty tiles (too many parcels).
+TILE_MAX_FEATURES = 20000  # Max parcels in a vector tile.
+TILE_SIMPLIFY = 1.0  # Simplification tolerance, in tile coordinates.
+TILE_ATTRIBUTES = ['crop', 'area', 'marker']  # Optional tile attributes.
+
+_srids = {}  # The SRID of the parcels tables, by (db, table).
+
+
+def tstype_filter(tstype):
+    """Get the band selection sql for the time series type, with the
+    %(bands)s parameter (tstype_bands)."""
+    if not tstype_bands(tstype):
+        return ""
+    return "And band = ANY(%(bands)s) "
+
+
+def tstype_bands(tstype):
+    return TSTYPE_BANDS.get(tstype.lower())
+
+
+def geometry_sql(withGeometry, wgs84, mode='full'):
+    """Get the selection of the parcel geometry as GeoJSON. The geometry
+    mode is 'full', 'simplified' (to the %(tolerance)s parameter, in the
+    units of the parcels table), 'bbox' or 'centroid'."""
+    if not withGeometry:
+        return sql.SQL("")
+    geometry = GEOMETRY_MODES[mode]
+    if wgs84:
+        geometry = f"st_transform({geometry}, 4326)"
+    return sql.SQL(f", st_asgeojson({geometry}) as geom")
+
+
+def parcel_columns(dataset):
+    """Get the quoted parcels table columns of the dataset."""
+    return {'parcel_id': db_sql.column(dataset, 'parcel_id'),
+            'cropname': db_sql.column(dataset, 'crop_name'),
+            'cropcode': db_sql.column(dataset, 'crop_code')}
+
+
+def tableSrid(cur, dataset, ptype=''):
+    """Get the SRID of the geometry of the parcels table, it is read once
+    for each table."""
+    parcels = db_sql.table(dataset, 'parcels', ptype)
+    key = (dataset['db'], parcels.strings)
+    if key not in _srids:
+        cur.execute("SELECT Find_SRID('', %s, 'wkb_geometry');",
+                    (f"{dataset['tables']['parcels']}{ptype}",))
+        _srids[key] = int(cur.fetchone()[0])
+    return _srids[key]
+
+
+def stream_rows(db_name, sql, params=None, name='stream_rows'):
+    """Run a query with a server side (named) cursor and yield the results.
+
+    The first item yielded is the tuple of the column names, followed by
+    lists of at most FETCH_SIZE rows, so the result set is never held in
+    memory at once. The pooled connection is returned when the generator
+    is exhausted or closed. The streamed queries are not prepared, a
+    cursor can not be declared for an EXECUTE of a prepared statement.
+    The sql can be a function that gets the query with a cursor of the
+    streaming connection (e.g. to read the SRID of a table), so no other
+    connection is taken from the pool.
+    """
+    with db.pooled(db_name) as conn:
+        if callable(sql):
+            with conn.cursor() as cur:
+                sql = sql(cur)
+        with conn.cursor(name=name) as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(sql, params)
+            rowset = cur.fetchmany(FETCH_SIZE)
+            yield tuple(etup.name for etup in cur.description)
+            while rowset:
+                yield rowset
+                rowset = cur.fetchmany(FETCH_SIZE)
 
 
 def getParcelByLocation(dataset, lon, lat, ptype='',
                         withGeometry=False, wgs84=False):
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcels_table = dataset['tables']['parcels']
-
-    try:
-        logging.debug("start queries")
-        getTableSrid = f"""
-            SELECT Find_SRID('', '{parcels_table}{ptype}',
-                'wkb_geometry');"""
-        logging.debug(getTableSrid)
-        cur.execute(getTableSrid)
-        srid = cur.fetchone()[0]
-        logging.debug(srid)
-        cropname = dataset['pcolumns']['crop_name']
-        cropcode = dataset['pcolumns']['crop_code']
-        parcel_id = dataset['pcolumns']['parcel_id']
-
-        if withGeometry:
-            if wgs84:
-                geometrySql = ", st_asgeojson(st_transform(wkb_geometry, 4326)) as geom"
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+        parcels_table = dataset['tables']['parcels']
+
+        try:
+            logging.debug("start queries")
+            srid = tableSrid(cur, dataset, ptype)
+            logging.debug(srid)
+
+            getTableDataSql = db_sql.query("""
+                SELECT {parcel_id}::text as pid, {cropname} as cropname,
+                    {cropcode} as cropcode,
+                    st_srid(wkb_geometry) as srid{geometry},
+                    st_area(st_transform(wkb_geometry, 3035))::integer as area,
+                    st_X(st_transform(st_centroid(wkb_geometry), 4326)) as clon,
+                    st_Y(st_transform(st_centroid(wkb_geometry), 4326)) as clat
+                FROM {parcels}
+                WHERE st_intersects(wkb_geometry, st_transform(
+                    st_setsrid(st_makepoint(%(lon)s, %(lat)s), 4326), {srid}));
+            """, parcels=db_sql.table(dataset, 'parcels', ptype),
+                geometry=geometry_sql(withGeometry, wgs84),
+                srid=sql.Literal(srid), **parcel_columns(dataset))
+
+            #  Return a list of tuples
+            db_sql.execute(cur, getTableDataSql,
+                           {'lon': float(lon), 'lat': float(lat)},
+                           prepare=True)
+            rows = cur.fetchall()
+            logging.debug(rows)
+
+            data.append(tuple(etup.name for etup in cur.description))
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
             else:
-                geometrySql = ", st_asgeojson(wkb_geometry) as geom"
-        else:
-            geometrySql = ""
-
-        getTableDataSql = f"""
-            SELECT {parcel_id}::text as pid, {cropname} as cropname,
-                {cropcode} as cropcode,
-                st_srid(wkb_geometry) as srid{geometrySql},
-                st_area(st_transform(wkb_geometry, 3035))::integer as area,
-                st_X(st_transform(st_centroid(wkb_geometry), 4326)) as clon,
-                st_Y(st_transform(st_centroid(wkb_geometry), 4326)) as clat
-            FROM {parcels_table}{ptype}
-            WHERE st_intersects(wkb_geometry,
-            st_transform(st_geomfromtext('POINT({lon} {lat})', 4326), {srid}));
-        """
-
-        #  Return a list of tuples
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-        logging.debug(rows)
-
-        data.append(tuple(etup.name for etup in cur.description))
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
-        else:
-            logging.debug(
-                f"No parcel found in {parcels_table}{ptype} that",
-                f"intersects with point ({lon}, {lat})")
-        logging.debug(data)
-        return data
+                logging.debug(
+                    f"No parcel found in {parcels_table}{ptype} that",
+                    f"intersects with point ({lon}, {lat})")
+            logging.debug(data)
+            return data
 
-    except Exception as err:
-        print(err)
-        logging.debug("Did not find data, please select the right database",
-                      "and table: ", err)
-        return data.append('Ended with no data')
+        except Exception as err:
+            print(err)
+            logging.debug("Did not find data, please select the right database",
+                          "and table: ", err)
+            return data.append('Ended with no data')
 
 
 def getParcelByID(dataset, pid, ptype='', withGeometry=False,
                   wgs84=False):
 
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcels_table = dataset['tables']['parcels']
-
-    try:
-        logging.debug("start queries")
-        cropname = dataset['pcolumns']['crop_name']
-        cropcode = dataset['pcolumns']['crop_code']
-        parcel_id = dataset['pcolumns']['parcel_id']
-
-        if withGeometry:
-            if wgs84:
-                geometrySql = ", st_asgeojson(st_transform(wkb_geometry, 4326)) as geom"
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+
+        try:
+            logging.debug("start queries")
+            getTableDataSql = db_sql.query("""
+                SELECT {parcel_id}::text as pid, {cropname} as cropname,
+                    {cropcode}::text as cropcode,
+                    st_srid(wkb_geometry) as srid{geometry},
+                    st_area(st_transform(wkb_geometry, 3035))::integer as area,
+                    st_X(st_transform(st_centroid(wkb_geometry), 4326)) as clon,
+                    st_Y(st_transform(st_centroid(wkb_geometry), 4326)) as clat
+                FROM {parcels}
+                WHERE {parcel_id} = %(pid)s;
+            """, parcels=db_sql.table(dataset, 'parcels', ptype),
+                geometry=geometry_sql(withGeometry, wgs84),
+                **parcel_columns(dataset))
+
+            #  Return a list of tuples
+            db_sql.execute(cur, getTableDataSql, {'pid': str(pid)},
+                           prepare=True)
+            rows = cur.fetchall()
+
+            data.append(tuple(etup.name for etup in cur.description))
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
             else:
-                geometrySql = ", st_asgeojson(wkb_geometry) as geom"
-        else:
-            geometrySql = ""
-
-        getTableDataSql = f"""
-            SELECT {parcel_id}::text as pid, {cropname} as cropname,
-                {cropcode}::text as cropcode,
-                st_srid(wkb_geometry) as srid{geometrySql},
-                st_area(st_transform(wkb_geometry, 3035))::integer as area,
-                st_X(st_transform(st_centroid(wkb_geometry), 4326)) as clon,
-                st_Y(st_transform(st_centroid(wkb_geometry), 4326)) as clat
-            FROM {parcels_table}{ptype}
-            WHERE {parcel_id} = '{pid}';
-        """
-
-        #  Return a list of tuples
-        # print(getTableDataSql)
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-
-        data.append(tuple(etup.name for etup in cur.description))
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
-        else:
-            logging.debug(
-                f"No parcel found in the selected table with id ({pid}).")
-        return data
-
-    except Exception as err:
-        print(err)
-        logging.debug("Did not find data, please select the right database",
-                      "and table: ", err)
-        return data.append('Ended with no data')
+                logging.debug(
+                    f"No parcel found in the selected table with id ({pid}).")
+            return data
+
+        except Exception as err:
+            print(err)
+            logging.debug("Did not find data, please select the right database",
+                          "and table: ", err)
+            return data.append('Ended with no data')
+
+
+def polygonWhereSql(dataset, srid, after=None, until=None):
+    """Get the filter of the parcels that intersect with the %(polygon)s
+    parameter, in a page of parcel ids: after the %(after)s parameter and
+    up to the %(until)s parameter (if given)."""
+    where = ["st_intersects(wkb_geometry, st_transform("
+             "st_geomfromtext(%(polygon)s, 4326), {srid}))"]
+    if after is not None:
+        where.append("{parcel_id} > %(after)s")
+    if until is not None:
+        where.append("{parcel_id} <= %(until)s")
+    return db_sql.query(' And '.join(where), srid=sql.Literal(srid),
+                        parcel_id=db_sql.column(dataset, 'parcel_id'))
+
+
+def polygonParams(polygon, after=None, until=None):
+    """Get the parameters of the polygonWhereSql filter."""
+    polygon = polygon.replace('_', ' ').replace('-', ',')
+    return {'polygon': f"POLYGON(({polygon}))", 'after': after,
+            'until': until}
+
+
+def getPolygonPageEnd(dataset, polygon, ptype='', size=100, after=None):
+    """Get the last parcel id of a page of the parcels that intersect with
+    the polygon (ordered by parcel id, after the given id), and if there
+    are more parcels after it. Only the parcel ids are read."""
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor()
+        try:
+            srid = tableSrid(cur, dataset, ptype)
+            query = db_sql.query("""
+                SELECT {parcel_id}
+                FROM {parcels}
+                WHERE {where}
+                ORDER BY {parcel_id}
+                OFFSET %(offset)s LIMIT 2;
+            """, where=polygonWhereSql(dataset, srid, after),
+                parcel_id=db_sql.column(dataset, 'parcel_id'),
+                parcels=db_sql.table(dataset, 'parcels', ptype))
+            cur.execute(query, {**polygonParams(polygon, after),
+                                'offset': max(int(size) - 1, 0)})
+            rows = cur.fetchall()
+            if not rows:
+                return None, False
+            return rows[0][0], len(rows) > 1
+        except Exception as err:
+            print("Can not get the page of the parcels: ", err)
+            return None, False
 
 
 def getParcelsByPolygon(dataset, polygon, ptype='', withGeometry=False,
-                        only_ids=True, wgs84=False):
-
-    polygon = polygon.replace('_', ' ').replace('-', ',')
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcels_table = dataset['tables']['parcels']
-
-    try:
-        logging.debug("start queries")
-        getTableSrid = f"""
-            SELECT Find_SRID('', '{parcels_table}{ptype}',
-                'wkb_geometry');"""
-        logging.debug(getTableSrid)
-        cur.execute(getTableSrid)
-        srid = cur.fetchone()[0]
+                        only_ids=True, wgs84=False, limit=100, stream=False,
+                        geometry='full', tolerance=0, after=None, until=None):
+    """Get the parcels that intersect with the polygon, ordered by parcel id,
+    if stream is True a stream_rows generator is returned instead of a list
+    of tuples. With after and until only the parcels of a page of parcel
+    ids are returned (see getPolygonPageEnd)."""
+    params = {**polygonParams(polygon, after, until),
+              'limit': int(limit), 'tolerance': float(tolerance)}
+
+    def getTableDataSql(cur):
+        # The query, with the SRID of the parcels table.
+        srid = tableSrid(cur, dataset, ptype)
         logging.debug(srid)
-        cropname = dataset['pcolumns']['crop_name']
-        cropcode = dataset['pcolumns']['crop_code']
-        parcel_id = dataset['pcolumns']['parcel_id']
-
-        if withGeometry:
-            if wgs84:
-                geometrySql = ", st_asgeojson(st_transform(wkb_geometry, 4326)) as geom"
-            else:
-                geometrySql = ", st_asgeojson(wkb_geometry) as geom"
-        else:
-            geometrySql = ""
+        columns = parcel_columns(dataset)
+        geometrySql = geometry_sql(withGeometry, wgs84, geometry)
 
         if only_ids:
-            selectSql = f"{parcel_id} as pid{geometrySql}"
+            selectSql = db_sql.query("{parcel_id} as pid{geometry}",
+                                     geometry=geometrySql, **columns)
         else:
-            selectSql = f"""
+            selectSql = db_sql.query("""
                 {parcel_id} as pid, {cropname} As cropname,
                 {cropcode} As cropcode,
-                st_srid(wkb_geometry) As srid{geometrySql},
+                st_srid(wkb_geometry) As srid{geometry},
                 st_area(st_transform(wkb_geometry, 3035))::integer As area,
                 st_X(st_transform(st_centroid(wkb_geometry), 4326)) As clon,
-                st_Y(st_transform(st_centroid(wkb_geometry), 4326)) As clat"""
-
-        getTableDataSql = f"""
-            SELECT {selectSql}
-            FROM {parcels_table}{ptype}
-            WHERE st_intersects(wkb_geometry,
-            st_transform(st_geomfromtext('POLYGON(({polygon}))', 4326), {srid}))
-            LIMIT 100;
-        """
-
-        #  Return a list of tuples
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-
-        data.append(tuple(etup.name for etup in cur.description))
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
-        else:
-            print(f"No parcel found in {parcels_table}{ptype} that",
-                  "intersects with the polygon.")
-        return data
-
-    except Exception as err:
-        print("Did not find data, please select the right database and table: ",
-              err)
-        return data.append('Ended with no data')
-
-
-def getParcelTimeSeries(dataset, pid, ptype='',
-                        tstype='s2', band=None, scl=True, ref=False):
-    """Get the time series for the given parcel"""
-
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-
-    sigs_table = dataset['tables'][tstype]
-    dias_catalog = dataset['tables']['dias_catalog']
+                st_Y(st_transform(st_centroid(wkb_geometry), 4326)) As clat""",
+                geometry=geometrySql, **columns)
+
+        return db_sql.query("""
+            SELECT {select}
+            FROM {parcels}
+            WHERE {where}
+            ORDER BY {parcel_id}
+            LIMIT %(limit)s;
+        """, select=selectSql,
+            where=polygonWhereSql(dataset, srid, after, until),
+            parcels=db_sql.table(dataset, 'parcels', ptype), **columns)
+
+    if stream:
+        # The SRID is read with the streaming connection.
+        return stream_rows(dataset['db'], getTableDataSql, params,
+                           name='parcels_by_polygon')
+
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+        parcels_table = dataset['tables']['parcels']
+
+        try:
+            logging.debug("start queries")
+            #  Return a list of tuples
+            cur.execute(getTableDataSql(cur), params)
+            rows = cur.fetchall()
+
+            data.append(tuple(etup.name for etup in cur.description))
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
+            else:
+                print(f"No parcel found in {parcels_table}{ptype} that",
+                      "intersects with the polygon.")
+            return data
+
+        except Exception as err:
+            print("Did not find data, please select the right database and table: ",
+                  err)
+            return data.append('Ended with no data')
+
+
+def tileTolerance(z):
+    """Get the simplification tolerance (in EPSG:3857 meters) of a zoom
+    level, TILE_SIMPLIFY tile coordinates."""
+    return 2 * 20037508.342789244 / 2 ** z / TILE_EXTENT * TILE_SIMPLIFY
+
+
+def parcelTileSql(dataset, ptype='', attributes=(), markers=None):
+    """Get the query of a Mapbox vector tile of the parcels, with the
+    parameters z, x, y, tolerance, max and srid. The layer 'parcels' has
+    the parcel id and the optional attributes ('crop', 'area' and 'marker',
+    the latest marker of the parcel from the markers table)."""
+    columns = parcel_columns(dataset)
+    select = [db_sql.query("p.{parcel_id}::text AS pid", **columns)]
+    joins = sql.SQL("")
+    if 'crop' in attributes:
+        select.append(db_sql.query("p.{cropname} AS cropname, "
+                                   "p.{cropcode} AS cropcode", **columns))
+    if 'area' in attributes:
+        select.append(sql.SQL(
+            "st_area(st_transform(p.wkb_geometry, 3035))::integer AS area"))
+    if 'marker' in attributes and markers is not None:
+        select.append(sql.SQL("m.marker, m.marker_type, m.date_end"))
+        joins = db_sql.query("""
+            LEFT JOIN LATERAL (
+                SELECT marker, marker_type, date_end::text
+                FROM {markers} mk
+                WHERE mk.{parcel_id} = p.{parcel_id}
+                ORDER BY mk.date_end DESC
+                LIMIT 1) m ON true""", markers=markers, **columns)
+    return db_sql.query("""
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom),
+        features AS (
+            SELECT {select},
+                ST_AsMVTGeom(
+                    ST_Simplify(ST_Transform(p.wkb_geometry, 3857),
+                                %(tolerance)s, true),
+                    bounds.geom, {extent}, {buffer}, true) AS geom
+            FROM {parcels} p{joins}, bounds
+            WHERE p.wkb_geometry && ST_Transform(bounds.geom, {srid})
+            LIMIT %(max)s)
+        SELECT ST_AsMVT(features.*, 'parcels', {extent}, 'geom')
+        FROM features
+        WHERE geom IS NOT NULL;
+        """, select=sql.SQL(', ').join(select), joins=joins,
+        parcels=db_sql.table(dataset, 'parcels', ptype),
+        extent=sql.Literal(TILE_EXTENT), buffer=sql.Literal(TILE_BUFFER),
+        srid=sql.Placeholder('srid'))
+
+
+def getParcelTile(dataset, aoi, year, z, x, y, ptype='', attributes=()):
+    """Get the Mapbox vector tile (bytes) of the parcels in the tile z/x/y,
+    with the geometries simplified to the zoom level. The tiles of zoom
+    levels below TILE_MIN_ZOOM are empty."""
+    if z < TILE_MIN_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        return b''
+    attributes = [a for a in attributes if a in TILE_ATTRIBUTES]
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor()
+        try:
+            markers = None
+            if 'marker' in attributes:
+                # The markers of the year, or the former markers_2020.
+                for table in [f"{aoi}.markers_{year}", f"{aoi}.markers_2020"]:
+                    if tableExists(conn, table):
+                        markers = db_sql.identifier(table)
+                        break
+            query = parcelTileSql(dataset, ptype, attributes, markers)
+            cur.execute(query, {'z': z, 'x': x, 'y': y,
+                                'tolerance': tileTolerance(z),
+                                'max': TILE_MAX_FEATURES,
+                                'srid': tableSrid(cur, dataset, ptype)})
+            tile = cur.fetchone()[0]
+            return bytes(tile) if tile else b''
+        except Exception as err:
+            print("Can not get the parcels tile: ", err)
+            return None
+
+
+def parcelTimeSeriesSql(dataset, ptype='', tstype='s2', band=None,
+                        scl=True, ref=False):
+    """Get the time series query of a parcel, with the parameters pid,
+    band and bands."""
+    select_scl = ', h.hist' if scl else ''
+    select_ref = ', d.reference' if ref else ''
+    where_shid = 'And s.pid = h.pid And s.obsid = h.obsid' if scl else ''
+    where_band = "And s.band = %(band)s " if band else ''
+    where_tstype = tstype_filter(tstype)
+
+    return db_sql.query(f"""
+        SELECT extract('epoch' from d.obstime) AS date_part, s.band,
+            s.count, s.mean, s.std, s.min, s.p25, s.p50, s.p75,
+            s.max{select_scl}{select_ref}
+        FROM {{parcels}} p, {{sigs_table}} s,
+            {{dias_catalog}} d{{from_hists}}
+        WHERE
+            p.ogc_fid = s.pid
+            And p.{{parcel_id}} = %(pid)s
+            And s.obsid = d.id
+            {where_shid}
+            {where_band}
+            {where_tstype}
+        ORDER By obstime, band asc;
+        """, parcels=db_sql.table(dataset, 'parcels', ptype),
+        sigs_table=db_sql.table(dataset, tstype),
+        dias_catalog=db_sql.table(dataset, 'dias_catalog'),
+        from_hists=sql.SQL(", {} h").format(db_sql.table(dataset, 'scl'))
+        if scl else sql.SQL(''),
+        parcel_id=db_sql.column(dataset, 'parcel_id'))
+
+
+def getParcelTimeSeries(dataset, pid, ptype='', tstype='s2', band=None,
+                        scl=True, ref=False, stream=False):
+    """Get the time series for the given parcel, if stream is True
+    a stream_rows generator is returned instead of a list of tuples."""
+
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+
+        sigs_table = dataset['tables'][tstype]
+        parcels_table = dataset['tables']['parcels']
+        logging.debug(f'getParcelTimeSeries {parcels_table}{ptype}, {pid}, {tstype}')
+
+        try:
+            getTableDataSql = parcelTimeSeriesSql(dataset, ptype, tstype,
+                                                  band, scl, ref)
+            params = {'pid': str(pid), 'band': band,
+                      'bands': tstype_bands(tstype)}
+            if stream:
+                return stream_rows(dataset['db'], getTableDataSql, params,
+                                   name='parcel_time_series')
+            #  Return a list of tuples
+            db_sql.execute(cur, getTableDataSql, params, prepare=True)
+            rows = cur.fetchall()
+            data.append(tuple(etup.name for etup in cur.description))
+
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
+            else:
+                print("No time series found for",
+                      f"{pid} in the selected signatures table '{sigs_table}'")
+            return data
+
+        except Exception as err:
+            print("Did not find data, please select the right database and table: ",
+                  err)
+            return data.append('Ended with no data')
+
+
+def getParcelsTimeSeries(dataset, pids=None, polygon=None, ptype='',
+                         tstype='s2', band=None, scl=True, ref=False,
+                         start_date=None, end_date=None,
+                         limit=BATCH_MAX_PARCELS):
+    """Get the time series of many parcels with one set based query.
+
+    The parcels are selected by a list of parcel ids (an empty list selects
+    no parcels), by a polygon or, if none of them is given, all the parcels
+    of the ptype table are used (up to limit parcels). The observations can be limited to the dates
+    from start_date to end_date (included). The rows are read with a server
+    side cursor and yielded grouped by parcel.
+
+    Yields:
+        (pid, columns, rows) for each parcel with time series data.
+    """
     parcels_table = dataset['tables']['parcels']
-    parcel_id = dataset['pcolumns']['parcel_id']
-    logging.debug(f'getParcelTimeSeries {parcels_table}{ptype}, {pid}, {tstype}')
+    parcels = db_sql.table(dataset, 'parcels', ptype)
+    parcel_id = db_sql.column(dataset, 'parcel_id')
+    logging.debug(f'getParcelsTimeSeries {parcels_table}{ptype}, {tstype}')
 
-    from_hists = f", {dataset['tables']['scl']} h" if scl else ''
     select_scl = ', h.hist' if scl else ''
     select_ref = ', d.reference' if ref else ''
 
     where_shid = 'And s.pid = h.pid And s.obsid = h.obsid' if scl else ''
-    where_band = f"And s.band = '{band}' " if band else ''
-
-    if tstype.lower() == 's2':
-        where_tstype = "And band IN ('B02', 'B03', 'B04', 'B05', 'B08', 'B11', 'B2', 'B3', 'B4', 'B5', 'B8', 'SC') "
-    elif tstype.lower() == 'bs':
-        where_tstype = "And band IN ('VVb', 'VHb') "
-    elif tstype.lower() == 'c6':
-        where_tstype = "And band IN ('VVc', 'VHc') "
-    elif tstype.lower() == 'c1':
-        where_tstype = "And band IN ('VVc', 'VHc') "
-    else:
-        where_tstype = ""
-
-    try:
-        getTableDataSql = f"""
-            SELECT extract('epoch' from d.obstime), s.band,
-                s.count, s.mean, s.std, s.min, s.p25, s.p50, s.p75,
-                s.max{select_scl}{select_ref}
-            FROM {parcels_table}{ptype} p, {sigs_table} s,
-                {dias_catalog} d{from_hists}
-            WHERE
-                p.ogc_fid = s.pid
-                And p.{parcel_id} = '{pid}'
-                And s.obsid = d.id
-                {where_shid}
-                {where_band}
-                {where_tstype}
-            ORDER By obstime, band asc;
-        """
-        #  Return a list of tuples
-        # print(getTableDataSql)
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-        data.append(tuple(etup.name for etup in cur.description))
-
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
+    where_band = "And s.band = %(band)s " if band else ''
+    where_tstype = tstype_filter(tstype)
+    where_dates = ''
+    if start_date:
+        where_dates += "And d.obstime >= %(start_date)s::date "
+    if end_date:
+        where_dates += "And d.obstime < %(end_date)s::date + 1 "
+
+    params = {'band': band, 'bands': tstype_bands(tstype),
+              'start_date': start_date, 'end_date': end_date,
+              'limit': int(limit)}
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor()
+        if pids is not None:
+            # Cast the ids to the parcel id column type to use its index.
+            cur.execute("""
+                SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attname = %s;""",
+                        (parcels.as_string(conn), parcel_id.string))
+            pid_type = cur.fetchone()[0]
+            where_parcels = db_sql.query(
+                f"WHERE {{parcel_id}} = ANY(%(pids)s::{pid_type}[])",
+                parcel_id=parcel_id)
+            params['pids'] = [str(p) for p in pids][:int(limit)]
+        elif polygon:
+            srid = tableSrid(cur, dataset, ptype)
+            where_parcels = db_sql.query("""WHERE st_intersects(wkb_geometry,
+                st_transform(st_geomfromtext(%(polygon)s, 4326), {srid}))""",
+                                         srid=sql.Literal(srid))
+            polygon = polygon.replace('_', ' ').replace('-', ',')
+            params['polygon'] = f"POLYGON(({polygon}))"
         else:
-            print("No time series found for",
-                  f"{pid} in the selected signatures table '{sigs_table}'")
-        return data
-
-    except Exception as err:
-        print("Did not find data, please select the right database and table: ",
-              err)
-        return data.append('Ended with no data')
-
+            where_parcels = sql.SQL('')
+        cur.close()
+
+    getTableDataSql = db_sql.query(f"""
+        WITH selection AS (
+            SELECT ogc_fid, {{parcel_id}}::text as pid
+            FROM {{parcels}}
+            {{where_parcels}}
+            ORDER By {{parcel_id}}
+            LIMIT %(limit)s)
+        SELECT p.pid, extract('epoch' from d.obstime) AS date_part, s.band,
+            s.count, s.mean, s.std, s.min, s.p25, s.p50, s.p75,
+            s.max{select_scl}{select_ref}
+        FROM selection p, {{sigs_table}} s,
+            {{dias_catalog}} d{{from_hists}}
+        WHERE
+            s.pid = ANY(ARRAY(SELECT ogc_fid FROM selection))
+            And p.ogc_fid = s.pid
+            And s.obsid = d.id
+            {where_shid}
+            {where_band}
+            {where_tstype}
+            {where_dates}
+        ORDER By p.pid, obstime, band asc;
+    """, parcels=parcels, parcel_id=parcel_id, where_parcels=where_parcels,
+        sigs_table=db_sql.table(dataset, tstype),
+        dias_catalog=db_sql.table(dataset, 'dias_catalog'),
+        from_hists=sql.SQL(", {} h").format(db_sql.table(dataset, 'scl'))
+        if scl else sql.SQL(''))
+    stream = stream_rows(dataset['db'], getTableDataSql, params,
+                         name='parcels_time_series')
+    columns = next(stream)[1:]
+    pid, rows = None, []
+    for rowset in stream:
+        for r in rowset:
+            if r[0] != pid:
+                if rows:
+                    yield pid, columns, rows
+                pid, rows = r[0], []
+            rows.append(tuple(r[1:]))
+    if rows:
+        yield pid, columns, rows
+
+
+def getAcquisitionDays(dataset, tstype='s2', start_date=None,
+                       end_date=None):
+    """Get the days (datetime.date) with acquisitions of the time series type
+    in the dias_catalogue, from start_date to end_date (included)."""
+    card = tstype.lower() if tstype.lower() in TSTYPE_BANDS else 's2'
+    where_dates = ''
+    if start_date:
+        where_dates += "And obstime >= %(start_date)s::date "
+    if end_date:
+        where_dates += "And obstime < %(end_date)s::date + 1 "
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(db_sql.query(f"""
+                SELECT DISTINCT obstime::date AS day
+                FROM {{dias_catalog}}
+                WHERE trim(card) = %(card)s
+                {where_dates}
+                ORDER By day;
+            """, dias_catalog=db_sql.table(dataset, 'dias_catalog')),
+                {'card': card, 'start_date': start_date,
+                 'end_date': end_date})
+            return [r[0] for r in cur.fetchall()]
+        except Exception as err:
+            print("Can not get the acquisition days: ", err)
+            return []
+
+
+def getSignatureBands(dataset, tstype='s2', sample=10000):
+    """Get the bands of the signatures table (of TSTYPE_BANDS, in that
+    order), from a sample of its first rows."""
+    bands = tstype_bands(tstype) or []
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(db_sql.query("""
+                SELECT DISTINCT band
+                FROM (SELECT band FROM {sigs_table} LIMIT %(sample)s) s;
+            """, sigs_table=db_sql.table(dataset, tstype)),
+                {'sample': int(sample)})
+            found = sorted(r[0] for r in cur.fetchall())
+        except Exception as err:
+            print("Can not get the signature bands: ", err)
+            return bands
+    if not bands:
+        return found
+    return [b for b in bands if b in found]
+
+
+def getParcelWeatherTS(dataset, pid, ptype, stream=False):
+    """Get the weather time series for the given parcel, if stream is True
+    a stream_rows generator is returned instead of a list of tuples."""
+
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+        parcels_table = dataset['tables']['parcels']
+        try:
+            env_table = dataset['tables']['env']
+        except Exception:
+            env_table = None
+        logging.debug(f'getParcelWeatherTS {parcels_table}{ptype}, {pid}')
+
+        try:
+            parcels = db_sql.table(dataset, 'parcels', ptype)
+            parcel_id = db_sql.column(dataset, 'parcel_id')
+            if env_table:
+                getTableDataSql = db_sql.query("""
+                    SELECT
+                        TO_CHAR(meteo_date, 'YYYY-MM-DD') meteo_date,
+                        tmin, tmax, tmean, prec
+                    FROM
+                        {env_table} e,
+                        {parcels} p,
+                        public.era5_data,
+                        public.era5_grid
+                    WHERE
+                        p.{parcel_id} = %(pid)s AND
+                        e.grid_id = era5_grid.grid_id AND
+                        era5_grid.grid_id = era5_data.grid_id AND
+                        e.pid = p.ogc_fid
+                    ORDER BY
+                        meteo_date;
+                    """, env_table=db_sql.table(dataset, 'env'),
+                    parcels=parcels, parcel_id=parcel_id)
+            else:
+                getTableDataSql = db_sql.query("""
+                    SELECT
+                        TO_CHAR(meteo_date, 'YYYY-MM-DD') meteo_date,
+                        tmin, tmax, tmean, prec
+                    FROM
+                        {parcels} p,
+                        public.era5_grid,
+                        public.era5_data
+                    WHERE
+                        p.{parcel_id} = %(pid)s AND
+                        era5_grid.grid_id = era5_data.grid_id AND
+                        ST_INTERSECTS(geom_cell,
+                            ST_TRANSFORM(ST_CENTROID(p.wkb_geometry), 4326))
+                    ORDER BY
+                        meteo_date;
+                    """, parcels=parcels, parcel_id=parcel_id)
+            params = {'pid': str(pid)}
+            if stream:
+                return stream_rows(dataset['db'], getTableDataSql, params,
+                                   name='parcel_weather_ts')
+            #  Return a list of tuples
+            db_sql.execute(cur, getTableDataSql, params, prepare=True)
+            rows = cur.fetchall()
+            data.append(tuple(etup.name for etup in cur.description))
+
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
+            else:
+                print("No time series found for",
+                      f"{pid} in the selected table '{env_table}'")
+            return data
+
+        except Exception as err:
+            print("Did not find data, please select the right database and table: ",
+                  err)
+            return data.append('Ended with no data')
+
+
+def parcelPeersIndexSql(dataset, ptype=''):
+    """Get the sql of the index of the parcel peers queries, on the equal
+    area geometry of the parcels."""
+    parcels_table = f"{dataset['tables']['parcels']}{ptype}"
+    return db_sql.query("""
+        CREATE INDEX IF NOT EXISTS {index}
+        ON {parcels}
+        USING gist (ST_Transform(wkb_geometry, {srid}));
+        ANALYZE {parcels};""",
+        index=db_sql.identifier(
+            f"{parcels_table.split('.')[-1]}_geom{PEERS_SRID}_idx"),
+        parcels=db_sql.table(dataset, 'parcels', ptype),
+        srid=sql.Literal(PEERS_SRID))
+
+
+def parcelPeersSql(dataset, ptype=''):
+    """Get the sql of the parcel peers, with the parameters pid, distance
+    and max. The candidates are read from the index in the order of the
+    distance, the scan stops at max parcels."""
+    return db_sql.query("""
+        WITH current_parcel AS (
+            SELECT {cropname} AS cropname,
+                ST_Transform(wkb_geometry, {srid}) AS geom
+            FROM {parcels}
+            WHERE {parcel_id} = %(pid)s)
+        SELECT peers.pids, peers.distance
+        FROM current_parcel c CROSS JOIN LATERAL (
+            SELECT p.{parcel_id}::text As pids,
+                ST_Distance({geom}, c.geom) As distance
+            FROM {parcels} p
+            WHERE ST_DWithin({geom}, c.geom, %(distance)s)
+            And p.{cropname} = c.cropname
+            And p.{parcel_id} != %(pid)s
+            And ST_Area({geom}) > {min_area}
+            ORDER BY {geom} <-> c.geom
+            LIMIT %(max)s) peers
+        ORDER BY peers.distance;
+        """, parcels=db_sql.table(dataset, 'parcels', ptype),
+        cropname=db_sql.column(dataset, 'crop_name'),
+        parcel_id=db_sql.column(dataset, 'parcel_id'),
+        geom=sql.SQL("ST_Transform(p.wkb_geometry, {})").format(
+            sql.Literal(PEERS_SRID)),
+        srid=sql.Literal(PEERS_SRID), min_area=sql.Literal(PEERS_MIN_AREA))
 
-def getParcelWeatherTS(dataset, pid, ptype):
-    """Get the time series for the given parcel"""
 
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcels_table = dataset['tables']['parcels']
-    parcel_id = dataset['pcolumns']['parcel_id']
-    try:
-        env_table = dataset['tables']['env']
-    except Exception:
-        env_table = None
-    logging.debug(f'getParcelWeatherTS {parcels_table}{ptype}, {pid}')
+def getParcelPeers(dataset, pid, distance, maxPeers, ptype=''):
 
-    try:
-        if env_table:
-            getTableDataSql = f"""
-                SELECT
-                    TO_CHAR(meteo_date, 'YYYY-MM-DD') meteo_date,
-                    tmin, tmax, tmean, prec
-                FROM
-                    {env_table} e,
-                    {parcels_table}{ptype} p,
-                    public.era5_data,
-                    public.era5_grid
-                WHERE
-                    p.{parcel_id} = '{pid}' AND
-                    e.grid_id = era5_grid.grid_id AND
-                    era5_grid.grid_id = era5_data.grid_id AND
-                    e.pid = p.ogc_fid
-                ORDER BY
-                    meteo_date;
-                """
-        else:
-            getTableDataSql = f"""
-                SELECT
-                    TO_CHAR(meteo_date, 'YYYY-MM-DD') meteo_date,
-                    tmin, tmax, tmean, prec
-                FROM
-                    {parcels_table}{ptype} p,
-                    public.era5_grid,
-                    public.era5_data
-                WHERE
-                    p.{parcel_id} = '{pid}' AND
-                    era5_grid.grid_id = era5_data.grid_id AND
-                    ST_INTERSECTS(geom_cell,
-                        ST_TRANSFORM(ST_CENTROID(p.wkb_geometry), 4326))
-                ORDER BY
-                    meteo_date;
-                """
-        #  Return a list of tuples
-        # print(getTableDataSql)
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-        data.append(tuple(etup.name for etup in cur.description))
-
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
-        else:
-            print("No time series found for",
-                  f"{pid} in the selected table '{env_table}'")
-        return data
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+        parcels_table = dataset['tables']['parcels']
+
+        try:
+            logging.debug("start queries")
+            getTableDataSql = parcelPeersSql(dataset, ptype)
+            #  Return a list of tuples
+            db_sql.execute(cur, getTableDataSql, {
+                'pid': str(pid), 'distance': float(distance),
+                'max': int(maxPeers)}, prepare=True)
+            rows = cur.fetchall()
+
+            data.append(tuple(etup.name for etup in cur.description))
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
+            else:
+                print("No parcel peers found in",
+                      f"{parcels_table} within {distance} meters from parcel {pid}")
+            return data
 
-    except Exception as err:
-        print("Did not find data, please select the right database and table: ",
-              err)
-        return data.append('Ended with no data')
+        except Exception as err:
+            print("Did not find data, please select the right database and table: ",
+                  err)
+            return data.append('Ended with no data')
 
 
-def getParcelPeers(dataset, pid, distance, maxPeers, ptype=''):
+def periodStatsTable(dataset, tstype='s2'):
+    """Get the per parcel, band and period summary table of the signatures
+    (maintained by cbm/extract/period_stats.py)."""
+    return f"{dataset['tables'][tstype]}_period_stats"
 
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcels_table = dataset['tables']['parcels']
 
-    try:
-        logging.debug("start queries")
-        getTableSrid = f"""
-            SELECT Find_SRID('', '{parcels_table}{ptype}',
-                'wkb_geometry');"""
-        logging.debug(getTableSrid)
-        cur.execute(getTableSrid)
-        srid = cur.fetchone()[0]
-        logging.debug(srid)
-        cropname = dataset['pcolumns']['crop_name']
-        parcel_id = dataset['pcolumns']['parcel_id']
-
-        getTableDataSql = f"""
-            WITH current_parcel AS (select {cropname},
-                ST_Transform(wkb_geometry,3035) as geom
-                FROM {parcels_table}{ptype}
-                WHERE {parcel_id} = '{pid}')
-            SELECT {parcel_id}::text as pids,
-                st_distance(ST_Transform(wkb_geometry,3035),
-                (SELECT geom FROM current_parcel)) As distance
-            FROM {parcels_table}{ptype}
-            WHERE {cropname} = (select {cropname} FROM current_parcel)
-            And {parcel_id} != '{pid}'
-            And st_dwithin(ST_Transform(wkb_geometry,3035),
-                (SELECT geom FROM current_parcel), {distance})
-            And st_area(ST_Transform(wkb_geometry,3035)) > 3000.0
-            ORDER by st_distance(ST_Transform(wkb_geometry,3035),
-                (SELECT geom FROM current_parcel)) asc
-            LIMIT {maxPeers};
-            """
-        #  Return a list of tuples
-        # print(getTableDataSql)
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-
-        data.append(tuple(etup.name for etup in cur.description))
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
-        else:
-            print("No parcel peers found in",
-                  f"{parcels_table} within {distance} meters from parcel {pid}")
-        return data
-
-    except Exception as err:
-        print("Did not find data, please select the right database and table: ",
-              err)
-        return data.append('Ended with no data')
+def tableExists(conn, table):
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+    return cur.fetchone()[0]
 
 
 def getParcelStatsPeers(dataset, start_date, end_date, band, stype,
-                        value, maxPeers=100, ptype=''):
-
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcels_table = dataset['tables']['parcels']
-    sigs_table = dataset['tables']['s2']
-    dias_catalog = dataset['tables']['dias_catalog']
-    parcel_id = dataset['pcolumns']['parcel_id']
-    cropname = dataset['pcolumns']['crop_name']
-    logging.debug(f'getParcelStatsPeers {parcels_table}{ptype}, {stype}, {value}')
-
-#     print('ptype',ptype)
-    if len(value.split('-')) == 2:
-        vmin, vmax = value.split('-')
-        vsql = f'AND {stype} BETWEEN {vmin} AND {vmax}'
-    else:
-        vsql = f'AND {stype} = {value}'
-
-    try:
-        getTableDataSql = f"""
-            SELECT p.{parcel_id}::text as pids FROM {sigs_table} s, {parcels_table}{ptype} p, {dias_catalog} d
-            WHERE s.obsid = d.id AND p.ogc_fid = s.pid
-            AND s.band = '{band}'
-            {vsql}
-            AND d.obstime BETWEEN '{start_date} 00:00:00'::timestamp
-            AND '{end_date} 23:59:59'::timestamp
-            GROUP BY p.{parcel_id}
-            LIMIT {maxPeers};
-            """
-        print(getTableDataSql)
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-
-#         data.append(tuple(etup.name for etup in cur.description))
-        if len(rows) > 0:
-            for r in rows:
-                data.append(r[0])
+                        value, maxPeers=100, ptype='', period='week'):
+    """Get the parcels with a weekly (or monthly) summary of the band in the
+    value range, read from the period stats table if it exists, from the
+    signatures otherwise."""
+
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+        parcels_table = dataset['tables']['parcels']
+        stats_table = periodStatsTable(dataset)
+        logging.debug(f'getParcelStatsPeers {parcels_table}{ptype}, {stype}, {value}')
+
+        if stype not in PEER_STATS:
+            print(f"Not supported stats type {stype}")
+            return data
+        # The stats type of the period stats (n) and of the signatures
+        # (count).
+        stype = {v: k for k, v in SIGNATURE_STATS.items()}.get(stype, stype)
+        if len(value.split('-')) == 2:
+            vmin, vmax = value.split('-')
         else:
-            print("No parcel peers found in",
-                  f"{parcels_table} with {stype}, ({value})")
-        return data
+            vmin = vmax = value
+        params = {'band': band, 'start': start_date, 'end': end_date,
+                  'vmin': float(vmin), 'vmax': float(vmax),
+                  'period': period, 'max': int(maxPeers)}
+
+        try:
+            names = {'parcels': db_sql.table(dataset, 'parcels', ptype),
+                     'parcel_id': db_sql.column(dataset, 'parcel_id')}
+            if tableExists(conn, stats_table):
+                names['stype'] = sql.Identifier(stype)
+                getTableDataSql = db_sql.query("""
+                    SELECT p.{parcel_id}::text as pids
+                    FROM {stats_table} s, {parcels} p
+                    WHERE p.ogc_fid = s.pid
+                    AND s.period_type = %(period)s
+                    AND s.band = %(band)s
+                    AND s.{stype} BETWEEN %(vmin)s AND %(vmax)s
+                    AND s.period BETWEEN
+                        date_trunc(%(period)s, %(start)s::date)::date
+                        AND %(end)s::date
+                    GROUP BY p.{parcel_id}
+                    LIMIT %(max)s;
+                    """, stats_table=db_sql.identifier(stats_table), **names)
+            else:
+                names['stype'] = sql.Identifier(
+                    SIGNATURE_STATS.get(stype, stype))
+                getTableDataSql = db_sql.query("""
+                    SELECT p.{parcel_id}::text as pids FROM {sigs_table} s, {parcels} p, {dias_catalog} d
+                    WHERE s.obsid = d.id AND p.ogc_fid = s.pid
+                    AND s.band = %(band)s
+                    AND s.{stype} BETWEEN %(vmin)s AND %(vmax)s
+                    AND d.obstime BETWEEN (%(start)s || ' 00:00:00')::timestamp
+                    AND (%(end)s || ' 23:59:59')::timestamp
+                    GROUP BY p.{parcel_id}
+                    LIMIT %(max)s;
+                    """, sigs_table=db_sql.table(dataset, 's2'),
+                    dias_catalog=db_sql.table(dataset, 'dias_catalog'),
+                    **names)
+            logging.debug(getTableDataSql)
+            cur.execute(getTableDataSql, params)
+            rows = cur.fetchall()
+
+    #         data.append(tuple(etup.name for etup in cur.description))
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(r[0])
+            else:
+                print("No parcel peers found in",
+                      f"{parcels_table} with {stype}, ({value})")
+            return data
+
+        except Exception as err:
+            print("Did not find data, please select the right database and table: ",
+                  err)
+            return data.append('Ended with no data')
+
+
+def getPeersTimeSeries(dataset, pid, distance, maxPeers, ptype='',
+                       tstype='s2', band='', period='week'):
+    """Get the weekly (or monthly) time series of the parcel peers: for each
+    period and band the number of peers and the mean and percentiles of
+    their period means, from the period stats table."""
+    peers = getParcelPeers(dataset, pid, distance, maxPeers, ptype)
+    pids = [r[0] for r in peers[1:]] if peers else []
+
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor()
+        data = []
+        band_sql = "AND s.band = %(band)s" if band else ""
+
+        try:
+            getTableDataSql = db_sql.query(f"""
+                WITH peers AS (
+                    SELECT ogc_fid FROM {{parcels}}
+                    WHERE {{parcel_id}}::text = ANY(%(pids)s))
+                SELECT s.period::text As period, s.band,
+                    count(*) As peers, sum(s.n) As observations,
+                    avg(s.mean) As mean,
+                    percentile_cont(0.25) WITHIN GROUP (ORDER BY s.mean)
+                        As p25,
+                    percentile_cont(0.5) WITHIN GROUP (ORDER BY s.mean)
+                        As p50,
+                    percentile_cont(0.75) WITHIN GROUP (ORDER BY s.mean)
+                        As p75
+                FROM {{stats_table}} s JOIN peers ON s.pid = peers.ogc_fid
+                WHERE s.period_type = %(period)s {band_sql}
+                GROUP BY s.period, s.band
+                ORDER BY s.period, s.band;
+                """, parcels=db_sql.table(dataset, 'parcels', ptype),
+                parcel_id=db_sql.column(dataset, 'parcel_id'),
+                stats_table=db_sql.identifier(
+                    periodStatsTable(dataset, tstype)))
+            cur.execute(getTableDataSql, {'pids': pids, 'band': band,
+                                          'period': period})
+            rows = cur.fetchall()
+            data.append(tuple(etup.name for etup in cur.description))
+            for r in rows:
+                data.append(tuple(r))
+            return data
 
-    except Exception as err:
-        print("Did not find data, please select the right database and table: ",
-              err)
-        return data.append('Ended with no data')
+        except Exception as err:
+            print("Did not find data, please select the right database and table: ",
+                  err)
+            return data.append('Ended with no data')
 
 
 def getS2frames(dataset, pid, start, end, ptype=''):
     """Get the sentinel images frames from dias cataloge for the given parcel"""
 
-    conn = db.conn(dataset['db'])
+    with db.pooled(dataset['db']) as conn:
+        # Get the S2 frames that cover a parcel identified by parcel
+        # ID from the dias_catalogue for the selected date.
 
-    dias_catalog = dataset['tables']['dias_catalog']
-    parcels_table = dataset['tables']['parcels']
-    parcel_id = dataset['pcolumns']['parcel_id']
-    # Get the S2 frames that cover a parcel identified by parcel
-    # ID from the dias_catalogue for the selected date.
-
-    end_date = pd.to_datetime(end) + pd.DateOffset(days=1)
-
-    getS2framesSql = f"""
-        SELECT reference, obstime, status
-        FROM {dias_catalog}, {parcels_table}{ptype}
-        WHERE card = 's2'
-        And footprint && st_transform(wkb_geometry, 4326)
-        And {parcel_id} = '{pid}'
-        And obstime between '{start}' and '{end_date}'
-        ORDER by obstime asc;
-    """
+        end_date = pd.to_datetime(end) + pd.DateOffset(days=1)
 
-    # Read result set into a pandas dataframe
-    df_s2frames = pd.read_sql_query(getS2framesSql, conn)
+        getS2framesSql = db_sql.query("""
+            SELECT reference, obstime, status
+            FROM {dias_catalog}, {parcels}
+            WHERE card = 's2'
+            And footprint && st_transform(wkb_geometry, 4326)
+            And {parcel_id} = %(pid)s
+            And obstime between %(start)s and %(end)s
+            ORDER by obstime asc;
+        """, dias_catalog=db_sql.table(dataset, 'dias_catalog'),
+            parcels=db_sql.table(dataset, 'parcels', ptype),
+            parcel_id=db_sql.column(dataset, 'parcel_id'))
 
-    return df_s2frames['reference'].tolist()
+        # Read result set into a pandas dataframe
+        df_s2frames = pd.read_sql_query(
+            getS2framesSql.as_string(conn), conn,
+            params={'pid': str(pid), 'start': start,
+                    'end': end_date.to_pydatetime()})
+
+        return df_s2frames['reference'].tolist()
 
 
 def getSRID(dataset, ptype=''):
     """Get the SRID"""
     # Get parcels SRID.
 
-    conn = db.conn(dataset['db'])
-
-    pgq_srid = f"""
-        SELECT ST_SRID(wkb_geometry)
-        FROM {dataset['tables']['parcels']}{ptype}
-        LIMIT 1;
-        """
+    with db.pooled(dataset['db']) as conn:
+        pgq_srid = db_sql.query("""
+            SELECT ST_SRID(wkb_geometry)
+            FROM {parcels}
+            LIMIT 1;
+            """, parcels=db_sql.table(dataset, 'parcels', ptype))
 
-    df_srid = pd.read_sql_query(pgq_srid, conn)
-    srid = df_srid['st_srid'][0]
-    target_EPSG = int(srid)
+        df_srid = pd.read_sql_query(pgq_srid.as_string(conn), conn)
+        srid = df_srid['st_srid'][0]
+        target_EPSG = int(srid)
 
-    return target_EPSG
+        return target_EPSG
 
 
 def getParcelSCL(dataset, pid, ptype=''):
 
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcel_id = dataset['pcolumns']['parcel_id']
-
-    try:
-        getTableDataSql = f"""
-            SELECT h.obsid, h.hist
-            FROM {dataset['tables']['scl']} h,
-                {dataset['tables']['parcels']}{ptype} p
-            WHERE h.pid = p.ogc_fid
-            And p.{parcel_id} = '{pid}'
-            ORDER By h.obsid Asc;
-        """
-        #  Return a list of tuples
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-        data.append(tuple(etup.name for etup in cur.description))
-
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
-        else:
-            print("No SCL time series found for",
-                  f"{dataset['tables']['parcels']}{ptype}")
-        return data
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+
+        try:
+            getTableDataSql = db_sql.query("""
+                SELECT h.obsid, h.hist
+                FROM {scl} h, {parcels} p
+                WHERE h.pid = p.ogc_fid
+                And p.{parcel_id} = %(pid)s
+                ORDER By h.obsid Asc;
+            """, scl=db_sql.table(dataset, 'scl'),
+                parcels=db_sql.table(dataset, 'parcels', ptype),
+                parcel_id=db_sql.column(dataset, 'parcel_id'))
+            #  Return a list of tuples
+            db_sql.execute(cur, getTableDataSql, {'pid': str(pid)},
+                           prepare=True)
+            rows = cur.fetchall()
+            data.append(tuple(etup.name for etup in cur.description))
+
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
+            else:
+                print("No SCL time series found for",
+                      f"{dataset['tables']['parcels']}{ptype}")
+            return data
 
-    except Exception as err:
-        print("Did not find data, please select the right database and table: ",
-              err)
-        return data.append('Ended with no data')
+        except Exception as err:
+            print("Did not find data, please select the right database and table: ",
+                  err)
+            return data.append('Ended with no data')
 
 
 def getParcelCentroid(dataset, pid, ptype=''):
 
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
-    parcel_id = dataset['pcolumns']['parcel_id']
-
-    try:
-        getTableDataSql = f"""
-        SELECT ST_Asgeojson(ST_transform(ST_Centroid(wkb_geometry), 4326))
-        FROM {dataset['tables']['parcels']}{ptype}
-        WHERE {parcel_id} = '{pid}'
-        LIMIT 1;
-        """
-        #  Return a list of tuples
-        cur.execute(getTableDataSql)
-        json_centroid = cur.fetchall()[0]
-        return json.loads(json_centroid[0])['coordinates']
-
-    except Exception as err:
-        print("Can not get the parcel centroid: ", err)
-        return data.append('Ended with no data')
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+
+        try:
+            getTableDataSql = db_sql.query("""
+            SELECT ST_Asgeojson(ST_transform(ST_Centroid(wkb_geometry), 4326))
+            FROM {parcels}
+            WHERE {parcel_id} = %(pid)s
+            LIMIT 1;
+            """, parcels=db_sql.table(dataset, 'parcels', ptype),
+                parcel_id=db_sql.column(dataset, 'parcel_id'))
+            #  Return a list of tuples
+            db_sql.execute(cur, getTableDataSql, {'pid': str(pid)},
+                           prepare=True)
+            json_centroid = cur.fetchall()[0]
+            return json.loads(json_centroid[0])['coordinates']
+
+        except Exception as err:
+            print("Can not get the parcel centroid: ", err)
+            return data.append('Ended with no data')
 
 
 def getPolygonCentroid(dataset, pid, ptype=''):
     """Get the centroid of the given polygon"""
 
-    conn = db.conn(dataset['db'])
-    parcel_id = dataset['pcolumns']['parcel_id']
+    with db.pooled(dataset['db']) as conn:
+        getParcelPolygonSql = db_sql.query("""
+            SELECT ST_Asgeojson(ST_transform(ST_Centroid(wkb_geometry), 4326))
+                As center, ST_Asgeojson(st_transform(wkb_geometry, 4326)) As polygon
+            FROM {parcels}
+            WHERE {parcel_id} = %(pid)s
+            LIMIT 1;
+        """, parcels=db_sql.table(dataset, 'parcels', ptype),
+            parcel_id=db_sql.column(dataset, 'parcel_id'))
 
-    getParcelPolygonSql = f"""
-        SELECT ST_Asgeojson(ST_transform(ST_Centroid(wkb_geometry), 4326))
-            As center, ST_Asgeojson(st_transform(wkb_geometry, 4326)) As polygon
-        FROM {dataset['tables']['parcels']}{ptype}
-        WHERE {parcel_id} = '{pid}'
-        LIMIT 1;
-    """
+        # Read result set into a pandas dataframe
+        df_pcent = pd.read_sql_query(getParcelPolygonSql.as_string(conn),
+                                     conn, params={'pid': str(pid)})
 
-    # Read result set into a pandas dataframe
-    df_pcent = pd.read_sql_query(getParcelPolygonSql, conn)
-
-    return df_pcent
+        return df_pcent
 
 
 def getTableCentroid(dataset, ptype=''):
 
-    conn = db.conn(dataset['db'])
-
-    getTablePolygonSql = f"""
-        SELECT ST_Asgeojson(ST_Transform(ST_PointOnSurface(ST_Union(geom)),
-            4326)) As center
-        FROM (SELECT wkb_geometry
-        FROM {dataset['tables']['parcels']}{ptype}
-        LIMIT 100) AS t(geom);
-    """
-    # Read result set into a pandas dataframe
-    df_tcent = pd.read_sql_query(getTablePolygonSql, conn)
+    with db.pooled(dataset['db']) as conn:
+        getTablePolygonSql = db_sql.query("""
+            SELECT ST_Asgeojson(ST_Transform(ST_PointOnSurface(ST_Union(geom)),
+                4326)) As center
+            FROM (SELECT wkb_geometry
+            FROM {parcels}
+            LIMIT 100) AS t(geom);
+        """, parcels=db_sql.table(dataset, 'parcels', ptype))
+        # Read result set into a pandas dataframe
+        df_tcent = pd.read_sql_query(getTablePolygonSql.as_string(conn), conn)
 
-    return df_tcent
+        return df_tcent
 
 
 def get_datasets():
@@ -631,57 +1112,57 @@ def get_datasets():
 
 
 def pids(dataset, limit=1, ptype='', random=False):
-    conn = db.conn(dataset['db'])
-    if random:
-        randomSql = "TABLESAMPLE SYSTEM(0.1)"
-    else:
-        randomSql = ""
-
-    getSql = f"""
-        SELECT {dataset['pcolumns']['parcel_id']}::text as pids
-        FROM {dataset['tables']['parcels']}{ptype}
-        {randomSql} LIMIT {limit};
-    """
-    # Read result set into a pandas dataframe
-    df = pd.read_sql_query(getSql, conn)
+    with db.pooled(dataset['db']) as conn:
+        if random:
+            randomSql = "TABLESAMPLE SYSTEM(0.1)"
+        else:
+            randomSql = ""
 
-    return df
+        getSql = db_sql.query(f"""
+            SELECT {{parcel_id}}::text as pids
+            FROM {{parcels}}
+            {randomSql} LIMIT %(limit)s;
+        """, parcels=db_sql.table(dataset, 'parcels', ptype),
+            parcel_id=db_sql.column(dataset, 'parcel_id'))
+        # Read result set into a pandas dataframe
+        df = pd.read_sql_query(getSql.as_string(conn), conn,
+                               params={'limit': int(limit)})
 
+        return df
 
-def markers(dataset, aoi, year, pid, ptype=''):
 
-    conn = db.conn(dataset['db'])
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    data = []
+def markers(dataset, aoi, year, pid, ptype=''):
 
-    try:
-        logging.debug("start queries")
-        parcel_id = dataset['pcolumns']['parcel_id']
-
-        getTableDataSql = f"""
-            SELECT foi_id, marker, marker_type, date_start::text,
-                date_main::text, date_end::text, duration_days,
-                value_1, value_2, value_3, pid, practice
-            FROM {aoi}.markers_2020
-            WHERE {parcel_id} = '{pid}';
-        """
-
-        #  Return a list of tuples
-        # print(getTableDataSql)
-        cur.execute(getTableDataSql)
-        rows = cur.fetchall()
-
-        data.append(tuple(etup.name for etup in cur.description))
-        if len(rows) > 0:
-            for r in rows:
-                data.append(tuple(r))
-        else:
-            logging.debug(
-                f"No parcel found in the selected table with id ({pid}).")
-        return data
-
-    except Exception as err:
-        print(err)
-        logging.debug("Did not find data, please select the right database",
-                      "and table: ", err)
-        return data.append('Ended with no data')
+    with db.pooled(dataset['db']) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        data = []
+
+        try:
+            logging.debug("start queries")
+            getTableDataSql = db_sql.query("""
+                SELECT foi_id, marker, marker_type, date_start::text,
+                    date_main::text, date_end::text, duration_days,
+                    value_1, value_2, value_3, pid, practice
+                FROM {markers}
+                WHERE {parcel_id} = %(pid)s;
+            """, markers=db_sql.identifier(f"{aoi}.markers_2020"),
+                parcel_id=db_sql.column(dataset, 'parcel_id'))
+
+            # Return a list of tuples
+            cur.execute(getTableDataSql, {'pid': str(pid)})
+            rows = cur.fetchall()
+
+            data.append(tuple(etup.name for etup in cur.description))
+            if len(rows) > 0:
+                for r in rows:
+                    data.append(tuple(r))
+            else:
+                logging.debug(
+                    f"No parcel found in the selected table with id ({pid}).")
+            return data
+
+        except Exception as err:
+            print(err)
+            logging.debug("Did not find data, please select the right database",
+                          "and table: ", err)
+            return data.append('Ended with no data')
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Safe and prepared SQL statements for the API queries.
+
+The table and column names of the queries come from the dataset
+configuration (config/datasets.json) and from the parcel type (ptype) of the
+request. They are checked with identifier() and quoted with psycopg2.sql.
+All the values are bound parameters (%(name)s).
+
+The statements that run most often (parcel by id or location, time series)
+are run with execute(..., prepare=True). On the pooled connections
+(db.Connection) they are prepared once with PREPARE, and after that run
+with EXECUTE, so PostgreSQL does not parse and plan them again for each
+request. On other connections they are executed as usual.
+"""
+
+import re
+import hashlib
+
+from psycopg2 import sql
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+PTYPE = re.compile(r'^[A-Za-z0-9_]*$')
+MAX_IDENTIFIER = 63  # PostgreSQL NAMEDATALEN - 1.
+_PLACEHOLDER = re.compile(r'%%|%\((\w+)\)s')
+
+
+def identifier(name):
+    """Get the quoted identifier of a (schema qualified) table or column
+    name, a ValueError is raised if it is not a plain SQL name. The name is
+    folded to lower case, as PostgreSQL does with unquoted names."""
+    parts = str(name).split('.')
+    if len(parts) > 2 or not all(IDENTIFIER.match(p) and
+                                 len(p) <= MAX_IDENTIFIER for p in parts):
+        raise ValueError(f"Not a valid table or column name: '{name}'")
+    return sql.Identifier(*[p.lower() for p in parts])
+
+
+def table(dataset, key, ptype=''):
+    """Get the quoted name of a table of the dataset, with the parcel type
+    suffix (e.g. '_m') for the parcels tables."""
+    if not PTYPE.match(ptype):
+        raise ValueError(f"Not a valid parcel type: '{ptype}'")
+    return identifier(f"{dataset['tables'][key]}{ptype}")
+
+
+def column(dataset, key):
+    """Get the quoted name of a parcels table column of the dataset."""
+    return identifier(dataset['pcolumns'][key])
+
+
+def query(text, **identifiers):
+    """Compose a query with the {name} identifiers (or sql fragments)."""
+    return sql.SQL(text).format(**identifiers)
+
+
+def prepare_sql(text):
+    """Get the PREPARE text of a query with %(name)s placeholders, with $n
+    parameters, and the list of the parameter names."""
+    names = []
+
+    def param(m):
+        if m.group(1) is None:
+            return '%'
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return f"${names.index(m.group(1)) + 1}"
+    return _PLACEHOLDER.sub(param, text), names
+
+
+def statement_name(text):
+    return f"cbm_{hashlib.md5(text.encode()).hexdigest()[:16]}"
+
+
+def execute(cur, statement, params=None, prepare=False):
+    """Execute a query (str or psycopg2.sql.Composable) with the params (dict).
+
+    With prepare=True the query is prepared on first use on connections that
+    keep their prepared statements (db.Connection), and the later calls with
+    the same query text only bind the params.
+    """
+    prepared = getattr(cur.connection, 'prepared', None)
+    if not prepare or prepared is None:
+        return cur.execute(statement, params)
+    if not isinstance(statement, str):
+        statement = statement.as_string(cur.connection)
+    name = statement_name(statement)
+    if name not in prepared:
+        text, names = prepare_sql(statement)
+        cur.execute(f"PREPARE {name} AS {text}")
+        prepared[name] = names
+    names = prepared[name]
+    if names:
+        args = ', '.join([f"%({n})s" for n in names])
+        return cur.execute(f"EXECUTE {name} ({args})", params)
+    return cur.execute(f"EXECUTE {name}")
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Metrics of the API, in the Prometheus text format (/metrics).
+
+For each route the number of requests and histograms of the request
+duration and of the time spent in the database and in the chip extraction
+are kept. The database time is measured by the cursors of the pooled
+connections (db.TimedConnection), the chip time by timed('chips'). The
+metrics of the connection pools, the response and chip caches and the
+admission control are collected when the metrics are read.
+
+The metrics are kept in memory by each server process.
+"""
+
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+KINDS = ['db', 'chips']  # The timed parts of a request.
+
+_lock = threading.Lock()
+_request = threading.local()
+
+
+class Histogram:
+    """A histogram with labels, the buckets are cumulative when rendered."""
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # labels: [bucket counts..., sum, count]
+
+    def observe(self, value, *labels):
+        with _lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        with _lock:
+            series = {k: list(v) for k, v in self.series.items()}
+        for labels, values in sorted(series.items()):
+            base = _labels(self.labels, labels)
+            total = 0
+            for bound, count in zip(self.buckets, values):
+                total += count
+                lines.append(f"{self.name}_bucket{{{base}le=\"{bound}\"}} "
+                             f"{total}")
+            lines.append(f"{self.name}_bucket{{{base}le=\"+Inf\"}} "
+                         f"{values[-1]}")
+            lines.append(f"{self.name}_sum{{{base.rstrip(',')}}} "
+                         f"{values[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{base.rstrip(',')}}} "
+                         f"{values[-1]}")
+        return lines
+
+
+class Counter:
+    """A counter with labels."""
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = defaultdict(int)
+
+    def inc(self, *labels, value=1):
+        with _lock:
+            self.series[labels] += value
+
+    def render(self):
+        with _lock:
+            series = dict(self.series)
+        return _render(self.name, self.help, 'counter', [
+            (dict(zip(self.labels, k)), v) for k, v in sorted(series.items())])
+
+
+REQUESTS = Counter('cbm_http_requests_total', "HTTP requests.",
+                   ['route', 'method', 'status'])
+DURATION = Histogram('cbm_http_request_duration_seconds',
+                     "Duration of the HTTP requests, until the response is "
+                     "sent.", ['route', 'method'])
+PARTS = {kind: Histogram(f'cbm_http_request_{kind}_seconds',
+                         f"Time spent in {kind} by the HTTP requests.",
+                         ['route']) for kind in KINDS}
+TOTALS = {kind: Counter(f'cbm_{kind}_seconds_total',
+                        f"Time spent in {kind}, by all the requests and "
+                        "jobs.", []) for kind in KINDS}
+QUERIES = Counter('cbm_db_queries_total', "Executed database queries.", [])
+CHIP_JOBS = Histogram('cbm_chip_job_duration_seconds',
+                      "Duration of the chip extraction jobs.",
+                      ['query', 'status'])
+
+
+def _labels(names, values):
+    return ''.join([f'{n}="{_escape(v)}",' for n, v in zip(names, values)])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _render(name, help, mtype, samples):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {mtype}"]
+    for labels, value in samples:
+        if value is None:
+            continue
+        base = _labels(labels.keys(), labels.values()).rstrip(',')
+        lines.append(f"{name}{{{base}}} {value}" if base
+                     else f"{name} {value}")
+    return lines
+
+
+def add(kind, seconds):
+    """Add the seconds spent in a kind of work ('db' or 'chips') to the
+    current request of this thread and to the totals."""
+    parts = getattr(_request, 'parts', None)
+    if parts is not None:
+        parts[kind] += seconds
+    TOTALS[kind].inc(value=seconds)
+
+
+@contextmanager
+def timed(kind):
+    """Time the work in the context, e.g.:
+        with metrics.timed('chips'):
+            backgroundExtract.getBackgroundExtract(...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(kind, time.perf_counter() - start)
+
+
+def start_request():
+    """Start the timing of the request of this thread."""
+    _request.start = time.perf_counter()
+    _request.parts = dict.fromkeys(KINDS, 0.0)
+
+
+def end_request(route, method, status):
+    """Record the request of this thread, and get its duration and the time
+    spent in each kind of work (seconds)."""
+    start = getattr(_request, 'start', None)
+    parts = getattr(_request, 'parts', None) or dict.fromkeys(KINDS, 0.0)
+    _request.start, _request.parts = None, None
+    duration = time.perf_counter() - start if start else 0.0
+    REQUESTS.inc(route, method, str(status))
+    DURATION.observe(duration, route, method)
+    for kind, seconds in parts.items():
+        PARTS[kind].observe(seconds, route)
+    return duration, parts
+
+
+def access_record(duration, parts, **fields):
+    """Get the json line of the access log of a request."""
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), **fields,
+              'duration_ms': round(duration * 1000, 3)}
+    for kind, seconds in parts.items():
+        record[f'{kind}_ms'] = round(seconds * 1000, 3)
+    return json.dumps(record)
+
+
+def _collected():
+    """The metrics of the pools, caches and admission control."""
+    lines = []
+    try:
+        from scripts import db
+        pools = db.pool_metrics()
+        for key, name, mtype in [
+                ('in_use', 'in_use', 'gauge'), ('max', 'max', 'gauge'),
+                ('saturation', 'saturation', 'gauge'),
+                ('checkouts', 'checkouts_total', 'counter'),
+                ('waits', 'waits_total', 'counter'),
+                ('timeouts', 'timeouts_total', 'counter'),
+                ('wait_time', 'wait_seconds_total', 'counter'),
+                ('discarded', 'discarded_total', 'counter')]:
+            lines += _render(f'cbm_db_pool_{name}', f"Connection pool "
+                             f"{key.replace('_', ' ')}.", mtype, [
+                                 ({'db': d}, m[key]) for d, m in
+                                 sorted(pools.items())])
+    except Exception as err:
+        print("Can not get the connection pool metrics:", err)
+    try:
+        from scripts import response_cache
+        stats = dict(response_cache.stats)
+        lines += _render('cbm_response_cache_requests_total',
+                         "Response cache lookups.", 'counter', [
+                             ({'result': k}, v) for k, v in
+                             sorted(stats.items())])
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        lines += _render('cbm_response_cache_hit_ratio',
+                         "Response cache hit ratio.", 'gauge', [
+                             ({}, stats.get('hits', 0) / lookups
+                              if lookups else None)])
+    except Exception as err:
+        print("Can not get the response cache metrics:", err)
+    try:
+        from scripts.chip_extract import chipCache
+        # The stores are not created by the metrics.
+        chips = chipCache.cache(create=False)
+        stats = chips.stats() if chips is not None else {}
+        lines += _render('cbm_chip_cache_requests_total',
+                         "Chip cache lookups.", 'counter', [
+                             ({'result': k}, stats.get(k)) for k in
+                             ['hits', 'misses']])
+        lines += _render('cbm_chip_cache_evictions_total',
+                         "Chips evicted from the chip cache.", 'counter',
+                         [({}, stats.get('evictions'))])
+        lines += _render('cbm_chip_cache_hit_ratio',
+                         "Chip cache hit ratio.", 'gauge',
+                         [({}, stats.get('hit_ratio'))])
+        lines += _render('cbm_chip_cache_chips', "Chips in the chip cache.",
+                         'gauge', [({}, stats.get('chips'))])
+        lines += _render('cbm_chip_cache_bytes', "Size of the chip cache.",
+                         'gauge', [({}, stats.get('size'))])
+    except Exception as err:
+        print("Can not get the chip cache metrics:", err)
+    try:
+        from scripts.chip_extract import sceneCache
+        scenes = sceneCache.cache(create=False)
+        stats = scenes.stats() if scenes is not None else {}
+        lines += _render('cbm_scene_cache_requests_total',
+                         "Scene cache lookups.", 'counter', [
+                             ({'result': k}, stats.get(k)) for k in
+                             ['hits', 'misses']])
+        lines += _render('cbm_scene_cache_evictions_total',
+                         "Images evicted from the scene cache.", 'counter',
+                         [({}, stats.get('evictions'))])
+        lines += _render('cbm_scene_cache_bytes', "Size of the scene cache.",
+                         'gauge', [({}, stats.get('size'))])
+        lines += _render('cbm_scene_cache_transcode_seconds', "Mean time "
+                         "to transcode an image.", 'gauge',
+                         [({}, stats.get('transcode_seconds'))])
+    except Exception as err:
+        print("Can not get the scene cache metrics:", err)
+    try:
+        from scripts import admission
+        stats = admission.metrics()
+        lines += _render('cbm_admission_active', "Admitted requests "
+                         "running.", 'gauge', [
+                             ({'class': c}, v) for c, v in
+                             stats['active'].items()])
+        lines += _render('cbm_admission_waiting', "Requests waiting for a "
+                         "slot.", 'gauge', [({}, stats['waiting'])])
+        lines += _render('cbm_admission_requests_total', "Admission "
+                         "decisions.", 'counter', [
+                             ({'result': k}, stats.get(k, 0)) for k in
+                             ['admitted', 'waits', 'rejected_429',
+                              'rejected_503']])
+    except Exception as err:
+        print("Can not get the admission metrics:", err)
+    return lines
+
+
+def render():
+    """Get all the metrics in the Prometheus text format."""
+    lines = REQUESTS.render() + DURATION.render()
+    for kind in KINDS:
+        lines += PARTS[kind].render() + TOTALS[kind].render()
+    lines += QUERIES.render() + CHIP_JOBS.render()
+    lines += _collected()
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Export the signatures of a parcel selection as a dense array cube.
+
+The cube has the dimensions parcel x time x band x stat, the time axis has
+the days with acquisitions in the date range (a parcel in the overlap of
+two tiles keeps the observation with the most pixels). The arrays are:
+  signatures (parcel, time, band, stat)
+      - float32, NaN for the missing observations.
+  observed (parcel, time, band)
+      - The mask of the observations.
+  scl (parcel, time, scl_class)
+      - Pixel counts of the scene classes (SCL) of the parcel (s2 only).
+  cloudfree (parcel, time)
+      - Observed without pixels of the SCL_CLOUDY classes (s2 only).
+with the coordinates parcel (the ids of the parcels with signatures), time,
+band, stat and scl_class.
+
+The formats are:
+  zarr
+      - A Zarr (version 2) store, chunked by CHUNK_PARCELS parcels and zlib
+        compressed, written without the zarr package. It is read lazily with
+        xarray.open_zarr(path).
+  npz
+      - One compressed numpy file for each CHUNK_PARCELS parcels, with the
+        arrays and coordinates of the parcels.
+Only the parcels of one chunk are kept in memory. The store is sent as a
+zip file (not compressed, the chunks are).
+"""
+
+import os
+import json
+import zlib
+import shutil
+import zipfile
+from datetime import date
+
+import numpy as np
+
+CHUNK_PARCELS = 256  # Parcels of each chunk of the arrays.
+MAX_PARCELS = 1000000  # Max parcels of a cube.
+COMPRESSION = 1  # The zlib compression level of the zarr chunks.
+STATS = ['count', 'mean', 'std', 'min', 'p25', 'p50', 'p75', 'max']
+SCL_CLASSES = 12  # The Sentinel-2 scene classes, 0 to 11.
+SCL_CLOUDY = [3, 8, 9, 10, 11]  # Shadows, clouds, cirrus and snow.
+FORMATS = ['zarr', 'npz']
+EPOCH = date(1970, 1, 1)
+TIME_UNITS = 'days since 1970-01-01'
+
+
+class Chunk:
+    """The arrays of the parcels of one chunk, with the days (since EPOCH)
+    of the time axis and the bands."""
+
+    def __init__(self, days, bands, scl=True):
+        self.days = {d: i for i, d in enumerate(days)}
+        self.bands = {b: i for i, b in enumerate(bands)}
+        shape = (CHUNK_PARCELS, len(days), len(bands))
+        self.arrays = {
+            'signatures': np.full(shape + (len(STATS),), np.nan, 'float32'),
+            'observed': np.zeros(shape, 'bool')}
+        if scl:
+            self.arrays['scl'] = np.zeros(shape[:2] + (SCL_CLASSES,),
+                                          'uint32')
+            self.arrays['cloudfree'] = np.zeros(shape[:2], 'bool')
+        self.pids = []
+
+    def add(self, pid, columns, rows):
+        """Add the time series of a parcel, as yielded by
+        db_queries.getParcelsTimeSeries (the first column is the epoch)."""
+        p = len(self.pids)
+        self.pids.append(str(pid))
+        stats = [columns.index(s) for s in STATS]
+        hist = columns.index('hist') if 'scl' in self.arrays and \
+            'hist' in columns else None
+        sigs = self.arrays['signatures']
+        observed = self.arrays['observed']
+        for row in rows:
+            t = self.days.get(int(float(row[0]) // 86400))
+            b = self.bands.get(row[1])
+            if t is None or b is None:
+                continue
+            count = row[stats[0]] or 0
+            if observed[p, t, b] and sigs[p, t, b, 0] >= count:
+                continue  # From an other tile, with more pixels.
+            sigs[p, t, b] = [np.nan if row[i] is None else row[i]
+                             for i in stats]
+            observed[p, t, b] = True
+            if hist is not None and row[hist]:
+                self.add_scl(p, t, row[hist])
+
+    def add_scl(self, p, t, hist):
+        if isinstance(hist, str):
+            hist = json.loads(hist.replace("'", '"'))
+        counts = np.zeros(SCL_CLASSES, 'uint32')
+        for c, n in hist.items():
+            if 0 <= int(c) < SCL_CLASSES:
+                counts[int(c)] = n
+        self.arrays['scl'][p, t] = counts
+        self.arrays['cloudfree'][p, t] = not counts[SCL_CLOUDY].any()
+
+    def full(self):
+        return len(self.pids) >= CHUNK_PARCELS
+
+
+# The dimensions and fill values of the arrays (only the signatures are
+# masked by the readers).
+DIMENSIONS = {
+    'signatures': (['parcel', 'time', 'band', 'stat'], 'NaN'),
+    'observed': (['parcel', 'time', 'band'], None),
+    'scl': (['parcel', 'time', 'scl_class'], None),
+    'cloudfree': (['parcel', 'time'], None)}
+
+
+class ZarrStore:
+    """A Zarr (version 2) store of the cube, with consolidated metadata."""
+
+    def __init__(self, path, days, bands, attrs=None):
+        self.path = path
+        self.coords = {
+            'time': np.array(days, 'int32'),
+            'band': np.array(bands, 'U'),
+            'stat': np.array(STATS, 'U'),
+            'scl_class': np.arange(SCL_CLASSES, dtype='uint8')}
+        self.attrs = attrs or {}
+        self.metadata = {}
+        self.pids = []
+        self.chunks = 0
+        self.arrays = {}  # name: (dtype, chunk shape)
+        os.makedirs(path, exist_ok=True)
+
+    def _chunk(self, name, key, data):
+        os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        with open(os.path.join(self.path, name, key), 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(data).tobytes(),
+                                  COMPRESSION))
+
+    def write(self, chunk):
+        """Write the arrays of a chunk of parcels."""
+        for name, data in chunk.arrays.items():
+            self.arrays[name] = (data.dtype, data.shape)
+            key = '.'.join([str(self.chunks)] + ['0'] * (data.ndim - 1))
+            self._chunk(name, key, data)
+        self.pids += chunk.pids
+        self.chunks += 1
+
+    def _array(self, name, dtype, shape, chunks, dims, fill, attrs=None):
+        self.metadata[f'{name}/.zarray'] = {
+            'zarr_format': 2, 'shape': list(shape), 'chunks': list(chunks),
+            'dtype': np.dtype(dtype).str, 'compressor': {
+                'id': 'zlib', 'level': COMPRESSION},
+            'fill_value': fill, 'order': 'C', 'filters': None,
+            'dimension_separator': '.'}
+        self.metadata[f'{name}/.zattrs'] = {'_ARRAY_DIMENSIONS': dims,
+                                            **(attrs or {})}
+
+    def close(self):
+        """Write the coordinates and the metadata of the store."""
+        pids = np.array(self.pids or [''], 'U')[:len(self.pids)]
+        for i in range(0, len(pids), CHUNK_PARCELS):
+            part = np.zeros(CHUNK_PARCELS, pids.dtype)
+            part[:len(pids[i:i + CHUNK_PARCELS])] = pids[i:i + CHUNK_PARCELS]
+            self._chunk('parcel', str(i // CHUNK_PARCELS), part)
+        self._array('parcel', pids.dtype, [len(pids)], [CHUNK_PARCELS],
+                    ['parcel'], None)
+        for name, values in self.coords.items():
+            self._chunk(name, '0', values)
+            self._array(name, values.dtype, values.shape,
+                        [max(len(values), 1)], [name], None,
+                        {'units': TIME_UNITS, 'calendar':
+                         'proleptic_gregorian'} if name == 'time' else None)
+        for name, (dtype, shape) in self.arrays.items():
+            dims, fill = DIMENSIONS[name]
+            self._array(name, dtype, [len(pids), *shape[1:]], shape, dims,
+                        fill)
+        self.metadata['.zgroup'] = {'zarr_format': 2}
+        self.metadata['.zattrs'] = self.attrs
+        for key, value in self.metadata.items():
+            os.makedirs(os.path.dirname(os.path.join(self.path, key)),
+                        exist_ok=True)
+            with open(os.path.join(self.path, key), 'w') as f:
+                json.dump(value, f)
+        with open(os.path.join(self.path, '.zmetadata'), 'w') as f:
+            json.dump({'zarr_consolidated_format': 1,
+                       'metadata': self.metadata}, f)
+
+
+class NpzStore:
+    """A directory of compressed numpy files, one for each chunk."""
+
+    def __init__(self, path, days, bands, attrs=None):
+        self.path = path
+        self.coords = {
+            'time': np.array(days, 'datetime64[D]'),
+            'band': np.array(bands, 'U'),
+            'stat': np.array(STATS, 'U')}
+        self.attrs = attrs or {}
+        self.chunks = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, chunk):
+        n = len(chunk.pids)
+        np.savez_compressed(
+            os.path.join(self.path, f"cube_{self.chunks:05d}.npz"),
+            parcel=np.array(chunk.pids, 'U'), **self.coords,
+            **{k: v[:n] for k, v in chunk.arrays.items()})
+        self.chunks += 1
+
+    def close(self):
+        with open(os.path.join(self.path, 'attrs.json'), 'w') as f:
+            json.dump({**self.attrs, 'chunks': self.chunks}, f)
+
+
+def write(series, path, days, bands, scl=True, oformat='zarr', attrs=None):
+    """Write the time series of the parcels (pid, columns, rows) to a cube
+    store, days are datetime.date. Returns the number of parcels."""
+    days = [(d - EPOCH).days for d in days]
+    store = (NpzStore if oformat == 'npz' else ZarrStore)(
+        path, days, bands, attrs)
+    parcels = 0
+    chunk = Chunk(days, bands, scl)
+    for pid, columns, rows in series:
+        chunk.add(pid, columns, rows)
+        parcels += 1
+        if chunk.full():
+            store.write(chunk)
+            chunk = Chunk(days, bands, scl)
+    if chunk.pids or not parcels:
+        store.write(chunk)
+    store.close()
+    return parcels
+
+
+def zip_store(path, zip_path):
+    """Zip a store (without compression) and remove it."""
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED,
+                         allowZip64=True) as z:
+        for root, dirs, files in os.walk(path):
+            for f in sorted(files):
+                full = os.path.join(root, f)
+                z.write(full, os.path.relpath(full, os.path.dirname(path)))
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def export(dataset, udir, params):
+    """Export the cube of the parcelsCube job parameters to
+    {udir}/cube.zip. Returns the number of parcels."""
+    from scripts import db_queries
+    ptype = f"_{params['ptype']}" if params.get('ptype') else ''
+    tstype = params.get('tstype', 's2')
+    oformat = params.get('format', 'zarr')
+    pids = params.get('pids')
+    if isinstance(pids, str):
+        pids = [p for p in pids.split(',') if p]
+    scl = tstype.lower() == 's2'
+    days = db_queries.getAcquisitionDays(
+        dataset, tstype, params['start_date'], params['end_date'])
+    bands = db_queries.getSignatureBands(dataset, tstype)
+    series = db_queries.getParcelsTimeSeries(
+        dataset, pids, params.get('polygon'), ptype, tstype, None, scl,
+        False, params['start_date'], params['end_date'], MAX_PARCELS)
+    os.makedirs(udir, exist_ok=True)
+    store = os.path.join(udir, f"cube.{oformat}")
+    shutil.rmtree(store, ignore_errors=True)
+    attrs = {k: params.get(k) for k in ['aoi', 'year', 'ptype', 'tstype',
+                                        'start_date', 'end_date']}
+    parcels = write(series, store, days, bands, scl, oformat, attrs)
+    zip_store(store, os.path.join(udir, 'cube.zip'))
+    return parcels
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+The dataset registry of the API.
+
+The registry holds the datasets of config/datasets.json and the snapshot of
+the information page (/query/info) of each aoi: the parcel types, time
+series, tile map servers and example requests. The snapshot is built once
+and served from memory.
+
+A background thread checks config/datasets.json, config/main.json and the
+tms folder every CHECK_INTERVAL seconds. When they change, the datasets are
+reloaded and only the aois whose configuration changed are rebuilt. The
+other aois are rebuilt one at a time, when they are older than
+REFRESH_INTERVAL seconds.
+
+The version number changes on each change of the datasets or of the
+snapshot, other caches can include it in their keys.
+"""
+
+import os
+import json
+import glob
+import time
+import threading
+
+from scripts import db_queries
+
+datasets_file = 'config/datasets.json'
+main_file = 'config/main.json'
+tms_files = 'tms/*'
+
+CHECK_INTERVAL = 10  # Seconds between the checks of the configuration.
+REFRESH_INTERVAL = 3600  # Seconds after which the snapshot of an aoi is old.
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def aoi_name(dskey):
+    return dskey.split('_')[0]
+
+
+class Registry:
+    """The datasets and the information page snapshot, see the module doc.
+
+    The datasets dictionary is updated in place, so references to it
+    (e.g. main.datasets) always see the current datasets.
+    """
+
+    def __init__(self):
+        self.datasets = {}
+        self.config = {}
+        self.version = 0
+        self._stamp = None
+        self._aois = {}  # aoi: {'key', 'info', 'built'}
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def stamp(self):
+        return (_mtime(datasets_file), _mtime(main_file),
+                tuple(sorted(glob.glob(tms_files))))
+
+    def load(self):
+        """Reload the configuration if it changed, returns True if the
+        datasets changed."""
+        stamp = self.stamp()
+        with self._lock:
+            if stamp == self._stamp:
+                return False
+            datasets = db_queries.get_datasets()
+            try:
+                with open(main_file) as f:
+                    self.config = json.load(f)
+            except Exception as err:
+                print(f"Can not read {main_file}: {err}")
+            changed = datasets != self.datasets
+            # Add the new datasets before removing the old ones, the dict
+            # is never empty for the requests that read it.
+            self.datasets.update(datasets)
+            for dskey in [k for k in self.datasets if k not in datasets]:
+                del self.datasets[dskey]
+            self._stamp = stamp
+            if changed:
+                self.version += 1
+            return changed
+
+    def _aoi_key(self, aoi):
+        # The configuration the snapshot of an aoi depends on.
+        return json.dumps([{k: v for k, v in self.datasets.items()
+                            if aoi_name(k) == aoi},
+                           self.config.get('server'), self._stamp[2]],
+                          sort_keys=True, default=str)
+
+    def aois(self):
+        return list(dict.fromkeys([aoi_name(k) for k in self.datasets]))
+
+    def _build(self, aoi, key):
+        from scripts import info_page
+        info = info_page.aoi_info(self.datasets, aoi, self.server_url())
+        with self._lock:
+            entry = self._aois.get(aoi)
+            if entry is None or entry['info'] != info:
+                self.version += 1
+            self._aois[aoi] = {'key': key, 'info': info,
+                               'built': time.time()}
+
+    def refresh(self, all_old=False):
+        """Reload the configuration if it changed and rebuild the snapshot
+        of the changed aois and of the oldest aoi (or of all the old aois)
+        if it is older than REFRESH_INTERVAL."""
+        self.load()
+        with self._lock:
+            aois = self.aois()
+            for aoi in [a for a in self._aois if a not in aois]:
+                del self._aois[aoi]
+                self.version += 1
+            keys = {aoi: self._aoi_key(aoi) for aoi in aois}
+            changed = [a for a in aois if a not in self._aois or
+                       self._aois[a]['key'] != keys[a]]
+            old = sorted([a for a in aois if a not in changed and
+                          time.time() - self._aois[a]['built'] >
+                          REFRESH_INTERVAL],
+                         key=lambda a: self._aois[a]['built'])
+        for aoi in changed + (old if all_old else old[:1]):
+            try:
+                self._build(aoi, keys[aoi])
+            except Exception as err:
+                print(f"Can not get the information of {aoi}: {err}")
+
+    def server_url(self):
+        return self.config.get('server', {}).get('host', '')
+
+    def snapshot(self, aois=None):
+        """Get the information page of the aois (all by default). The aois
+        that are not built yet are built now."""
+        if self._stamp is None:
+            self.load()
+        aois = self.aois() if aois is None else [
+            a for a in aois if a in self.aois()]
+        missing = [a for a in aois if a not in self._aois]
+        for aoi in missing:
+            try:
+                self._build(aoi, self._aoi_key(aoi))
+            except Exception as err:
+                print(f"Can not get the information of {aoi}: {err}")
+        with self._lock:
+            return {'version': self.version,
+                    'server': self.config.get('server', {}),
+                    'aois': {a: self._aois[a]['info'] for a in aois
+                             if a in self._aois}}
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as err:
+                print("Can not refresh the dataset registry:", err)
+            time.sleep(CHECK_INTERVAL)
+
+    def start(self):
+        """Start the background refresh of the registry, once."""
+        with self._lock:
+            if self._thread is None:
+                self.load()
+                self._thread = threading.Thread(
+                    target=self._run, name='dataset-registry', daemon=True)
+                self._thread.start()
+        return self
+
+
+_registry = Registry()
+
+
+def registry():
+    """Get the dataset registry of this process."""
+    return _registry
+
+
+def datasets():
+    """Get the live datasets dictionary, see Registry."""
+    if _registry._stamp is None:
+        _registry.load()
+    return _registry.datasets
+
+
+def version():
+    """Get the version of the datasets and of the information page."""
+    return _registry.version
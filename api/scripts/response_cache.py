@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Cache of query responses with strong ETags.
+
+The responses are stored in process memory or in a local directory, with
+LRU eviction when the size limit is reached. The cache keys include a
+version of the dataset, taken from the extracted images of the
+dias_catalogue, so all the cached time series of a dataset are renewed
+when a new image is extracted.
+
+The cache is configured in config/main.json, e.g.:
+    "cache": {"backend": "disk", "path": "cache", "max_size_mb": 512}
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from scripts import db
+from scripts import db_sql
+
+db_conf_file = 'config/main.json'
+
+BACKEND = 'memory'  # 'memory', 'disk' or 'none'.
+CACHE_PATH = 'cache/responses'
+MAX_SIZE_MB = 128
+MAX_ENTRY_SIZE = 8 * 1024 * 1024  # Larger responses are not cached.
+VERSION_TTL = 60  # Seconds to reuse a dataset version before checking.
+
+
+class MemoryStore:
+    """Responses kept in process memory."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)['body'])
+            self._entries[key] = entry
+            self.size += len(entry['body'])
+            while self.size > self.max_size and self._entries:
+                old_key, old = self._entries.popitem(last=False)
+                self.size -= len(old['body'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class DiskStore:
+    """Responses kept as files in a local directory.
+
+    Each entry is a '<key>.body' file with a '<key>.json' header file,
+    written atomically. The access time is kept in the file mtime, so the
+    least recently used entries are removed first.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        files = []
+        for f in os.listdir(path):
+            if f.endswith('.body'):
+                stat = os.stat(os.path.join(path, f))
+                files.append((stat.st_mtime, f[:-5], stat.st_size))
+        for mtime, key, size in sorted(files):
+            self._entries[key] = size
+            self.size += size
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    def get(self, key):
+        try:
+            with open(self._file(key, 'json')) as f:
+                entry = json.load(f)
+            with open(self._file(key, 'body'), 'rb') as f:
+                entry['body'] = f.read()
+            os.utime(self._file(key, 'body'))
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        header = {k: v for k, v in entry.items() if k != 'body'}
+        for ext, data, mode in [('body', entry['body'], 'wb'),
+                                ('json', json.dumps(header), 'w')]:
+            tmp = self._file(key, f"{ext}.{os.getpid()}.tmp")
+            with open(tmp, mode) as f:
+                f.write(data)
+            os.replace(tmp, self._file(key, ext))
+        with self._lock:
+            self.size -= self._entries.pop(key, 0)
+            self._entries[key] = len(entry['body'])
+            self.size += len(entry['body'])
+            while self.size > self.max_size and self._entries:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.size -= old_size
+                self._remove(old_key)
+
+    def _remove(self, key):
+        for ext in ['body', 'json']:
+            try:
+                os.remove(self._file(key, ext))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+            self._entries.clear()
+            self.size = 0
+
+
+_store = None
+_store_lock = threading.Lock()
+_versions = {}
+stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'uncached': 0}
+
+
+def store():
+    """Get the configured response store, None if caching is disabled."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                try:
+                    with open(db_conf_file) as f:
+                        conf = json.load(f).get('cache', {})
+                except Exception:
+                    conf = {}
+                backend = conf.get('backend', BACKEND)
+                max_size = int(float(conf.get('max_size_mb', MAX_SIZE_MB))
+                               * 1024 * 1024)
+                if backend == 'disk':
+                    _store = DiskStore(conf.get('path', CACHE_PATH),
+                                       max_size)
+                elif backend == 'memory':
+                    _store = MemoryStore(max_size)
+                else:
+                    _store = False
+    return _store or None
+
+
+def dataset_version(dataset):
+    """Get the version of the dataset signatures.
+
+    The version changes when an image of the dias_catalogue is extracted,
+    it is checked again after VERSION_TTL seconds.
+    """
+    dias_catalog = dataset['tables']['dias_catalog']
+    key = (dataset['db'], dias_catalog)
+    version, checked = _versions.get(key, (None, 0))
+    if time.time() - checked < VERSION_TTL:
+        return version
+    try:
+        with db.pooled(dataset['db']) as conn:
+            cur = conn.cursor()
+            cur.execute(db_sql.query("""
+                SELECT count(*), max(id) FROM {dias_catalog}
+                WHERE status = 'extracted';""",
+                dias_catalog=db_sql.table(dataset, 'dias_catalog')))
+            version = '-'.join([str(v) for v in cur.fetchone()])
+    except Exception as err:
+        print("Can not get the dataset version: ", err)
+        version = None
+    _versions[key] = (version, time.time())
+    return version
+
+
+def cache_key(path, args, accept='', version=None):
+    """Get the cache key of a request."""
+    items = sorted(args.items(multi=True))
+    data = json.dumps([path, items, accept, version])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def etag(body):
+    """Get a strong ETag for the response body."""
+    return f'"{hashlib.sha256(body).hexdigest()[:40]}"'
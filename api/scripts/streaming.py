@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Serialize query results to streamed http responses.
+
+The functions take a 'stream', as returned by db_queries.stream_rows(), the
+tuple of the column names followed by lists of rows, and generate the
+response body in small chunks:
+  json_columns(stream)
+      - A JSON dictionary of columns, the same format as the list responses.
+  ndjson(stream)
+      - One JSON dictionary per row (newline delimited JSON).
+  csv_rows(stream)
+      - CSV with a header row.
+  arrow(stream) and parquet(stream)
+      - Binary Arrow IPC stream or Parquet file with typed columns,
+        available if pyarrow is installed.
+
+The pages of the keyset paginated queries are continued with an opaque
+token, page_token(after, params), with the last key of the page and a hash
+of the query parameters, read back with page_after(token, params).
+"""
+
+import io
+import csv
+import json
+import base64
+import hashlib
+from datetime import date
+from decimal import Decimal
+from tempfile import SpooledTemporaryFile
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+SPOOL_SIZE = 1024 * 1024  # Column data kept in memory before going to disk.
+BLOCK_SIZE = 64 * 1024  # Size of the chunks sent from the spooled columns.
+
+MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet'
+}
+BINARY = ['arrow', 'parquet']
+
+# Column types of the binary formats, other columns are inferred.
+STATS = ['mean', 'std', 'min', 'max', 'p25', 'p50', 'p75',
+         'tmin', 'tmax', 'tmean', 'prec']
+# The epoch columns, named extract (and numeric) if not aliased on PG14+.
+TIMESTAMPS = ['date_part', 'extract']
+DATES = ['meteo_date']
+
+
+def params_hash(params):
+    """Get a short hash of the query parameters (dict)."""
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+def page_token(after, params):
+    """Get the token of the next page, after the key 'after' of a query
+    with the given parameters."""
+    text = json.dumps([after, params_hash(params)], cls=JsonEncoder)
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def page_after(token, params):
+    """Get the key of a page token, a ValueError is raised if the token is
+    not valid or is not of a query with the same parameters."""
+    try:
+        text = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        after, key = json.loads(text)
+    except Exception:
+        raise ValueError("Not a valid page token.")
+    if key != params_hash(params):
+        raise ValueError("The page token is not of this query.")
+    return after
+
+
+class JsonEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return super(JsonEncoder, self).default(obj)
+
+
+def from_rows(data):
+    """Convert a list of tuples with the column names as first item
+    (as returned by the db_queries functions) to a stream."""
+    yield tuple(data[0])
+    if len(data) > 1:
+        yield data[1:]
+
+
+def json_columns(stream, cls=JsonEncoder):
+    """Generate a column oriented JSON dictionary {column: [values]}.
+
+    The values of each column are written to a spooled temporary file while
+    the rows are read, so the memory use stays flat for large results and
+    the rows are never held in memory as python objects.
+    """
+    columns = next(stream)
+    spools = [SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+')
+              for c in columns]
+    try:
+        sep = ''
+        for rowset in stream:
+            for i, spool in enumerate(spools):
+                values = json.dumps([r[i] for r in rowset], cls=cls)
+                spool.write(sep + values[1:-1])
+            sep = ', '
+        yield '{'
+        for i, column in enumerate(columns):
+            yield f"{', ' if i else ''}{json.dumps(column)}: ["
+            spools[i].seek(0)
+            block = spools[i].read(BLOCK_SIZE)
+            while block:
+                yield block
+                block = spools[i].read(BLOCK_SIZE)
+            yield ']'
+        yield '}'
+    finally:
+        for spool in spools:
+            spool.close()
+
+
+def ndjson(stream, cls=JsonEncoder):
+    """Generate one JSON dictionary per row, separated by new lines."""
+    columns = next(stream)
+    for rowset in stream:
+        yield ''.join([json.dumps(dict(zip(columns, r)), cls=cls) + '\n'
+                       for r in rowset])
+
+
+def csv_rows(stream):
+    """Generate CSV text, the first row is the header."""
+    io_file = io.StringIO()
+    write = csv.writer(io_file, delimiter=',')
+    write.writerow(next(stream))
+    for rowset in stream:
+        write.writerows(rowset)
+        yield io_file.getvalue()
+        io_file.seek(0)
+        io_file.truncate(0)
+    yield io_file.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """A write only file that hands over the written bytes in chunks,
+    it keeps counting the position for the writers that need it."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_type(column):
+    if column in TIMESTAMPS:
+        return pa.timestamp('ms', tz='UTC')
+    elif column in DATES:
+        return pa.date32()
+    elif column in STATS:
+        return pa.float32()
+    elif column == 'count':
+        return pa.int32()
+    return None
+
+
+def _arrow_values(column, values):
+    if column in TIMESTAMPS:
+        return [None if v is None else int(float(v) * 1000) for v in values]
+    elif column in DATES:
+        return [None if v is None else date.fromisoformat(str(v)[:10])
+                for v in values]
+    elif column in STATS:
+        return [None if v is None else float(v) for v in values]
+    return [json.dumps(v) if isinstance(v, (dict, list)) else
+            float(v) if isinstance(v, Decimal) else v for v in values]
+
+
+def _record_batch(columns, rowset, schema=None):
+    arrays = []
+    for i, column in enumerate(columns):
+        values = _arrow_values(column, [r[i] for r in rowset])
+        if schema is not None:
+            atype = schema.field(i).type
+        else:
+            atype = _arrow_type(column)
+        array = pa.array(values, type=atype)
+        if array.type == pa.null():
+            array = pa.array(values, type=pa.string())
+        arrays.append(array)
+    if schema is not None:
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+    return pa.RecordBatch.from_arrays(arrays, names=list(columns))
+
+
+def _binary(stream, oformat):
+    columns = next(stream)
+    sink = _ChunkSink()
+    writer = None
+    try:
+        for rowset in stream:
+            if writer is None:
+                batch = _record_batch(columns, rowset)
+                if oformat == 'parquet':
+                    writer = pq.ParquetWriter(sink, batch.schema,
+                                              compression='zstd')
+                else:
+                    writer = pa.ipc.new_stream(sink, batch.schema)
+            else:
+                batch = _record_batch(columns, rowset, writer.schema)
+            if oformat == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            yield sink.drain()
+        if writer is None:
+            # No rows, send an empty table with string columns.
+            schema = pa.schema([(c, _arrow_type(c) or pa.string())
+                                for c in columns])
+            if oformat == 'parquet':
+                writer = pq.ParquetWriter(sink, schema)
+            else:
+                writer = pa.ipc.new_stream(sink, schema)
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+
+def arrow(stream):
+    """Generate an Arrow IPC stream, one record batch per set of rows."""
+    return _binary(stream, 'arrow')
+
+
+def parquet(stream):
+    """Generate a Parquet file, one row group per set of rows."""
+    return _binary(stream, 'parquet')
+
+
+def generator(stream, oformat='json'):
+    """Get the body generator of the given output format."""
+    if oformat == 'csv':
+        return csv_rows(stream)
+    elif oformat == 'ndjson':
+        return ndjson(stream)
+    elif oformat == 'arrow':
+        return arrow(stream)
+    elif oformat == 'parquet':
+        return parquet(stream)
+    else:
+        return json_columns(stream)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Cache of the WMTS tiles of the background images.
+
+The tiles are read through the GDAL WMS description of the tile map
+server (config/tms/<tms>.xml), one overview level of the description for
+each zoom level, and stored by (tms, zoom, x, y). The background extracts
+are mosaics of the stored tiles, so the neighbouring parcels of a block
+share the tiles. The tiles around an extract can be fetched in the
+background ("prefetch"), for the next parcels. The size and age of the
+store are limited as for the chip store (chipCache.py).
+
+The cache is configured in config/main.json, e.g.:
+    "background": {"tile_cache": "static/tmp/tiles", "cache_size_mb": 1024,
+                   "cache_max_age_days": 30, "prefetch": true}
+"""
+
+import os
+import json
+import math
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+from rasterio.transform import Affine
+from rasterio.warp import reproject, Resampling
+
+from scripts.chip_extract import chipCache
+
+db_conf_file = 'config/main.json'
+
+TILE_DIR = 'static/tmp/tiles'
+CACHE_SIZE_MB = 1024
+CACHE_MAX_AGE_DAYS = 30
+PREFETCH = False
+FETCH_WORKERS = 4  # Tiles fetched in parallel, as MaxConnections of GDAL.
+
+
+def config():
+    try:
+        with open(db_conf_file) as f:
+            conf = json.load(f).get('background', {})
+    except Exception:
+        conf = {}
+    return {'path': conf.get('tile_cache', TILE_DIR),
+            'max_size': int(float(conf.get('cache_size_mb', CACHE_SIZE_MB)) *
+                            1024 * 1024),
+            'max_age': float(conf.get('cache_max_age_days',
+                                      CACHE_MAX_AGE_DAYS)) * 86400,
+            'prefetch': bool(conf.get('prefetch', PREFETCH))}
+
+
+class TileCache(chipCache.ChipCache):
+    """The tile store, the tiles are <tms>/<zoom>/<x>/<y>.npy files."""
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.npy")
+
+    def has(self, key):
+        return os.path.isfile(self._file(key))
+
+
+@lru_cache(maxsize=32)
+def tile_grid(tms_file):
+    """Get the tile grid of a tile map server: the zoom, resolution and
+    number of tiles of each overview level, the first being the finest."""
+    with rio.open(tms_file) as src:
+        bw, bh = src.block_shapes[0][1], src.block_shapes[0][0]
+        levels = []
+        for factor in [1] + src.overviews(1):
+            width = src.width // factor
+            levels.append({'zoom': int(round(math.log2(max(width / bw, 1)))),
+                           'res': src.res[0] * factor,
+                           'tiles': (math.ceil(width / bw), math.ceil(
+                               src.height // factor / bh))})
+        return {'origin': (src.transform.c, src.transform.f),
+                'block': (bw, bh), 'count': src.count,
+                'dtype': src.dtypes[0], 'levels': levels}
+
+
+def level_index(grid, res):
+    """Get the coarsest level that is at least as fine as res."""
+    index = 0
+    for i, level in enumerate(grid['levels']):
+        if level['res'] <= res * 1.0001:
+            index = i
+    return index
+
+
+def _fetch_tile(tms, tms_file, index, x, y):
+    # Get the stored tile, it is read from the server if it is not stored.
+    grid = tile_grid(tms_file)
+    bw, bh = grid['block']
+
+    def write(path):
+        kwargs = {'overview_level': index - 1} if index else {}
+        with rio.open(tms_file, **kwargs) as src:
+            data = src.read(window=Window(x * bw, y * bh, bw, bh),
+                            boundless=True, fill_value=0)
+        with open(path, 'wb') as f:
+            np.save(f, data)
+    key = f"{tms}/{grid['levels'][index]['zoom']}/{x}/{y}"
+    return np.load(cache().fetch(key, write))
+
+
+def _prefetch_tile(tms, tms_file, index, x, y):
+    grid = tile_grid(tms_file)
+    if not cache().has(f"{tms}/{grid['levels'][index]['zoom']}/{x}/{y}"):
+        _fetch_tile(tms, tms_file, index, x, y)
+
+
+def read_window(tms, tms_file, bounds, size, prefetch=None):
+    """Get the size x size pixels image of the EPSG:3857 bounds (west,
+    south, east, north), as a mosaic of the stored tiles."""
+    grid = tile_grid(tms_file)
+    west, south, east, north = bounds
+    index = level_index(grid, (east - west) / size)
+    level = grid['levels'][index]
+    bw, bh = grid['block']
+    ox, oy = grid['origin']
+    res = level['res']
+    nx, ny = level['tiles']
+
+    def tile(v, origin, step, n):
+        return min(max(int((v - origin) // step), 0), n - 1)
+    x0, x1 = [tile(v, ox, res * bw, nx) for v in (west, east)]
+    y0, y1 = [tile(-v, -oy, res * bh, ny) for v in (north, south)]
+
+    tiles = [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+    mosaic = np.zeros((grid['count'], (y1 - y0 + 1) * bh,
+                       (x1 - x0 + 1) * bw), dtype=grid['dtype'])
+    for (x, y), data in zip(tiles, executor().map(
+            lambda t: _fetch_tile(tms, tms_file, index, *t), tiles)):
+        mosaic[:, (y - y0) * bh:(y - y0 + 1) * bh,
+               (x - x0) * bw:(x - x0 + 1) * bw] = data
+
+    output = np.zeros((grid['count'], size, size), dtype=grid['dtype'])
+    reproject(mosaic, output,
+              src_transform=Affine(res, 0, ox + x0 * bw * res,
+                                   0, -res, oy - y0 * bh * res),
+              src_crs='EPSG:3857',
+              dst_transform=Affine((east - west) / size, 0, west,
+                                   0, -(north - south) / size, north),
+              dst_crs='EPSG:3857', resampling=Resampling.nearest)
+
+    if config()['prefetch'] if prefetch is None else prefetch:
+        # The ring of tiles around the mosaic.
+        for y in range(max(y0 - 1, 0), min(y1 + 2, ny)):
+            for x in range(max(x0 - 1, 0), min(x1 + 2, nx)):
+                if not (x0 <= x <= x1 and y0 <= y <= y1):
+                    executor().submit(_prefetch_tile, tms, tms_file, index,
+                                      x, y)
+    return output
+
+
+_cache = None
+_executor = None
+_lock = threading.Lock()
+
+
+def cache():
+    """Get the tile store of this process."""
+    global _cache
+    with _lock:
+        if _cache is None:
+            conf = config()
+            _cache = TileCache(conf['path'], conf['max_size'],
+                               conf['max_age'])
+    return _cache
+
+
+def executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(FETCH_WORKERS,
+                                           thread_name_prefix='tiles')
+    return _executor
@@ -11,12 +11,83 @@
 
 import os
 import sys
+import hmac
 import json
+import time
 import hashlib
+import threading
 from codecs import encode
+from collections import OrderedDict
 
 users_file = 'config/users.json'
 
+# Verified credentials are cached to skip the PBKDF2 check on every request.
+AUTH_CACHE_TTL = 300  # Seconds a verified password is trusted.
+AUTH_CACHE_SIZE = 1024  # Max number of cached users.
+
+# The cache holds only a keyed digest of the password, the key is random
+# for every process and never leaves memory.
+_cache_key = os.urandom(32)
+_auth_cache = OrderedDict()
+_users_cache = {'file': None, 'stamp': None, 'users': {}}
+_lock = threading.Lock()
+
+
+def _load_users(file=users_file):
+    """Get the users from the users file, reloaded only if it changed."""
+    stat = os.stat(file)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        if _users_cache['file'] == file and _users_cache['stamp'] == stamp:
+            return _users_cache['users']
+    with open(file, 'r') as u:
+        users = json.load(u)
+    with _lock:
+        _users_cache.update({'file': file, 'stamp': stamp, 'users': users})
+        _auth_cache.clear()
+    return users
+
+
+def invalidate():
+    """Drop the cached users and verified credentials."""
+    with _lock:
+        _users_cache.update({'file': None, 'stamp': None, 'users': {}})
+        _auth_cache.clear()
+
+
+def _digest(username, password):
+    return hmac.new(_cache_key, f"{username}\0{password}".encode('utf-8'),
+                    hashlib.sha256).digest()
+
+
+def _verify(username, password, user):
+    """Check the password against the stored PBKDF2 key, using the cache."""
+    digest = _digest(username, password)
+    with _lock:
+        cached = _auth_cache.get(username)
+        if cached and cached[1] > time.time():
+            if hmac.compare_digest(cached[0], digest):
+                _auth_cache.move_to_end(username)
+                return True
+
+    salt = encode(user['salt'].encode().decode('unicode_escape'),
+                  "raw_unicode_escape")
+
+    key = encode(user['key'].encode().decode('unicode_escape'),
+                 "raw_unicode_escape")
+
+    new_key = hashlib.pbkdf2_hmac(
+        'sha256', password.encode('utf-8'), salt, 100000)
+
+    if not hmac.compare_digest(key, new_key):
+        return False
+    with _lock:
+        _auth_cache[username] = (digest, time.time() + AUTH_CACHE_TTL)
+        _auth_cache.move_to_end(username)
+        while len(_auth_cache) > AUTH_CACHE_SIZE:
+            _auth_cache.popitem(last=False)
+    return True
+
 
 def auth(username, password, aoi=None):
     """Authentication check with hashed passwords
@@ -49,21 +120,11 @@ def auth(username, password, aoi=None):
 
     """
     try:
-        users = get_list(users_file, False)
+        users = _load_users(users_file)
         user = users[username.lower()]
 
-        salt = encode(user['salt'].encode().decode('unicode_escape'),
-                      "raw_unicode_escape")
-
-        key = encode(user['key'].encode().decode('unicode_escape'),
-                     "raw_unicode_escape")
-
-        new_key = hashlib.pbkdf2_hmac(
-            'sha256', password.encode('utf-8'), salt, 100000)
-
-        if key == new_key:
+        if _verify(username.lower(), password, user):
             if aoi:
-                users = get_list(users_file, False)
                 if any(x in [aoi, 'admin'] for x in users[username]['aois']):
                     return True
                 else:
@@ -78,13 +139,40 @@ def auth(username, password, aoi=None):
 
 
 def data_auth(aoi, username):
-    users = get_list(users_file, False)
+    users = _load_users(users_file)
     if any(x in [aoi, 'admin'] for x in users[username]['aois']):
         return True
     else:
         return False
 
 
+def tier(username):
+    """Get the admission tier of the user (see admission.py)."""
+    try:
+        return _load_users(users_file)[username.lower()].get('tier',
+                                                              'default')
+    except Exception:
+        return 'default'
+
+
+def set_tier(username, tier='default'):
+    """Set the admission tier of the user, the limits of the tiers are set
+    in config/limits.json.
+
+    Example:
+        users.set_tier('MyUserName', 'power')
+    """
+    users = get_list(users_file, False)
+    if username.lower() not in users:
+        print(f"Err: The user '{username}' was not found.")
+        return
+    users[username.lower()]['tier'] = tier
+    with open(users_file, 'w') as u:
+        json.dump(users, u, indent=2)
+    invalidate()
+    print(f"The user '{username}' is in the '{tier}' tier.")
+
+
 def add(username, password='', aoi=''):
     """Create a new user
 
@@ -113,6 +201,7 @@ def add(username, password='', aoi=''):
     }
     with open(users_file, 'w') as u:
         json.dump(users, u, indent=2)
+    invalidate()
 
     if aoi == 'admin':
         aoi = "all"
@@ -130,8 +219,7 @@ def get_list(file=users_file, only_names=True, aois=False):
 
     """
     try:
-        with open(file, 'r') as u:
-            users = json.load(u)
+        users = dict(_load_users(file))
         if only_names:
             return [*users]
         elif aois:
@@ -170,6 +258,7 @@ def delete(username):
 
     with open(users_file, 'w') as u:
         json.dump(users, u, indent=2)
+    invalidate()
 
 
 def sort(data_file):
@@ -187,6 +276,8 @@ if __name__ == '__main__':
         add(sys.argv[2], sys.argv[3], sys.argv[4])
     elif sys.argv[1].lower() == 'delete':
         delete(sys.argv[2])
+    elif sys.argv[1].lower() == 'tier':
+        set_tier(sys.argv[2], sys.argv[3])
     elif sys.argv[1].lower() == 'list':
         for key in get_list(users_file, False):
             print(key)
@@ -194,5 +285,6 @@ if __name__ == '__main__':
         print("""Not recognized arguments. Available options:
     python users.py add username password  aoi # Create a new user.
     python users.py delete username            # Delete a user.
+    python users.py tier username tier         # Set the tier of a user.
     python users.py list                       # Print a list of the users.
         """)
@@ -61,7 +61,9 @@ def parcel_by_id(aoi, year, pid, ptype=None, geom=False,
 
 
 def parcel_by_polygon(aoi, year, polygon, ptype=None, geom=False,
-                      wgs84=False, only_ids=True, debug=False):
+                      wgs84=False, only_ids=True, debug=False,
+                      geometry=None, tolerance=None, page_size=None,
+                      page=None):
 
     api_url, api_user, api_pass = config.credentials('api')
     requrl = """{}/query/parcelsByPolygon?aoi={}&year={}&polygon={}"""
@@ -73,6 +75,14 @@ def parcel_by_polygon(aoi, year, polygon, ptype=None, geom=False,
         requrl = f"{requrl}&ptype={ptype}"
     if wgs84 is True:
         requrl = f"{requrl}&wgs84={wgs84}"
+    if geometry is not None:
+        requrl = f"{requrl}&geometry={geometry}"
+    if tolerance is not None:
+        requrl = f"{requrl}&tolerance={tolerance}"
+    if page_size is not None:
+        requrl = f"{requrl}&page_size={page_size}"
+    if page is not None:
+        requrl = f"{requrl}&page={page}"
     response = requests.get(requrl.format(api_url, aoi, year, polygon),
                             auth=(api_user, api_pass))
     if debug:
@@ -80,6 +90,40 @@ def parcel_by_polygon(aoi, year, polygon, ptype=None, geom=False,
     return response.content
 
 
+def parcel_by_polygon_pages(aoi, year, polygon, page_size=1000, **params):
+    """Get the pages of the parcels within the polygon (generator of the
+    response contents), following the next page tokens. The params are
+    the query parameters, e.g. geometry='centroid'."""
+    api_url, api_user, api_pass = config.credentials('api')
+    requrl = f"{api_url}/query/parcelsByPolygon"
+    params = {'aoi': aoi, 'year': year, 'polygon': polygon,
+              'page_size': page_size, **params}
+    while True:
+        response = requests.get(requrl, params=params,
+                                auth=(api_user, api_pass))
+        yield response.content
+        params['page'] = response.headers.get('X-Next-Page')
+        if not params['page']:
+            break
+
+
+def parcel_tile(aoi, year, z, x, y, ptype=None, attributes=None,
+                debug=False):
+    """Get the Mapbox vector tile of the parcels in the tile z/x/y, with
+    the attributes (list of 'crop', 'area' and 'marker')."""
+    api_url, api_user, api_pass = config.credentials('api')
+    requrl = """{}/query/tiles/{}/{}/{}/{}/{}.mvt?"""
+    if ptype not in [None, '']:
+        requrl = f"{requrl}&ptype={ptype}"
+    if attributes:
+        requrl = f"{requrl}&attributes={','.join(attributes)}"
+    response = requests.get(requrl.format(api_url, aoi, year, z, x, y),
+                            auth=(api_user, api_pass))
+    if debug:
+        print(requrl.format(api_url, aoi, year, z, x, y), response)
+    return response.content
+
+
 def parcel_peers(aoi, year, pid, distance=1000.0,
                  maxPeers=10, ptype=None, debug=False):
     api_url, api_user, api_pass = config.credentials('api')
@@ -94,14 +138,19 @@ def parcel_peers(aoi, year, pid, distance=1000.0,
     return response.content
 
 
-def parcel_ts(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
-
+def parcel_ts(aoi, year, pid, tstype='s2', ptype=None, band='',
+              debug=False, tsformat=None):
+    """Get the parcel time series, by default in json format.
+    With tsformat 'arrow' or 'parquet' the binary content is returned,
+    use read_table() to load it to a pandas DataFrame."""
     api_url, api_user, api_pass = config.credentials('api')
     requrl = """{}/query/parcelTimeSeries?aoi={}&year={}&pid={}&tstype={}"""
     if ptype not in [None, '']:
         requrl = f"{requrl}&ptype={ptype}"
     if band not in [None, '']:
         requrl = f"{requrl}&band={band}"
+    if tsformat not in [None, '']:
+        requrl = f"{requrl}&tsformat={tsformat}"
     response = requests.get(requrl.format(api_url, aoi, year,
                                           pid, tstype, band),
                             auth=(api_user, api_pass))
@@ -110,6 +159,149 @@ def parcel_ts(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
     return response.content
 
 
+def peers_ts(aoi, year, pid, tstype='s2', ptype=None, band='',
+             period='week', distance=1000.0, maxPeers=100, debug=False):
+    """Get the weekly (or monthly) time series of the parcel peers."""
+    api_url, api_user, api_pass = config.credentials('api')
+    requrl = """{}/query/peersTimeSeries?aoi={}&year={}&pid={}&tstype={}&period={}&distance={}&max={}"""
+    if ptype not in [None, '']:
+        requrl = f"{requrl}&ptype={ptype}"
+    if band not in [None, '']:
+        requrl = f"{requrl}&band={band}"
+    response = requests.get(requrl.format(api_url, aoi, year, pid, tstype,
+                                          period, distance, maxPeers),
+                            auth=(api_user, api_pass))
+    if debug:
+        print(requrl.format(api_url, aoi, year, pid, tstype, period,
+                            distance, maxPeers), response)
+    return response.content
+
+
+def read_table(content, tsformat='arrow'):
+    """Read an Arrow IPC stream or Parquet response to a pandas DataFrame.
+
+    The Arrow buffers are wrapped without copying and released while the
+    DataFrame is built, pyarrow is required."""
+    import pyarrow as pa
+    buffer = pa.py_buffer(content)
+    if tsformat == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(pa.BufferReader(buffer))
+    else:
+        table = pa.ipc.open_stream(buffer).read_all()
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def parcel_ts_batch(aoi, year, pids=None, polygon=None, tstype='s2',
+                    ptype=None, band='', scl=True, debug=False):
+    """Get the time series of many parcels with one request.
+
+    Examples:
+        ts = json.loads(parcel_ts_batch('ms', 2020, [123, 124]))
+        ts['123']  # The time series of parcel 123
+
+    Arguments:
+        aoi, the area of interest e.g.: es, nld (str)
+        year, the year of the parcels dataset (int)
+        pids, list of parcel ids (list)
+        polygon, polygon to select the parcels, if no pids are given (str)
+        tstype, the time series type s2, bs, c6 (str)
+    """
+    api_url, api_user, api_pass = config.credentials('api')
+    requrl = f"{api_url}/query/parcelTimeSeriesBatch"
+    payload = {'aoi': aoi, 'year': str(year), 'tstype': tstype,
+               'scl': str(scl)}
+    if pids is not None:
+        payload['pids'] = [str(p) for p in pids]
+    elif polygon is not None:
+        payload['polygon'] = polygon
+    if ptype not in [None, '']:
+        payload['ptype'] = ptype
+    if band not in [None, '']:
+        payload['band'] = band
+    response = requests.post(requrl, json=payload, auth=(api_user, api_pass))
+    if debug:
+        print(requrl, payload, response)
+    return response.content
+
+
+def parcels_cube(aoi, year, start_date, end_date, outfile, pids=None,
+                 polygon=None, tstype='s2', ptype=None, cformat='zarr',
+                 timeout=3600, debug=False):
+    """Export the signatures of many parcels as a dense cube (a job on the
+    server) and download the zip file of the cube to outfile.
+
+    Arguments:
+        start_date, end_date, the dates of the observations (str)
+        pids, list of parcel ids (list)
+        polygon, polygon to select the parcels, if no pids are given (str)
+        cformat, the format of the cube 'zarr' or 'npz' (str)
+    Returns the outfile, or None if the export failed.
+    """
+    api_url, api_user, api_pass = config.credentials('api')
+    payload = {'aoi': aoi, 'year': str(year), 'start_date': start_date,
+               'end_date': end_date, 'tstype': tstype, 'format': cformat}
+    if pids is not None:
+        payload['pids'] = [str(p) for p in pids]
+    elif polygon is not None:
+        payload['polygon'] = polygon
+    if ptype not in [None, '']:
+        payload['ptype'] = ptype
+    job = requests.post(f"{api_url}/query/parcelsCube", json=payload,
+                        auth=(api_user, api_pass)).json()
+    if debug:
+        print(payload, job)
+    return job_result(job, outfile, timeout)
+
+
+def job_result(job, outfile, timeout=3600):
+    """Wait for a job of the API (the job status) and download its result
+    to outfile. Returns the outfile, or None if the job failed."""
+    import time
+    api_url, api_user, api_pass = config.credentials('api')
+    start = time.time()
+    while job.get('status') not in ['done', 'failed', None]:
+        if time.time() - start > timeout:
+            print("The job is still running, job:", job['id'])
+            return None
+        time.sleep(5)
+        job = requests.get(f"{api_url}{job['status_url']}",
+                           auth=(api_user, api_pass)).json()
+    if job.get('status') != 'done':
+        print("The job failed:", job.get('error', job))
+        return None
+    response = requests.get(f"{api_url}{job['result_url']}", stream=True,
+                            auth=(api_user, api_pass))
+    with open(outfile, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            f.write(chunk)
+    return outfile
+
+
+def rcbl_stack(lon, lat, start_date, end_date, bands, chipsize, outfile,
+               sformat='tif', timeout=3600, debug=False):
+    """Get the raw chips of all the acquisitions and bands at a location,
+    stacked in one GeoTIFF (or NPZ) file, saved to outfile."""
+    api_url, api_user, api_pass = config.credentials('api')
+    params = {'lon': lon, 'lat': lat, 'start_date': start_date,
+              'end_date': end_date, 'bands': '_'.join(bands),
+              'chipsize': chipsize, 'format': sformat}
+    response = requests.get(f"{api_url}/query/rawChipStack", params=params,
+                            auth=(api_user, api_pass), stream=True)
+    if debug:
+        print(response.url, response)
+    if response.status_code == 202:
+        return job_result(response.json(), outfile, timeout)
+    if response.status_code != 200 or response.headers.get(
+            'content-type', '').startswith('application/json'):
+        print("No chip stack:", response.content)
+        return None
+    with open(outfile, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            f.write(chunk)
+    return outfile
+
+
 def parcel_wts(aoi, year, pid, ptype=None, debug=False):
 
     api_url, api_user, api_pass = config.credentials('api')
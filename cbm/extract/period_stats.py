@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Project: Copernicus DIAS for CAP 'checks by monitoring'.
+
+Per parcel, band and period (week or month) summary of the signatures.
+
+The '<signatures table>_period_stats' table keeps, for each parcel, band
+and period, the number of observations, the mean and std of the
+observation means, the min and max, and the mean p25, p50 and p75. The
+parcel peers comparisons read it instead of aggregating the signatures.
+
+The summaries of the parcels of a scene are recomputed when the scene is
+extracted (update(conn, ..., [obsid])). The extracted scenes that were not
+summarised yet, e.g. extracted before the table existed or by other
+extraction scripts, are added with:
+    python -m cbm.extract.period_stats <signatures table> <dias_catalogue>
+"""
+
+PERIODS = ('week', 'month')
+STATS_COLUMNS = ['n', 'mean', 'std', 'min', 'max', 'p25', 'p50', 'p75']
+
+
+def stats_table(sigs_table):
+    """Get the name of the summary table of a signatures table."""
+    return f"{sigs_table}_period_stats"
+
+
+def create_sql(sigs_table):
+    table = stats_table(sigs_table)
+    name = table.split('.')[-1]
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            pid int,
+            band varchar(3),
+            period_type varchar(5),
+            period date,
+            n int,
+            mean real,
+            std real,
+            min real,
+            max real,
+            p25 real,
+            p50 real,
+            p75 real,
+            PRIMARY KEY (period_type, band, pid, period)
+        );
+        CREATE INDEX IF NOT EXISTS {name}_period_idx
+            ON {table} (period_type, band, period);
+        CREATE TABLE IF NOT EXISTS {table}_obs (obsid int PRIMARY KEY);
+        """
+
+
+def update_sql(sigs_table, dias_catalogue, period):
+    # Recompute the summaries of the periods and parcels of the new scenes.
+    table = stats_table(sigs_table)
+    return f"""
+        WITH new_obs AS (
+            SELECT id, obstime FROM {dias_catalogue}
+            WHERE id = ANY(%(obsids)s)),
+        touched AS (
+            SELECT DISTINCT s.pid,
+                date_trunc('{period}', o.obstime) AS period
+            FROM {sigs_table} s JOIN new_obs o ON o.id = s.obsid)
+        INSERT INTO {table}
+        SELECT s.pid, s.band, '{period}', t.period::date, count(*),
+            avg(s.mean), coalesce(stddev_samp(s.mean), 0), min(s.min),
+            max(s.max), avg(s.p25), avg(s.p50), avg(s.p75)
+        FROM touched t
+        JOIN {dias_catalogue} d ON d.obstime >= t.period
+            And d.obstime < t.period + interval '1 {period}'
+        JOIN {sigs_table} s ON s.obsid = d.id And s.pid = t.pid
+        GROUP BY s.pid, s.band, t.period
+        ON CONFLICT (period_type, band, pid, period) DO UPDATE SET
+        {', '.join([f'{c} = excluded.{c}' for c in STATS_COLUMNS])};
+        """
+
+
+def update(conn, sigs_table, dias_catalogue, obsids=None, periods=PERIODS):
+    """Update the summaries with the signatures of the scenes (dias_catalogue
+    ids), by default of all the extracted scenes that were not added yet.
+    Returns the number of scenes added."""
+    table = stats_table(sigs_table)
+    with conn.cursor() as cur:
+        cur.execute(create_sql(sigs_table))
+        if obsids is None:
+            cur.execute(f"""
+                SELECT d.id FROM {dias_catalogue} d
+                WHERE d.status = 'extracted'
+                And NOT EXISTS (SELECT 1 FROM {table}_obs o
+                    WHERE o.obsid = d.id)
+                And EXISTS (SELECT 1 FROM {sigs_table} s
+                    WHERE s.obsid = d.id)
+                ORDER BY d.id;""")
+            obsids = [r[0] for r in cur.fetchall()]
+        if obsids:
+            for period in periods:
+                cur.execute(update_sql(sigs_table, dias_catalogue, period),
+                            {'obsids': list(obsids)})
+            cur.execute(f"""
+                INSERT INTO {table}_obs SELECT unnest(%(obsids)s::int[])
+                ON CONFLICT DO NOTHING;""", {'obsids': list(obsids)})
+    conn.commit()
+    return len(obsids)
+
+
+if __name__ == "__main__":
+    import sys
+    from cbm.datas import db
+    conn = db.conn()
+    print(update(conn, sys.argv[1], sys.argv[2]),
+          f"scenes added to {stats_table(sys.argv[1])}")
+    conn.close()
@@ -22,6 +22,7 @@ import pandas as pd
 
 from cbm.utils import config
 from cbm.datas import db, object_storage
+from cbm.extract import period_stats
 
 def extractS1bs(startdate, enddate):
     start = time.time()
@@ -271,6 +272,14 @@ def extractS1bs(startdate, enddate):
         if outconn:
             outconn.close()
 
+    if not inconn.closed:
+        try:
+            # Add the scene to the per period summaries of the parcels.
+            period_stats.update(inconn, results_table, dias_catalogue, [oid])
+        except (Exception, psycopg2.DatabaseError) as error:
+            inconn.rollback()
+            print("Could not update the period stats:", error)
+
     incurs.close()
     inconn.close()
 
@@ -45,6 +45,7 @@ from rasterstats import zonal_stats
 
 from cbm.utils import config
 from cbm.datas import db, object_storage
+from cbm.extract import period_stats, scene_cache
 
 
 def main(startdate, enddate, parcels_table=None, results_table=None,
@@ -165,21 +166,22 @@ def main(startdate, enddate, parcels_table=None, results_table=None,
 
     file_set = {}
 
-    # Copy input data from S3 to local disk
+    # Copy input data from S3 to local disk, or get the transcoded images
+    # from the scene cache.
     for k in selection.keys():
         s = selection.get(k)
         fpath = f"tmp/{s.split('/')[-1]}"
         alt_s = s.replace('0m/', '0m/L2A_')
 
-        if object_storage.get_file('{}{}/IMG_DATA/{}'.format(
-                s3path, s3subdir, s), fpath) == 1:
-            #             print("Image {} found in bucket".format(s))
-            file_set[k] = fpath
-        elif object_storage.get_file('{}{}/IMG_DATA/{}'.format(
-                s3path, s3subdir, alt_s), fpath) == 1:
+        def download(fpath, s=s, alt_s=alt_s):
             # LEVEL2AP has another naming convention.
-            #             print("Image {} found in bucket".format(alt_s))
-            file_set[k] = fpath
+            return any(object_storage.get_file('{}{}/IMG_DATA/{}'.format(
+                s3path, s3subdir, name), fpath) == 1 for name in (s, alt_s))
+
+        image = scene_cache.resolve('{}{}/IMG_DATA/{}'.format(
+            s3path, s3subdir, s), download, fpath)
+        if image:
+            file_set[k] = image
         else:
             print("Neither Image {} nor {} found in bucket".format(s, alt_s))
             incurs.execute(updateSql.format(
@@ -310,12 +312,21 @@ def main(startdate, enddate, parcels_table=None, results_table=None,
         if outconn:
             outconn.close()
 
+    if not inconn.closed:
+        try:
+            # Add the scene to the per period summaries of the parcels.
+            period_stats.update(inconn, results_table, dias_catalogue, [oid])
+        except (Exception, psycopg2.DatabaseError) as error:
+            inconn.rollback()
+            print("Could not update the period stats:", error)
+
     incurs.close()
     inconn.close()
 
     print(f"Removing '*{file_set['B4'][4:-12]}*' images.")
     for f in file_set.keys():
-        if os.path.exists(file_set.get(f)):
+        if file_set.get(f).startswith('tmp/') and \
+                os.path.exists(file_set.get(f)):
             print(f"Removing {file_set.get(f)}")
             os.remove(file_set.get(f))
 
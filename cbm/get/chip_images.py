@@ -113,6 +113,40 @@ def by_pid(aoi, year, pid, start_date, end_date, band, chipsize,
         print("No files where downloaded, please check your configurations")
 
 
+def stack(lon, lat, start_date, end_date, bands, chipsize, sformat='tif',
+          debug=False):
+    """Download the raw chips of all the acquisitions and bands at a
+    location, stacked in one file (time x band x y x x).
+
+    Examples:
+        import cbm
+        cbm.get.chip_images.stack(lon, lat, '2020-03-01', '2020-10-31',
+                                  ['B08', 'B04', 'SCL'], 1280)
+
+    Arguments:
+        lon, lat, the the coords of the parcel (float).
+        start_date, end_date, the time window e.g. '2019-06-01' (str)
+        bands, the Sentinel-2 bands, the first band determines the
+            resolution of the stack (list).
+        chipsize, size of the chip in meters (int).
+        sformat, 'tif' (a band for each date and band, with 'date' and
+            'band' tags) or 'npz' (str).
+    Returns the path of the stack file.
+    """
+    get_requests = data_source()
+    workdir = normpath(join(config.get_value(['paths', 'temp']),
+                            f"{lon}_{lat}".replace('.', '_'), 'chip_images'))
+    os.makedirs(workdir, exist_ok=True)
+    outfile = normpath(join(workdir, f"chipstack_{'_'.join(bands)}_"
+                            f"{start_date}_{end_date}.{sformat}"))
+    outfile = get_requests.rcbl_stack(lon, lat, start_date, end_date, bands,
+                                      chipsize, outfile, sformat,
+                                      debug=debug)
+    if debug and outfile:
+        print(f"File saved at: {outfile}")
+    return outfile
+
+
 def file_len(fname):
     with open(fname) as f:
         for i, l in enumerate(f):
@@ -14,11 +14,13 @@ from os.path import join, normpath
 from cbm.utils import config
 
 
-def by_pid(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
-    return sentinel(aoi, year, pid, tstype, ptype, band, debug)
+def by_pid(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False,
+           tsformat='json'):
+    return sentinel(aoi, year, pid, tstype, ptype, band, debug, tsformat)
 
 
-def sentinel(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
+def sentinel(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False,
+             tsformat='json'):
     """Download the time series for the selected year
 
     Examples:
@@ -28,14 +30,22 @@ def sentinel(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
     Arguments:
         aoi, the area of interest and year e.g.: es2019, nld2020 (str)
         pid, the parcel id (int).
+        tsformat, 'arrow' or 'parquet' to transfer the time series in a
+            binary columnar format and return a pandas DataFrame (str).
     """
     get_requests = data_source()
     workdir = config.get_value(['paths', 'temp'])
     file_ts = normpath(join(workdir, aoi, str(year), str(pid),
                             f'time_series_{tstype}{band}.csv'))
-    ts = json.loads(get_requests.parcel_ts(
-        aoi, year, pid, tstype, ptype, band, debug))
+    if tsformat in ['arrow', 'parquet'] and hasattr(get_requests,
+                                                     'read_table'):
+        ts = get_requests.read_table(get_requests.parcel_ts(
+            aoi, year, pid, tstype, ptype, band, debug, tsformat), tsformat)
+    else:
+        ts = json.loads(get_requests.parcel_ts(
+            aoi, year, pid, tstype, ptype, band, debug))
     if isinstance(ts, pd.DataFrame):
+        os.makedirs(os.path.dirname(file_ts), exist_ok=True)
         ts.to_csv(file_ts, index=True, header=True)
     elif isinstance(ts, dict):
         os.makedirs(os.path.dirname(file_ts), exist_ok=True)
@@ -46,6 +56,36 @@ def sentinel(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
     return ts
 
 
+def peers(aoi, year, pid, tstype='s2', ptype=None, band='', period='week',
+          distance=1000.0, maxPeers=100, debug=False):
+    """Download the weekly (or monthly) time series of the parcel peers
+
+    Examples:
+        import cbm
+        cbm.get.time_series.peers(aoi, year, pid)
+
+    Arguments:
+        aoi, the area of interest and year e.g.: es2019, nld2020 (str)
+        pid, the parcel id (int).
+        period, 'week' or 'month' (str).
+    Returns a pandas DataFrame with for each period and band the number of
+    peers, the mean and the percentiles of the period means of the peers.
+    """
+    get_requests = data_source()
+    workdir = config.get_value(['paths', 'temp'])
+    file_ts = normpath(join(workdir, aoi, str(year), str(pid),
+                            f'time_series_peers_{tstype}{band}_{period}.csv'))
+    ts = json.loads(get_requests.peers_ts(aoi, year, pid, tstype, ptype,
+                                          band, period, distance, maxPeers,
+                                          debug))
+    df = pd.DataFrame.from_dict(ts, orient='columns')
+    os.makedirs(os.path.dirname(file_ts), exist_ok=True)
+    df.to_csv(file_ts, index=True, header=True)
+    if debug:
+        print(f"File saved at: {file_ts}")
+    return df
+
+
 def weather(aoi, year, pid, ptype=None, debug=False):
     """Download the time series for the selected year
 
@@ -73,6 +113,59 @@ def weather(aoi, year, pid, ptype=None, debug=False):
     return ts
 
 
+def cube(aoi, year, start_date, end_date, pids=None, polygon=None,
+         tstype='s2', ptype=None, cformat='zarr', debug=False):
+    """Download the signatures of many parcels as a dense
+    parcel x time x band x stat cube, with the observation and SCL masks.
+
+    Examples:
+        import cbm
+        ds = cbm.get.time_series.cube('ms', 2020, '2020-03-01',
+                                      '2020-10-31', pids=[123, 124])
+        ds.signatures.sel(band='B08', stat='mean')
+
+    Arguments:
+        aoi, the area of interest e.g.: es, nld (str)
+        year, the year of the parcels dataset (int)
+        pids, list of parcel ids (list)
+        polygon, polygon to select the parcels, if no pids are given (str)
+        cformat, 'zarr' or 'npz' (str)
+    Returns the cube opened lazily with xarray (zarr, if xarray is
+    installed) or the folder of the extracted cube.
+    """
+    import shutil
+    import hashlib
+    import zipfile
+    get_requests = data_source()
+    workdir = config.get_value(['paths', 'temp'])
+    cube_dir = normpath(join(workdir, aoi, str(year), 'cubes'))
+    os.makedirs(cube_dir, exist_ok=True)
+    # The other selections of parcels are extracted to other folders.
+    selection = hashlib.sha1(json.dumps(
+        [pids, polygon, ptype], default=str).encode()).hexdigest()[:8]
+    name = f"cube_{tstype}_{start_date}_{end_date}_{selection}"
+    zip_file = get_requests.parcels_cube(
+        aoi, year, start_date, end_date, join(cube_dir, f"{name}.zip"),
+        pids, polygon, tstype, ptype, cformat, debug=debug)
+    if zip_file is None:
+        return None
+    # No chunks of an earlier download are left in the store.
+    shutil.rmtree(join(cube_dir, name), ignore_errors=True)
+    with zipfile.ZipFile(zip_file) as z:
+        z.extractall(join(cube_dir, name))
+    os.remove(zip_file)
+    path = join(cube_dir, name, f"cube.{cformat}")
+    if debug:
+        print(f"Cube saved at: {path}")
+    if cformat == 'zarr':
+        try:
+            import xarray as xr
+            return xr.open_zarr(path)
+        except ImportError:
+            pass
+    return path
+
+
 def data_source():
     source = config.get_value(['set', 'data_source'])
     if source == 'api':
@@ -27,8 +27,35 @@ def all_equal(iterable):
     return next(g, True) and not next(g, False)
 
 
+def peers_ndvi(axn, aoi, year, pid, ptype=None, period='week',
+               debug=False):
+    """Plot the NDVI of the median and the quartiles of the weekly (or
+    monthly) mean B04 and B08 of the parcel peers."""
+    df = time_series.peers(aoi, year, pid, 's2', ptype, period=period,
+                           debug=debug)
+    if df.empty:
+        print("No period stats found for the parcel peers.")
+        return
+    df['date'] = pd.to_datetime(df['period']) + timedelta(
+        days=3.5 if period == 'week' else 15)
+    df['band'] = df['band'].replace({'B4': 'B04', 'B8': 'B08'})
+    bands = df.pivot_table(index='date', columns='band',
+                           values=['p25', 'p50', 'p75'])
+    q = {p: (bands[p]['B08'] - bands[p]['B04']) /
+         (bands[p]['B08'] + bands[p]['B04']) for p in ['p25', 'p50', 'p75']}
+    peers = int(df['peers'].max())
+    axn.fill_between(q['p50'].index, q['p25'], q['p75'], color='g',
+                     alpha=0.15, label=f"Parcel peers ({peers}), p25-p75")
+    axn.plot(q['p50'].index, q['p50'], linestyle=':', color='g',
+             label=f"Parcel peers, {period}ly median")
+
+
 def ndvi(aoi, year, pids, ptype=None, scl='3_8_9_10_11', std=True,
-         max_line_plots=10, errorbar=True, view=True, debug=False):
+         max_line_plots=10, errorbar=True, view=True, debug=False,
+         peers=None):
+    """Plot the NDVI profiles of the parcels. With peers 'week' or 'month'
+    the weekly or monthly NDVI of the peers of a single parcel is added,
+    from the parcel period stats."""
 
     if type(pids) is not list:
         pids = [pids]
@@ -164,6 +191,9 @@ def ndvi(aoi, year, pids, ptype=None, scl='3_8_9_10_11', std=True,
         pcount += 1
     if 'message' in locals():
         print(message)
+    if peers and len(pids) == 1:
+        peers_ndvi(axn, aoi, year, pids[0], ptype, peers, debug)
+        axn.legend(frameon=False)
     axn.set_title(plot_title)
 
     if not view:
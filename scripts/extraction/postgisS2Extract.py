@@ -40,6 +40,10 @@ import pandas as pd
 from rasterstats import zonal_stats
 
 import download_with_boto3 as dwb
+try:
+    from cbm.extract import scene_cache
+except ImportError:
+    scene_cache = None
 
 start = time.time()
 
@@ -201,13 +205,20 @@ for k in selection.keys():
     fpath = "data/{}".format(s.split('/')[-1])
     alt_s = s.replace('0m/', '0m/L2A_')
 
-    if dwb.getFileFromS3('{}{}/IMG_DATA/{}'.format(s3path, s3subdir, s), fpath) == 1:
-        print("Image {} found in bucket".format(s))
-        file_set[k] = fpath
-    elif dwb.getFileFromS3('{}{}/IMG_DATA/{}'.format(s3path, s3subdir, alt_s), fpath) == 1:
+    def download(fpath, s=s, alt_s=alt_s):
         # LEVEL2AP has another naming convention.
-        print("Image {} found in bucket".format(alt_s))
-        file_set[k] = fpath
+        for name in (s, alt_s):
+            if dwb.getFileFromS3('{}{}/IMG_DATA/{}'.format(s3path, s3subdir, name), fpath) == 1:
+                print("Image {} found in bucket".format(name))
+                return True
+        return False
+
+    if scene_cache is not None:
+        image = scene_cache.resolve('{}{}/IMG_DATA/{}'.format(s3path, s3subdir, s), download, fpath)
+    else:
+        image = fpath if download(fpath) else None
+    if image:
+        file_set[k] = image
     else:
         print("Neither Image {} nor {} found in bucket".format(s, alt_s))
         incurs.execute(updateSql.format(
@@ -348,7 +359,7 @@ if os.path.exists(fpath):
     os.remove(fpath)
 
 for f in file_set.keys():
-    if os.path.exists(file_set.get(f)):
+    if file_set.get(f).startswith('data/') and os.path.exists(file_set.get(f)):
         print("Removing {}".format(file_set.get(f)))
         os.remove(file_set.get(f))
 
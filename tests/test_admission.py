@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the admission control of the API queries. The statement timeout
+test needs a PostgreSQL test database:
+    CBM_TEST_DSN="host=localhost dbname=postgres user=postgres" \\
+        python -m pytest tests/test_admission.py"""
+
+import os
+import sys
+import json
+import time
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import admission  # noqa: E402
+
+DSN = os.environ.get('CBM_TEST_DSN')
+LIMITS = {'global': {'light': 3, 'heavy': 2},
+          'queue_size': 2, 'max_wait': 0.2,
+          'tiers': {'default': {'light': 2, 'heavy': 1, 'queue_size': 1,
+                                'max_wait': 0.2},
+                    'power': {'heavy': 2, 'queue_size': 2}}}
+
+
+@pytest.fixture
+def controller(tmp_path, monkeypatch):
+    limits_file = tmp_path / 'limits.json'
+    limits_file.write_text(json.dumps(LIMITS))
+    monkeypatch.setattr(admission, 'limits_file', str(limits_file))
+    monkeypatch.setitem(admission._config, 'limits', None)
+    return admission.Admission()
+
+
+def test_user_limit(controller):
+    tickets = [controller.acquire('a', 'light') for i in range(2)]
+    start = time.monotonic()
+    with pytest.raises(admission.Rejected) as err:
+        controller.acquire('a', 'light')
+    assert err.value.status == 429 and err.value.retry_after >= 1
+    assert time.monotonic() - start >= 0.2  # Waited for a free slot.
+    # Other users and classes are not limited by the user limit.
+    tickets.append(controller.acquire('b', 'light'))
+    tickets.append(controller.acquire('a', 'heavy'))
+    for ticket in tickets:
+        ticket.release()
+        ticket.release()  # Released once.
+    assert controller.metrics()['active'] == {'light': 0, 'heavy': 0,
+                                              'chips': 0}
+
+
+def test_global_limit(controller):
+    tickets = [controller.acquire(u, 'light') for u in 'abc']
+    with pytest.raises(admission.Rejected) as err:
+        controller.acquire('d', 'light')
+    assert err.value.status == 503
+    assert controller.metrics()['rejected_503'] == 1
+    for ticket in tickets:
+        ticket.release()
+
+
+def test_wait_for_slot(controller):
+    ticket = controller.acquire('a', 'heavy')
+    threading.Timer(0.05, ticket.release).start()
+    start = time.monotonic()
+    controller.acquire('a', 'heavy').release()
+    assert 0.04 <= time.monotonic() - start < 0.2
+    assert controller.metrics()['waits'] == 1
+
+
+def test_queue_size(controller):
+    ticket = controller.acquire('a', 'heavy')
+    waiter = threading.Thread(target=lambda: pytest.raises(
+        admission.Rejected, controller.acquire, 'a', 'heavy'))
+    waiter.start()
+    time.sleep(0.05)
+    # The queue of the user is full, rejected without waiting.
+    start = time.monotonic()
+    with pytest.raises(admission.Rejected) as err:
+        controller.acquire('a', 'heavy')
+    assert err.value.status == 429
+    assert time.monotonic() - start < 0.05
+    waiter.join()
+    ticket.release()
+
+
+def test_tiers(controller):
+    tickets = [controller.acquire('p', 'heavy', 'power') for i in range(2)]
+    with pytest.raises(admission.Rejected) as err:
+        controller.acquire('q', 'heavy', 'power')
+    assert err.value.status == 503  # The global heavy limit.
+    for ticket in tickets:
+        ticket.release()
+    # Unknown tiers have the default limits.
+    assert admission.tier_limits('unknown')['heavy'] == 1
+    assert admission.tier_limits('power')['light'] == 2
+    assert admission.tier_limits('power')['chips'] == \
+        admission.TIERS['default']['chips']
+
+
+def test_streamed_release(controller):
+    ticket = controller.acquire('a', 'light')
+    body = ticket.released_after(iter([b'a', b'b']))
+    assert controller.metrics()['active']['light'] == 1
+    assert list(body) == [b'a', b'b']
+    assert controller.metrics()['active']['light'] == 0
+    # Closed before the end.
+    ticket = controller.acquire('a', 'light')
+    body = ticket.released_after(iter([b'a', b'b']))
+    next(body)
+    body.close()
+    assert controller.metrics()['active']['light'] == 0
+
+
+@pytest.mark.skipif(not DSN, reason="CBM_TEST_DSN is not set")
+def test_statement_timeout(monkeypatch):
+    psycopg2 = pytest.importorskip('psycopg2')
+    pytest.importorskip('pandas')
+    from scripts import db
+    monkeypatch.setattr(db, 'conn_str', lambda name: DSN)
+    pool = db.ConnectionPool('test', 1, 2)
+    with db.statement_timeout(0.1):
+        with pool.connection() as conn:
+            with pytest.raises(psycopg2.errors.QueryCanceled):
+                conn.cursor().execute("SELECT pg_sleep(1);")
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SHOW statement_timeout;")
+        assert cur.fetchone()[0] == '0'
+    pool.closeall()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests and microbenchmark of the chip overlap of scene footprints and the
+selection of the best scene of each acquisition.
+Run with: python -m pytest tests/test_chip_footprints.py -s"""
+
+import os
+import sys
+import time
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts.chip_extract import chipFootprints  # noqa: E402
+
+LON, LAT = 5.66, 52.69
+CHIPSIZE = 1280
+
+
+def square(x0, y0, x1, y1):
+    # A lon/lat box as a WKT polygon.
+    return f"POLYGON(({x0} {y0}, {x1} {y0}, {x1} {y1}, {x0} {y1}, {x0} {y0}))"
+
+
+def chip_bounds():
+    # The lon/lat bounds of the chip, from its EPSG:3857 square.
+    x, y = chipFootprints.mercator(LON, LAT)
+    half = CHIPSIZE // 2
+    r = chipFootprints.EARTH_RADIUS
+    lons = np.degrees(np.array([x - half, x + half]) / r)
+    lats = np.degrees(2 * np.arctan(np.exp(np.array([y - half, y + half]) /
+                                           r)) - np.pi / 2)
+    return lons, lats
+
+
+def contains(ring, points):
+    # Even-odd rule point in polygon test.
+    inside = np.zeros(len(points), bool)
+    px, py = points[:, 0], points[:, 1]
+    for (x0, y0), (x1, y1) in zip(ring, np.roll(ring, -1, axis=0)):
+        crosses = (y0 > py) != (y1 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (px < x)
+    return inside
+
+
+def sampled_overlap(footprint, n=200):
+    # The overlap from a grid of points in the chip, for comparison.
+    lons, lats = chip_bounds()
+    xs, ys = np.meshgrid(np.linspace(*lons, n), np.linspace(*lats, n))
+    points = np.column_stack([xs.ravel(), ys.ravel()])
+    inside = np.zeros(len(points), bool)
+    for coords, hole in chipFootprints.wkt_rings(footprint):
+        in_ring = contains(coords, points)
+        inside = inside & ~in_ring if hole else inside | in_ring
+    return inside.mean()
+
+
+def test_overlaps():
+    lons, lats = chip_bounds()
+    mid = (lons[0] + lons[1]) / 2
+    footprints = [
+        square(5, 52, 6, 53),  # Covers the chip.
+        square(6, 52, 7, 53),  # Outside the chip.
+        square(mid, 52, 7, 53),  # Covers the east half.
+        # The chip is in a hole of the footprint.
+        f"POLYGON((5 52, 6 52, 6 53, 5 53, 5 52), "
+        f"({lons[0] - 0.01} {lats[0] - 0.01}, {lons[1] + 0.01} "
+        f"{lats[0] - 0.01}, {lons[1] + 0.01} {lats[1] + 0.01}, "
+        f"{lons[0] - 0.01} {lats[1] + 0.01}, {lons[0] - 0.01} "
+        f"{lats[0] - 0.01}))",
+        # The east half in two parts.
+        f"MULTIPOLYGON((({mid} 52, 7 52, 7 {LAT}, {mid} {LAT}, {mid} 52)), "
+        f"(({mid} {LAT}, 7 {LAT}, 7 53, {mid} 53, {mid} {LAT})))",
+    ]
+    overlaps = chipFootprints.chip_overlaps(LON, LAT, CHIPSIZE, footprints)
+    assert overlaps == pytest.approx([1, 0, 0.5, 0, 0.5], abs=1e-6)
+
+
+def test_geojson():
+    geometry = {'type': 'Polygon', 'coordinates': [
+        [[5, 52], [6, 52], [6, 53], [5, 53], [5, 52]]]}
+    assert chipFootprints.chip_overlaps(
+        LON, LAT, CHIPSIZE, [geometry]) == pytest.approx([1])
+    assert len(chipFootprints.chip_overlaps(LON, LAT, CHIPSIZE, [])) == 0
+
+
+def test_random_footprints():
+    rng = random.Random(1)
+    lons, lats = chip_bounds()
+    footprints = []
+    for i in range(20):
+        # Random (concave) polygons around the chip.
+        cx = rng.uniform(lons[0], lons[1])
+        cy = rng.uniform(lats[0], lats[1])
+        ring = []
+        for a in sorted([rng.uniform(0, 2 * np.pi) for v in range(7)]):
+            r = rng.uniform(0.2, 1.5) * (lons[1] - lons[0])
+            ring.append(f"{cx + r * np.cos(a)} {cy + r * np.sin(a) * 0.6}")
+        footprints.append(f"POLYGON(({', '.join(ring + ring[:1])}))")
+    overlaps = chipFootprints.chip_overlaps(LON, LAT, CHIPSIZE, footprints)
+    for footprint, overlap in zip(footprints, overlaps):
+        assert overlap == pytest.approx(sampled_overlap(footprint), abs=0.02)
+
+
+def test_best_per_acquisition():
+    references = [
+        # Two tiles of one acquisition, the best covering is kept.
+        {'id': 'S2A_MSIL2A_20190503T104031_N0211_R008_T31TEG_'
+               '20190503T112944.SAFE', 'chipoverlap': 0.4},
+        {'id': 'S2A_MSIL2A_20190503T104031_N0211_R008_T31TFG_'
+               '20190503T112944.SAFE', 'chipoverlap': 1.0},
+        # Full overlap in both tiles, the highest version is kept.
+        {'id': 'S2B_MSIL2A_20190508T104029_N0211_R008_T31TEG_'
+               '20190508T132035.SAFE', 'chipoverlap': 1.0},
+        {'id': 'S2B_MSIL2A_20190508T104029_N0212_R008_T31TFG_'
+               '20190508T150059.SAFE', 'chipoverlap': 0.9999999999},
+        {'id': 'S2A_MSIL2A_20190513T104031_N0212_R008_T31TFG_'
+               '20190513T133108.SAFE', 'chipoverlap': 0.7},
+    ]
+    expected = [references[4]['id'], references[3]['id'],
+                references[1]['id']]
+    for i in range(10):
+        random.Random(i).shuffle(references)
+        assert chipFootprints.best_per_acquisition(references) == expected
+
+
+def test_best_per_day_s1():
+    references = [
+        {'id': 'S1B_IW_GRDH_1SDV_20190301T172436_20190301T172501_015164_'
+               '01C5BF_40F5_CARD_BS', 'orbitDirection': 'ASCENDING',
+         'chipoverlap': 1.0},
+        {'id': 'S1A_IW_GRDH_1SDV_20190301T055814_20190301T055839_026111_'
+               '02E91C_1C2F_CARD_BS', 'orbitDirection': 'DESCENDING',
+         'chipoverlap': 0.6},
+        {'id': 'S1A_IW_GRDH_1SDV_20190302T172436_20190302T172501_026126_'
+               '02E9A0_40F5_CARD_BS', 'orbitDirection': 'ASCENDING',
+         'chipoverlap': 1.0}]
+    assert chipFootprints.best_per_acquisition(
+        references, chipFootprints.s1_acquisition,
+        chipFootprints.s1_rank) == [references[2]['id'], references[0]['id']]
+
+
+def test_benchmark():
+    # A year of candidate scenes: the batch against a call for each scene,
+    # as ogr_intersect was used.
+    rng = random.Random(2)
+    footprints = []
+    for i in range(1500):
+        x0, y0 = LON - rng.uniform(0, 1.2), LAT - rng.uniform(0, 1.2)
+        footprints.append(square(x0, y0, x0 + 1.2, y0 + 1.2))
+
+    start = time.perf_counter()
+    batch = chipFootprints.chip_overlaps(LON, LAT, CHIPSIZE, footprints)
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [chipFootprints.chip_overlaps(LON, LAT, CHIPSIZE, [f])[0]
+              for f in footprints]
+    single_time = time.perf_counter() - start
+
+    references = [{'id': f"S2A_MSIL2A_2019{i // 4:04d}T104031_N0211_R008_"
+                         f"T31U{i % 4}G_20190503T112944.SAFE",
+                   'chipoverlap': o} for i, o in enumerate(batch)]
+    start = time.perf_counter()
+    chipFootprints.best_per_acquisition(references)
+    dedupe_time = time.perf_counter() - start
+
+    print(f"\n{len(footprints)} footprints: batch {batch_time * 1000:.1f} ms,"
+          f" one by one {single_time * 1000:.1f} ms, best per acquisition "
+          f"{dedupe_time * 1000:.1f} ms")
+    assert batch == pytest.approx(single)
+    assert batch_time < single_time / 5
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the background jobs of the chip queries.
+Run with: python -m pytest tests/test_chip_jobs.py"""
+
+import os
+import sys
+from concurrent.futures import Future
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import chip_jobs  # noqa: E402
+
+PARAMS = {'lon': '5.1', 'lat': '45.2', 'start_date': '2020-06-01',
+          'end_date': '2020-06-30'}
+
+
+class Executor:
+    # Keeps the submitted jobs, without running them.
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, job):
+        self.jobs.append(job)
+        return Future()
+
+
+@pytest.fixture
+def executor(tmp_path, monkeypatch):
+    monkeypatch.setattr(chip_jobs, 'JOBS_DIR', str(tmp_path / 'jobs'))
+    monkeypatch.setattr(chip_jobs, '_futures', {})
+    executor = Executor()
+    monkeypatch.setattr(chip_jobs, 'executor', lambda: executor)
+    return executor
+
+
+def submit(query, params, user):
+    params, error = chip_jobs.check_params(query, params)
+    assert error is None
+    return chip_jobs.submit(query, params, user)
+
+
+def test_keys():
+    # The requests that share a unique_dir have other keys.
+    keys = set()
+    for query, params in [
+            ('rawChipByLocation', PARAMS),
+            ('rawChipByLocation', {**PARAMS, 'end_date': '2020-07-31'}),
+            ('chipsByLocation', PARAMS),
+            ('chipsByLocation', {**PARAMS, 'start_date': '2020-05-01'}),
+            ('rawChipsBatch', {'lon': '5.1', 'lat': '45.2', 'chipsize': 1280,
+                               'tiles': ['a'], 'bands': ['B04']}),
+            ('rawChipsBatch', {'lon': '5.1', 'lat': '45.2', 'chipsize': 1280,
+                               'tiles': ['a', 'b'], 'bands': ['B04']}),
+            ('rawChipsBatch', {'lon': '5.1', 'lat': '45.2', 'chipsize': 1280,
+                               'tiles': ['a'], 'bands': ['B08']}),
+            ('rawS1ChipsBatch', {'lon': '5.1', 'lat': '45.2', 'chipsize': 1280,
+                                 'plevel': 'CARD-BS', 'dates': ['a']}),
+            ('rawS1ChipsBatch', {'lon': '5.1', 'lat': '45.2', 'chipsize': 1280,
+                                 'plevel': 'CARD-BS', 'dates': ['b']})]:
+        params, error = chip_jobs.check_params(query, params)
+        keys.add(chip_jobs.job_key(query, params))
+    assert len(keys) == 9
+    assert chip_jobs.job_key('rawChipByLocation', {**PARAMS}) == \
+        chip_jobs.job_key('rawChipByLocation', dict(reversed(PARAMS.items())))
+
+
+def test_shared_job(executor):
+    alice = submit('rawChipByLocation', PARAMS, 'alice')
+    assert submit('rawChipByLocation', PARAMS, 'alice')['id'] == alice['id']
+    # Bob gets his own job, that follows the job of Alice.
+    bob = submit('rawChipByLocation', PARAMS, 'bob')
+    assert bob['id'] != alice['id'] and bob['runner'] == alice['id']
+    assert len(executor.jobs) == 1
+    assert chip_jobs.get(bob['id'])['user'] == 'bob'
+    assert [j['id'] for j in chip_jobs.jobs('bob')] == [bob['id']]
+    # An other date range of the same unique_dir is an other job.
+    other = submit('rawChipByLocation', {**PARAMS, 'end_date': '2020-07-31'},
+                   'bob')
+    assert other['unique_dir'] == alice['unique_dir']
+    assert 'runner' not in other and len(executor.jobs) == 2
+
+    job = chip_jobs.get(alice['id'])
+    job.update({'status': 'done', 'result': 'chipslist_x.json'})
+    chip_jobs._write(job)
+    bob = chip_jobs.get(bob['id'])
+    assert (bob['status'], bob['result']) == ('done', 'chipslist_x.json')
+    assert chip_jobs.wait(bob, 0)['status'] == 'done'
+    os.remove(chip_jobs._job_file(alice['id']))
+    assert chip_jobs.get(bob['id'])['status'] == 'failed'
+
+
+def test_run(executor, tmp_path, monkeypatch):
+    # Each job keeps its result, the unique_dir is shared.
+    pytest.importorskip('requests')
+    from scripts import registry, parcel_cube
+
+    def export(dataset, udir, params):
+        os.makedirs(udir, exist_ok=True)
+        with open(os.path.join(udir, 'cube.zip'), 'w') as f:
+            f.write(params['end_date'])
+        return 1
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(registry, 'datasets', lambda: {'xx_2020': {}})
+    monkeypatch.setattr(parcel_cube, 'export', export)
+    monkeypatch.setattr(chip_jobs, 'unique_dir', lambda q, p: 'cube')
+    params = {'aoi': 'xx', 'year': '2020', 'start_date': '2020-03-01'}
+    jobs = [submit('parcelsCube', {**params, 'end_date': d}, 'alice')
+            for d in ['2020-06-30', '2020-10-31']]
+    for job in executor.jobs:
+        assert chip_jobs.run(job) == 1
+    for job, end_date in zip(jobs, ['2020-06-30', '2020-10-31']):
+        job = chip_jobs.get(job['id'])
+        assert job['status'] == 'done' and job['result'] != 'cube/cube.zip'
+        with open(job['result']) as f:
+            assert f.read() == end_date
+    assert chip_jobs._active(jobs[0]['key']) is None
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the chip task scheduler, with local subprocesses standing in
+for the chip extraction VMs.
+Run with: python -m pytest tests/test_chip_scheduler.py"""
+
+import os
+import sys
+import subprocess
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts.chip_extract import chipScheduler  # noqa: E402
+
+# Seconds each stand-in VM takes for a chip, None for a dead VM.
+VMS = {'fast': 0.05, 'slow': 0.5, 'dead': None}
+
+
+def launch(vm, task):
+    # Run a chip task in a subprocess, as if it was the docker on the VM.
+    if VMS[vm] is None:
+        code = "import sys; sys.exit(1)"
+    else:
+        code = f"import time; time.sleep({VMS[vm]}); print('{task}')"
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                         text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f"{task} failed on {vm}")
+    return (vm, out.stdout.strip())
+
+
+def test_all_tasks_done_with_a_dead_worker():
+    registry = chipScheduler.WorkerRegistry(VMS, capacity=2)
+    tasks = [f"chip{i}" for i in range(12)]
+    results = chipScheduler.run_tasks(registry, launch, tasks)
+    assert [r[1] for r in results] == tasks
+    assert 'dead' not in [r[0] for r in results]
+    status = registry.status()
+    assert status['dead']['failures'] >= 1
+    assert status['fast']['tasks'] > 0
+
+
+def test_unhealthy_worker_left_out():
+    registry = chipScheduler.WorkerRegistry(['dead', 'fast'], capacity=1,
+                                            max_failures=2, cooldown=60)
+    for i in range(2):
+        chipScheduler.run_task(registry, launch, f"chip{i}")
+    assert registry.status()['dead']['healthy'] is False
+    assert registry.acquire() == 'fast'
+
+
+def test_least_loaded_and_faster_workers_first():
+    registry = chipScheduler.WorkerRegistry(['fast', 'slow'], capacity=1)
+    results = chipScheduler.run_tasks(
+        registry, launch, [f"chip{i}" for i in range(12)])
+    counts = Counter([r[0] for r in results])
+    assert counts['fast'] > counts['slow']
+    status = registry.status()
+    assert 0 < status['slow']['utilisation'] <= 1
+    assert status['fast']['latency'] < status['slow']['latency']
+
+
+def test_acquire_least_loaded():
+    registry = chipScheduler.WorkerRegistry(['a', 'b'], capacity=2)
+    first = registry.acquire()
+    second = registry.acquire()
+    assert first != second
+    registry.release(first, 0.1)
+    assert registry.acquire() == first
+
+
+def test_no_worker_available():
+    registry = chipScheduler.WorkerRegistry(['dead'], capacity=1)
+    with pytest.raises(RuntimeError):
+        chipScheduler.run_task(registry, launch, 'chip')
+    registry.add('other')
+    registry.remove('other')
+    with pytest.raises(chipScheduler.NoWorkerAvailable):
+        registry.acquire(exclude=['dead'])
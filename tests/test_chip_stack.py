@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the stacks of the raw chips, with synthetic chips.
+Run with: python -m pytest tests/test_chip_stack.py"""
+
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+rio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin  # noqa: E402
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import chip_jobs  # noqa: E402
+from scripts.chip_extract import (chipStack, chipRipper,  # noqa: E402
+                                  chipWorkers)
+
+REFERENCES = [
+    f"S2A_MSIL2A_202006{d:02d}T101031_N0214_R022_T32UPU_"
+    f"202006{d:02d}T130334.SAFE" for d in [1, 6, 11]]
+
+
+def write_chip(path, value, size, res):
+    with rio.open(path, 'w', driver='GTiff', width=size, height=size,
+                  count=1, dtype='uint16', crs='EPSG:32632', nodata=0,
+                  transform=from_origin(600000, 5100000, res, res)) as dst:
+        dst.write(np.full((1, size, size), value, 'uint16'))
+
+
+@pytest.fixture
+def chips(tmp_path):
+    # B08 (10 m) and B11 (20 m) chips, the B11 chip of the last date is
+    # missing (failed).
+    for t, reference in enumerate(REFERENCES):
+        write_chip(chipStack.chip_path(str(tmp_path), reference, 'B08'),
+                   100 + t, 8, 10)
+        if t < 2:
+            write_chip(chipStack.chip_path(str(tmp_path), reference, 'B11'),
+                       200 + t, 4, 20)
+    return str(tmp_path)
+
+
+def test_stack(chips):
+    data, dates, references, profile = chipStack.stack(
+        chips, '2020-06-01', '2020-06-10', ['B08', 'B11'])
+    assert dates == ['20200601T101031', '20200606T101031']
+    assert references == REFERENCES[:2]
+    assert data.shape == (2, 2, 8, 8) and data.dtype == np.uint16
+    assert (data[1, 0] == 101).all() and (data[1, 1] == 201).all()
+    assert profile['transform'].a == 10
+
+    data, dates, references, profile = chipStack.stack(
+        chips, '2020-06-01', '2020-06-30', ['B11', 'B08'])
+    assert data.shape == (3, 2, 4, 4)  # The grid of the first band.
+    assert (data[2, 0] == 0).all() and (data[2, 1] == 102).all()
+
+
+def test_geotiff(chips):
+    path = chipStack.buildStack(chips, '2020-06-01', '2020-06-30',
+                                ['B08', 'B11'])
+    assert path.endswith('chipstack_2020-06-01_2020-06-30.tif')
+    with rio.open(path) as src:
+        assert src.count == 6 and src.compression.value == 'DEFLATE'
+        assert src.tags()['dates'].split(',')[2] == '20200611T101031'
+        assert src.tags(4) == {'date': '20200606T101031', 'band': 'B11',
+                               'reference': REFERENCES[1]}
+        assert src.descriptions[4] == '20200611T101031_B08'
+        stack = src.read().reshape(3, 2, 8, 8)
+    assert (stack[:, 0, 0, 0] == [100, 101, 102]).all()
+    assert chipStack.buildStack(chips, '2021-01-01', '2021-01-31',
+                                ['B08']) is None
+
+
+def test_npz(chips):
+    path = chipStack.buildStack(chips, '2020-06-01', '2020-06-30',
+                                ['B08', 'B11'], 'npz')
+    npz = np.load(path)
+    assert npz['data'].shape == (3, 2, 8, 8)
+    assert list(npz['bands']) == ['B08', 'B11']
+    assert list(npz['transform'][:3]) == [10, 0, 600000]
+    assert 'UTM zone 32N' in str(npz['crs'])
+
+
+def test_extract(chips, monkeypatch):
+    # Only the missing chips are extracted, in one run of the worker pool.
+    pytest.importorskip('requests')
+    from scripts.chip_extract import creodiasCARDchips
+    runs = []
+
+    class Pool:
+        def run(self, tasks):
+            runs.append(tasks)
+            return {t['output']: t['output'] for t in tasks}
+    monkeypatch.setattr(creodiasCARDchips, 'getS2Chips',
+                        lambda *args: REFERENCES)
+    monkeypatch.setattr(creodiasCARDchips, 'rinseAndDryS2', lambda r: r)
+    monkeypatch.setattr(chipWorkers, 'config', lambda: {'backend': 'local'})
+    monkeypatch.setattr(chipWorkers, 'pool', lambda: Pool())
+    assert chipStack.parallelExtract(
+        5.1, 45.2, '2020-06-01', '2020-06-30', chips, ['B08', 'B11', 'SCL'],
+        '1280', 'LEVEL2A') == 3
+    assert len(runs) == 1
+    assert sorted((t['reference'], t['band']) for t in runs[0]) == sorted(
+        [(REFERENCES[2], 'B11')] + [(r, 'SCL') for r in REFERENCES])
+    assert chipWorkers.batches(runs[0])[0]['tasks'][0]['type'] == 's2'
+    monkeypatch.setattr(chipStack, 'MAX_DATES', 2)
+    assert chipStack.parallelExtract(
+        5.1, 45.2, '2020-06-01', '2020-06-30', chips, ['B08'], '1280',
+        'LEVEL2A') == -1
+    assert chipRipper.BAND_RESOLUTION['SCL'] == 20
+
+
+def test_job_key():
+    # The stacks of other dates share the chips, not the job.
+    params = [chip_jobs.check_params('rawChipStack', {
+        'lon': '5.1', 'lat': '45.2', 'start_date': '2020-06-01',
+        'end_date': end_date})[0] for end_date in ['2020-06-30', '2020-07-31']]
+    assert chip_jobs.unique_dir('rawChipStack', params[0]) == \
+        chip_jobs.unique_dir('rawChipStack', params[1])
+    assert chip_jobs.job_key('rawChipStack', params[0]) != \
+        chip_jobs.job_key('rawChipStack', params[1])
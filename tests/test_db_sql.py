@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the identifier checks and prepared statements of the API
+queries, and microbenchmark of the parcel time series query, ad hoc (the
+values in the query text) against prepared. The database tests need a
+PostgreSQL test database:
+    CBM_TEST_DSN="host=localhost dbname=postgres user=postgres" \\
+        python -m pytest tests/test_db_sql.py -s"""
+
+import os
+import sys
+import time
+import random
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+pytest.importorskip('pandas')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import db, db_sql, db_queries  # noqa: E402
+
+DSN = os.environ.get('CBM_TEST_DSN')
+PARCELS = 20000
+DATES = 60
+DATASET = {'db': 'test',
+           'tables': {'parcels': 'cbm_test_sql_parcels',
+                      's2': 'cbm_test_sql_s2',
+                      'dias_catalog': 'cbm_test_sql_dias',
+                      'scl': 'cbm_test_sql_hists'},
+           'pcolumns': {'parcel_id': 'parcel_id', 'crop_name': 'cropname',
+                        'crop_code': 'cropcode'}}
+
+needs_db = pytest.mark.skipif(not DSN, reason="CBM_TEST_DSN is not set")
+
+
+def test_identifiers():
+    assert db_sql.identifier('parcels').strings == ('parcels',)
+    assert db_sql.identifier('AOI.Parcels_2020').strings == (
+        'aoi', 'parcels_2020')
+    assert db_sql.table(DATASET, 'parcels', '_m').strings == (
+        'cbm_test_sql_parcels_m',)
+    for name in ['parcels; DROP TABLE x', 'a.b.c', "p' OR '1'='1", '',
+                 '1parcels', 'parcels--', 'a' * 64]:
+        with pytest.raises(ValueError):
+            db_sql.identifier(name)
+    with pytest.raises(ValueError):
+        db_sql.table(DATASET, 'parcels', "_m p; DELETE FROM users")
+
+
+def test_prepare_sql():
+    text, names = db_sql.prepare_sql(
+        "SELECT %(a)s, %(b)s, %(a)s, x LIKE 'p%%' FROM t LIMIT %(max)s")
+    assert text == "SELECT $1, $2, $1, x LIKE 'p%' FROM t LIMIT $3"
+    assert names == ['a', 'b', 'max']
+    assert db_sql.statement_name(text) == db_sql.statement_name(text)
+    assert db_sql.statement_name(text) != db_sql.statement_name(text + ' ')
+
+
+@pytest.fixture(scope='module')
+def conn():
+    conn = psycopg2.connect(DSN, connection_factory=db.Connection)
+    conn.autocommit = True
+    cur = conn.cursor()
+    tables = DATASET['tables']
+    for t in tables.values():
+        cur.execute(f"DROP TABLE IF EXISTS {t}")
+    cur.execute(f"""
+        CREATE TABLE {tables['parcels']} AS
+        SELECT i AS ogc_fid, i + 100000 AS parcel_id,
+            'crop' || i % 10 AS cropname, i % 10 AS cropcode
+        FROM generate_series(1, {PARCELS}) i;
+        CREATE INDEX ON {tables['parcels']} (parcel_id);
+        CREATE TABLE {tables['dias_catalog']} AS
+        SELECT i AS id, timestamp '2020-01-01' + i * interval '5 days'
+            AS obstime, 'S2_' || i AS reference
+        FROM generate_series(1, {DATES}) i;
+        ALTER TABLE {tables['dias_catalog']} ADD PRIMARY KEY (id);
+        CREATE TABLE {tables['s2']} AS
+        SELECT p AS pid, d AS obsid, b AS band, 100 AS count,
+            random() AS mean, random() AS std, 0.0 AS min, 0.2 AS p25,
+            0.5 AS p50, 0.7 AS p75, 1.0 AS max
+        FROM generate_series(1, {PARCELS}) p,
+            generate_series(1, {DATES}) d,
+            unnest(ARRAY['B04', 'B08', 'B11']::varchar(3)[]) b;
+        CREATE INDEX ON {tables['s2']} (pid, obsid);
+        CREATE TABLE {tables['scl']} AS
+        SELECT p AS pid, d AS obsid, '{{"4": 100}}'::text AS hist
+        FROM generate_series(1, {PARCELS}) p,
+            generate_series(1, {DATES}) d;
+        CREATE INDEX ON {tables['scl']} (pid, obsid);
+        ANALYZE;""")
+    yield conn
+    for t in tables.values():
+        cur.execute(f"DROP TABLE IF EXISTS {t}")
+    conn.close()
+
+
+def adhoc_sql(pid):
+    # The former query, with the values in the query text.
+    t = DATASET['tables']
+    return f"""
+        SELECT extract('epoch' from d.obstime), s.band,
+            s.count, s.mean, s.std, s.min, s.p25, s.p50, s.p75,
+            s.max, h.hist
+        FROM {t['parcels']} p, {t['s2']} s,
+            {t['dias_catalog']} d, {t['scl']} h
+        WHERE
+            p.ogc_fid = s.pid
+            And p.parcel_id = '{pid}'
+            And s.obsid = d.id
+            And s.pid = h.pid And s.obsid = h.obsid
+            And band IN ('B02', 'B03', 'B04', 'B05', 'B08', 'B11', 'B2',
+                'B3', 'B4', 'B5', 'B8', 'SC')
+        ORDER By obstime, band asc;"""
+
+
+def params(pid):
+    return {'pid': str(pid), 'band': None,
+            'bands': db_queries.tstype_bands('s2')}
+
+
+@needs_db
+def test_prepared_once(conn):
+    conn.prepared.clear()
+    cur = conn.cursor()
+    cur.execute("DEALLOCATE ALL")
+    query = db_queries.parcelTimeSeriesSql(DATASET)
+    for pid in [100001, 100002, 100003]:
+        db_sql.execute(cur, query, params(pid), prepare=True)
+        prepared = cur.fetchall()
+        cur.execute(adhoc_sql(pid))
+        assert prepared == cur.fetchall()
+        assert len(prepared) == DATES * 3
+    cur.execute("SELECT count(*) FROM pg_prepared_statements")
+    assert cur.fetchone()[0] == len(conn.prepared) == 1
+
+    # A quoted value is a value (not an integer parcel id), not sql.
+    with pytest.raises(psycopg2.DataError):
+        db_sql.execute(cur, query, params("1' OR '1'='1"), prepare=True)
+
+
+@needs_db
+def test_benchmark(conn):
+    cur = conn.cursor()
+    query = db_queries.parcelTimeSeriesSql(DATASET)
+    rng = random.Random(1)
+    pids = [100000 + rng.randrange(1, PARCELS) for i in range(300)]
+
+    def run(execute):
+        times = []
+        for pid in pids:
+            start = time.perf_counter()
+            execute(pid)
+            cur.fetchall()
+            times.append(time.perf_counter() - start)
+        return sorted(times)[len(times) // 2]
+
+    adhoc = run(lambda pid: cur.execute(adhoc_sql(pid)))
+    bound = run(lambda pid: db_sql.execute(cur, query, params(pid)))
+    prepared = run(lambda pid: db_sql.execute(cur, query, params(pid),
+                                              prepare=True))
+    print(f"\nParcel time series, median: ad hoc {adhoc * 1000:.3f} ms, "
+          f"bound {bound * 1000:.3f} ms, prepared {prepared * 1000:.3f} ms")
+    assert prepared < adhoc
+
+
+@needs_db
+def test_stream_cursor(conn, monkeypatch):
+    # The streams are read with a server side cursor, FETCH_SIZE rows at a
+    # time, also for the queries that are prepared otherwise.
+    monkeypatch.setattr(db, 'conn_str', lambda name: DSN)
+    monkeypatch.setattr(db, 'db_config', lambda name: {})
+    monkeypatch.setattr(db_queries, 'FETCH_SIZE', 50)
+    stream = db_queries.getParcelTimeSeries(DATASET, 100001, stream=True)
+    try:
+        assert next(stream)[:2] == ('date_part', 'band')
+        assert len(next(stream)) == 50
+        cur = conn.cursor()
+        cur.execute("""SELECT query FROM pg_stat_activity
+            WHERE query LIKE 'FETCH FORWARD 50 FROM "parcel_time_series"'""")
+        assert cur.fetchone() is not None
+        assert sum(len(rows) for rows in stream) == DATES * 3 - 50
+    finally:
+        stream.close()
+        db.close_pools()
+
+
+@needs_db
+def test_stats_peers_count(conn, monkeypatch):
+    # The count of the signatures is the n of the period stats.
+    monkeypatch.setattr(db, 'conn_str', lambda name: DSN)
+    monkeypatch.setattr(db, 'db_config', lambda name: {})
+    stats_table = db_queries.periodStatsTable(DATASET)
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {stats_table}")
+    try:
+        for stype in ['count', 'n']:
+            assert len(db_queries.getParcelStatsPeers(
+                DATASET, '2020-01-01', '2020-01-31', 'B04', stype, '100',
+                5)) == 5
+        cur.execute(f"""
+            CREATE TABLE {stats_table} AS
+            SELECT pid, 'week' AS period_type, date '2020-01-06' AS period,
+                band, 100 AS n, 0.5 AS mean
+            FROM {DATASET['tables']['s2']}
+            WHERE obsid = 1 AND pid <= 3""")
+        for stype in ['count', 'n']:
+            assert len(db_queries.getParcelStatsPeers(
+                DATASET, '2020-01-01', '2020-01-31', 'B04', stype,
+                '99-101', 5)) == 3
+        assert db_queries.getParcelStatsPeers(
+            DATASET, '2020-01-01', '2020-01-31', 'B04', 'hist', '1') == []
+    finally:
+        cur.execute(f"DROP TABLE IF EXISTS {stats_table}")
+        db.close_pools()
+
+
+@needs_db
+def test_batch_pids(conn, monkeypatch):
+    # An empty list of parcel ids selects no parcels, not all of them.
+    monkeypatch.setattr(db, 'conn_str', lambda name: DSN)
+    monkeypatch.setattr(db, 'db_config', lambda name: {})
+    try:
+        assert list(db_queries.getParcelsTimeSeries(DATASET, [])) == []
+        series = list(db_queries.getParcelsTimeSeries(
+            DATASET, ['100001', '100002']))
+        assert [s[0] for s in series] == ['100001', '100002']
+    finally:
+        db.close_pools()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the API metrics. The database time test needs a PostgreSQL test
+database:
+    CBM_TEST_DSN="host=localhost dbname=postgres user=postgres" \\
+        python -m pytest tests/test_metrics.py"""
+
+import os
+import sys
+import json
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import metrics  # noqa: E402
+
+DSN = os.environ.get('CBM_TEST_DSN')
+
+
+def samples(text):
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+def test_histogram():
+    hist = metrics.Histogram('test_seconds', "Test.", ['route'],
+                             buckets=(0.1, 1))
+    for value in [0.05, 0.5, 0.5, 5]:
+        hist.observe(value, '/a"b')
+    text = '\n'.join(hist.render())
+    assert '# TYPE test_seconds histogram' in text
+    values = samples(text)
+    assert values['test_seconds_bucket{route="/a\\"b",le="0.1"}'] == 1
+    assert values['test_seconds_bucket{route="/a\\"b",le="1"}'] == 3
+    assert values['test_seconds_bucket{route="/a\\"b",le="+Inf"}'] == 4
+    assert values['test_seconds_count{route="/a\\"b"}'] == 4
+    assert values['test_seconds_sum{route="/a\\"b"}'] == pytest.approx(6.05)
+
+
+def test_request_timing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics.start_request()
+    with metrics.timed('chips'):
+        time.sleep(0.02)
+    metrics.add('db', 0.01)
+    duration, parts = metrics.end_request('/query/test', 'GET', 200)
+    assert duration >= 0.02
+    assert parts['chips'] >= 0.02 and parts['db'] == 0.01
+    record = json.loads(metrics.access_record(duration, parts,
+                                              route='/query/test'))
+    assert record['route'] == '/query/test' and record['db_ms'] == 10
+    # Work outside of a request only counts in the totals.
+    metrics.add('db', 0.01)
+    values = samples(metrics.render())
+    assert values['cbm_http_requests_total{route="/query/test",'
+                  'method="GET",status="200"}'] >= 1
+    assert values['cbm_http_request_chips_seconds_count{'
+                  'route="/query/test"}'] >= 1
+    assert values['cbm_db_seconds_total'] >= 0.02
+    assert 'cbm_admission_active{class="heavy"}' in values
+    # The chip and scene caches are not created by the metrics.
+    assert not os.path.exists('static')
+
+
+def test_chip_cache(tmp_path, monkeypatch):
+    # The stats of the chip store are read once it exists.
+    from scripts.chip_extract import chipCache
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(chipCache, '_cache', None)
+    assert 'cbm_chip_cache_chips' not in samples(metrics.render())
+    assert chipCache._cache is None
+    chipCache.ChipCache()
+    assert samples(metrics.render())['cbm_chip_cache_chips'] == 0
+
+
+@pytest.mark.skipif(not DSN, reason="CBM_TEST_DSN is not set")
+def test_db_time():
+    psycopg2 = pytest.importorskip('psycopg2')
+    pytest.importorskip('pandas')
+    import psycopg2.extras
+    from scripts import db
+    conn = psycopg2.connect(DSN, connection_factory=db.TimedConnection)
+    queries = metrics.QUERIES.series[()]
+    metrics.start_request()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("SELECT pg_sleep(0.05), 1 AS one;")
+    assert cur.fetchone()['one'] == 1
+    with conn.cursor(name='test_metrics') as cur:
+        cur.execute("SELECT generate_series(1, 10);")
+        assert len(cur.fetchmany(5)) == 5
+    duration, parts = metrics.end_request('/query/db', 'GET', 200)
+    assert 0.05 <= parts['db'] <= duration
+    assert metrics.QUERIES.series[()] == queries + 2
+    conn.close()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the parcel cube export. The export test needs a PostgreSQL test
+database:
+    CBM_TEST_DSN="host=localhost dbname=postgres user=postgres" \\
+        python -m pytest tests/test_parcel_cube.py"""
+
+import os
+import sys
+import json
+import zlib
+import zipfile
+from datetime import date, datetime, timezone
+
+import pytest
+
+np = pytest.importorskip('numpy')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import parcel_cube, chip_jobs  # noqa: E402
+
+DSN = os.environ.get('CBM_TEST_DSN')
+DAYS = [date(2020, 5, 1), date(2020, 5, 6), date(2020, 5, 11)]
+BANDS = ['B04', 'B08']
+COLUMNS = ('date_part', 'band', 'count', 'mean', 'std', 'min', 'p25', 'p50',
+           'p75', 'max', 'hist')
+
+
+def epoch(day, hour=10):
+    return datetime(day.year, day.month, day.day, hour,
+                    tzinfo=timezone.utc).timestamp()
+
+
+def series(parcels):
+    # Parcel i is observed on day i % 3, and cloudy if i is odd.
+    for i in range(parcels):
+        day = DAYS[i % 3]
+        hist = {'4': 100, '8': i % 2}
+        yield f"p{i}", COLUMNS, [
+            (epoch(day), 'B04', 100, 1000 + i, 1, 2, 3, 4, 5, 6, hist),
+            (epoch(day), 'B08', 100, 2000 + i, 1, 2, 3, 4, 5, 6, hist),
+            # An other tile of the same day, with less pixels.
+            (epoch(day, 11), 'B04', 10, -1, 1, 2, 3, 4, 5, 6, hist),
+            (epoch(date(2020, 6, 1)), 'B04', 10, -1, 1, 2, 3, 4, 5, 6, None)]
+
+
+def read_zarr(path, name):
+    # Read an array of the store without zarr.
+    with open(os.path.join(path, name, '.zarray')) as f:
+        meta = json.load(f)
+    shape, chunks = meta['shape'], meta['chunks']
+    parts = []
+    for i in range(-(-shape[0] // chunks[0])):
+        key = '.'.join([str(i)] + ['0'] * (len(shape) - 1))
+        with open(os.path.join(path, name, key), 'rb') as f:
+            parts.append(np.frombuffer(zlib.decompress(f.read()),
+                                       meta['dtype']).reshape(chunks))
+    return np.concatenate(parts)[:shape[0]]
+
+
+def test_zarr(tmp_path, monkeypatch):
+    monkeypatch.setattr(parcel_cube, 'CHUNK_PARCELS', 4)
+    path = str(tmp_path / 'cube.zarr')
+    assert parcel_cube.write(series(10), path, DAYS, BANDS,
+                             attrs={'aoi': 'xx'}) == 10
+    sigs = read_zarr(path, 'signatures')
+    assert sigs.shape == (10, 3, 2, 8)
+    assert sigs[5, 2, 0, 1] == 1005 and sigs[5, 2, 1, 1] == 2005
+    assert np.isnan(sigs[5, 0]).all()
+    observed = read_zarr(path, 'observed')
+    assert observed.sum() == 20 and observed[5, 2].all()
+    assert read_zarr(path, 'cloudfree')[:, :].sum(axis=1).tolist() == [
+        1, 0] * 5
+    assert list(read_zarr(path, 'parcel')) == [f"p{i}" for i in range(10)]
+    with open(os.path.join(path, '.zmetadata')) as f:
+        meta = json.load(f)['metadata']
+    assert meta['.zattrs'] == {'aoi': 'xx'}
+    assert meta['time/.zattrs']['units'] == parcel_cube.TIME_UNITS
+
+    xr = pytest.importorskip('xarray')
+    pytest.importorskip('zarr')
+    ds = xr.open_zarr(path)
+    assert ds.signatures.dims == ('parcel', 'time', 'band', 'stat')
+    assert ds.time.values[1] == np.datetime64('2020-05-06')
+    assert float(ds.signatures.sel(parcel='p4', band='B08', stat='mean',
+                                   time='2020-05-06')) == 2004
+    assert ds.scl.sel(parcel='p1', scl_class=8).values.tolist() == [0, 1, 0]
+
+
+def test_npz(tmp_path, monkeypatch):
+    monkeypatch.setattr(parcel_cube, 'CHUNK_PARCELS', 4)
+    path = tmp_path / 'cube.npz'
+    parcel_cube.write(series(10), str(path), DAYS, BANDS, oformat='npz')
+    shards = sorted(os.listdir(path))
+    assert shards[:3] == ['attrs.json', 'cube_00000.npz', 'cube_00001.npz']
+    last = np.load(path / 'cube_00002.npz')
+    assert list(last['parcel']) == ['p8', 'p9']
+    assert last['signatures'].shape == (2, 3, 2, 8)
+    assert last['time'][2] == np.datetime64('2020-05-11')
+
+
+def test_empty(tmp_path):
+    path = str(tmp_path / 'cube.zarr')
+    assert parcel_cube.write(iter([]), path, DAYS, BANDS) == 0
+    with open(os.path.join(path, 'signatures', '.zarray')) as f:
+        assert json.load(f)['shape'] == [0, 3, 2, 8]
+
+
+def test_job_dir():
+    params, error = chip_jobs.check_params('parcelsCube', {
+        'aoi': 'xx', 'year': '2020', 'start_date': '2020-03-01',
+        'end_date': '2020-10-31', 'pids': ['1', '2']})
+    assert error is None
+    udir = chip_jobs.unique_dir('parcelsCube', params)
+    assert udir.startswith('static/tmp/cube_xx2020_s2_')
+    params['pids'] = ['1', '3']
+    assert chip_jobs.unique_dir('parcelsCube', params) != udir
+
+
+@pytest.fixture
+def dataset(monkeypatch):
+    if not DSN:
+        pytest.skip("CBM_TEST_DSN is not set")
+    psycopg2 = pytest.importorskip('psycopg2')
+    pytest.importorskip('pandas')
+    from scripts import db
+    conn = psycopg2.connect(DSN)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("""
+        DROP TABLE IF EXISTS cbm_test_cube, cbm_test_cube_s2,
+            cbm_test_cube_hists, cbm_test_cube_dias;
+        CREATE TABLE cbm_test_cube AS
+        SELECT i AS ogc_fid, 'p' || i AS parcel_id
+        FROM generate_series(1, 5) i;
+        CREATE TABLE cbm_test_cube_dias AS
+        SELECT i AS id, timestamp '2020-05-01 10:00' + (i || ' days')::interval
+            AS obstime, 's2  '::char(4) AS card
+        FROM generate_series(0, 9) i;
+        CREATE TABLE cbm_test_cube_s2 AS
+        SELECT p.ogc_fid AS pid, d.id AS obsid, b AS band, 100 AS count,
+            (p.ogc_fid * 100 + d.id)::float AS mean, 1.0::float AS std,
+            0.0::float AS min, 1.0::float AS p25, 2.0::float AS p50,
+            3.0::float AS p75, 4.0::float AS max
+        FROM cbm_test_cube p, cbm_test_cube_dias d,
+            unnest(ARRAY['B04', 'B08']) b
+        WHERE (p.ogc_fid + d.id) % 2 = 0;
+        CREATE TABLE cbm_test_cube_hists AS
+        SELECT pid, obsid,
+            ('{"4": 90, "9": ' || (obsid % 3) || '}')::json AS hist
+        FROM (SELECT DISTINCT pid, obsid FROM cbm_test_cube_s2) s;""")
+    monkeypatch.setattr(db, 'conn_str', lambda name: DSN)
+    monkeypatch.setattr(db, 'db_config', lambda name: {})
+    yield {'db': 'test', 'tables': {
+        'parcels': 'cbm_test_cube', 's2': 'cbm_test_cube_s2',
+        'scl': 'cbm_test_cube_hists', 'dias_catalog': 'cbm_test_cube_dias'},
+        'pcolumns': {'parcel_id': 'parcel_id', 'crop_name': 'parcel_id',
+                     'crop_code': 'parcel_id'}}
+    db.close_pools()
+    cur.execute("""DROP TABLE cbm_test_cube, cbm_test_cube_s2,
+        cbm_test_cube_hists, cbm_test_cube_dias;""")
+    conn.close()
+
+
+def test_export(dataset, tmp_path):
+    xr = pytest.importorskip('xarray')
+    pytest.importorskip('zarr')
+    params = {'aoi': 'xx', 'year': '2020', 'start_date': '2020-05-02',
+              'end_date': '2020-05-08', 'pids': ['p1', 'p2', 'p3'],
+              'tstype': 's2', 'format': 'zarr'}
+    assert parcel_cube.export(dataset, str(tmp_path), params) == 3
+    with zipfile.ZipFile(tmp_path / 'cube.zip') as z:
+        z.extractall(tmp_path / 'out')
+    ds = xr.open_zarr(tmp_path / 'out' / 'cube.zarr')
+    assert list(ds.parcel.values) == ['p1', 'p2', 'p3']
+    assert list(ds.band.values) == ['B04', 'B08']
+    assert len(ds.time) == 7 and str(ds.time.values[0])[:10] == '2020-05-02'
+    mean = ds.signatures.sel(stat='mean', band='B08')
+    # Parcel 2 is observed on the even obsid (2, 4 and 6 of 1 to 7), the
+    # obsid 6 is cloud free.
+    assert mean.sel(parcel='p2').values[[1, 3, 5]].tolist() == [202, 204,
+                                                                206]
+    assert not ds.observed.sel(parcel='p2').values[[0, 2, 4, 6]].any()
+    assert ds.cloudfree.sel(parcel='p2').values[[1, 3, 5]].tolist() == [
+        False, False, True]
+    assert ds.attrs['start_date'] == '2020-05-02'
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Query plan regression test of the parcel peers query, on a generated
+parcels table in a PostGIS test database.
+Run with:
+    CBM_TEST_DSN="host=localhost dbname=postgres user=postgres" \\
+        python -m pytest tests/test_parcel_peers_plan.py -s
+CBM_TEST_PARCELS sets the number of parcels (default 1000000)."""
+
+import os
+import sys
+import time
+import json
+import random
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+from psycopg2 import sql  # noqa: E402
+DSN = os.environ.get('CBM_TEST_DSN')
+if not DSN:
+    pytest.skip("CBM_TEST_DSN is not set", allow_module_level=True)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import db_queries  # noqa: E402
+
+PARCELS = int(os.environ.get('CBM_TEST_PARCELS', 1000000))
+TABLE = 'cbm_test_peers'
+DATASET = {'tables': {'parcels': TABLE},
+           'pcolumns': {'parcel_id': 'ogc_fid', 'crop_name': 'cropname'}}
+
+
+@pytest.fixture(scope='module')
+def conn():
+    conn = psycopg2.connect(DSN)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    # A grid of 80 x 80 m parcels (in EPSG:3035) with 10 crops.
+    side = int(PARCELS ** 0.5)
+    cur.execute(f"""
+        CREATE TABLE {TABLE} AS
+        SELECT (i * {side} + j) AS ogc_fid,
+            'crop' || ((i * 7 + j * 3) % 10) AS cropname,
+            ST_Transform(ST_MakeEnvelope(
+                4000000 + j * 100, 3200000 + i * 100,
+                4000080 + j * 100, 3200080 + i * 100, 3035), 4326)
+                AS wkb_geometry
+        FROM generate_series(0, {side - 1}) i,
+            generate_series(0, {side - 1}) j;
+        ALTER TABLE {TABLE} ADD PRIMARY KEY (ogc_fid);""")
+    cur.execute(db_queries.parcelPeersIndexSql(DATASET))
+    yield conn
+    cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    conn.close()
+
+
+def params(pid):
+    return {'pid': str(pid), 'distance': 1000.0, 'max': 10}
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def test_plan_uses_knn_index(conn):
+    cur = conn.cursor()
+    cur.execute(sql.SQL("EXPLAIN (FORMAT JSON) ") + db_queries.parcelPeersSql(
+        DATASET), params(PARCELS // 2))
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = list(plan_nodes(plan[0]['Plan']))
+    knn = [n for n in nodes if n.get('Index Name') ==
+           f"{TABLE}_geom{db_queries.PEERS_SRID}_idx"]
+    assert knn, nodes
+    assert knn[0]['Node Type'] == 'Index Scan'
+    assert '<->' in knn[0].get('Order By', '')
+    assert not [n for n in nodes if n['Node Type'] == 'Seq Scan' and
+                n.get('Relation Name') == TABLE]
+
+
+def test_peers_latency(conn):
+    cur = conn.cursor()
+    sql = db_queries.parcelPeersSql(DATASET)
+    rng = random.Random(1)
+    times = []
+    for i in range(50):
+        pid = rng.randrange(PARCELS // 4, PARCELS * 3 // 4)
+        start = time.perf_counter()
+        cur.execute(sql, params(pid))
+        rows = cur.fetchall()
+        times.append(time.perf_counter() - start)
+        assert 0 < len(rows) <= 10
+        distances = [r[1] for r in rows]
+        assert distances == sorted(distances)
+        assert max(distances) <= 1000.0
+    median = sorted(times)[len(times) // 2]
+    print(f"\nParcel peers of {PARCELS} parcels: {median * 1000:.2f} ms")
+    assert median < 0.01
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the parcel vector tiles. The tile queries need a PostGIS (3.0 or
+later) test database:
+    CBM_TEST_DSN="host=localhost dbname=postgres user=postgres" \\
+        python -m pytest tests/test_parcel_tiles.py"""
+
+import os
+import sys
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+pytest.importorskip('pandas')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import db, db_queries  # noqa: E402
+
+DSN = os.environ.get('CBM_TEST_DSN')
+TABLE = 'cbm_test_tiles'
+DATASET = {'db': 'test', 'tables': {'parcels': TABLE},
+           'pcolumns': {'parcel_id': 'parcel_id', 'crop_name': 'cropname',
+                        'crop_code': 'cropcode'}}
+# Web mercator tile of zoom 14 over the test parcels.
+Z, X, Y = 14, 8801, 5372
+
+
+def test_tolerance():
+    # One tile coordinate: the tile size divided by the extent.
+    assert db_queries.tileTolerance(0) == pytest.approx(
+        40075016.686 / 4096, rel=1e-6)
+    assert db_queries.tileTolerance(14) == pytest.approx(
+        db_queries.tileTolerance(13) / 2)
+
+
+def test_out_of_range():
+    # No database access for empty tiles.
+    assert db_queries.getParcelTile(DATASET, 'xx', 2020, 5, 1, 1) == b''
+    assert db_queries.getParcelTile(DATASET, 'xx', 2020, 14, 2 ** 14, 1) \
+        == b''
+
+
+@pytest.fixture(scope='module')
+def conn(monkeypatch_module):
+    if not DSN:
+        pytest.skip("CBM_TEST_DSN is not set")
+    conn = psycopg2.connect(DSN)
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+        cur.execute("SELECT ST_TileEnvelope(1, 0, 0);")
+    except psycopg2.Error as err:
+        pytest.skip(f"PostGIS 3 is not available: {err}")
+    cur.execute(f"""
+        DROP TABLE IF EXISTS {TABLE};
+        DROP SCHEMA IF EXISTS xx CASCADE;
+        CREATE TABLE {TABLE} AS
+        SELECT i * 100 + j AS parcel_id, 'crop' || (i % 3) AS cropname,
+            i % 3 AS cropcode,
+            ST_Transform(ST_Buffer(ST_SetSRID(ST_MakePoint(
+                13.38 + i * 0.001, 52.52 + j * 0.001), 4326)::geography,
+                30, 16)::geometry, 32633) AS wkb_geometry
+        FROM generate_series(0, 9) i, generate_series(0, 9) j;
+        CREATE INDEX ON {TABLE} USING gist (wkb_geometry);
+        CREATE SCHEMA xx;
+        CREATE TABLE xx.markers_2021 AS
+        SELECT parcel_id, 'mowing' AS marker, 'event' AS marker_type,
+            date '2021-05-01' + (parcel_id % 7) AS date_end
+        FROM {TABLE}
+        UNION ALL
+        SELECT parcel_id, 'grazing', 'event', date '2021-03-01'
+        FROM {TABLE};""")
+    monkeypatch_module.setattr(db, 'conn_str', lambda name: DSN)
+    monkeypatch_module.setattr(db, 'db_config', lambda name: {})
+    db_queries._srids.clear()
+    yield conn
+    db.close_pools()
+    cur.execute(f"DROP TABLE IF EXISTS {TABLE}; DROP SCHEMA xx CASCADE;")
+    conn.close()
+
+
+@pytest.fixture(scope='module')
+def monkeypatch_module():
+    mp = pytest.MonkeyPatch()
+    yield mp
+    mp.undo()
+
+
+def tile_parcels(conn):
+    # The number of parcels in the test tile.
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT count(*) FROM {TABLE} p
+        WHERE p.wkb_geometry && ST_Transform(
+            ST_TileEnvelope(%s, %s, %s), 32633)""", (Z, X, Y))
+    return cur.fetchone()[0]
+
+
+def test_tile(conn):
+    tile = db_queries.getParcelTile(DATASET, 'xx', 2021, Z, X, Y)
+    assert isinstance(tile, bytes) and len(tile) > 0
+    assert tile_parcels(conn) > 0
+    mvt = pytest.importorskip('mapbox_vector_tile')
+    layer = mvt.decode(tile)['parcels']
+    assert len(layer['features']) == tile_parcels(conn)
+    assert set(layer['features'][0]['properties']) == {'pid'}
+
+    tile = db_queries.getParcelTile(DATASET, 'xx', 2021, Z, X, Y,
+                                    attributes=['crop', 'marker', 'bad'])
+    props = mvt.decode(tile)['parcels']['features'][0]['properties']
+    assert {'pid', 'cropname', 'cropcode', 'marker'} <= set(props)
+    assert props['marker'] == 'mowing'  # The latest marker.
+
+
+def test_simplified(conn):
+    # The tiles of lower zoom levels have simplified (smaller) geometries.
+    full = db_queries.getParcelTile(DATASET, 'xx', 2021, Z, X, Y)
+    low = db_queries.getParcelTile(DATASET, 'xx', 2021, 10, X >> 4, Y >> 4)
+    assert 0 < len(low) < len(full)
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    # The API app, run in an empty working directory.
+    for module in ['flask', 'flasgger', 'requests', 'boto3', 'osgeo']:
+        pytest.importorskip(module)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('logs')
+    os.makedirs('config')
+    import main
+    from scripts import users, response_cache
+    grants = {'alice': ['xx'], 'bob': ['yy']}
+    monkeypatch.setattr(users, 'auth', lambda username, password: True)
+    monkeypatch.setattr(users, 'data_auth',
+                        lambda aoi, username: aoi in grants[username])
+    monkeypatch.setattr(response_cache, '_store',
+                        response_cache.MemoryStore(1024 * 1024))
+    monkeypatch.setattr(response_cache, 'dataset_version', lambda ds: '1')
+    monkeypatch.setitem(main.datasets, 'xx_2021', DATASET)
+    return main.app.test_client()
+
+
+def test_tile_auth(api, monkeypatch):
+    # The cached tiles are only served to the users of the aoi.
+    tiles = []
+
+    def getParcelTile(*args, **kwargs):
+        tiles.append(args)
+        return b'tile'
+    monkeypatch.setattr(db_queries, 'getParcelTile', getParcelTile)
+    url = f'/query/tiles/xx/2021/{Z}/{X}/{Y}.mvt'
+    for i in range(2):
+        response = api.get(url, auth=('alice', ''))
+        assert response.status_code == 200 and response.data == b'tile'
+        assert response.headers['Vary'] == 'Accept'
+    assert len(tiles) == 1  # Served from the cache.
+    assert api.get(url, auth=('bob', '')).status_code == 401
+    assert api.get(url.replace('xx', 'XX'),
+                   auth=('bob', '')).status_code == 401
+    assert len(tiles) == 1
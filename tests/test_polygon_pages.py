@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the pages of the parcelsByPolygon query. The page queries need a
+PostGIS test database:
+    CBM_TEST_DSN="host=localhost dbname=postgres user=postgres" \\
+        python -m pytest tests/test_polygon_pages.py"""
+
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import streaming  # noqa: E402
+
+DSN = os.environ.get('CBM_TEST_DSN')
+TABLE = 'cbm_test_pages'
+DATASET = {'db': 'test', 'tables': {'parcels': TABLE},
+           'pcolumns': {'parcel_id': 'parcel_id', 'crop_name': 'cropname',
+                        'crop_code': 'cropcode'}}
+POLYGON = "13.379_52.519-13.395_52.519-13.395_52.535-13.379_52.519"
+
+
+def test_page_token():
+    query = {'aoi': 'xx', 'polygon': POLYGON, 'geometry': None}
+    token = streaming.page_token(1234, query)
+    assert '=' not in token and '/' not in token
+    assert streaming.page_after(token, dict(query)) == 1234
+    assert streaming.page_after(streaming.page_token('a-1', query),
+                                query) == 'a-1'
+    with pytest.raises(ValueError):
+        streaming.page_after(token, {**query, 'geometry': 'bbox'})
+    for bad in ['', 'xyz', token[:-3]]:
+        with pytest.raises(ValueError):
+            streaming.page_after(bad, query)
+
+
+@pytest.fixture(scope='module')
+def db_queries():
+    if not DSN:
+        pytest.skip("CBM_TEST_DSN is not set")
+    psycopg2 = pytest.importorskip('psycopg2')
+    pytest.importorskip('pandas')
+    from scripts import db, db_queries
+    conn = psycopg2.connect(DSN)
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+    except psycopg2.Error as err:
+        pytest.skip(f"PostGIS is not available: {err}")
+    cur.execute(f"""
+        DROP TABLE IF EXISTS {TABLE};
+        CREATE TABLE {TABLE} AS
+        SELECT (i * 37 + j * 11) % 1000 + i * 1000 + j AS parcel_id,
+            'crop' || (i % 3) AS cropname, i % 3 AS cropcode,
+            ST_Transform(ST_Buffer(ST_SetSRID(ST_MakePoint(
+                13.38 + i * 0.001, 52.52 + j * 0.001), 4326)::geography,
+                30, 16)::geometry, 32633) AS wkb_geometry
+        FROM generate_series(0, 9) i, generate_series(0, 9) j;
+        CREATE INDEX ON {TABLE} USING gist (wkb_geometry);""")
+    mp = pytest.MonkeyPatch()
+    mp.setattr(db, 'conn_str', lambda name: DSN)
+    mp.setattr(db, 'db_config', lambda name: {})
+    db_queries._srids.clear()
+    yield db_queries
+    mp.undo()
+    db.close_pools()
+    cur.execute(f"DROP TABLE IF EXISTS {TABLE};")
+    conn.close()
+
+
+def read(stream):
+    columns = next(stream)
+    return [dict(zip(columns, row)) for rows in stream for row in rows]
+
+
+def test_pages(db_queries):
+    everything = read(db_queries.getParcelsByPolygon(
+        DATASET, POLYGON, limit=1000, stream=True))
+    pids = [r['pid'] for r in everything]
+    assert len(pids) > 20 and pids == sorted(pids)
+    pages, after, more = [], None, True
+    while more:
+        until, more = db_queries.getPolygonPageEnd(DATASET, POLYGON,
+                                                   size=7, after=after)
+        page = read(db_queries.getParcelsByPolygon(
+            DATASET, POLYGON, limit=7, stream=True, after=after,
+            until=until if more else None))
+        assert len(page) == 7 or not more
+        assert page[-1]['pid'] == until
+        pages.append([r['pid'] for r in page])
+        after = until
+    assert sum(pages, []) == pids
+    assert db_queries.getPolygonPageEnd(DATASET, POLYGON, size=7,
+                                        after=pids[-1]) == (None, False)
+
+
+def test_geometry(db_queries):
+    def geometries(mode, tolerance=0):
+        rows = read(db_queries.getParcelsByPolygon(
+            DATASET, POLYGON, withGeometry=True, wgs84=True, limit=3,
+            stream=True, geometry=mode, tolerance=tolerance))
+        return [json.loads(r['geom']) for r in rows]
+    full = geometries('full')
+    assert full[0]['type'] == 'Polygon'
+    assert len(full[0]['coordinates'][0]) == 65
+    simplified = geometries('simplified', 10)
+    assert 4 <= len(simplified[0]['coordinates'][0]) < 65
+    assert len(geometries('bbox')[0]['coordinates'][0]) == 5
+    assert geometries('centroid')[0]['type'] == 'Point'
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the windowed byte range reads of the chip images, with a local
+http server (with range requests) standing in for the object storage and
+synthetic rasters.
+Run with: python -m pytest tests/test_range_reader.py"""
+
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+np = pytest.importorskip('numpy')
+rio = pytest.importorskip('rasterio')
+from rasterio.windows import Window  # noqa: E402
+from rasterio.transform import from_origin  # noqa: E402
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts.chip_extract import rangeReader, chipRipper, chipCache  # noqa
+
+SIZE = 1000  # Pixels of the synthetic images (not a multiple of the tiles).
+TRANSFORM = from_origin(600000, 5100000, 10, 10)
+
+requests = []
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Static files with single byte range requests, like the S3 gateway."""
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        spec = self.headers.get('Range')
+        requests.append((self.path, spec))
+        if spec is None:
+            self.send_response(200)
+        else:
+            start, end = spec.split('=')[1].split('-')
+            data = data[int(start):int(end) + 1]
+            self.send_response(206)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    root = tmp_path_factory.mktemp('eodata')
+    rng = np.random.default_rng(1)
+    images = {
+        'cog.tif': ({'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+                     'compress': 'deflate', 'predictor': 2}, 'uint16', 1),
+        'float.tif': ({'compress': 'none'}, 'float32', 1),
+        'bands.tif': ({'tiled': True, 'blockxsize': 128, 'blockysize': 128,
+                       'compress': 'deflate', 'interleave': 'pixel'},
+                      'int16', 2),
+        'big.tif': ({'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+                     'compress': 'deflate', 'BIGTIFF': 'YES',
+                     'interleave': 'band'}, 'uint16', 2),
+    }
+    data = {}
+    for name, (options, dtype, count) in images.items():
+        values = rng.integers(0, 10000, (count, SIZE, SIZE)).astype(dtype)
+        with rio.open(root / name, 'w', driver='GTiff', width=SIZE,
+                      height=SIZE, count=count, dtype=dtype,
+                      crs='EPSG:32633', transform=TRANSFORM, nodata=0,
+                      **options) as dst:
+            dst.write(values)
+        data[name] = values
+
+    def handler(*args, **kwargs):
+        return RangeHandler(*args, directory=str(root), **kwargs)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"/vsicurl/http://127.0.0.1:{httpd.server_port}", root, data
+    httpd.shutdown()
+
+
+WINDOWS = [Window(0, 0, 64, 64), Window(300, 500, 128, 128),
+           Window(250, 250, 20, 20), Window(950, 960, 128, 128),
+           Window(-30, 100, 64, 64)]
+
+
+def test_merge_ranges():
+    ranges = [(100, 200), (0, 50), (210, 300), (10000, 10100), (40, 60)]
+    assert rangeReader.merge_ranges(ranges, gap=20) == [
+        (0, 60, [1, 4]), (100, 300, [0, 2]), (10000, 10100, [3])]
+    assert rangeReader.merge_ranges(ranges, gap=20, max_size=150) == [
+        (0, 60, [1, 4]), (100, 200, [0]), (210, 300, [2]),
+        (10000, 10100, [3])]
+
+
+@pytest.mark.parametrize('name', ['cog.tif', 'float.tif', 'bands.tif',
+                                  'big.tif'])
+def test_windows(server, name):
+    url, root, data = server
+    band = rangeReader.TiffBand(f"{url}/{name}")
+    with rio.open(root / name) as src:
+        assert band.crs == src.crs and band.transform == src.transform
+        assert band.nodata == src.nodata and band.res == src.res
+        for index in range(1, src.count + 1):
+            chips = band.read(WINDOWS, index)
+            for window, chip in zip(WINDOWS, chips):
+                expected = src.read(index, window=window, boundless=True,
+                                    fill_value=0)
+                np.testing.assert_array_equal(chip, expected)
+    band.close()
+
+
+def test_one_pass(server):
+    url, root, data = server
+    path = f"{url}/cog.tif"
+    rangeReader._bands.clear()
+    band = rangeReader.open_band(path)
+    requests.clear()
+    # Two chips in the same four tiles, one request for each row of tiles
+    # (the random pixels do not compress, the rows are far apart).
+    band.read([Window(200, 200, 100, 100), Window(220, 230, 50, 50)])
+    assert len(requests) == 2
+    requests.clear()
+    # The header and tile index are kept.
+    assert rangeReader.open_band(path) is band
+    assert requests == []
+    # Only the tiles of the window are read.
+    tiles = band.read([Window(600, 600, 10, 10)])
+    assert len(requests) == 1
+    start, end = requests[0][1].split('=')[1].split('-')
+    assert int(end) - int(start) + 1 < os.path.getsize(root / 'cog.tif') / 4
+    np.testing.assert_array_equal(tiles[0],
+                                  data['cog.tif'][0, 600:610, 600:610])
+
+
+def test_unsupported(server, tmp_path):
+    url, root, data = server
+    path = tmp_path / 'lzw.tif'
+    with rio.open(path, 'w', driver='GTiff', width=10, height=10, count=1,
+                  dtype='uint8', crs='EPSG:32633', transform=TRANSFORM,
+                  compress='lzw') as dst:
+        dst.write(np.ones((1, 10, 10), 'uint8'))
+    for p in [str(path), f"{url}/image.jp2"]:
+        for i in range(2):
+            with pytest.raises(rangeReader.Unsupported):
+                rangeReader.open_band(p)
+    assert not any(r[0] == '/image.jp2' for r in requests)
+
+
+def test_batch(server, tmp_path, monkeypatch):
+    url, root, data = server
+    monkeypatch.setattr(chipCache, '_cache',
+                        chipCache.ChipCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(chipRipper, 's2_band_path',
+                        lambda reference, band: f"{url}/{band}.tif")
+    lon, lat = rio.warp.transform('EPSG:32633', 'EPSG:4326',
+                                  [603000, 603500], [5096000, 5095500])
+    tasks = [{'type': 's2', 'reference': 'S2A_MSIL2A_20200601', 'band': b,
+              'lon': x, 'lat': y, 'chipsize': 640,
+              'output': str(tmp_path / f"{b}_{i}.tif")}
+             for b in ['cog', 'float'] for i, (x, y) in
+             enumerate(zip(lon, lat))]
+    rangeReader._bands.clear()
+    requests.clear()
+    results = chipRipper.extract({'type': 'batch', 'tasks': tasks})
+    assert results == {t['output']: t['output'] for t in tasks}
+    # Two bands: the header and one pass for the two chips of each band.
+    assert len(requests) == 4
+    for task in tasks:
+        with rio.open(task['output']) as chip, \
+                rio.open(root / f"{task['band']}.tif") as src:
+            window = rio.windows.from_bounds(*chip.bounds, src.transform)
+            np.testing.assert_array_equal(chip.read(1), src.read(
+                1, window=window.round_offsets().round_lengths()))
+    # Stored chips are not read again.
+    requests.clear()
+    chipRipper.extract({'type': 'batch', 'tasks': tasks})
+    assert requests == []
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the dataset registry and of the refresh of the information page
+snapshot, with a counting aoi_info instead of the database queries."""
+
+import os
+import sys
+import json
+
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('pandas')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import registry, info_page  # noqa: E402
+
+
+def dataset(parcels):
+    return {'db': 'main', 'tables': {'parcels': parcels},
+            'pcolumns': {'parcel_id': 'id'}}
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    paths = {'datasets': tmp_path / 'datasets.json',
+             'main': tmp_path / 'main.json'}
+    paths['main'].write_text(json.dumps({'server': {'host': 'http://cbm'}}))
+    monkeypatch.setattr(registry, 'datasets_file', str(paths['datasets']))
+    monkeypatch.setattr(registry, 'main_file', str(paths['main']))
+    monkeypatch.setattr(registry, 'tms_files', str(tmp_path / 'tms' / '*'))
+    monkeypatch.setattr(registry.db_queries, 'get_datasets', lambda: json.loads(
+        paths['datasets'].read_text()))
+    builds = []
+
+    def aoi_info(datasets, aoi, url):
+        builds.append(aoi)
+        return {'years': sorted(k.split('_')[1] for k in datasets
+                                if k.startswith(f"{aoi}_")), 'url': url}
+    monkeypatch.setattr(info_page, 'aoi_info', aoi_info)
+    return paths, builds
+
+
+def write(path, data):
+    path.write_text(json.dumps(data))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+
+def test_incremental_refresh(files, monkeypatch):
+    paths, builds = files
+    write(paths['datasets'], {'nl_2020': dataset('nl.parcels'),
+                              'es_2020': dataset('es.parcels')})
+    reg = registry.Registry()
+    live = reg.datasets
+    reg.refresh()
+    assert sorted(builds) == ['es', 'nl']
+    assert reg.snapshot(['nl'])['aois'] == {
+        'nl': {'years': ['2020'], 'url': 'http://cbm'}}
+    version = reg.version
+
+    # Nothing changed, nothing is rebuilt.
+    reg.refresh()
+    assert len(builds) == 2 and reg.version == version
+
+    # Only the changed aoi is rebuilt, the datasets are updated in place.
+    write(paths['datasets'], {'nl_2020': dataset('nl.parcels'),
+                              'nl_2021': dataset('nl.parcels21'),
+                              'es_2020': dataset('es.parcels')})
+    reg.refresh()
+    assert builds[2:] == ['nl'] and reg.version > version
+    assert reg.datasets is live and 'nl_2021' in live
+    assert reg.snapshot()['aois']['nl']['years'] == ['2020', '2021']
+
+    # Removed aois are dropped.
+    write(paths['datasets'], {'nl_2020': dataset('nl.parcels')})
+    reg.refresh()
+    assert list(reg.snapshot()['aois']) == ['nl'] and 'es_2020' not in live
+
+
+def test_scheduled_refresh(files, monkeypatch):
+    paths, builds = files
+    write(paths['datasets'], {'nl_2020': dataset('nl.parcels'),
+                              'es_2020': dataset('es.parcels')})
+    reg = registry.Registry()
+    reg.refresh()
+    version = reg.version
+    monkeypatch.setattr(registry, 'REFRESH_INTERVAL', -1)
+    # The oldest aoi is rebuilt, the same snapshot keeps the version.
+    reg.refresh()
+    assert builds[2:] == builds[:1] and reg.version == version
+    reg.refresh(all_old=True)
+    assert len(builds) == 5
+
+
+def test_server_config(files):
+    paths, builds = files
+    write(paths['datasets'], {'nl_2020': dataset('nl.parcels')})
+    reg = registry.Registry()
+    assert reg.snapshot()['aois']['nl']['url'] == 'http://cbm'
+    write(paths['main'], {'server': {'host': 'http://new'}})
+    reg.refresh()
+    assert reg.snapshot()['aois']['nl']['url'] == 'http://new'
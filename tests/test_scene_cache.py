@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the scene cache of the JP2 bands, with synthetic JP2 images.
+Run with: python -m pytest tests/test_scene_cache.py"""
+
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+rio = pytest.importorskip('rasterio')
+from rasterio.windows import Window  # noqa: E402
+from rasterio.transform import from_origin  # noqa: E402
+from rasterio.warp import transform as warp_transform  # noqa: E402
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts.chip_extract import (sceneCache, rangeReader,  # noqa: E402
+                                  chipRipper, chipCache)
+
+SIZE = 1100
+KEY = ('Sentinel-2/MSI/L2A/2020/06/01/S2A_MSIL2A_20200601T101031_N0214_'
+       'R022_T32UPU_20200601T130334.SAFE/GRANULE/L2A_T32UPU_A025736_'
+       '20200601T101322/IMG_DATA/R10m/T32UPU_20200601T101031_B04_10m.jp2')
+
+
+@pytest.fixture(scope='module')
+def jp2(tmp_path_factory):
+    with rio.Env() as env:
+        if 'JP2OpenJPEG' not in env.drivers():
+            pytest.skip("No JP2 driver")
+    path = str(tmp_path_factory.mktemp('eodata') / 'B04.jp2')
+    data = (np.arange(SIZE * SIZE, dtype='uint16') % 4093).reshape(
+        1, SIZE, SIZE)
+    with rio.open(path, 'w', driver='JP2OpenJPEG', width=SIZE, height=SIZE,
+                  count=1, dtype='uint16', crs='EPSG:32632', nodata=0,
+                  transform=from_origin(600000, 5100000, 10, 10),
+                  QUALITY=100, REVERSIBLE='YES') as dst:
+        dst.write(data)
+    return path, data[0]
+
+
+@pytest.fixture
+def scenes(tmp_path, monkeypatch):
+    cache = sceneCache.SceneCache(str(tmp_path / 'scenes'))
+    monkeypatch.setattr(sceneCache, '_cache', cache)
+    return cache
+
+
+def test_object_key():
+    assert sceneCache.object_key(f"/eodata/{KEY}") == KEY
+    assert sceneCache.object_key(f"/vsis3/DIAS/{KEY}") == KEY
+
+
+def test_transcode(jp2, scenes, monkeypatch):
+    path, data = jp2
+    cog = scenes.get(KEY, path)
+    band = rangeReader.TiffBand(cog)
+    assert band.block == (512, 512) and band.compression in \
+        rangeReader.DEFLATE and band.predictor == 2
+    assert band.transform == from_origin(600000, 5100000, 10, 10)
+    chip = band.read([Window(1000, 500, 200, 120)])[0]
+    assert chip.shape == (120, 200)
+    assert (chip[:, :100] == data[500:620, 1000:]).all()
+    assert (chip[:, 100:] == 0).all()
+    band.close()
+
+    # The next reads are hits, without transcoding.
+    monkeypatch.setattr(sceneCache, 'transcode', None)
+    assert scenes.get(KEY, path) == cog
+    stats = scenes.stats()
+    assert (stats['hits'], stats['misses'], stats['scenes']) == (1, 1, 1)
+    assert stats['size'] == os.path.getsize(cog)
+
+
+def test_resolve(jp2, scenes, tmp_path):
+    path, data = jp2
+    downloads = []
+
+    def fetch(local):
+        downloads.append(local)
+        with open(path, 'rb') as src, open(local, 'wb') as dst:
+            dst.write(src.read())
+        return True
+    cog = sceneCache.resolve(KEY, fetch, str(tmp_path / 'B04.jp2'))
+    assert cog.startswith(scenes.path) and len(downloads) == 1
+    assert not os.path.exists(downloads[0])  # The JP2 is removed.
+    assert sceneCache.resolve(KEY, fetch, 'tmp/B04.jp2') == cog
+    assert len(downloads) == 1
+    assert sceneCache.resolve(f"/eodata/{KEY}") == cog
+    assert sceneCache.resolve(KEY.replace('B04', 'B08'),
+                              lambda local: False) is None
+    # Other images are not transcoded.
+    assert sceneCache.resolve('/eodata/S1/Gamma0_VV.img') == \
+        '/eodata/S1/Gamma0_VV.img'
+
+
+def test_disabled(jp2, tmp_path, monkeypatch):
+    path, data = jp2
+    monkeypatch.setattr(sceneCache, '_cache', False)
+    assert sceneCache.resolve(path) == path
+    local = str(tmp_path / 'B04.jp2')
+    assert sceneCache.resolve(KEY, lambda p: True, local) == local
+    assert sceneCache.resolve(KEY, lambda p: False, local) is None
+
+
+def test_evict(jp2, tmp_path):
+    path, data = jp2
+    scenes = sceneCache.SceneCache(str(tmp_path / 'scenes'))
+    first = scenes.get('a.jp2', path)
+    scenes.max_size = os.path.getsize(first) * 2.5
+    scenes.get('b.jp2', path)
+    scenes.get('a.jp2', path)  # b is now the least recently used.
+    third = scenes.get('c.jp2', path)
+    assert scenes.stats()['evictions'] == 1
+    assert os.path.isfile(first) and os.path.isfile(third)
+    assert not os.path.isfile(scenes._file('b.jp2'))
+    # A band larger than the quota is kept until the next one.
+    scenes.max_size = 1
+    assert os.path.isfile(scenes.get('d.jp2', path))
+    assert scenes.stats()['scenes'] == 1
+
+
+def test_chips(jp2, scenes, tmp_path, monkeypatch):
+    # The chips of a JP2 band are read with byte ranges of the COG.
+    path, data = jp2
+    monkeypatch.setattr(chipCache, '_cache', chipCache.ChipCache(
+        str(tmp_path / 'chips')))
+    lon, lat = [v[0] for v in warp_transform(
+        'EPSG:32632', 'EPSG:4326', [605000], [5095000])]
+    chip = chipRipper.band_chip(path, 1, 'S2A_MSIL2A_X', 'B04', lon, lat,
+                                1000, str(tmp_path / 'chip.tif'))
+    assert isinstance(rangeReader.open_band(sceneCache.resolve(path)),
+                      rangeReader.TiffBand)
+    with rio.open(path) as src:
+        window = chipRipper.chip_window(src, lon, lat, 1000)
+    assert (window.col_off, window.row_off) == (450, 450)
+    with rio.open(chip) as src:
+        assert (src.read(1) == data[450:550, 450:550]).all()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the local scene index, with the scenes of fixtures/scenes.json
+instead of the CREODIAS finder.
+Run with: python -m pytest tests/test_scene_index.py"""
+
+import os
+import sys
+import json
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts.chip_extract import sceneIndex  # noqa: E402
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'scenes.json')
+LON, LAT = 5.66, 52.69  # In tile 31UFU and in both Sentinel-1 scenes.
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = sceneIndex.SceneIndex(str(tmp_path / 'scenes.sqlite'))
+    with open(FIXTURE) as f:
+        index.add(json.load(f))
+    return index
+
+
+def references(scenes):
+    return [s['reference'][:26] for s in scenes]
+
+
+def test_point_and_dates(index):
+    scenes = index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                          (LON, LAT), 'LEVEL2A')
+    assert references(scenes) == ['S2B_MSIL2A_20220608T105619',
+                                  'S2A_MSIL2A_20220603T105031']
+    assert index.search('Sentinel2', '2022-06-04', '2022-06-07',
+                        (LON, LAT), 'LEVEL2A') == []
+    # The end date is inclusive.
+    assert len(index.search('Sentinel2', '2022-06-01', '2022-06-03',
+                            (LON, LAT), 'LEVEL2A')) == 1
+
+
+def test_bbox(index):
+    scenes = index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                          (5.5, 52.5, 6.5, 52.9), 'LEVEL2A')
+    assert len(scenes) == 3
+    assert len(index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                            (8.0, 52.5, 9.0, 52.9))) == 0
+
+
+def test_cloud_and_ptype(index):
+    scenes = index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                          (LON, LAT), 'LEVEL2A', max_cloud=20)
+    assert references(scenes) == ['S2A_MSIL2A_20220603T105031']
+    assert len(index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                            (LON, LAT))) == 3
+    # Sentinel-1 has no cloud cover, it is never filtered out.
+    scenes = index.search('Sentinel1', '2022-06-01', '2022-06-30',
+                          (LON, LAT), 'CARD-BS', max_cloud=20)
+    assert [s['orbit'] for s in scenes] == ['ASCENDING', 'DESCENDING']
+
+
+def test_update(index):
+    with open(FIXTURE) as f:
+        scene = json.load(f)[0]
+    scene['footprint'] = "POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))"
+    index.add([scene])
+    assert index.count() == 6
+    assert len(index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                            (0.5, 0.5))) == 1
+    assert len(index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                            (LON, LAT), 'LEVEL2A')) == 1
+
+
+def test_lookup_time(tmp_path):
+    # A year of daily scenes on a 20x20 grid of 1 degree tiles.
+    index = sceneIndex.SceneIndex(str(tmp_path / 'scenes.sqlite'))
+    scenes = []
+    for day in range(365):
+        obstime = time.strftime('%Y-%m-%dT10:30:00',
+                                time.gmtime(1640995200 + day * 86400))
+        for x in range(20):
+            for y in range(0, 20, 5):
+                scenes.append({
+                    'reference': f"S2_{day}_{x}_{y}", 'collection':
+                    'Sentinel2', 'ptype': 'LEVEL2A', 'obstime': obstime,
+                    'cloud': (day * 7 + x) % 100, 'footprint':
+                    f"POLYGON(({x} {y}, {x + 1.1} {y}, {x + 1.1} {y + 5.1},"
+                    f" {x} {y + 5.1}, {x} {y}))"})
+    index.add(scenes)
+    lookups = 200
+    start = time.perf_counter()
+    for i in range(lookups):
+        found = index.search('Sentinel2', '2022-04-01', '2022-09-30',
+                             (i % 19 + 0.5, 10.5), 'LEVEL2A', 50)
+    elapsed = (time.perf_counter() - start) / lookups
+    assert 0 < len(found) < 183
+    print(f"{elapsed * 1000:.3f} ms per lookup")
+    assert elapsed < 0.001
+
+
+def test_coverage(index, monkeypatch):
+    # The index is used for the searches that a sync covers.
+    monkeypatch.setattr(sceneIndex, '_index', index)
+    assert index.count() > 0
+    assert not sceneIndex.available('Sentinel2', 'LEVEL2A', (LON, LAT),
+                                    '2022-06-01', '2022-06-30')
+    index.add_coverage('Sentinel2', 'LEVEL2A', (5.0, 52.0, 6.0, 53.0),
+                       '2022-01-01', '2022-12-31', 'finder')
+    assert sceneIndex.available('Sentinel2', 'LEVEL2A', (LON, LAT),
+                                '2022-06-01', '2022-06-30')
+    assert index.covers('Sentinel2', 'LEVEL2A', (5.5, 52.5, 5.9, 52.9),
+                        '2022-12-31', '2022-12-31')
+    for args in [('Sentinel2', 'LEVEL2A', (6.5, 52.5)),
+                 ('Sentinel2', 'LEVEL2A', (5.5, 52.5, 6.5, 52.9)),
+                 ('Sentinel1', 'CARD-BS', (LON, LAT))]:
+        assert not index.covers(*args, '2022-06-01', '2022-06-30')
+    assert not index.covers('Sentinel2', 'LEVEL2A', (LON, LAT),
+                            '2021-12-01', '2022-06-30')
+
+
+def test_finder_fallback(index, monkeypatch):
+    # The finder is used for the searches that are not covered, or that
+    # have no scenes in the index.
+    pytest.importorskip('requests')
+    from scripts.chip_extract import creodiasCARDchips
+    monkeypatch.setattr(sceneIndex, '_index', index)
+    requests = []
+
+    class Response:
+        headers = {'content-type': 'application/json'}
+
+        def json(self):
+            return {'features': []}
+    monkeypatch.setattr(creodiasCARDchips.requests, 'get',
+                        lambda url: requests.append(url) or Response(),
+                        raising=False)
+    index.add_coverage('Sentinel2', 'LEVEL2A', (5.0, 52.0, 6.0, 53.0),
+                       '2022-01-01', '2022-12-31', 'finder')
+    assert len(creodiasCARDchips.getS2Chips(
+        LON, LAT, '2022-06-01', '2022-06-30')) == 2
+    assert requests == []
+    assert creodiasCARDchips.getS2Chips(
+        LON, LAT, '2022-07-01', '2022-07-31') == []
+    assert creodiasCARDchips.getS1Chips(
+        LON, LAT, '2022-06-01', '2022-06-30') == []
+    assert len(requests) == 2
+
+
+def test_index_footprints(index, monkeypatch):
+    # The scenes with a bounding box but not a footprint that overlaps the
+    # chip are not returned.
+    pytest.importorskip('requests')
+    from scripts.chip_extract import creodiasCARDchips
+    monkeypatch.setattr(sceneIndex, '_index', index)
+    with open(FIXTURE) as f:
+        scene = json.load(f)[0]
+    scene['reference'] = scene['reference'].replace('20220603', '20220618')
+    scene['obstime'] = scene['obstime'].replace('06-03', '06-18')
+    scene['footprint'] = "POLYGON((6.5 52.0, 6.5 53.5, 5.0 53.5, 6.5 52.0))"
+    index.add([scene])
+    index.add_coverage('Sentinel2', 'LEVEL2A', (5.0, 52.0, 6.0, 53.0),
+                       '2022-01-01', '2022-12-31', 'finder')
+    assert len(index.search('Sentinel2', '2022-06-01', '2022-06-30',
+                            (LON, LAT), 'LEVEL2A')) == 3
+    references = creodiasCARDchips.getS2Chips(
+        LON, LAT, '2022-06-01', '2022-06-30')
+    assert [r['id'][:26] for r in references] == [
+        'S2B_MSIL2A_20220608T105619', 'S2A_MSIL2A_20220603T105031']
+    assert all(r['chipoverlap'] == 1 for r in references)
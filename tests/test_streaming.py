@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Tests of the streamed response formats of the query results.
+Run with: python -m pytest tests/test_streaming.py"""
+
+import os
+import sys
+import json
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+from scripts import streaming  # noqa: E402
+
+EPOCH = 1590999031.0  # 2020-06-01T08:10:31Z
+
+
+def rows(timestamp):
+    # The epoch column is double precision (date_part) before PG14 and
+    # numeric (extract) from PG14 on.
+    value = EPOCH if timestamp == 'date_part' else Decimal(f"{EPOCH:.6f}")
+    return [(timestamp, 'band', 'count', 'mean'),
+            (value, 'B04', 100, 0.5), (value + 5, 'B08', 100, 0.25)]
+
+
+@pytest.mark.parametrize('timestamp', ['date_part', 'extract'])
+def test_json(timestamp):
+    body = b''.join(
+        c if isinstance(c, bytes) else c.encode() for c in
+        streaming.json_columns(streaming.from_rows(rows(timestamp))))
+    data = json.loads(body)
+    assert data[timestamp] == [EPOCH, EPOCH + 5]
+    assert data['band'] == ['B04', 'B08']
+
+
+@pytest.mark.parametrize('timestamp', ['date_part', 'extract'])
+def test_arrow(timestamp):
+    pa = pytest.importorskip('pyarrow')
+    body = b''.join(streaming.arrow(streaming.from_rows(rows(timestamp))))
+    table = pa.ipc.open_stream(body).read_all()
+    assert table.schema.field(timestamp).type == pa.timestamp('ms', tz='UTC')
+    assert table.column(timestamp)[0].value == EPOCH * 1000
+    assert table.schema.field('count').type == pa.int32()